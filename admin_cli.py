@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+"""
+🛠️ CÔNG CỤ QUẢN TRỊ BOT THU CHI
+Chạy:
+    python admin_cli.py export --user-name "Nguyễn An" --start 01/01/2025 --end 31/12/2025 --format xlsx
+    python admin_cli.py export --user-name "Nguyễn An" --user-id 123456 --format csv
+    python admin_cli.py benchmark-export --rows 100000 --format csv
+    python admin_cli.py import --user-name "Nguyễn An" --file saoke.csv --dry-run
+    python admin_cli.py recategorize --all --max-ai-calls 30
+    python admin_cli.py benchmark-nlp --accuracy --count-tokens
+"""
+
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+
+
+def parse_date(value: str, end_of_day: bool = False) -> datetime:
+    """Parse ngày dd/mm/yyyy"""
+    date = datetime.strptime(value, "%d/%m/%Y")
+    if end_of_day:
+        date = date.replace(hour=23, minute=59, second=59, microsecond=999999)
+    return date
+
+
+def print_result(result: dict):
+    """In kết quả xuất dữ liệu"""
+    print(f"✅ Đã xuất {result['rows']:,} giao dịch → {result['path']}")
+    print(f"   📄 Định dạng: {result['format'].upper()} ({result['bytes'] / 1024 / 1024:.2f} MB)")
+    print(f"   ⏱️ Thời gian: {result['seconds']:.2f}s ({result['rows_per_second']:,} dòng/s)")
+
+
+def get_backend(args):
+    """Lấy nơi lưu giao dịch của user theo cấu hình bot"""
+    from services.storage_backend import create_storage_backend, get_storage_backend_name
+
+    if args.user_id and get_storage_backend_name() == 'sheets':
+        # Private mode - sheet riêng của user
+        from services.user_sheet_manager import UserSheetManager
+        backend = UserSheetManager().get_user_service(args.user_id)
+        if not backend:
+            raise SystemExit(f"❌ User {args.user_id} chưa thiết lập Google Sheet")
+        return backend
+
+    if args.sheet_url:
+        from services.user_sheet_manager import UserSheetManager
+        sheet_id = UserSheetManager()._extract_sheet_id(args.sheet_url)
+        if not sheet_id:
+            raise SystemExit(f"❌ Link Google Sheet không hợp lệ: {args.sheet_url}")
+        return create_storage_backend(sheet_id=sheet_id, sheet_url=args.sheet_url)
+
+    return create_storage_backend(namespace=args.user_id)
+
+
+def command_export(args):
+    """Xuất sổ thu chi của một user ra CSV/XLSX"""
+    from services.ledger_exporter import LedgerExporter
+
+    start_date = parse_date(args.start) if args.start else None
+    end_date = parse_date(args.end, end_of_day=True) if args.end else None
+
+    exporter = LedgerExporter()
+    if args.chunk_size:
+        exporter.chunk_size = args.chunk_size
+
+    print(f"📦 Xuất dữ liệu của {args.user_name} ({args.format.upper()})...")
+    result = exporter.export(get_backend(args), args.user_name, start_date, end_date, args.format, args.output)
+    print_result(result)
+
+
+def command_import(args):
+    """Import giao dịch từ file CSV (sao kê ngân hàng) vào sổ của user"""
+    from services.transaction_importer import TransactionImporter
+
+    ai_service = None
+    if not args.no_ai:
+        from services.gemini_ai import get_ai_service
+        ai_service = get_ai_service()
+
+    importer = TransactionImporter(
+        get_backend(args), ai_service,
+        chunk_size=args.chunk_size, max_ai_calls=args.max_ai_calls, encoding=args.encoding
+    )
+
+    plan = importer.scan(args.file, args.user_name)
+    print(f"📄 {args.file}: {plan['rows']:,} giao dịch hợp lệ, {plan['invalid']:,} dòng lỗi")
+    if plan['rows']:
+        print(f"   📅 {plan['start_date'].strftime('%d/%m/%Y')} - {plan['end_date'].strftime('%d/%m/%Y')}")
+    print(f"   📊 Quota dự kiến: {plan['write_calls']:,} lệnh ghi Sheets, "
+          f"{plan['ai_calls']:,} lệnh AI cho {plan['ai_descriptions']:,} mô tả cần AI phân loại")
+    if args.dry_run or not plan['rows']:
+        return
+
+    def progress(status: dict):
+        percent = status['processed'] * 100 // max(status['total'], 1)
+        print(f"   📈 {status['processed']:,}/{status['total']:,} ({percent}%) - "
+              f"mới {status['imported']:,}, trùng {status['duplicates']:,}, AI {status['ai_calls']} lệnh")
+
+    result = importer.run(args.file, args.user_name, progress=progress, plan=plan)
+    print(f"✅ Đã import {result['imported']:,} giao dịch mới cho {args.user_name} trong {result['seconds']:.1f}s")
+    print(f"   🔁 Bỏ qua {result['duplicates']:,} giao dịch đã có, {result['invalid']:,} dòng lỗi")
+    print(f"   📂 Phân loại: {result['categorized_local']:,} bằng luật, {result['categorized_ai']:,} bằng AI "
+          f"({result['ai_calls']} lệnh), {result['uncategorized']:,} để 'Khác'")
+
+
+def command_recategorize(args):
+    """Phân loại lại các giao dịch "Khác" trong Google Sheets"""
+    from services.recategorizer import Recategorizer
+    from services.storage_backend import get_storage_backend_name
+
+    if get_storage_backend_name() != 'sheets':
+        raise SystemExit("❌ Phân loại lại chỉ hỗ trợ STORAGE_BACKEND=sheets")
+    if not args.all and not args.user_name:
+        raise SystemExit("❌ Cần --user-name hoặc --all")
+
+    ai_service = None
+    if not args.no_ai:
+        from services.gemini_ai import get_ai_service
+        ai_service = get_ai_service()
+
+    recategorizer = Recategorizer(ai_service, max_ai_calls=args.max_ai_calls, dry_run=args.dry_run)
+    if args.reset:
+        recategorizer.reset()
+
+    if args.all and not args.user_id and not args.sheet_url and os.getenv('PRIVATE_MODE', 'false').lower() == 'true':
+        # Private mode - quét sheet riêng của mọi user đã đăng ký
+        from services.user_sheet_manager import UserSheetManager
+        manager = UserSheetManager()
+        services = [manager.get_user_service(user_id) for user_id in manager.user_sheets]
+    else:
+        services = [get_backend(args)]
+
+    def progress(status: dict):
+        print(f"   📈 {status['worksheets']} worksheet, {status['other_rows']:,} dòng 'Khác', "
+              f"đã sửa {status['updated']:,}, AI {status['ai_calls']} lệnh")
+
+    result = {}
+    for service in services:
+        if not service:
+            continue
+        user_names = recategorizer.list_user_worksheets(service) if args.all else [args.user_name]
+        print(f"🏷️ {service.sheet_url}: {len(user_names)} worksheet")
+        result = recategorizer.run(service, user_names, progress=progress)
+        if result['paused']:
+            break
+
+    if not result:
+        print("📭 Không có sheet nào để xử lý")
+        return
+    action = "Sẽ sửa" if args.dry_run else "Đã sửa"
+    print(f"✅ {action} {result['updated']:,}/{result['other_rows']:,} giao dịch 'Khác' "
+          f"({result['categorized_local']:,} bằng luật, {result['categorized_ai']:,} bằng AI, {result['ai_calls']} lệnh AI)")
+    if result['conflicts']:
+        print(f"   ⚠️ Bỏ qua {result['conflicts']:,} dòng bị sửa trong lúc chạy")
+    if result['skipped_worksheets']:
+        print(f"   📍 Bỏ qua {result['skipped_worksheets']} worksheet đã xong ở lần chạy trước")
+    if result['paused']:
+        print("   ⏸️ Hết ngân sách AI - chạy lại lệnh để tiếp tục")
+
+
+def command_outbox(args):
+    """Xem outbox chờ đồng bộ lên Google Sheets và thử lại các giao dịch lỗi"""
+    from services.write_journal import get_write_journal
+
+    journal = get_write_journal()
+    sheet_id = None
+    if args.sheet_url:
+        from services.user_sheet_manager import UserSheetManager
+        sheet_id = UserSheetManager()._extract_sheet_id(args.sheet_url)
+        if not sheet_id:
+            raise SystemExit(f"❌ Link Google Sheet không hợp lệ: {args.sheet_url}")
+
+    if args.retry:
+        retried = journal.retry_failed(sheet_id, args.user_name)
+        print(f"🔁 Đưa {retried:,} giao dịch lỗi về hàng chờ")
+
+    stats = journal.get_stats()
+    print(f"📮 Outbox: {stats['pending']:,} giao dịch chờ ({stats['worksheets']} worksheet), "
+          f"{stats['failed']:,} giao dịch lỗi")
+
+    if args.retry and journal.pending_count():
+        synced = journal.drain_once()
+        print(f"📤 Đã đồng bộ {synced:,} giao dịch, còn {journal.pending_count():,} chờ, "
+              f"{journal.failed_count():,} lỗi")
+
+
+def seed_sheets_benchmark(args, user_name: str, transactions: list):
+    """Tạo worksheet benchmark trên Google Sheet thật (ghi theo lô append_rows, ưu tiên nền)"""
+    from services.google_sheets import GoogleSheetsService
+    from services.user_sheet_manager import UserSheetManager
+
+    sheet_id = UserSheetManager()._extract_sheet_id(args.sheet_url)
+    if not sheet_id:
+        raise SystemExit(f"❌ Link Google Sheet không hợp lệ: {args.sheet_url}")
+    backend = GoogleSheetsService(sheet_id, args.sheet_url)
+
+    if transactions:
+        started = time.perf_counter()
+        for start_index in range(0, len(transactions), args.seed_batch):
+            backend.add_transactions(user_name, transactions[start_index:start_index + args.seed_batch])
+        print(f"   ⬆️ Ghi {len(transactions):,} dòng lên '{backend._worksheet_title(user_name)}' "
+              f"trong {time.perf_counter() - started:.1f}s")
+    return backend
+
+
+def command_benchmark_export(args):
+    """Đo throughput xuất dữ liệu trên sổ thu chi giả lập (memory/sqlite) hoặc Google Sheet thật"""
+    from services.ledger_exporter import LedgerExporter
+    from services.memory_storage import InMemoryStorageBackend
+    from services.sqlite_storage import SQLiteStorageBackend
+
+    if args.backend == 'sheets' and not args.sheet_url:
+        raise SystemExit("❌ --backend sheets cần --sheet-url (sheet đã share cho bot)")
+
+    # Sheets: --user-name đo trên worksheet có sẵn, không thì tạo worksheet tạm
+    seed = not (args.backend == 'sheets' and args.user_name)
+    user_name = args.user_name or f"Benchmark {datetime.now().strftime('%Y%m%d%H%M%S')}"
+    categories = ['Ăn uống', 'Di chuyển', 'Mua sắm', 'Giải trí', 'Sinh hoạt', 'Y tế', 'Khác']
+    start = datetime(datetime.now().year, 1, 1)
+
+    if seed:
+        print(f"🧪 Tạo {args.rows:,} giao dịch giả lập ({args.backend})...")
+    else:
+        print(f"🧪 Đo trên worksheet có sẵn '{user_name}' (sheets)...")
+    random.seed(42)
+    transactions = [
+        {
+            'date': start + timedelta(minutes=index * 5),
+            'type': 'Thu' if index % 20 == 0 else 'Chi',
+            'amount': float(random.randint(10, 5000) * 1000),
+            'category': random.choice(categories),
+            'note': f"giao dịch thử {index}",
+            'user': user_name
+        }
+        for index in range(args.rows if seed else 0)
+    ]
+
+    workdir = tempfile.mkdtemp(prefix="export_benchmark_")
+    if args.backend == 'sqlite':
+        backend = SQLiteStorageBackend(namespace='benchmark', db_path=os.path.join(workdir, 'benchmark.db'))
+        with backend._connect() as conn:
+            conn.executemany(
+                "INSERT INTO transactions (namespace, user_name, date, type, amount, category, note) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    ('benchmark', user_name, t['date'].strftime("%Y-%m-%d %H:%M:%S"),
+                     t['type'], t['amount'], t['category'], t['note'])
+                    for t in transactions
+                ]
+            )
+        del transactions
+    elif args.backend == 'sheets':
+        backend = seed_sheets_benchmark(args, user_name, transactions)
+        del transactions
+    else:
+        backend = InMemoryStorageBackend('benchmark')
+        backend._transactions[user_name] = transactions
+
+    exporter = LedgerExporter(export_dir=workdir)
+    if args.chunk_size:
+        exporter.chunk_size = args.chunk_size
+
+    result = exporter.export(backend, user_name, export_format=args.format)
+    print_result(result)
+
+    # Lần chạy thứ 2 chỉ để đo bộ nhớ (tracemalloc làm chậm nên không tính throughput)
+    tracemalloc.start()
+    memory_result = exporter.export(backend, user_name, export_format=args.format)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"   🧠 Bộ nhớ đỉnh khi xuất: {peak / 1024 / 1024:.1f} MB (lô {exporter.chunk_size:,} dòng)")
+
+    os.remove(memory_result['path'])
+    if not args.keep:
+        os.remove(result['path'])
+        if args.backend == 'sheets' and seed:
+            worksheet = backend._get_or_create_user_worksheet(user_name)
+            backend._call(backend.spreadsheet.del_worksheet, worksheet, kind='write')
+            print(f"   🗑️ Đã xóa worksheet benchmark '{worksheet.title}'")
+
+
+# Tin nhắn mẫu cho benchmark-nlp: (tin nhắn, intent mong đợi, các trường cần khớp)
+NLP_BENCHMARK_CASES = [
+    ("500k trà sữa", "EXPENSE", {"amount": 500000, "category": "Ăn uống", "custom_date": None}),
+    ("mua áo 300k", "EXPENSE", {"amount": 300000, "category": "Mua sắm"}),
+    ("200k xăng", "EXPENSE", {"amount": 200000, "category": "Di chuyển"}),
+    ("grab đi làm 45k", "EXPENSE", {"amount": 45000, "category": "Di chuyển"}),
+    ("480k nướng", "EXPENSE", {"amount": 480000, "category": "Ăn uống"}),
+    ("tiền điện 650k", "EXPENSE", {"amount": 650000, "category": "Nhà cửa"}),
+    ("khám răng 1.2tr", "EXPENSE", {"amount": 1200000, "category": "Y tế"}),
+    ("học phí tiếng anh 3tr", "EXPENSE", {"amount": 3000000, "category": "Học tập"}),
+    ("vé xem phim 120k", "EXPENSE", {"amount": 120000, "category": "Giải trí"}),
+    ("bún 80k và phở 150k", "EXPENSE", {"amount": 230000, "category": "Ăn uống"}),
+    ("mua áo 300k và giày 200k", "EXPENSE", {"amount": 500000, "category": "Mua sắm"}),
+    ("hôm qua 80k đi chợ", "EXPENSE", {"amount": 80000, "category": "Ăn uống", "custom_date": "hôm qua"}),
+    ("5/9 bánh 200k", "EXPENSE", {"amount": 200000, "category": "Ăn uống", "custom_date": "5/9"}),
+    ("tuần trước mua áo 300k", "EXPENSE", {"amount": 300000, "category": "Mua sắm", "custom_date": "tuần trước"}),
+    ("thứ hai mua sách 50k", "EXPENSE", {"amount": 50000, "category": "Học tập", "custom_date": "thứ hai"}),
+    ("480k nướng, 575k siêu thị", "MULTIPLE_EXPENSES",
+     {"transactions": [(480000, "Ăn uống"), (575000, "Mua sắm")]}),
+    ("hôm qua bún 12k, laptop 1.5m", "MULTIPLE_EXPENSES",
+     {"transactions": [(12000, "Ăn uống"), (1500000, "Mua sắm")], "custom_date": "hôm qua"}),
+    ("cà phê 35k, gửi xe 5k, wifi 220k", "MULTIPLE_EXPENSES",
+     {"transactions": [(35000, "Ăn uống"), (5000, "Di chuyển"), (220000, "Nhà cửa")]}),
+    ("1tr2 tiền nhà", "EXPENSE", {"amount": 1200000, "category": "Nhà cửa"}),
+    ("tiền nhà 1 triệu rưỡi", "EXPENSE", {"amount": 1500000, "category": "Nhà cửa"}),
+    ("50 nghìn cà phê", "EXPENSE", {"amount": 50000, "category": "Ăn uống"}),
+    ("laptop 2.5tr", "EXPENSE", {"amount": 2500000, "category": "Mua sắm"}),
+    ("100 ngàn đổ xăng", "EXPENSE", {"amount": 100000, "category": "Di chuyển"}),
+    ("ăn sáng hết 30k", "EXPENSE", {"amount": 30000, "category": "Ăn uống"}),
+    ("cafe 30k + bánh mì 20k", "EXPENSE", {"amount": 50000, "category": "Ăn uống"}),
+    ("hôm kia taxi 150.000đ", "EXPENSE", {"amount": 150000, "category": "Di chuyển", "custom_date": "hôm kia"}),
+    ("ngày 3/9 thuốc 85k, gửi xe 10k", "MULTIPLE_EXPENSES",
+     {"transactions": [(85000, "Y tế"), (10000, "Di chuyển")], "custom_date": "3/9"}),
+    ("phở 60k\ntrà sữa 45k\nxăng 80k", "MULTIPLE_EXPENSES",
+     {"transactions": [(60000, "Ăn uống"), (45000, "Ăn uống"), (80000, "Di chuyển")]}),
+    ("nhận lương 15tr", "INCOME", {"amount": 15000000, "category": "Lương"}),
+    ("2/9 thưởng 500k", "INCOME", {"amount": 500000, "category": "Thưởng", "custom_date": "2/9"}),
+    ("thứ hai lương 5m", "INCOME", {"amount": 5000000, "category": "Lương", "custom_date": "thứ hai"}),
+    ("được khách trả tiền thiết kế logo 2tr", "INCOME", {"amount": 2000000, "category": "Freelance"}),
+    ("bán xe cũ được 8tr", "INCOME", {"amount": 8000000, "category": "Bán hàng"}),
+    ("cho An mượn 500k", "LENDING", {"amount": 500000, "category": "Cho vay", "person": "An"}),
+    ("hôm qua cho vay 1tr", "LENDING", {"amount": 1000000, "category": "Cho vay", "custom_date": "hôm qua"}),
+    ("vay anh Nam 2tr", "BORROWING", {"amount": 2000000, "category": "Đi vay", "person": "anh Nam"}),
+    ("mượn bạn 500k", "BORROWING", {"amount": 500000, "category": "Đi vay"}),
+    ("thống kê", "STATS", {"time_period": "thang"}),
+    ("báo cáo tháng 8", "STATS", {"time_period": "thang", "specific_value": "8"}),
+    ("thống kê tháng trước", "STATS", {"time_period": "thang", "specific_value": "thang_truoc"}),
+    ("thống kê tuần này", "STATS", {"time_period": "tuan"}),
+    ("thống kê hôm qua", "STATS", {"time_period": "ngay", "specific_value": "hôm qua"}),
+    ("thống kê 2/9", "STATS", {"time_period": "ngay", "specific_value": "2/9"}),
+    ("báo cáo từ 1/9 đến 5/9", "STATS", {"time_period": "custom", "specific_value": "01/09-05/09"}),
+    ("tổng kết năm nay", "STATS", {"time_period": "nam"}),
+    ("cho mình xem báo cáo tuần trước nhé", "STATS", {"time_period": "tuan", "specific_value": "tuan_truoc"}),
+    ("ăn uống", "CATEGORY_STATS", {"category_name": "ăn uống", "time_period": "thang"}),
+    ("ăn uống hôm nay", "CATEGORY_STATS", {"category_name": "ăn uống", "time_period": "ngay"}),
+    ("xăng xe tuần này", "CATEGORY_STATS", {"category_name": "xăng xe", "time_period": "tuan"}),
+    ("mua sắm tháng 8", "CATEGORY_STATS", {"category_name": "mua sắm", "time_period": "thang", "specific_value": "8"}),
+    ("top chi tiêu tuần này", "CATEGORY_STATS", {"category_name": "top chi tiêu", "time_period": "tuan"}),
+    ("chi tiêu ăn uống tháng trước", "CATEGORY_STATS", {"category_name": "ăn uống", "time_period": "thang", "specific_value": "thang_truoc"}),
+    ("danh mục", "CATEGORY_LIST", {}),
+    ("xem danh mục", "CATEGORY_LIST", {}),
+    ("hướng dẫn", "HELP", {}),
+    ("xuất dữ liệu", "EXPORT", {"format": "csv", "time_period": "nam"}),
+    ("xuất excel tháng 8", "EXPORT", {"format": "xlsx", "time_period": "thang", "specific_value": "8"}),
+    ("export năm 2024", "EXPORT", {"format": "csv", "time_period": "nam", "specific_value": "2024"}),
+    ("xuất ra file csv tuần này", "EXPORT", {"format": "csv", "time_period": "tuan"}),
+    ("xin chào", "HELP_GUIDE", {}),
+    ("bạn ăn cơm chưa", "HELP_GUIDE", {}),
+    ("hôm nay thời tiết thế nào", "HELP_GUIDE", {}),
+]
+
+
+def _same_value(expected, actual) -> bool:
+    """So sánh một trường kết quả (số tiền theo giá trị, chuỗi không phân biệt hoa/thường)"""
+    if expected is None:
+        return actual in (None, '', 'null')
+    if isinstance(expected, (int, float)):
+        try:
+            return abs(float(actual) - expected) < 0.5
+        except (TypeError, ValueError):
+            return False
+    return str(actual or '').strip().lower() == str(expected).lower()
+
+
+def _score_nlp_result(result, intent: str, fields: dict) -> list:
+    """Các trường sai của một kết quả phân tích (list rỗng = đúng hoàn toàn)"""
+    if not result or result.get('intent') != intent:
+        return [f"intent={result.get('intent') if result else None}"]
+    data = result.get('data') or {}
+    errors = []
+    for key, expected in fields.items():
+        if key == 'transactions':
+            actual = [(t.get('amount'), t.get('category')) for t in data.get('transactions') or []]
+            if len(actual) != len(expected) or not all(
+                _same_value(amount, actual_amount) and _same_value(category, actual_category)
+                for (amount, category), (actual_amount, actual_category) in zip(expected, actual)
+            ):
+                errors.append(f"transactions={actual}")
+        elif key == 'custom_date' and 'transactions' in data:
+            if not all(_same_value(expected, t.get('custom_date')) for t in data['transactions']):
+                errors.append("custom_date")
+        elif not _same_value(expected, data.get(key)):
+            errors.append(f"{key}={data.get(key)!r}")
+    return errors
+
+
+def command_benchmark_nlp(args):
+    """So sánh prompt cũ với router + prompt ngắn theo nhóm (kích thước, độ chính xác, độ trễ) và phân tích cục bộ"""
+    from services.nlp_prompts import (
+        FAMILY_INTENTS, build_family_prompt, build_legacy_prompt, build_router_prompt,
+        prompt_sizes, route_message
+    )
+
+    cases = NLP_BENCHMARK_CASES[:args.limit] if args.limit else NLP_BENCHMARK_CASES
+    sample = "hôm qua 80k đi chợ"
+    prompts = {
+        'legacy': build_legacy_prompt(sample),
+        'router': build_router_prompt(sample),
+        'transaction': build_family_prompt('transaction', sample),
+        'query': build_family_prompt('query', sample),
+    }
+
+    print("📏 Kích thước prompt (token ước lượng ~3 ký tự/token):")
+    ai_service = None
+    if args.count_tokens:
+        from services.gemini_ai import get_ai_service
+        ai_service = get_ai_service()
+        if not ai_service.is_enabled():
+            raise SystemExit("❌ --count-tokens cần GEMINI_API_KEY")
+    for name, size in prompt_sizes(prompts).items():
+        line = f"   {name:<12} {size['chars']:>6,} ký tự  ~{size['tokens']:>5,} token"
+        if ai_service:
+            line += f"  ({ai_service.count_tokens(prompts[name]):,} token Gemini)"
+        print(line)
+
+    # Router cục bộ: đúng / sai / để router AI quyết
+    family_of = {intent: family for family, intents in FAMILY_INTENTS.items() for intent in intents}
+    routed = Counter()
+    for message, intent, _ in cases:
+        family = route_message(message)
+        if family is None:
+            routed['ai'] += 1
+        elif family == family_of[intent]:
+            routed['correct'] += 1
+        else:
+            routed['wrong'] += 1
+            print(f"   ⚠️ Router cục bộ sai: '{message}' → {family} (cần {family_of[intent]})")
+    print(f"🧭 Router cục bộ: {routed['correct']}/{len(cases)} đúng, {routed['wrong']} sai, "
+          f"{routed['ai']} chuyển router AI")
+
+    # Phân tích cục bộ (không gọi AI): tỉ lệ tin nhắn xử lý được, độ chính xác, tốc độ
+    from services.natural_language_processor import NaturalLanguageProcessor
+    nlp = NaturalLanguageProcessor()
+    covered, correct = 0, 0
+    started = time.perf_counter()
+    for message, intent, fields in cases:
+        result = nlp._quick_classify(message)
+        if not result:
+            continue
+        covered += 1
+        errors = _score_nlp_result(result, intent, fields)
+        if errors:
+            print(f"   ⚠️ Cục bộ sai: '{message}' ({intent}): {', '.join(errors)}")
+        else:
+            correct += 1
+    elapsed = time.perf_counter() - started
+    print(f"⚡ Phân tích cục bộ: {covered}/{len(cases)} tin nhắn không cần AI ({covered / len(cases):.0%}), "
+          f"{correct}/{covered} đúng, ~{elapsed / len(cases) * 1e6:,.0f} µs/tin nhắn")
+
+    if not args.accuracy:
+        print("ℹ️ Thêm --accuracy để gọi Gemini so sánh độ chính xác hai cách")
+        return
+
+    if not nlp.ai_service.is_enabled():
+        raise SystemExit("❌ --accuracy cần GEMINI_API_KEY")
+
+    for name, analyze in (('legacy', nlp._analyze_legacy), ('staged', nlp._analyze_staged)):
+        before = nlp.get_stats()
+        correct, latencies = 0, []
+        print(f"\n🧪 {name}: {len(cases)} tin nhắn...")
+        for message, intent, fields in cases:
+            started = time.perf_counter()
+            try:
+                result = analyze(message)
+            except Exception as e:
+                result = None
+                print(f"   ❌ '{message}': {e}")
+            latencies.append(time.perf_counter() - started)
+            errors = _score_nlp_result(result, intent, fields)
+            if errors:
+                print(f"   ✗ '{message}' ({intent}): {', '.join(errors)}")
+            else:
+                correct += 1
+        after = nlp.get_stats()
+        calls = after['ai_calls'] - before.get('ai_calls', 0)
+        total_tokens = sum(value for key, value in after.items() if key.endswith('_tokens')) - \
+            sum(value for key, value in before.items() if key.endswith('_tokens'))
+        latencies.sort()
+        print(f"   🎯 Chính xác: {correct}/{len(cases)} ({correct / len(cases):.0%})")
+        print(f"   📨 {calls} lần gọi AI, ~{total_tokens:,} token prompt (~{total_tokens // len(cases):,}/tin nhắn)")
+        print(f"   ⏱️ Độ trễ: trung bình {sum(latencies) / len(latencies):.2f}s, "
+              f"p90 {latencies[int(len(latencies) * 0.9) - 1]:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Công cụ quản trị bot thu chi")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help="Xuất giao dịch của user ra CSV/XLSX")
+    export_parser.add_argument('--user-name', required=True, help="Tên hiển thị Zalo của user (tên worksheet)")
+    export_parser.add_argument('--user-id', help="Zalo user id (private mode/backend cục bộ)")
+    export_parser.add_argument('--sheet-url', help="Link Google Sheet (mặc định GOOGLE_SHEET_URL)")
+    export_parser.add_argument('--start', help="Từ ngày dd/mm/yyyy")
+    export_parser.add_argument('--end', help="Đến ngày dd/mm/yyyy")
+    export_parser.add_argument('--format', choices=['csv', 'xlsx'], default='csv')
+    export_parser.add_argument('--output', help="Đường dẫn file (mặc định trong EXPORT_DIR)")
+    export_parser.add_argument('--chunk-size', type=int, help="Số dòng đọc mỗi lô (mặc định EXPORT_CHUNK_ROWS)")
+    export_parser.set_defaults(func=command_export)
+
+    import_parser = subparsers.add_parser('import', help="Import giao dịch từ file CSV/sao kê ngân hàng")
+    import_parser.add_argument('--user-name', required=True, help="Tên hiển thị Zalo của user (tên worksheet)")
+    import_parser.add_argument('--user-id', help="Zalo user id (private mode/backend cục bộ)")
+    import_parser.add_argument('--sheet-url', help="Link Google Sheet (mặc định GOOGLE_SHEET_URL)")
+    import_parser.add_argument('--file', required=True, help="File CSV cần import")
+    import_parser.add_argument('--encoding', default='utf-8-sig', help="Encoding của file (mặc định utf-8-sig)")
+    import_parser.add_argument('--chunk-size', type=int, help="Số dòng mỗi lần ghi (mặc định IMPORT_CHUNK_ROWS)")
+    import_parser.add_argument('--max-ai-calls', type=int, help="Ngân sách lệnh gọi AI (mặc định IMPORT_MAX_AI_CALLS)")
+    import_parser.add_argument('--no-ai', action='store_true', help="Chỉ phân loại bằng luật từ khóa")
+    import_parser.add_argument('--dry-run', action='store_true', help="Chỉ đọc file và in kế hoạch quota")
+    import_parser.set_defaults(func=command_import)
+
+    recategorize_parser = subparsers.add_parser('recategorize', help="Phân loại lại các giao dịch 'Khác'")
+    recategorize_parser.add_argument('--user-name', help="Tên worksheet của user")
+    recategorize_parser.add_argument('--all', action='store_true', help="Mọi worksheet user trong spreadsheet")
+    recategorize_parser.add_argument('--user-id', help="Zalo user id (private mode)")
+    recategorize_parser.add_argument('--sheet-url', help="Link Google Sheet (mặc định GOOGLE_SHEET_URL)")
+    recategorize_parser.add_argument('--max-ai-calls', type=int,
+                                     help="Ngân sách lệnh gọi AI (mặc định RECATEGORIZE_MAX_AI_CALLS)")
+    recategorize_parser.add_argument('--no-ai', action='store_true', help="Chỉ phân loại bằng luật từ khóa")
+    recategorize_parser.add_argument('--dry-run', action='store_true', help="Không ghi lên sheet (vẫn gọi AI)")
+    recategorize_parser.add_argument('--reset', action='store_true', help="Bỏ checkpoint, quét lại từ đầu")
+    recategorize_parser.set_defaults(func=command_recategorize)
+
+    outbox_parser = subparsers.add_parser('outbox', help="Xem/thử lại giao dịch chờ đồng bộ lên Google Sheets")
+    outbox_parser.add_argument('--retry', action='store_true', help="Thử ghi lại các giao dịch đã lỗi")
+    outbox_parser.add_argument('--sheet-url', help="Chỉ giao dịch của Google Sheet này")
+    outbox_parser.add_argument('--user-name', help="Chỉ worksheet của user này (cần --sheet-url)")
+    outbox_parser.set_defaults(func=command_outbox)
+
+    benchmark_parser = subparsers.add_parser('benchmark-export', help="Đo throughput xuất dữ liệu")
+    benchmark_parser.add_argument('--rows', type=int, default=100000)
+    benchmark_parser.add_argument('--format', choices=['csv', 'xlsx'], default='csv')
+    benchmark_parser.add_argument('--backend', choices=['memory', 'sqlite', 'sheets'], default='sqlite')
+    benchmark_parser.add_argument('--sheet-url', help="Google Sheet đã share cho bot (--backend sheets)")
+    benchmark_parser.add_argument('--user-name', help="Worksheet có sẵn để đo (--backend sheets, không tạo dữ liệu)")
+    benchmark_parser.add_argument('--seed-batch', type=int, default=10000,
+                                  help="Số dòng mỗi lệnh append_rows khi tạo dữ liệu trên Sheets")
+    benchmark_parser.add_argument('--chunk-size', type=int, help="Số dòng đọc mỗi lô")
+    benchmark_parser.add_argument('--keep', action='store_true', help="Giữ lại file đã xuất (và worksheet benchmark)")
+    benchmark_parser.set_defaults(func=command_benchmark_export)
+
+    nlp_parser = subparsers.add_parser('benchmark-nlp',
+                                       help="So sánh prompt NLP cũ với prompt theo bước và phân tích cục bộ")
+    nlp_parser.add_argument('--accuracy', action='store_true', help="Gọi Gemini đo độ chính xác và độ trễ")
+    nlp_parser.add_argument('--count-tokens', action='store_true', help="Đếm token prompt bằng API Gemini")
+    nlp_parser.add_argument('--limit', type=int, help="Chỉ chạy N tin nhắn đầu")
+    nlp_parser.set_defaults(func=command_benchmark_nlp)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except KeyboardInterrupt:
+        print("\n⛔ Đã dừng")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 import re
@@ -6,9 +7,11 @@ from typing import Dict, Any
 from zalo_bot import Update
 from zalo_bot.constants import ChatAction
 from services.natural_language_processor import NaturalLanguageProcessor
-from services.google_sheets import GoogleSheetsService
-from services.gemini_ai import GeminiAIService
-from utils.format_utils import format_currency
+from services.storage_backend import StorageBackend
+from services.category_memo import get_category_memo
+from services.gemini_ai import get_ai_service
+from services.ledger_exporter import get_ledger_exporter, is_xlsx_available
+from utils.format_utils import format_currency, format_pending_sync
 
 
 logger = logging.getLogger(__name__)
@@ -16,11 +19,12 @@ logger = logging.getLogger(__name__)
 class NaturalLanguageHandler:
     """Handler xử lý tin nhắn ngôn ngữ tự nhiên"""
     
-    def __init__(self, sheets_service: GoogleSheetsService = None, user_sheet_manager = None):
+    def __init__(self, sheets_service: StorageBackend = None, user_sheet_manager = None):
         self.nlp = NaturalLanguageProcessor()
         self.sheets_service = sheets_service
         self.user_sheet_manager = user_sheet_manager
-        self.ai_service = GeminiAIService()
+        self.ai_service = get_ai_service()
+        self.category_memo = get_category_memo()
     
     async def handle_natural_message(self, update: Update, context) -> bool:
         """
@@ -54,11 +58,8 @@ class NaturalLanguageHandler:
         
         # Phân tích ý định
         try:
-            intent_result = self.nlp.process_message(message_text)
-            
-            # Nếu process_message trả về coroutine, await nó
-            if hasattr(intent_result, '__await__'):
-                intent_result = await intent_result
+            # Gọi Gemini không chặn event loop, có hạn chót GEMINI_TIMEOUT_SECONDS
+            intent_result = await self.nlp.process_message_async(message_text, self._get_user_key(update, user_name))
             
             if not intent_result:
                 # Không thể phân tích - bỏ qua
@@ -113,6 +114,10 @@ class NaturalLanguageHandler:
                 await self._handle_category_list(update)
                 return True
                 
+            elif intent == 'EXPORT':
+                await self._handle_export(update, data, user_name)
+                return True
+                
             elif intent == 'HELP':
                 await self._handle_help(update)
                 return True
@@ -140,18 +145,13 @@ class NaturalLanguageHandler:
             )
             return
         
-        # Sử dụng category từ AI hoặc fallback
-        category = data.get('category')
-        if not category:
-            # Fallback nếu AI không trả về category
-            if self.ai_service.is_enabled():
-                category = self.ai_service.categorize_expense(description)
-            else:
-                category = "Khác"
+        # Danh mục user đã giữ trên sheet > category từ AI > memo > gọi AI phân loại
+        category = await self._resolve_category("Chi", description, data.get('category'), update, user_name)
         
         # Lưu vào Google Sheets
         custom_date = data.get('custom_date')
-        success = self._add_transaction_with_user_info(
+        success = await asyncio.to_thread(
+            self._add_transaction_with_user_info,
             transaction_type="Chi",
             amount=amount,
             category=category,
@@ -185,6 +185,7 @@ class NaturalLanguageHandler:
 
 🔗 Xem chi tiết: {self._get_sheet_url(update)}
 """
+            response = response.strip() + self._get_pending_sync_note(update, user_name)
         else:
             response = "🚫 Có lỗi khi lưu dữ liệu. Vui lòng thử lại!"
         
@@ -202,18 +203,13 @@ class NaturalLanguageHandler:
             )
             return
         
-        # Sử dụng category từ AI hoặc fallback
-        category = data.get('category')
-        if not category:
-            # Fallback nếu AI không trả về category
-            if self.ai_service.is_enabled():
-                category = self.ai_service.categorize_income(description)
-            else:
-                category = "Khác"
+        # Danh mục user đã giữ trên sheet > category từ AI > memo > gọi AI phân loại
+        category = await self._resolve_category("Thu", description, data.get('category'), update, user_name)
         
         # Lưu vào Google Sheets
         custom_date = data.get('custom_date')
-        success = self._add_transaction_with_user_info(
+        success = await asyncio.to_thread(
+            self._add_transaction_with_user_info,
             transaction_type="Thu",
             amount=amount,
             category=category,
@@ -247,6 +243,7 @@ class NaturalLanguageHandler:
 
 🔗 Xem chi tiết: {self._get_sheet_url(update)}
 """
+            response = response.strip() + self._get_pending_sync_note(update, user_name)
         else:
             response = "🚫 Có lỗi khi lưu dữ liệu. Vui lòng thử lại!"
         
@@ -265,16 +262,19 @@ class NaturalLanguageHandler:
         
         successful_transactions = []
         failed_transactions = []
-        
+
+        await self._prefill_categories("Chi", transactions)
+
         # Xử lý từng giao dịch
         for transaction in transactions:
             amount = transaction.get('amount', 0)
             description = transaction.get('description', '')
-            category = transaction.get('category', 'Khác')
+            category = await self._resolve_category("Chi", description, transaction.get('category'), update, user_name)
             custom_date = transaction.get('custom_date')  # Lấy custom_date từ từng transaction
             
             if amount > 0 and description:
-                success = self._add_transaction_with_user_info(
+                success = await asyncio.to_thread(
+                    self._add_transaction_with_user_info,
                     transaction_type="Chi",
                     amount=amount,
                     category=category,
@@ -330,6 +330,8 @@ class NaturalLanguageHandler:
             
             if failed_transactions:
                 response += f"\n\n⚠️ Có {len(failed_transactions)} khoản thất bại, vui lòng thử lại!"
+            
+            response += self._get_pending_sync_note(update, user_name)
         else:
             response = "❌ Không thể ghi nhận khoản chi nào. Vui lòng thử lại!"
         
@@ -353,7 +355,8 @@ class NaturalLanguageHandler:
         
         # Lưu vào Google Sheets
         custom_date = data.get('custom_date')
-        success = self._add_transaction_with_user_info(
+        success = await asyncio.to_thread(
+            self._add_transaction_with_user_info,
             transaction_type="Chi",  # Cho vay được tính là chi tiêu
             amount=amount,
             category=category,
@@ -388,6 +391,7 @@ class NaturalLanguageHandler:
 
 🔗 Xem chi tiết: {self._get_sheet_url(update)}
 """
+            response = response.strip() + self._get_pending_sync_note(update, user_name)
         else:
             response = "🚫 Có lỗi khi lưu dữ liệu. Vui lòng thử lại!"
         
@@ -411,7 +415,8 @@ class NaturalLanguageHandler:
         
         # Lưu vào Google Sheets
         custom_date = data.get('custom_date')
-        success = self._add_transaction_with_user_info(
+        success = await asyncio.to_thread(
+            self._add_transaction_with_user_info,
             transaction_type="Thu",  # Đi vay được tính là thu nhập
             amount=amount,
             category=category,
@@ -446,6 +451,7 @@ class NaturalLanguageHandler:
 
 🔗 Xem chi tiết: {self._get_sheet_url(update)}
 """
+            response = response.strip() + self._get_pending_sync_note(update, user_name)
         else:
             response = "🚫 Có lỗi khi lưu dữ liệu. Vui lòng thử lại!"
         
@@ -473,10 +479,10 @@ class NaturalLanguageHandler:
                 if not user_service:
                     await update.message.reply_text("❌ Bạn chưa thiết lập Google Sheet. Vui lòng gửi link sheet của bạn!")
                     return
-                stats = user_service.get_statistics(user_name, start_date, end_date)
+                stats = await asyncio.to_thread(user_service.get_statistics, user_name, start_date, end_date)
             else:
                 # Shared mode - lấy từ sheet chung
-                stats = self.sheets_service.get_statistics(user_name, start_date, end_date)
+                stats = await asyncio.to_thread(self.sheets_service.get_statistics, user_name, start_date, end_date)
             
             # Format response với tên phù hợp
             if time_period == 'custom':
@@ -511,6 +517,9 @@ class NaturalLanguageHandler:
 
 🔗 Xem chi tiết: {self._get_sheet_url(update)}
 """
+            pending_note = format_pending_sync(stats.get('pending_sync', 0), stats.get('failed_sync', 0))
+            if pending_note:
+                response = response.strip() + f"\n\n{pending_note}"
             
             await update.message.reply_text(response.strip())
             
@@ -520,6 +529,64 @@ class NaturalLanguageHandler:
                 f"🚫 Có lỗi khi tạo thống kê {period_name}. Vui lòng thử lại!"
             )
     
+    async def _handle_export(self, update: Update, data: Dict[str, Any], user_name: str):
+        """Xuất giao dịch trong khoảng thời gian ra file CSV/XLSX và gửi link tải"""
+        time_period = data.get('time_period', 'nam')
+        specific_value = data.get('specific_value')
+        export_format = 'xlsx' if str(data.get('format', 'csv')).lower() in ('xlsx', 'excel') else 'csv'
+        
+        try:
+            if specific_value:
+                start_date, end_date = self._get_date_range_with_specific_value(time_period, specific_value)
+            else:
+                start_date, end_date = self._get_date_range_for_period(time_period)
+            
+            sheets_service = self._get_sheets_service(update)
+            if not sheets_service:
+                await update.message.reply_text("❌ Bạn chưa thiết lập Google Sheet. Vui lòng gửi link sheet của bạn!")
+                return
+            
+            format_note = ""
+            if export_format == 'xlsx' and not is_xlsx_available():
+                export_format = 'csv'
+                format_note = "\nℹ️ Máy chủ chưa hỗ trợ Excel nên bot xuất CSV (mở được bằng Excel)"
+            
+            await update.message.reply_text(
+                f"⏳ Đang xuất dữ liệu {start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')}..."
+            )
+            
+            # Đọc/ghi theo lô trong thread riêng để không chặn event loop
+            exporter = get_ledger_exporter()
+            result = await asyncio.to_thread(
+                exporter.export, sheets_service, user_name, start_date, end_date, export_format
+            )
+            
+            if not result['rows']:
+                os.remove(result['path'])
+                await update.message.reply_text("📭 Không có giao dịch nào trong khoảng thời gian này.")
+                return
+            
+            download_url = exporter.build_download_url(exporter.register_download(result['path']))
+            if not download_url:
+                await update.message.reply_text("❌ Bot chưa cấu hình PUBLIC_BASE_URL nên không tạo được link tải.")
+                return
+            
+            response = f"""
+📦 XUẤT DỮ LIỆU {result['format'].upper()}
+📅 {start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')}
+📝 Giao dịch: {result['rows']:,}
+
+⬇️ Tải file: {download_url}
+⌛ Link có hiệu lực trong {exporter.link_ttl // 60} phút{format_note}
+"""
+            await update.message.reply_text(response.strip())
+            
+        except Exception as e:
+            logger.error(f"Lỗi xuất dữ liệu cho {user_name}: {e}")
+            await update.message.reply_text(
+                "🚫 Có lỗi khi xuất dữ liệu. Vui lòng thử lại!"
+            )
+    
     async def _handle_help(self, update: Update):
         """Xử lý trợ giúp"""
         response = f"""
@@ -551,6 +618,10 @@ class NaturalLanguageHandler:
 • "top chi tiêu" → Top 5 khoản chi lớn nhất
 • "danh mục" → Xem tất cả danh mục
 
+📦 XUẤT DỮ LIỆU:
+• "xuất dữ liệu" → File CSV cả năm nay
+• "xuất excel tháng 8" → File Excel tháng cụ thể
+
 🎯 DANH MỤC TỰ ĐỘNG:
 🍜 Ăn uống • 🛒 Mua sắm • ⛽ Di chuyển • 🏥 Y tế
 🎮 Giải trí • 🏠 Sinh hoạt • 📚 Học tập • 👨‍👩‍👧‍👦 Gia đình
@@ -614,6 +685,10 @@ class NaturalLanguageHandler:
                     end_year = now.year
                     end = datetime(end_year, end_month, end_day, 23, 59, 59, 999999)
                 
+                # Khoảng qua năm mới ("25/12-05/01"): ngày bắt đầu thuộc năm trước
+                if start > end:
+                    start = datetime(start_year - 1, start_month, start_day, 0, 0, 0)
+                
                 return start, end
             except Exception as e:
                 logger.error(f"Lỗi parse custom date range: {specific_value}, {e}")
@@ -681,6 +756,11 @@ class NaturalLanguageHandler:
                 end = day_before_yesterday.replace(hour=23, minute=59, second=59, microsecond=999999)
                 return start, end
                 
+        elif time_period == "nam" and specific_value.isdigit() and len(specific_value) == 4:
+            # Năm cụ thể: "2024"
+            year = int(specific_value)
+            return datetime(year, 1, 1), datetime(year + 1, 1, 1) - timedelta(microseconds=1)
+        
         elif specific_value.isdigit():
             # Tháng cụ thể (số)
             month = int(specific_value)
@@ -770,7 +850,8 @@ class NaturalLanguageHandler:
     async def _handle_setup_request(self, update: Update, context):
         """Yêu cầu user setup Google Sheet"""
         user_name = update.message.from_user.display_name or "bạn"
-        setup_message = self.user_sheet_manager.generate_setup_message(user_name)
+        user_id = update.message.from_user.id
+        setup_message = self.user_sheet_manager.generate_setup_message(user_name, user_id)
         await update.message.reply_text(setup_message.strip())
     
     async def _handle_sheet_setup(self, update: Update, context):
@@ -797,7 +878,7 @@ class NaturalLanguageHandler:
 🔒 Bảo mật: Chỉ bạn và bot mới truy cập được sheet này!
 """
         else:
-            service_email = os.getenv('GOOGLE_SERVICE_EMAIL', 'service-account-email')
+            service_email = self.user_sheet_manager.get_service_email(user_id)
             response = f"""
 ❌ LỖI THIẾT LẬP!
 
@@ -903,6 +984,84 @@ class NaturalLanguageHandler:
             )
      
 
+    def _get_user_key(self, update: Update, user_name: str):
+        """Key sổ giao dịch của user (None nếu chưa có nơi lưu)"""
+        try:
+            sheets_service = self._get_sheets_service(update)
+            return sheets_service.get_user_key(user_name) if sheets_service else None
+        except Exception as e:
+            logger.error(f"❌ Lỗi lấy key user: {e}")
+            return None
+    
+    async def _resolve_category(self, transaction_type: str, description: str, category: str,
+                          update: Update, user_name: str) -> str:
+        """Chọn danh mục cho giao dịch, chỉ gọi AI khi chưa từng gặp mô tả này"""
+        if not description:
+            return category or "Khác"
+        
+        # User đã sửa/giữ danh mục khác trên sheet cho mô tả này
+        user_category = self.category_memo.get_user_category(
+            self._get_user_key(update, user_name), transaction_type, description
+        )
+        if user_category:
+            return user_category
+        
+        if category:
+            self.category_memo.remember(transaction_type, description, category)
+            return category
+        
+        # Fallback nếu AI không trả về category
+        category = self.category_memo.lookup(transaction_type, description)
+        if category:
+            return category
+        
+        if not self.ai_service.is_enabled():
+            return "Khác"
+        # Gọi AI đồng bộ (có retry/backoff) trong thread riêng để không chặn event loop
+        if transaction_type == "Thu":
+            category = await asyncio.to_thread(self.ai_service.categorize_income, description)
+        else:
+            category = await asyncio.to_thread(self.ai_service.categorize_expense, description)
+        self.category_memo.remember(transaction_type, description, category)
+        return category
+
+    async def _prefill_categories(self, transaction_type: str, transactions: list):
+        """Phân loại một lần (categorize_batch) các khoản AI chưa gán danh mục và memo chưa biết"""
+        missing = [
+            transaction for transaction in transactions
+            if transaction.get('description') and not transaction.get('category')
+            and not self.category_memo.lookup(transaction_type, transaction['description'])
+        ]
+        if len(missing) < 2 or not self.ai_service.is_enabled():
+            # 0-1 khoản: _resolve_category tự xử lý như giao dịch đơn
+            return
+        categories = await asyncio.to_thread(
+            self.ai_service.categorize_batch,
+            [transaction['description'] for transaction in missing], transaction_type
+        )
+        for transaction, category in zip(missing, categories):
+            transaction['category'] = category or "Khác"
+
+    def _get_sheets_service(self, update: Update):
+        """Helper method để lấy sheets service phù hợp với từng mode"""
+        if self.user_sheet_manager:
+            # Private mode - service của sheet riêng
+            return self.user_sheet_manager.get_user_service(update.message.from_user.id)
+        # Shared mode - service của sheet chung
+        return self.sheets_service
+    
+    def _get_pending_sync_note(self, update: Update, user_name: str) -> str:
+        """Ghi chú giao dịch chờ đồng bộ (khi Google Sheets đang lỗi/hết quota)"""
+        try:
+            sheets_service = self._get_sheets_service(update)
+            pending_note = format_pending_sync(
+                sheets_service.get_pending_count(user_name), sheets_service.get_failed_sync_count(user_name)
+            ) if sheets_service else ""
+            return f"\n\n{pending_note}" if pending_note else ""
+        except Exception as e:
+            logger.error(f"❌ Lỗi lấy số giao dịch chờ đồng bộ: {e}")
+            return ""
+    
     def _get_sheet_url(self, update: Update) -> str:
         """Helper method để lấy sheet URL phù hợp với từng mode"""
         try:
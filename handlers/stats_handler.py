@@ -1,7 +1,8 @@
+import asyncio
 from zalo_bot import Update
 from zalo_bot.constants import ChatAction
 
-from utils.format_utils import format_currency, format_statistics
+from utils.format_utils import format_currency, format_statistics, format_pending_sync
 from utils.date_utils import DateUtils
 from datetime import datetime
 import logging
@@ -64,7 +65,7 @@ async def handle_categories(update: Update, context, sheets_service):
             )
         
         user_name = update.message.from_user.display_name or "Người dùng"
-        categories = sheets_service.get_categories()
+        categories = await asyncio.to_thread(sheets_service.get_category_usage, user_name)
         
         if not categories['Thu'] and not categories['Chi']:
             await update.message.reply_text(
@@ -77,14 +78,14 @@ async def handle_categories(update: Update, context, sheets_service):
         
         if categories['Thu']:
             response += "💰 DANH MỤC THU:\n"
-            for i, category in enumerate(categories['Thu'], 1):
-                response += f"  {i}. {category}\n"
+            for i, item in enumerate(categories['Thu'], 1):
+                response += f"  {i}. {item['category']} ({item['count']} lần)\n"
             response += "\n"
         
         if categories['Chi']:
             response += "💸 DANH MỤC CHI:\n"
-            for i, category in enumerate(categories['Chi'], 1):
-                response += f"  {i}. {category}\n"
+            for i, item in enumerate(categories['Chi'], 1):
+                response += f"  {i}. {item['category']} ({item['count']} lần)\n"
         
         # Thêm thống kê nhanh về danh mục
         total_categories = len(categories.get('Thu', [])) + len(categories.get('Chi', []))
@@ -129,7 +130,7 @@ async def handle_category_stats(update: Update, context, sheets_service):
             return
         
         # Lấy thống kê
-        stats = sheets_service.get_statistics(user_name, start_date, end_date)
+        stats = await asyncio.to_thread(sheets_service.get_statistics, user_name, start_date, end_date)
         
         if stats['transaction_count'] == 0:
             await update.message.reply_text(
@@ -146,7 +147,11 @@ async def handle_category_stats(update: Update, context, sheets_service):
         response += f"💸 Tổng chi: {format_currency(stats['total_expense'])}\n"
         balance_icon = "💵" if stats['balance'] >= 0 else "⚠️"
         response += f"{balance_icon} Số dư: {format_currency(stats['balance'])}\n"
-        response += f"📝 Số giao dịch: {stats['transaction_count']}\n\n"
+        response += f"📝 Số giao dịch: {stats['transaction_count']}\n"
+        pending_note = format_pending_sync(stats.get('pending_sync', 0), stats.get('failed_sync', 0))
+        if pending_note:
+            response += f"{pending_note}\n"
+        response += "\n"
         
         # Phân tích chi tiêu theo danh mục
         expense_categories = stats.get('expense_categories', {})
@@ -211,7 +216,7 @@ async def handle_specific_category_stats(update: Update, context, sheets_service
             return
         
         # Lấy thống kê
-        stats = sheets_service.get_statistics(user_name, start_date, end_date)
+        stats = await asyncio.to_thread(sheets_service.get_statistics, user_name, start_date, end_date)
         
         if stats['transaction_count'] == 0:
             await update.message.reply_text(
@@ -331,6 +336,10 @@ async def _handle_single_category_stats(update: Update, stats: dict, category_na
         response += f"   💰 {format_currency(amount)}\n"
         response += f"   📊 {percentage:.1f}% tổng thu nhập\n\n"
     
+    pending_note = format_pending_sync(stats.get('pending_sync', 0), stats.get('failed_sync', 0))
+    if pending_note:
+        response += f"\n{pending_note}\n"
+    
     response += f"\n🔗 Xem chi tiết: {sheets_service.get_sheet_url() if sheets_service else 'Google Sheet'}"
     
     await update.message.reply_text(response)
@@ -1,4 +1,4 @@
-from flask import Flask, request
+from flask import Flask, request, send_file
 from zalo_bot import Bot, Update
 from zalo_bot.ext import Dispatcher, CommandHandler, MessageHandler, filters
 from zalo_bot.constants import ChatAction
@@ -12,8 +12,16 @@ from handlers.income_handler import handle_income
 from handlers.expense_handler import handle_expense  
 from handlers.stats_handler import handle_stats, handle_categories, handle_category_stats
 from handlers.natural_language_handler import NaturalLanguageHandler
-from services.google_sheets import GoogleSheetsService
+from services.storage_backend import create_storage_backend, get_storage_backend_name
 from services.user_sheet_manager import UserSheetManager
+from services.sheets_scheduler import get_all_scheduler_stats
+from services.write_journal import get_write_journal
+from services.worksheet_cache import get_worksheet_cache
+from services.ledger_exporter import get_ledger_exporter
+from services.intent_cache import get_intent_cache
+from services.template_cache import get_template_cache
+from services.category_memo import get_category_memo
+from services.gemini_ai import get_ai_service
 
 # Load environment variables
 load_dotenv()
@@ -34,6 +42,7 @@ WEBHOOK_URL = os.getenv('WEBHOOK_URL')
 PRIVATE_MODE = os.getenv('PRIVATE_MODE', 'false').lower() == 'true'
 SECRET_TOKEN = os.getenv('SECRET_TOKEN', 'default_secret')
 PORT = int(os.getenv('PORT', 8443))
+STORAGE_BACKEND = get_storage_backend_name()
 
 if not TOKEN:
     raise ValueError("ZALO_BOT_TOKEN không được tìm thấy trong file .env")
@@ -45,14 +54,19 @@ if not WEBHOOK_URL:
 bot = Bot(token=TOKEN)
 
 # Khởi tạo services
-if PRIVATE_MODE:
+if PRIVATE_MODE and STORAGE_BACKEND == 'sheets':
     logger.info("🔒 Khởi động chế độ PRIVATE - User tự cung cấp Google Sheet")
     user_sheet_manager = UserSheetManager()
     sheets_service = None  # Sẽ tạo động cho từng user
-else:
+elif STORAGE_BACKEND == 'sheets':
     logger.info("🌐 Khởi động chế độ SHARED - Tất cả dùng chung Google Sheet")
     user_sheet_manager = None
-    sheets_service = GoogleSheetsService()
+    sheets_service = create_storage_backend()
+else:
+    # Backend cục bộ đã tách dữ liệu theo user - không cần user gửi Google Sheet
+    logger.info(f"💾 Khởi động với storage backend: {STORAGE_BACKEND}")
+    user_sheet_manager = None
+    sheets_service = create_storage_backend()
 
 nl_handler = NaturalLanguageHandler(sheets_service, user_sheet_manager)
 
@@ -159,7 +173,18 @@ dispatcher.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_na
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return {"status": "ok", "message": "Bot is running"}, 200
+    return {
+        "status": "ok",
+        "message": "Bot is running",
+        "sheets_scheduler": get_all_scheduler_stats(),
+        "write_journal": get_write_journal().get_stats(),
+        "worksheet_cache": get_worksheet_cache().get_stats(),
+        "intent_cache": get_intent_cache().get_stats(),
+        "template_cache": get_template_cache().get_stats(),
+        "category_memo": get_category_memo().get_stats(),
+        "nlp": nl_handler.nlp.get_stats(),
+        "gemini": get_ai_service().get_metrics()
+    }, 200
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
@@ -184,6 +209,14 @@ def webhook():
         logger.error(f"Lỗi xử lý webhook: {e}")
         return {'status': 'error', 'message': str(e)}, 500
 
+@app.route('/exports/<token>', methods=['GET'])
+def download_export(token):
+    """Tải file xuất dữ liệu (link gửi cho user, hết hạn sau EXPORT_LINK_TTL)"""
+    path = get_ledger_exporter().resolve_download(token)
+    if not path:
+        return {'status': 'error', 'message': 'Link đã hết hạn hoặc không tồn tại'}, 404
+    return send_file(os.path.abspath(path), as_attachment=True, download_name=os.path.basename(path))
+
 @app.route('/')
 def home():
     """Trang chủ"""
@@ -206,11 +239,12 @@ def print_startup_info():
     logger.info(f"   🔌 Port: {PORT}")
     logger.info(f"   🔧 Debug Mode: {os.getenv('DEBUG', 'False')}")
     logger.info(f"   🔒 Private Mode: {'✅ BẬT' if PRIVATE_MODE else '❌ TẮT'}")
+    logger.info(f"   💾 Storage Backend: {STORAGE_BACKEND}")
     
     # Kiểm tra Google Sheets
     logger.info("📊 KIỂM TRA GOOGLE SHEETS:")
     try:
-        if PRIVATE_MODE:
+        if user_sheet_manager:
             stats = user_sheet_manager.get_stats()
             logger.info("   ✅ User Sheet Manager đã sẵn sàng!")
             logger.info(f"   👥 Đã có {stats['total_users']} user đăng ký")
@@ -225,8 +259,7 @@ def print_startup_info():
     # Kiểm tra Gemini AI
     logger.info("🤖 KIỂM TRA GEMINI AI:")
     try:
-        from services.gemini_ai import GeminiAIService
-        ai_service = GeminiAIService()
+        ai_service = get_ai_service()
         if ai_service.is_enabled():
             logger.info("   ✅ Gemini AI đã được kích hoạt!")
             logger.info("   🧠 Tính năng: Phân loại danh mục tự động")
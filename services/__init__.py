@@ -3,15 +3,19 @@ Services package cho Zalo Bot
 """
 
 from .google_sheets import GoogleSheetsService
+from .storage_backend import StorageBackend, create_storage_backend
 from .natural_language_processor import NaturalLanguageProcessor
-from .gemini_ai import GeminiAIService
+from .gemini_ai import GeminiAIService, get_ai_service
 from .user_sheet_manager import UserSheetManager
 from .api_key_manager import APIKeyManager
 
 __all__ = [
     'GoogleSheetsService',
+    'StorageBackend',
+    'create_storage_backend',
     'NaturalLanguageProcessor',
     'GeminiAIService',
+    'get_ai_service',
     'UserSheetManager',
     'APIKeyManager'
 ]
\ No newline at end of file
@@ -1,21 +1,181 @@
+import atexit
+import hashlib
+import json
 import os
 import logging
+import threading
 import time
 from typing import List, Optional, Dict
 from datetime import datetime, timedelta
 
+from utils.json_utils import write_json_atomic
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9
+    ZoneInfo = None
+
 logger = logging.getLogger(__name__)
 
+
+class KeyBudget:
+    """
+    Ngân sách request của một API key
+
+    - RPM: token bucket dung lượng rpm, nạp lại rpm/60 token mỗi giây.
+    - RPD: đếm request trong ngày quota (Gemini reset lúc 0h giờ Pacific).
+    """
+
+    def __init__(self, rpm: int, rpd: int, used_today: int = 0):
+        self.rpm = rpm
+        self.rpd = rpd
+        self.tokens = float(rpm)
+        self.used_today = used_today
+        self._refilled_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rpm, self.tokens + (now - self._refilled_at) * self.rpm / 60.0)
+        self._refilled_at = now
+
+    def can_spend(self) -> bool:
+        self._refill()
+        return self.tokens >= 1 and self.used_today < self.rpd
+
+    def spend(self):
+        self._refill()
+        self.tokens -= 1
+        self.used_today += 1
+
+    def drain_minute(self):
+        """Server vẫn trả 429 - coi như hết RPM của phút này"""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+    def remaining_today(self) -> int:
+        return max(self.rpd - self.used_today, 0)
+
+
+class KeyLease:
+    """Quyền dùng một API key cho một lệnh gọi - trả lại bằng APIKeyManager.release_key()"""
+
+    def __init__(self, api_key: str, index: int):
+        self.api_key = api_key
+        self.index = index  # Bắt đầu từ 1, để log
+        self.acquired_at = time.monotonic()
+        self.released = False
+
+
 class APIKeyManager:
-    """Quản lý multiple API keys với auto rotation khi hết quota"""
+    """
+    Quản lý multiple API keys (thread-safe)
+
+    Giới hạn trước thay vì chờ 429: mỗi key có ngân sách RPM/RPD (GEMINI_KEY_RPM,
+    GEMINI_KEY_RPD), request được chia cho key còn nhiều ngân sách nhất và số
+    request trong ngày được lưu xuống file (GEMINI_KEY_USAGE_FILE, ghi nguyên tử
+    bởi thread nền mỗi GEMINI_KEY_USAGE_SAVE_SECONDS giây và khi thoát) để khởi động
+    lại không reset bộ đếm. 429 vẫn xảy ra (key dùng chung với nơi khác) thì key
+    nghỉ ngắn GEMINI_KEY_COOLDOWN_SECONDS.
+
+    Dùng key theo kiểu mượn - trả: acquire_key() -> gọi API -> release_key(lease, lỗi).
+    Mọi thao tác chỉ giữ lock trong thời gian cập nhật bộ đếm (không chờ I/O mạng),
+    nên gọi được từ nhiều thread lẫn trực tiếp trong event loop asyncio.
+    """
     
     def __init__(self):
         self.api_keys = self._load_api_keys()
         self.current_key_index = 0
         self.failed_keys = {}  # Track failed keys with timestamp
-        self.cooldown_minutes = 30  # Cooldown time for failed keys (optimized for 150/day)
+        # Request AI chạy song song từ nhiều thread - khóa trạng thái key khi đọc/ghi
+        self._lock = threading.RLock()
+        self.cooldown_seconds = int(os.getenv('GEMINI_KEY_COOLDOWN_SECONDS', 60))
+        self.rpm_limit = int(os.getenv('GEMINI_KEY_RPM', 15))
+        self.rpd_limit = int(os.getenv('GEMINI_KEY_RPD', 1500))
+        self.usage_file = os.getenv('GEMINI_KEY_USAGE_FILE', 'gemini_key_usage.json')
+        self.usage_save_seconds = float(os.getenv('GEMINI_KEY_USAGE_SAVE_SECONDS', 5))
+        self.quota_timezone = os.getenv('GEMINI_QUOTA_TIMEZONE', 'America/Los_Angeles')
+
+        self._quota_day = self._today()
+        usage = self._load_usage()
+        self.budgets: Dict[str, KeyBudget] = {
+            key: KeyBudget(self.rpm_limit, self.rpd_limit, usage.get(self._key_id(key), 0))
+            for key in self.api_keys
+        }
+        self.in_flight: Dict[str, int] = {key: 0 for key in self.api_keys}
+
+        # Bộ đếm đổi sau lần lưu cuối - thread nền ghi file, acquire_key() không chờ I/O đĩa
+        self._usage_dirty = False
+        self._save_lock = threading.Lock()
+        self._usage_flusher = None
+        atexit.register(self.flush_usage)
         
-        logger.info(f"🔑 Loaded {len(self.api_keys)} API keys")
+        logger.info(f"🔑 Loaded {len(self.api_keys)} API keys "
+                    f"(giới hạn mỗi key: {self.rpm_limit} RPM, {self.rpd_limit} RPD)")
+
+    @staticmethod
+    def _key_id(api_key: str) -> str:
+        """Định danh key khi lưu file (không ghi key thật xuống đĩa)"""
+        return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+    def _today(self) -> str:
+        """Ngày quota hiện tại theo múi giờ reset quota của Gemini"""
+        try:
+            if ZoneInfo:
+                return datetime.now(ZoneInfo(self.quota_timezone)).date().isoformat()
+        except Exception:
+            pass
+        return datetime.utcnow().date().isoformat()
+
+    def _load_usage(self) -> Dict[str, int]:
+        """Số request trong ngày của từng key (0 nếu file là của ngày trước)"""
+        try:
+            if os.path.exists(self.usage_file):
+                with open(self.usage_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('day') == self._quota_day:
+                    return data.get('used', {})
+        except Exception as e:
+            logger.error(f"❌ Lỗi load bộ đếm quota API key: {e}")
+        return {}
+
+    def _mark_usage_dirty(self):
+        """Bộ đếm vừa đổi - hẹn thread nền lưu xuống file (gọi khi đang giữ lock)"""
+        self._usage_dirty = True
+        if self._usage_flusher is None:
+            self._usage_flusher = threading.Thread(target=self._flush_loop, name="gemini-key-usage", daemon=True)
+            self._usage_flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.usage_save_seconds)
+            self.flush_usage()
+
+    def flush_usage(self):
+        """Lưu bộ đếm trong ngày nếu có thay đổi (ghi file ngoài lock trạng thái key)"""
+        with self._save_lock:
+            with self._lock:
+                if not self._usage_dirty:
+                    return
+                data = {
+                    'day': self._quota_day,
+                    'used': {self._key_id(key): budget.used_today for key, budget in self.budgets.items()}
+                }
+                self._usage_dirty = False
+            try:
+                write_json_atomic(self.usage_file, data)
+            except Exception as e:
+                logger.error(f"❌ Lỗi lưu bộ đếm quota API key: {e}")
+                with self._lock:
+                    self._usage_dirty = True
+
+    def _roll_day(self):
+        """Sang ngày quota mới thì reset bộ đếm RPD (gọi khi đang giữ lock)"""
+        today = self._today()
+        if today != self._quota_day:
+            self._quota_day = today
+            for budget in self.budgets.values():
+                budget.used_today = 0
+            logger.info(f"🌅 Ngày quota mới {today} - reset bộ đếm request của {len(self.budgets)} key")
     
     def _load_api_keys(self) -> List[str]:
         """Load API keys từ environment variables"""
@@ -52,112 +212,176 @@ class APIKeyManager:
     
     def get_current_api_key(self) -> Optional[str]:
         """Lấy API key hiện tại (có thể sử dụng được)"""
-        if not self.api_keys:
-            return None
+        with self._lock:
+            if not self.api_keys:
+                return None
         
-        # Thử từ key hiện tại
-        for attempt in range(len(self.api_keys)):
-            key_index = (self.current_key_index + attempt) % len(self.api_keys)
-            key = self.api_keys[key_index]
+            # Thử từ key hiện tại
+            for attempt in range(len(self.api_keys)):
+                key_index = (self.current_key_index + attempt) % len(self.api_keys)
+                key = self.api_keys[key_index]
             
-            # Kiểm tra key có trong cooldown không
-            if self._is_key_in_cooldown(key):
-                logger.debug(f"🕒 API Key {key_index + 1} đang trong cooldown")
-                continue
+                # Kiểm tra key có trong cooldown không
+                if self._is_key_in_cooldown(key):
+                    logger.debug(f"🕒 API Key {key_index + 1} đang trong cooldown")
+                    continue
             
-            # Cập nhật current index
-            if key_index != self.current_key_index:
-                self.current_key_index = key_index
-                logger.info(f"🔄 Chuyển sang API Key {key_index + 1}")
+                # Cập nhật current index
+                if key_index != self.current_key_index:
+                    self.current_key_index = key_index
+                    logger.info(f"🔄 Chuyển sang API Key {key_index + 1}")
             
-            return key
+                return key
         
-        # Tất cả keys đều trong cooldown
-        logger.warning("⏰ Tất cả API keys đang trong cooldown")
-        return self.api_keys[self.current_key_index]  # Return current anyway
+            # Tất cả keys đều trong cooldown
+            logger.warning("⏰ Tất cả API keys đang trong cooldown")
+            return self.api_keys[self.current_key_index]  # Return current anyway
     
+    def acquire_key(self, exclude=()) -> Optional[KeyLease]:
+        """
+        Mượn một key cho một lệnh gọi và trừ ngân sách của key đó
+
+        Chỉ xét key không cooldown, còn token RPM và còn RPD; ưu tiên key đang có ít
+        lệnh gọi dở dang nhất, sau đó key còn nhiều request trong ngày nhất - nhiều
+        worker chạy song song được rải đều thay vì dồn vào một key. None nếu mọi key
+        đã hết ngân sách hoặc đã thử (exclude) - không gửi request chắc chắn bị 429.
+        """
+        with self._lock:
+            self._roll_day()
+            candidates = [
+                (-self.in_flight[key], budget.remaining_today(), budget.tokens, -index, key)
+                for index, key in enumerate(self.api_keys)
+                for budget in (self.budgets[key],)
+                if key not in exclude and not self._is_key_in_cooldown(key) and budget.can_spend()
+            ]
+            if not candidates:
+                return None
+
+            key = max(candidates)[-1]
+            self.budgets[key].spend()
+            self.in_flight[key] += 1
+            self._mark_usage_dirty()
+
+            key_index = self.api_keys.index(key)
+            if key_index != self.current_key_index:
+                self.current_key_index = key_index
+                logger.debug(f"🔄 Chuyển sang API Key {key_index + 1}")
+            return KeyLease(key, key_index + 1)
+
+    def release_key(self, lease: KeyLease, error: Optional[BaseException] = None):
+        """
+        Trả key sau lệnh gọi, kèm lỗi nếu gọi thất bại (429 -> cooldown key)
+
+        Trả nhiều lần chỉ tính lần đầu, nên có thể gọi thêm trong finally cho chắc.
+        """
+        with self._lock:
+            if lease.released:
+                return
+            lease.released = True
+            self.in_flight[lease.api_key] = max(self.in_flight.get(lease.api_key, 0) - 1, 0)
+            if error is not None:
+                self.mark_key_failed(lease.api_key, str(error) or type(error).__name__)
+
     def mark_key_failed(self, api_key: str, error_message: str = ""):
         """Đánh dấu API key bị lỗi và chuyển sang key khác"""
-        if api_key not in self.api_keys:
-            return
+        with self._lock:
+            if api_key not in self.api_keys:
+                return
         
-        key_index = self.api_keys.index(api_key) + 1
+            key_index = self.api_keys.index(api_key) + 1
         
-        # Check if it's a quota/rate limit error
-        is_quota_error = any(keyword in error_message.lower() for keyword in [
-            '429', 'quota', 'rate limit', 'exceeded', 'resource_exhausted'
-        ])
+            # Check if it's a quota/rate limit error
+            is_quota_error = any(keyword in error_message.lower() for keyword in [
+                '429', 'quota', 'rate limit', 'exceeded', 'resource_exhausted'
+            ])
         
-        if is_quota_error:
-            # Mark key as failed with timestamp
-            self.failed_keys[api_key] = datetime.now()
-            logger.warning(f"🚫 API Key {key_index} hết quota - đánh dấu cooldown {self.cooldown_minutes} phút")
+            if is_quota_error:
+                # Ngân sách cục bộ lệch với server (key dùng ở nơi khác...) - nghỉ ngắn rồi thử lại
+                self.failed_keys[api_key] = datetime.now()
+                self.budgets[api_key].drain_minute()
+                logger.warning(f"🚫 API Key {key_index} bị 429 - cooldown {self.cooldown_seconds} giây")
             
-            # Rotate to next key
-            self._rotate_to_next_key()
-        else:
-            logger.error(f"❌ API Key {key_index} lỗi: {error_message[:100]}")
+                # Rotate to next key
+                self._rotate_to_next_key()
+            else:
+                logger.error(f"❌ API Key {key_index} lỗi: {error_message[:100]}")
     
     def _rotate_to_next_key(self):
         """Chuyển sang API key tiếp theo"""
-        if len(self.api_keys) <= 1:
-            return
-        
-        old_index = self.current_key_index
-        self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
-        
-        logger.info(f"🔄 Rotation: Key {old_index + 1} → Key {self.current_key_index + 1}")
+        with self._lock:
+            if len(self.api_keys) <= 1:
+                return
+
+            old_index = self.current_key_index
+            self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
+
+            logger.info(f"🔄 Rotation: Key {old_index + 1} → Key {self.current_key_index + 1}")
     
     def _is_key_in_cooldown(self, api_key: str) -> bool:
         """Kiểm tra API key có đang trong cooldown không"""
-        if api_key not in self.failed_keys:
-            return False
+        with self._lock:
+            if api_key not in self.failed_keys:
+                return False
         
-        failed_time = self.failed_keys[api_key]
-        cooldown_until = failed_time + timedelta(minutes=self.cooldown_minutes)
+            failed_time = self.failed_keys[api_key]
+            cooldown_until = failed_time + timedelta(seconds=self.cooldown_seconds)
         
-        if datetime.now() >= cooldown_until:
-            # Cooldown ended, remove from failed list
-            del self.failed_keys[api_key]
-            key_index = self.api_keys.index(api_key) + 1
-            logger.info(f"✅ API Key {key_index} đã hết cooldown - có thể sử dụng lại")
-            return False
+            if datetime.now() >= cooldown_until:
+                # Cooldown ended, remove from failed list
+                del self.failed_keys[api_key]
+                key_index = self.api_keys.index(api_key) + 1
+                logger.info(f"✅ API Key {key_index} đã hết cooldown - có thể sử dụng lại")
+                return False
         
-        return True
+            return True
     
     def get_status(self) -> Dict:
         """Lấy trạng thái của tất cả API keys"""
-        status = {
-            'total_keys': len(self.api_keys),
-            'current_key_index': self.current_key_index + 1,
-            'available_keys': 0,
-            'cooldown_keys': 0,
-            'keys_status': []
-        }
-        
-        for i, key in enumerate(self.api_keys):
-            key_status = {
-                'index': i + 1,
-                'key_preview': f"{key[:20]}..." if key else "None",
-                'status': 'available',
-                'is_current': i == self.current_key_index
+        with self._lock:
+            self._roll_day()
+            status = {
+                'total_keys': len(self.api_keys),
+                'current_key_index': self.current_key_index + 1,
+                'available_keys': 0,
+                'cooldown_keys': 0,
+                'quota_day': self._quota_day,
+                'requests_today': sum(budget.used_today for budget in self.budgets.values()),
+                'daily_capacity': self.rpd_limit * len(self.api_keys),
+                'keys_status': []
             }
+        
+            for i, key in enumerate(self.api_keys):
+                budget = self.budgets[key]
+                budget.can_spend()  # nạp lại token RPM trước khi báo cáo
+                key_status = {
+                    'index': i + 1,
+                    'key_preview': f"{key[:20]}..." if key else "None",
+                    'status': 'available',
+                    'is_current': i == self.current_key_index,
+                    'requests_today': budget.used_today,
+                    'remaining_today': budget.remaining_today(),
+                    'rpm_tokens': round(budget.tokens, 1),
+                    'in_flight': self.in_flight[key]
+                }
             
-            if self._is_key_in_cooldown(key):
-                key_status['status'] = 'cooldown'
-                failed_time = self.failed_keys[key]
-                remaining = failed_time + timedelta(minutes=self.cooldown_minutes) - datetime.now()
-                key_status['cooldown_remaining'] = f"{int(remaining.total_seconds() // 60)}m"
-                status['cooldown_keys'] += 1
-            else:
-                status['available_keys'] += 1
+                if self._is_key_in_cooldown(key):
+                    key_status['status'] = 'cooldown'
+                    failed_time = self.failed_keys[key]
+                    remaining = failed_time + timedelta(seconds=self.cooldown_seconds) - datetime.now()
+                    key_status['cooldown_remaining'] = f"{int(remaining.total_seconds())}s"
+                    status['cooldown_keys'] += 1
+                elif budget.remaining_today() == 0:
+                    key_status['status'] = 'daily_limit'
+                else:
+                    status['available_keys'] += 1
             
-            status['keys_status'].append(key_status)
+                status['keys_status'].append(key_status)
         
-        return status
+            return status
     
     def has_available_keys(self) -> bool:
         """Kiểm tra có API key nào khả dụng không"""
-        return len(self.api_keys) > 0 and any(
-            not self._is_key_in_cooldown(key) for key in self.api_keys
-        ) 
\ No newline at end of file
+        with self._lock:
+            return len(self.api_keys) > 0 and any(
+                not self._is_key_in_cooldown(key) for key in self.api_keys
+            ) 
\ No newline at end of file
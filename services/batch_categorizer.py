@@ -0,0 +1,122 @@
+import logging
+import os
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from services.category_memo import get_category_memo
+from services.category_rules import FALLBACK_CATEGORY, match_category
+
+logger = logging.getLogger(__name__)
+
+
+class BatchCategorizer:
+    """
+    Phân loại nhiều mô tả giao dịch cùng lúc (import, phân loại lại)
+
+    1. Memo mô tả → danh mục (danh mục user giữ trên sheet trước), rồi luật
+       từ khóa cục bộ (không tốn quota AI).
+    2. Mô tả còn lại được gộp (bỏ trùng) và gửi cho AI theo lô qua
+       GeminiAIService.categorize_batch - 1 lệnh gọi cho nhiều mô tả.
+    3. Hết ngân sách AI, AI lỗi hoặc trả danh mục không hợp lệ → "Khác".
+    """
+
+    def __init__(self, ai_service=None, batch_size: int = None, max_ai_calls: int = None,
+                 ai_calls_per_minute: float = None):
+        """
+        Args:
+            ai_service: GeminiAIService (None = chỉ dùng luật cục bộ)
+            batch_size: Số mô tả tối đa mỗi lệnh gọi AI (lô còn bị chia nhỏ nếu prompt quá dài)
+            max_ai_calls: Ngân sách lệnh gọi AI cho cả phiên (None = không giới hạn)
+            ai_calls_per_minute: Giãn cách lệnh gọi AI để không vượt RPM của key
+        """
+        self.ai_service = ai_service
+        self.batch_size = batch_size or int(os.getenv('AI_CATEGORIZE_BATCH_SIZE', 40))
+        self.max_ai_calls = max_ai_calls
+        rpm = ai_calls_per_minute or float(os.getenv('AI_CATEGORIZE_CALLS_PER_MINUTE', 10))
+        self._min_interval = 60.0 / rpm if rpm > 0 else 0
+        self._last_call = 0.0
+        # Kết quả AI trong phiên - mô tả lặp lại ở lô sau không phải hỏi lại
+        self._memo: Dict[Tuple[str, str], str] = {}
+
+        self.stats = Counter()
+
+    def ai_budget_left(self) -> Optional[int]:
+        """Số lệnh gọi AI còn lại (None = không giới hạn)"""
+        if self.max_ai_calls is None:
+            return None
+        return max(self.max_ai_calls - self.stats['ai_calls'], 0)
+
+    def _ai_available(self) -> bool:
+        if not self.ai_service or not self.ai_service.is_enabled():
+            return False
+        budget = self.ai_budget_left()
+        return budget is None or budget > 0
+
+    def categorize(self, items: Sequence[Tuple[str, str]], user_key: str = None) -> List[str]:
+        """
+        Phân loại danh sách giao dịch
+
+        Args:
+            items: [(transaction_type, description)] với transaction_type là 'Thu'/'Chi'
+            user_key: Key sổ giao dịch của user (StorageBackend.get_user_key) để ưu tiên danh mục user đã dùng
+
+        Returns:
+            List[str]: Danh mục theo đúng thứ tự đầu vào
+        """
+        results: List[Optional[str]] = [None] * len(items)
+        # (loại, mô tả chuẩn hóa) → vị trí cần điền; mô tả trùng chỉ hỏi AI 1 lần
+        pending: Dict[Tuple[str, str], List[int]] = {}
+        originals: Dict[Tuple[str, str], str] = {}
+        memo = get_category_memo()
+
+        for index, (transaction_type, description) in enumerate(items):
+            category = memo.lookup(transaction_type, description, user_key) or match_category(description, transaction_type)
+            if category:
+                results[index] = category
+                self.stats['local'] += 1
+                continue
+            key = (transaction_type, ' '.join(str(description or '').lower().split()))
+            if not key[1]:
+                continue
+            if key in self._memo:
+                results[index] = self._memo[key]
+                self.stats['ai'] += 1
+                continue
+            pending.setdefault(key, []).append(index)
+            originals.setdefault(key, str(description).strip())
+
+        for transaction_type in ('Chi', 'Thu'):
+            keys = [key for key in pending if key[0] == transaction_type]
+            if not keys or not self._ai_available():
+                continue
+            descriptions = [originals[key] for key in keys]
+            for batch in self.ai_service.split_category_batches(descriptions, max_items=self.batch_size):
+                if not self._ai_available():
+                    break
+                categories = self._ask_ai(transaction_type, [descriptions[index] for index in batch])
+                for index, category in zip(batch, categories):
+                    if not category:
+                        continue
+                    key = keys[index]
+                    self._memo[key] = category
+                    for position in pending[key]:
+                        results[position] = category
+                    self.stats['ai'] += len(pending[key])
+
+        fallback = sum(1 for category in results if category is None)
+        self.stats['fallback'] += fallback
+        return [category or FALLBACK_CATEGORY for category in results]
+
+    def _ask_ai(self, transaction_type: str, descriptions: List[str]) -> List[Optional[str]]:
+        """Một lệnh gọi AI cho cả lô mô tả, trả về danh mục theo thứ tự (None nếu không hợp lệ)"""
+        # Giãn cách giữa các lệnh gọi để không đốt hết RPM của key đang dùng cho chat
+        wait = self._last_call + self._min_interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self._last_call = time.monotonic()
+        self.stats['ai_calls'] += 1
+
+        categories = self.ai_service.categorize_batch(descriptions, transaction_type)
+        self.stats['ai_invalid'] += sum(1 for category in categories if category is None)
+        return categories
@@ -0,0 +1,211 @@
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_TYPES = ('Thu', 'Chi')
+
+
+class CategoryIndex:
+    """
+    Index danh mục của từng worksheet: số lần dùng và ngày dùng gần nhất
+
+    Lưu trong SQLite, tách theo nguồn (worksheet đang dùng và từng archive năm cũ)
+    để mỗi lần cache tải lại một worksheet chỉ cần dựng lại phần của worksheet đó.
+    Được cập nhật khi ghi giao dịch, khi cache tải lại worksheet và khi đọc toàn
+    bộ, nên lệnh "danh mục" không cần gọi Google Sheets API.
+    """
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or os.getenv('CATEGORY_INDEX_PATH', 'category_index.db')
+        self._lock = threading.Lock()
+        self._init_db()
+        # Worksheet đã index đầy đủ (mọi nguồn) - tra cứu O(1) khi ghi giao dịch
+        self._indexed = self._load_indexed()
+        logger.info(f"📂 Loaded index danh mục của {len(self._indexed)} worksheet")
+
+    @staticmethod
+    def make_key(sheet_id: str, worksheet_title: str) -> str:
+        """Key của một worksheet trong index"""
+        return f"{sheet_id}:{worksheet_title}"
+
+    @staticmethod
+    def _default_source(key: str) -> str:
+        """Nguồn mặc định của key là worksheet đang dùng"""
+        return key.split(':', 1)[1] if ':' in key else key
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _init_db(self):
+        """Tạo bảng index nếu chưa có"""
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS category_usage (
+                    user_key TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    category TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    last_used TEXT,
+                    PRIMARY KEY (user_key, source, type, category)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS indexed_worksheets (
+                    user_key TEXT PRIMARY KEY,
+                    indexed_at TEXT NOT NULL
+                )
+            """)
+
+    def _load_indexed(self) -> set:
+        with self._connect() as conn:
+            return {row[0] for row in conn.execute("SELECT user_key FROM indexed_worksheets")}
+
+    def has(self, key: str) -> bool:
+        """Worksheet đã được index chưa"""
+        with self._lock:
+            return key in self._indexed
+
+    @staticmethod
+    def _aggregate(transactions: List[Dict]) -> Dict[tuple, List]:
+        """{(loại, danh mục): [số lần, ngày dùng gần nhất]}"""
+        usage = {}
+        for transaction in transactions:
+            transaction_type = transaction.get('type')
+            category = transaction.get('category')
+            if transaction_type not in TRANSACTION_TYPES or not category:
+                continue
+            used = transaction['date'].strftime("%Y-%m-%d")
+            entry = usage.setdefault((transaction_type, category), [0, used])
+            entry[0] += 1
+            if used > entry[1]:
+                entry[1] = used
+        return usage
+
+    @staticmethod
+    def _add_usage(conn: sqlite3.Connection, key: str, source: str, usage: Dict[tuple, List]):
+        conn.executemany(
+            """
+            INSERT INTO category_usage (user_key, source, type, category, count, last_used)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_key, source, type, category) DO UPDATE SET
+                count = count + excluded.count,
+                last_used = MAX(COALESCE(last_used, ''), excluded.last_used)
+            """,
+            [(key, source, transaction_type, category, count, last_used)
+             for (transaction_type, category), (count, last_used) in usage.items()]
+        )
+
+    def record(self, key: str, transaction_type: str, category: str, used_at: datetime = None):
+        """
+        Ghi nhận một giao dịch mới (1 lệnh UPSERT)
+
+        Chỉ cập nhật worksheet đã được index đầy đủ - worksheet chưa index
+        sẽ được dựng lại từ lần đọc toàn bộ đầu tiên.
+        """
+        self.record_many(key, [{'type': transaction_type, 'category': category, 'date': used_at or datetime.now()}])
+
+    def record_many(self, key: str, transactions: List[Dict]):
+        """Ghi nhận nhiều giao dịch (import) vào worksheet đang dùng trong 1 transaction"""
+        if not self.has(key):
+            return
+        usage = self._aggregate(transactions)
+        if not usage:
+            return
+        try:
+            with self._connect() as conn:
+                self._add_usage(conn, key, self._default_source(key), usage)
+        except Exception as e:
+            logger.error(f"❌ Lỗi ghi index danh mục: {e}")
+
+    def rebuild(self, key: str, transactions_by_source: Dict[str, List[Dict]]):
+        """
+        Dựng lại toàn bộ index của worksheet (đọc full worksheet + mọi archive)
+
+        Args:
+            transactions_by_source: {tên worksheet/archive: giao dịch của nó}
+        """
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM category_usage WHERE user_key = ?", (key,))
+                for source, transactions in transactions_by_source.items():
+                    self._add_usage(conn, key, source, self._aggregate(transactions))
+                conn.execute(
+                    "INSERT OR REPLACE INTO indexed_worksheets (user_key, indexed_at) VALUES (?, ?)",
+                    (key, datetime.now().isoformat(timespec='seconds'))
+                )
+        except Exception as e:
+            logger.error(f"❌ Lỗi dựng index danh mục: {e}")
+            return
+
+        with self._lock:
+            self._indexed.add(key)
+        total = sum(len(transactions) for transactions in transactions_by_source.values())
+        logger.info(f"📂 Đã index danh mục từ {total} giao dịch ({len(transactions_by_source)} worksheet)")
+
+    def rebuild_source(self, key: str, source: str, transactions: List[Dict]):
+        """
+        Dựng lại phần index của một worksheet/archive (cache vừa tải lại worksheet đó)
+
+        Bỏ qua nếu worksheet chưa index đầy đủ (thiếu các nguồn còn lại).
+        """
+        if not self.has(key):
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM category_usage WHERE user_key = ? AND source = ?", (key, source))
+                self._add_usage(conn, key, source, self._aggregate(transactions))
+        except Exception as e:
+            logger.error(f"❌ Lỗi cập nhật index danh mục: {e}")
+
+    def invalidate(self, key: str):
+        """Xóa index của worksheet (dữ liệu bị sửa hàng loạt) - sẽ dựng lại ở lần đọc toàn bộ tiếp theo"""
+        with self._lock:
+            self._indexed.discard(key)
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM indexed_worksheets WHERE user_key = ?", (key,))
+                conn.execute("DELETE FROM category_usage WHERE user_key = ?", (key,))
+        except Exception as e:
+            logger.error(f"❌ Lỗi xóa index danh mục: {e}")
+
+    def get_entries(self, key: str) -> Optional[Dict[str, List[Dict]]]:
+        """
+        Lấy danh mục kèm số lần dùng, sắp xếp theo mức độ sử dụng
+
+        Returns:
+            Dict: {'Thu': [{'category', 'count', 'last_used'}], 'Chi': [...]}, None nếu chưa index
+        """
+        if not self.has(key):
+            return None
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT type, category, SUM(count), MAX(last_used) FROM category_usage "
+                "WHERE user_key = ? GROUP BY type, category ORDER BY SUM(count) DESC, category",
+                (key,)
+            ).fetchall()
+
+        result = {transaction_type: [] for transaction_type in TRANSACTION_TYPES}
+        for transaction_type, category, count, last_used in rows:
+            if transaction_type in result:
+                result[transaction_type].append({'category': category, 'count': count, 'last_used': last_used})
+        return result
+
+
+_index: Optional[CategoryIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_category_index() -> CategoryIndex:
+    """Lấy index danh mục dùng chung của process"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = CategoryIndex()
+        return _index
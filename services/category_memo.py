@@ -0,0 +1,204 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, Optional
+
+from services.category_rules import FALLBACK_CATEGORY
+from services.intent_cache import normalize_message
+from utils.json_utils import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+
+class CategoryMemo:
+    """
+    Bộ nhớ mô tả → danh mục, trả lời trước khi phải gọi AI
+
+    - Global: danh mục đã dùng cho mỗi mô tả (từ AI, luật cục bộ) kèm số lần.
+    - Theo user: danh mục user thực sự giữ trong sheet của mình (học lại mỗi lần
+      đọc toàn bộ worksheet), nên sửa tay "Khác" → "Ăn uống" trên sheet sẽ được nhớ.
+    User override được ưu tiên hơn global.
+
+    File memo (CATEGORY_MEMO_FILE) được thread nền ghi nguyên tử mỗi
+    CATEGORY_MEMO_SAVE_SECONDS giây nếu có thay đổi và khi thoát - remember()
+    trên đường xử lý tin nhắn chỉ cập nhật bộ nhớ.
+    """
+
+    def __init__(self, memo_file: str = None):
+        self.memo_file = memo_file or os.getenv('CATEGORY_MEMO_FILE', 'category_memo.json')
+        self.max_entries = int(os.getenv('CATEGORY_MEMO_MAX_ENTRIES', 20000))
+        self.max_per_user = int(os.getenv('CATEGORY_MEMO_MAX_PER_USER', 2000))
+        self.save_seconds = float(os.getenv('CATEGORY_MEMO_SAVE_SECONDS', 5))
+
+        self._lock = threading.Lock()
+        self._stats = Counter()
+        data = self._load_memo()
+        # "Chi|bún bò" → {"Ăn uống": 12}
+        self._global: Dict[str, Dict[str, int]] = data.get('global', {})
+        # user key → {"Chi|bún bò": "Ăn uống"}
+        self._users: Dict[str, Dict[str, str]] = data.get('users', {})
+
+        # Memo đổi sau lần lưu cuối - thread nền ghi file
+        self._dirty = False
+        self._save_lock = threading.Lock()
+        self._flusher = None
+        atexit.register(self.flush)
+
+    @staticmethod
+    def make_key(transaction_type: str, description: str) -> str:
+        """Key của một mô tả giao dịch"""
+        return f"{transaction_type}|{normalize_message(description)}"
+
+    def _load_memo(self) -> Dict:
+        """Load memo từ file JSON"""
+        try:
+            if os.path.exists(self.memo_file):
+                with open(self.memo_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                    logger.info(f"📂 Loaded memo danh mục: {len(data.get('global', {}))} mô tả, "
+                                f"{len(data.get('users', {}))} user")
+                    return data
+        except Exception as e:
+            logger.error(f"❌ Lỗi load memo danh mục: {e}")
+        return {}
+
+    def _mark_dirty(self):
+        """Memo vừa đổi - hẹn thread nền lưu xuống file (gọi khi đang giữ lock)"""
+        self._dirty = True
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name="category-memo-save", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.save_seconds)
+            self.flush()
+
+    def flush(self):
+        """Lưu memo vào file JSON nếu có thay đổi (ghi file ngoài lock của memo)"""
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                # Bộ đếm global được cộng tại chỗ - chép từng dict; memo của user chỉ bị thay cả dict
+                data = {
+                    'global': {key: dict(counts) for key, counts in self._global.items()},
+                    'users': dict(self._users)
+                }
+                self._dirty = False
+            try:
+                write_json_atomic(self.memo_file, data)
+            except Exception as e:
+                logger.error(f"❌ Lỗi lưu memo danh mục: {e}")
+                with self._lock:
+                    self._dirty = True
+
+    def lookup(self, transaction_type: str, description: str, user_key: str = None) -> Optional[str]:
+        """
+        Danh mục đã biết của mô tả
+
+        Returns:
+            Optional[str]: Danh mục user giữ trong sheet, hoặc danh mục dùng nhiều nhất; None nếu chưa gặp
+        """
+        if not description:
+            return None
+        key = self.make_key(transaction_type, description)
+        with self._lock:
+            category = self._users.get(user_key, {}).get(key) if user_key else None
+            if category:
+                self._stats['user_hits'] += 1
+                return category
+            counts = self._global.get(key)
+            if counts:
+                self._stats['global_hits'] += 1
+                return max(counts.items(), key=lambda item: item[1])[0]
+            self._stats['misses'] += 1
+            return None
+
+    def get_user_category(self, user_key: str, transaction_type: str, description: str) -> Optional[str]:
+        """Danh mục user giữ trên sheet cho mô tả (None nếu user chưa dùng mô tả này)"""
+        if not user_key or not description:
+            return None
+        with self._lock:
+            return self._users.get(user_key, {}).get(self.make_key(transaction_type, description))
+
+    def remember(self, transaction_type: str, description: str, category: str):
+        """Ghi nhận danh mục của một mô tả (bỏ qua "Khác" - không mang thông tin)"""
+        if not description or not category or category == FALLBACK_CATEGORY:
+            return
+        key = self.make_key(transaction_type, description)
+        with self._lock:
+            counts = self._global.setdefault(key, {})
+            counts[category] = counts.get(category, 0) + 1
+            if len(self._global) > self.max_entries * 1.1:
+                self._prune_global()
+            self._mark_dirty()
+
+    def _prune_global(self):
+        """Giữ lại max_entries mô tả được dùng nhiều nhất (gọi khi đang giữ lock)"""
+        keep = sorted(self._global.items(), key=lambda item: sum(item[1].values()), reverse=True)[:self.max_entries]
+        self._global = dict(keep)
+
+    def learn_user(self, user_key: str, transactions: Iterable[Dict]):
+        """
+        Học danh mục user giữ trong sheet từ toàn bộ giao dịch của họ
+
+        Mỗi mô tả lấy danh mục xuất hiện nhiều nhất, giữ tối đa
+        max_per_user mô tả được dùng nhiều nhất.
+        """
+        usage = defaultdict(Counter)
+        for transaction in transactions:
+            category = transaction.get('category')
+            if transaction.get('type') not in ('Thu', 'Chi') or not category or category == FALLBACK_CATEGORY:
+                continue
+            usage[self.make_key(transaction['type'], transaction.get('note') or '')][category] += 1
+
+        with self._lock:
+            overrides = []
+            for key, counts in usage.items():
+                if key.endswith('|'):
+                    continue
+                category, count = counts.most_common(1)[0]
+                overrides.append((count, key, category))
+            overrides.sort(reverse=True)
+            learned = {key: category for _, key, category in overrides[:self.max_per_user]}
+            if learned == self._users.get(user_key, {}):
+                return
+            if learned:
+                self._users[user_key] = learned
+            else:
+                self._users.pop(user_key, None)
+            self._mark_dirty()
+
+        logger.info(f"🧠 Học {len(learned)} danh mục riêng của {user_key}")
+
+    def get_stats(self) -> Dict:
+        """Thống kê memo (số mô tả, tỉ lệ trả lời được)"""
+        with self._lock:
+            lookups = self._stats['user_hits'] + self._stats['global_hits'] + self._stats['misses']
+            hits = self._stats['user_hits'] + self._stats['global_hits']
+            return {
+                'descriptions': len(self._global),
+                'users': len(self._users),
+                'user_hits': self._stats['user_hits'],
+                'global_hits': self._stats['global_hits'],
+                'misses': self._stats['misses'],
+                'hit_rate': round(hits / lookups, 3) if lookups else 0.0
+            }
+
+
+_memo: Optional[CategoryMemo] = None
+_memo_lock = threading.Lock()
+
+
+def get_category_memo() -> CategoryMemo:
+    """Lấy memo danh mục dùng chung của process"""
+    global _memo
+    with _memo_lock:
+        if _memo is None:
+            _memo = CategoryMemo()
+        return _memo
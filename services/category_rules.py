@@ -0,0 +1,98 @@
+import re
+import unicodedata
+from typing import Dict, List, Optional
+
+FALLBACK_CATEGORY = "Khác"
+
+EXPENSE_CATEGORIES = ["Ăn uống", "Di chuyển", "Mua sắm", "Giải trí", "Y tế", "Học tập", "Nhà cửa", "Khác"]
+INCOME_CATEGORIES = ["Lương", "Thưởng", "Freelance", "Bán hàng", "Đầu tư", "Khác"]
+
+# Từ khóa → danh mục (khớp trọn từ, từ khóa dài được ưu tiên: "nhà hàng" thắng "nhà")
+EXPENSE_KEYWORDS: Dict[str, List[str]] = {
+    "Ăn uống": [
+        "bún", "phở", "cơm", "bánh", "bánh mì", "thịt", "tôm", "nướng", "luộc", "xào", "chiên",
+        "lẩu", "canh", "súp", "trà sữa", "cà phê", "cafe", "coffee", "bia", "rượu", "sinh tố",
+        "nước ngọt", "nhà hàng", "quán ăn", "quán nhậu", "buffet", "căng tin", "đi chợ",
+        "mua đồ ăn", "rau", "gạo", "trứng", "snack", "kẹo", "ăn sáng", "ăn trưa", "ăn tối",
+        "highlands", "starbucks", "phúc long", "kfc", "lotteria", "jollibee", "pizza",
+        "shopeefood", "grabfood", "baemin", "gofood"
+    ],
+    "Di chuyển": [
+        "xăng", "xăng xe", "đổ xăng", "vé xe", "xe buýt", "bus", "taxi", "grab", "gojek",
+        "xanhsm", "xe ôm", "gửi xe", "tiền xe", "phí đường", "cầu phí", "vetc", "epass",
+        "vé máy bay", "vietjet", "vietnam airlines", "bamboo airways", "petrolimex"
+    ],
+    "Mua sắm": [
+        "quần áo", "áo", "quần", "giày", "dép", "túi xách", "mỹ phẩm", "điện thoại", "laptop",
+        "máy tính", "tai nghe", "siêu thị", "shopee", "lazada", "tiki", "sendo", "winmart",
+        "coopmart", "bách hóa xanh", "circle k", "thế giới di động", "điện máy xanh", "uniqlo"
+    ],
+    "Giải trí": [
+        "xem phim", "phim", "game", "du lịch", "karaoke", "bar", "concert", "vui chơi",
+        "cgv", "lotte cinema", "galaxy cinema", "netflix", "spotify", "youtube premium", "steam"
+    ],
+    "Y tế": [
+        "thuốc", "khám bệnh", "khám răng", "nhổ răng", "nha khoa", "bác sĩ", "bệnh viện", "xét nghiệm", "phòng khám",
+        "pharmacity", "long châu", "an khang"
+    ],
+    "Học tập": [
+        "học phí", "khóa học", "sách", "sách vở", "văn phòng phẩm", "fahasa", "udemy", "coursera"
+    ],
+    "Nhà cửa": [
+        "tiền nhà", "thuê nhà", "tiền điện", "tiền nước", "điện nước", "internet", "wifi", "gas",
+        "sửa nhà", "sửa chữa", "evn", "fpt telecom", "vnpt", "viettel internet", "phí quản lý"
+    ],
+}
+
+INCOME_KEYWORDS: Dict[str, List[str]] = {
+    "Lương": ["lương", "salary", "payroll", "phụ cấp"],
+    "Thưởng": ["thưởng", "bonus", "lì xì"],
+    "Freelance": ["freelance", "làm thêm", "part-time", "dự án"],
+    "Bán hàng": ["bán hàng", "bán đồ", "doanh thu"],
+    "Đầu tư": ["cổ tức", "lãi tiết kiệm", "tiền lãi", "lãi suất", "chứng khoán", "crypto", "dividend", "interest"],
+}
+
+
+def strip_accents(text: str) -> str:
+    """Bỏ dấu tiếng Việt (sao kê ngân hàng thường không dấu)"""
+    text = text.replace('đ', 'd').replace('Đ', 'D')
+    return ''.join(c for c in unicodedata.normalize('NFD', text) if unicodedata.category(c) != 'Mn')
+
+
+def _compile(keywords: Dict[str, List[str]]) -> List[tuple]:
+    patterns = []
+    for category, words in keywords.items():
+        for word in words:
+            patterns.append((word, category, re.compile(rf"(?<!\w){re.escape(word)}(?!\w)")))
+            ascii_word = strip_accents(word)
+            # Từ không dấu ngắn dễ trùng nghĩa ("ca", "ga") - chỉ dùng từ dài hoặc nhiều chữ
+            if ascii_word != word and (len(ascii_word) >= 4 or ' ' in ascii_word):
+                patterns.append((ascii_word, category, re.compile(rf"(?<!\w){re.escape(ascii_word)}(?!\w)")))
+    return sorted(patterns, key=lambda item: len(item[0]), reverse=True)
+
+
+_EXPENSE_PATTERNS = _compile(EXPENSE_KEYWORDS)
+_INCOME_PATTERNS = _compile(INCOME_KEYWORDS)
+
+
+def get_valid_categories(transaction_type: str) -> List[str]:
+    """Danh mục hợp lệ theo loại giao dịch ('Thu' hoặc 'Chi')"""
+    return INCOME_CATEGORIES if transaction_type == 'Thu' else EXPENSE_CATEGORIES
+
+
+def match_category(description: str, transaction_type: str = 'Chi') -> Optional[str]:
+    """
+    Phân loại bằng từ khóa, không cần gọi AI
+
+    Returns:
+        Optional[str]: Danh mục, None nếu không chắc chắn (để AI quyết định)
+    """
+    if not description:
+        return None
+
+    text = description.lower()
+    patterns = _INCOME_PATTERNS if transaction_type == 'Thu' else _EXPENSE_PATTERNS
+    for _, category, pattern in patterns:
+        if pattern.search(text):
+            return category
+    return None
@@ -0,0 +1,155 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _option(value, env_name: str, default, cast):
+    """Tham số truyền vào (kể cả 0) hoặc giá trị từ biến môi trường"""
+    return cast(value if value is not None else os.getenv(env_name, default))
+
+
+class CircuitOpenError(Exception):
+    """Circuit đang mở - không gọi dịch vụ, xử lý cục bộ ngay"""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker cho một dịch vụ ngoài (Gemini)
+
+    - CLOSED: gọi bình thường, ghi kết quả N lệnh gọi gần nhất. Đủ mẫu mà tỉ lệ
+      lỗi hoặc tỉ lệ gọi chậm vượt ngưỡng thì chuyển OPEN.
+    - OPEN: từ chối ngay (CircuitOpenError) trong open_seconds - người dùng nhận
+      kết quả xử lý cục bộ thay vì chờ từng key hết hạn.
+    - HALF_OPEN: hết open_seconds thì cho từng lệnh thăm dò đi qua; đủ
+      probe_successes lần thành công (không chậm) liên tiếp thì CLOSED, lỗi thì OPEN lại.
+
+    Mỗi check() thành công phải đi kèm đúng một record() khi lệnh gọi kết thúc
+    (failed=None nếu không tính được) để giải phóng lượt thăm dò.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str = 'gemini', window_size: int = None, min_calls: int = None,
+                 error_rate: float = None, slow_call_seconds: float = None, slow_rate: float = None,
+                 open_seconds: float = None, probe_successes: int = None):
+        self.name = name
+        self.enabled = os.getenv('GEMINI_BREAKER', 'true').lower() == 'true'
+        self.window_size = _option(window_size, 'GEMINI_BREAKER_WINDOW', 20, int)
+        self.min_calls = _option(min_calls, 'GEMINI_BREAKER_MIN_CALLS', 5, int)
+        self.error_rate = _option(error_rate, 'GEMINI_BREAKER_ERROR_RATE', 0.5, float)
+        self.slow_call_seconds = _option(slow_call_seconds, 'GEMINI_BREAKER_SLOW_SECONDS', 8, float)
+        self.slow_rate = _option(slow_rate, 'GEMINI_BREAKER_SLOW_RATE', 0.5, float)
+        self.open_seconds = _option(open_seconds, 'GEMINI_BREAKER_OPEN_SECONDS', 30, float)
+        self.probe_successes = _option(probe_successes, 'GEMINI_BREAKER_PROBE_SUCCESSES', 2, int)
+
+        self.state = self.CLOSED
+        # (lỗi, chậm) của các lệnh gọi gần nhất khi CLOSED
+        self._window = deque(maxlen=self.window_size)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_ok = 0
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def check(self) -> bool:
+        """
+        Cho lệnh gọi đi qua hoặc raise CircuitOpenError
+
+        Returns:
+            bool: True nếu đây là lệnh thăm dò (HALF_OPEN: mỗi lúc một lệnh) - truyền lại cho record()
+        """
+        if not self.enabled:
+            return False
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    self._stats['rejected'] += 1
+                    raise CircuitOpenError(f"Circuit {self.name} đang mở")
+                self.state = self.HALF_OPEN
+                self._probe_ok = 0
+                logger.info(f"🔌 Circuit {self.name}: HALF_OPEN - gửi lệnh thăm dò")
+
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    self._stats['rejected'] += 1
+                    raise CircuitOpenError(f"Circuit {self.name} đang thăm dò")
+                self._probe_in_flight = True
+                self._stats['probes'] += 1
+                return True
+            return False
+
+    def record(self, seconds: float, failed: Optional[bool], probe: bool = False):
+        """
+        Ghi kết quả một lệnh gọi đã qua check()
+
+        failed=None: không tính - lệnh bị hủy giữa chừng, hoặc lỗi không phải do dịch vụ
+        (hết ngân sách cục bộ, request sai); chỉ giải phóng lượt thăm dò, kể cả lúc HALF_OPEN
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if probe:
+                self._probe_in_flight = False
+            if failed is None:
+                return
+
+            slow = seconds >= self.slow_call_seconds
+            if probe:
+                if self.state != self.HALF_OPEN:
+                    return
+                if failed or slow:
+                    self._open(f"thăm dò {'lỗi' if failed else f'chậm {seconds:.1f}s'}")
+                else:
+                    self._probe_ok += 1
+                    if self._probe_ok >= self.probe_successes:
+                        self.state = self.CLOSED
+                        self._window.clear()
+                        logger.info(f"✅ Circuit {self.name}: CLOSED - dịch vụ đã hồi phục")
+                return
+
+            if self.state != self.CLOSED:
+                # Lệnh bắt đầu trước khi circuit mở - kết quả không còn ý nghĩa
+                return
+            self._window.append((bool(failed), slow))
+            if len(self._window) < self.min_calls:
+                return
+            failures = sum(1 for error, _ in self._window if error)
+            slow_calls = sum(1 for _, is_slow in self._window if is_slow)
+            if failures / len(self._window) >= self.error_rate:
+                self._open(f"{failures}/{len(self._window)} lệnh gọi lỗi")
+            elif slow_calls / len(self._window) >= self.slow_rate:
+                self._open(f"{slow_calls}/{len(self._window)} lệnh gọi chậm hơn {self.slow_call_seconds:g}s")
+
+    def _open(self, reason: str):
+        """Chuyển OPEN (gọi khi đang giữ lock)"""
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._window.clear()
+        self._stats['opened'] += 1
+        logger.warning(f"🚨 Circuit {self.name}: OPEN {self.open_seconds:g}s ({reason}) - chuyển sang xử lý cục bộ")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Trạng thái circuit cho /health"""
+        with self._lock:
+            window = list(self._window)
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = round(max(self.open_seconds - (time.monotonic() - self._opened_at), 0), 1)
+            return {
+                'enabled': self.enabled,
+                'state': self.state,
+                'window_calls': len(window),
+                'window_errors': sum(1 for error, _ in window if error),
+                'window_slow': sum(1 for _, slow in window if slow),
+                'retry_in_seconds': retry_in,
+                'opened': self._stats.get('opened', 0),
+                'rejected': self._stats.get('rejected', 0),
+                'probes': self._stats.get('probes', 0),
+            }
@@ -1,102 +1,148 @@
-import google.generativeai as genai
+from google.ai import generativelanguage as glm
+import asyncio
 import os
 import logging
-from typing import Optional
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Dict, List, Optional, Sequence
 import json
-from services.api_key_manager import APIKeyManager
+from services.api_key_manager import APIKeyManager, KeyLease
+from services.circuit_breaker import CircuitBreaker, CircuitOpenError
+from services.category_rules import EXPENSE_KEYWORDS, FALLBACK_CATEGORY, INCOME_KEYWORDS, get_valid_categories
+from utils.json_utils import parse_json_lenient
 
 logger = logging.getLogger(__name__)
 
+
+class KeysExhaustedError(Exception):
+    """Đã thử hết API key mà không lệnh gọi nào thành công"""
+
+
+class KeyBudgetExhaustedError(KeysExhaustedError):
+    """Mọi key đã hết ngân sách RPM/RPD cục bộ - chưa gửi request nào, Gemini không lỗi"""
+
+
 class GeminiAIService:
-    """Service tích hợp Gemini AI với multiple API keys rotation"""
-    
+    """
+    Service tích hợp Gemini AI với multiple API keys rotation
+
+    Dùng chung cho cả process qua get_ai_service(): một APIKeyManager (key bị
+    đánh dấu hết quota thì mọi nơi đều bỏ qua) và một client cho mỗi key.
+    """
+
+    MODEL_NAME = 'gemini-1.5-flash'
+
     def __init__(self):
         self.api_manager = APIKeyManager()
-        self.model = None
-        self.current_api_key = None
-        self.enabled = False
-        
-        if self.api_manager.has_available_keys():
-            self._initialize_with_current_key()
-        else:
+        # API key → client Gemini riêng của key đó
+        self._clients: Dict[str, glm.GenerativeServiceClient] = {}
+        self._clients_lock = threading.Lock()
+        self.enabled = self.api_manager.has_available_keys()
+        # Hạn chót mỗi lệnh gọi Gemini - quá hạn thì hủy và thử key khác
+        self.timeout_seconds = float(os.getenv('GEMINI_TIMEOUT_SECONDS', 15))
+        # Hedging: lệnh gọi chậm hơn percentile độ trễ gần đây → gửi bản sao qua key khác
+        self.hedging = os.getenv('GEMINI_HEDGING', 'false').lower() == 'true'
+        self.hedge_percentile = float(os.getenv('GEMINI_HEDGE_PERCENTILE', 90))
+        self.hedge_default_delay = float(os.getenv('GEMINI_HEDGE_DELAY_SECONDS', 3))
+        self._latencies = deque(maxlen=200)
+        # Gemini lỗi/chậm liên tục thì ngắt mạch - tin nhắn xử lý cục bộ ngay, không chờ từng key
+        self.circuit = CircuitBreaker('gemini')
+        self._metrics = Counter()
+        self._metrics_lock = threading.Lock()
+        # Giới hạn một lệnh phân loại theo lô: số mô tả và độ dài prompt
+        self.categorize_batch_size = int(os.getenv('AI_CATEGORIZE_BATCH_SIZE', 40))
+        self.categorize_max_prompt_chars = int(os.getenv('AI_CATEGORIZE_MAX_PROMPT_CHARS', 6000))
+
+        if not self.enabled:
             logger.warning("⚠️  Không có API key khả dụng - tính năng AI sẽ bị vô hiệu hóa")
-    
-    def _initialize_with_current_key(self):
-        """Khởi tạo Gemini với API key hiện tại"""
-        try:
-            api_key = self.api_manager.get_current_api_key()
-            if not api_key:
-                self.enabled = False
-                return
-            
-            # Chỉ configure lại nếu key khác
-            if api_key != self.current_api_key:
-                genai.configure(api_key=api_key)
-                self.model = genai.GenerativeModel('gemini-1.5-flash')
-                self.current_api_key = api_key
-                
-                key_index = self.api_manager.api_keys.index(api_key) + 1
-                logger.info(f"🔑 Gemini AI khởi tạo với API Key {key_index}")
-            
-            self.enabled = True
-            
-        except Exception as e:
-            logger.error(f"❌ Lỗi khởi tạo Gemini AI: {e}")
-            self.enabled = False
-    
-    def categorize_expense(self, description: str) -> str:
+
+    @property
+    def current_api_key(self) -> Optional[str]:
+        """API key đang được ưu tiên dùng"""
+        return self.api_manager.get_current_api_key()
+
+    def _get_client(self, api_key: str) -> glm.GenerativeServiceClient:
         """
-        Phân loại khoản chi dựa trên mô tả
-        
-        Args:
-            description: Mô tả khoản chi (VD: "trà sữa", "đổ xăng", "mua áo")
-            
-        Returns:
-            str: Danh mục được phân loại
+        Client Gemini của một API key (tạo 1 lần, dùng lại cho mọi request)
+
+        Mỗi key một GenerativeServiceClient riêng thay vì genai.configure() - configure
+        là biến global, đổi key ở một thread sẽ đổi luôn key của request ở thread khác.
         """
-        if not self.enabled:
-            return "Khác"
-        
-        try:
-            prompt = f"""
-Hãy phân loại khoản chi tiêu sau vào một trong các danh mục phù hợp nhất:
+        with self._clients_lock:
+            client = self._clients.get(api_key)
+            if client is None:
+                client = glm.GenerativeServiceClient(client_options={'api_key': api_key})
+                self._clients[api_key] = client
 
-Mô tả: "{description}"
+                key_index = self.api_manager.api_keys.index(api_key) + 1
+                logger.info(f"🔑 Gemini AI khởi tạo với API Key {key_index}")
+            return client
 
-Danh sách danh mục có sẵn:
-- Ăn uống: đồ ăn, thức uống, nhà hàng, quán cà phê, trà sữa, bánh kẹo, nướng, luộc, xào, chiên, thịt, cá, gà, rau, củ, quả
-- Di chuyển: xăng xe, vé xe buýt, taxi, grab, đi lại, gửi xe, tiền xe, phí đường
-- Mua sắm: quần áo, giày dép, đồ dùng, mỹ phẩm, điện tử, laptop, điện thoại
-- Giải trí: xem phim, game, du lịch, karaoke, bar, concert, show
-- Y tế: thuốc, khám bệnh, nha khoa, bảo hiểm y tế, xét nghiệm
-- Học tập: sách vở, khóa học, học phí, văn phòng phẩm, giáo dục
-- Nhà cửa: tiền nhà, điện nước, internet, sửa chữa, gas, wifi
-- Khác: những thứ THỰC SỰ không thuộc 7 danh mục trên
+    @classmethod
+    def _contents(cls, prompt: str) -> List[glm.Content]:
+        return [glm.Content(role='user', parts=[glm.Part(text=prompt)])]
+
+    def count_tokens(self, prompt: str) -> int:
+        """Số token Gemini của prompt (dùng key đang được ưu tiên)"""
+        response = self._get_client(self.current_api_key).count_tokens(
+            request=glm.CountTokensRequest(model=f"models/{self.MODEL_NAME}", contents=self._contents(prompt)),
+            timeout=self.timeout_seconds
+        )
+        return response.total_tokens
 
-QUAN TRỌNG: "nướng", "luộc", "xào", "chiên" = NẤU ĂN → Ăn uống
+    @staticmethod
+    def _category_prompt(description: str, transaction_type: str) -> str:
+        """Prompt phân loại một mô tả - danh mục và ví dụ lấy từ category_rules"""
+        kind = "thu nhập" if transaction_type == 'Thu' else "chi tiêu"
+        keywords = INCOME_KEYWORDS if transaction_type == 'Thu' else EXPENSE_KEYWORDS
+        lines = [
+            f"- {category}: {', '.join(keywords[category][:12])}" if category in keywords
+            else f"- {category}: những khoản THỰC SỰ không thuộc các danh mục trên"
+            for category in get_valid_categories(transaction_type)
+        ]
+        hint = '\nQUAN TRỌNG: "nướng", "luộc", "xào", "chiên" = NẤU ĂN → Ăn uống\n' if transaction_type != 'Thu' else ''
+        return f"""
+Hãy phân loại khoản {kind} sau vào một trong các danh mục phù hợp nhất:
+
+Mô tả: "{description}"
 
+Danh sách danh mục có sẵn:
+{chr(10).join(lines)}
+{hint}
 Chỉ trả về TÊN DANH MỤC, không giải thích gì thêm.
 """
-            
-            response = self.model.generate_content(prompt)
-            category = response.text.strip()
-            
+
+    def _categorize_one(self, description: str, transaction_type: str) -> str:
+        """Phân loại một mô tả bằng AI (danh mục không hợp lệ thì trả về "Khác")"""
+        if not self.enabled:
+            return FALLBACK_CATEGORY
+
+        try:
+            category = self._generate_content(self._category_prompt(description, transaction_type))
+
             # Validate danh mục trả về
-            valid_categories = [
-                "Ăn uống", "Di chuyển", "Mua sắm", "Giải trí", 
-                "Y tế", "Học tập", "Nhà cửa", "Khác"
-            ]
-            
-            if category in valid_categories:
+            if category in get_valid_categories(transaction_type):
                 logger.info(f"AI phân loại '{description}' -> '{category}'")
                 return category
-            else:
-                logger.warning(f"AI trả về danh mục không hợp lệ: {category}")
-                return "Khác"
-                
+            logger.warning(f"AI trả về danh mục không hợp lệ: {category}")
+            return FALLBACK_CATEGORY
+
         except Exception as e:
             logger.error(f"Lỗi phân loại AI: {e}")
-            return "Khác"
+            return FALLBACK_CATEGORY
+
+    def categorize_expense(self, description: str) -> str:
+        """
+        Phân loại khoản chi dựa trên mô tả
+        
+        Args:
+            description: Mô tả khoản chi (VD: "trà sữa", "đổ xăng", "mua áo")
+            
+        Returns:
+            str: Danh mục được phân loại
+        """
+        return self._categorize_one(description, 'Chi')
     
     def categorize_income(self, description: str) -> str:
         """
@@ -108,45 +154,125 @@ Chỉ trả về TÊN DANH MỤC, không giải thích gì thêm.
         Returns:
             str: Danh mục được phân loại
         """
-        if not self.enabled:
-            return "Khác"
-        
-        try:
-            prompt = f"""
-Hãy phân loại khoản thu nhập sau vào một trong các danh mục phù hợp nhất:
+        return self._categorize_one(description, 'Thu')
+    
+    # Mô tả quá dài (sao kê ngân hàng) chỉ gửi phần đầu - đủ để phân loại
+    CATEGORIZE_DESCRIPTION_MAX_CHARS = 200
 
-Mô tả: "{description}"
+    def _category_batch_prompt(self, transaction_type: str, descriptions: Sequence[str]) -> str:
+        """Prompt phân loại một lô mô tả, đánh số từ 1"""
+        kind = "thu nhập" if transaction_type == 'Thu' else "chi tiêu"
+        numbered = "\n".join(
+            f"{i + 1}. {json.dumps(str(description)[:self.CATEGORIZE_DESCRIPTION_MAX_CHARS], ensure_ascii=False)}"
+            for i, description in enumerate(descriptions)
+        )
+        return f"""Phân loại từng khoản {kind} sau vào MỘT trong các danh mục: {", ".join(get_valid_categories(transaction_type))}
+"nướng", "luộc", "xào", "chiên" = NẤU ĂN → Ăn uống. "Khác" chỉ khi không thuộc danh mục nào.
 
-Danh sách danh mục có sẵn:
-- Lương: lương tháng, lương cơ bản, phụ cấp
-- Thưởng: thưởng tết, thưởng dự án, thưởng hiệu suất
-- Freelance: làm thêm, dự án cá nhân, part-time
-- Bán hàng: bán đồ, kinh doanh nhỏ lẻ
-- Đầu tư: cổ tức, lãi suất, crypto, chứng khoán
-- Khác: những khoản thu khác
+{numbered}
 
-Chỉ trả về TÊN DANH MỤC, không giải thích gì thêm.
-"""
-            
-            response = self.model.generate_content(prompt)
-            category = response.text.strip()
-            
-            # Validate danh mục trả về
-            valid_categories = [
-                "Lương", "Thưởng", "Freelance", "Bán hàng", "Đầu tư", "Khác"
-            ]
-            
-            if category in valid_categories:
-                logger.info(f"AI phân loại '{description}' -> '{category}'")
-                return category
-            else:
-                logger.warning(f"AI trả về danh mục không hợp lệ: {category}")
-                return "Khác"
-                
+Trả về JSON array, mỗi khoản một object {{"i": số thứ tự, "category": tên danh mục}}."""
+
+    def split_category_batches(self, descriptions: Sequence[str], max_items: int = None) -> List[List[int]]:
+        """
+        Chia mô tả thành các lô vừa một lệnh gọi AI
+
+        Mỗi lô không quá max_items mô tả (mặc định AI_CATEGORIZE_BATCH_SIZE) và
+        prompt không quá AI_CATEGORIZE_MAX_PROMPT_CHARS ký tự.
+
+        Returns:
+            List[List[int]]: Chỉ số mô tả của từng lô, giữ thứ tự đầu vào
+        """
+        max_items = max_items or self.categorize_batch_size
+        base_chars = len(self._category_batch_prompt('Chi', []))
+        batches, current, current_chars = [], [], base_chars
+        for index, description in enumerate(descriptions):
+            # Dòng "12. \"mô tả\"" - ước lượng theo độ dài JSON của mô tả
+            line_chars = len(json.dumps(str(description)[:self.CATEGORIZE_DESCRIPTION_MAX_CHARS],
+                                        ensure_ascii=False)) + 6
+            if current and (len(current) >= max_items or current_chars + line_chars > self.categorize_max_prompt_chars):
+                batches.append(current)
+                current, current_chars = [], base_chars
+            current.append(index)
+            current_chars += line_chars
+        if current:
+            batches.append(current)
+        return batches
+
+    def categorize_batch(self, descriptions: Sequence[str], transaction_type: str = 'Chi') -> List[Optional[str]]:
+        """
+        Phân loại nhiều mô tả, mỗi lô vừa prompt là một lệnh gọi AI
+
+        Args:
+            descriptions: Danh sách mô tả
+            transaction_type: 'Chi' hoặc 'Thu'
+
+        Returns:
+            List[Optional[str]]: Danh mục theo đúng thứ tự đầu vào; None nếu AI lỗi
+            hoặc trả danh mục không hợp lệ (người gọi tự chọn fallback)
+        """
+        results: List[Optional[str]] = [None] * len(descriptions)
+        if not self.enabled or not descriptions:
+            return results
+
+        for batch in self.split_category_batches(descriptions):
+            categories = self._categorize_chunk([descriptions[index] for index in batch], transaction_type)
+            for index, category in zip(batch, categories):
+                results[index] = category
+        return results
+
+    def _categorize_chunk(self, descriptions: List[str], transaction_type: str) -> List[Optional[str]]:
+        """Một lệnh gọi AI cho một lô, kết quả khớp theo số thứ tự"""
+        valid_categories = {category.lower(): category for category in get_valid_categories(transaction_type)}
+        schema = {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "i": {"type": "integer"},
+                    "category": {"type": "string", "enum": list(valid_categories.values())},
+                },
+                "required": ["i", "category"],
+            },
+        }
+        try:
+            response = self._generate_content(
+                self._category_batch_prompt(transaction_type, descriptions), response_schema=schema
+            )
         except Exception as e:
-            logger.error(f"Lỗi phân loại AI: {e}")
-            return "Khác"
-    
+            logger.error(f"❌ Lỗi phân loại AI theo lô ({len(descriptions)} mô tả): {e}")
+            return [None] * len(descriptions)
+
+        items, _ = parse_json_lenient(response)
+        if isinstance(items, dict):
+            items = next((value for value in items.values() if isinstance(value, list)), None)
+        if not isinstance(items, list):
+            logger.warning(f"⚠️ AI trả về kết quả phân loại không đọc được: {response[:200]}")
+            return [None] * len(descriptions)
+
+        results: List[Optional[str]] = [None] * len(descriptions)
+        for position, item in enumerate(items):
+            if isinstance(item, dict):
+                try:
+                    index = int(item.get('i')) - 1
+                except (TypeError, ValueError):
+                    continue
+                category = item.get('category')
+            elif len(items) == len(descriptions):
+                # Chỉ có tên danh mục - khớp theo vị trí khi đủ số lượng
+                index, category = position, item
+            else:
+                continue
+            if 0 <= index < len(descriptions):
+                results[index] = valid_categories.get(str(category or '').strip().lower())
+
+        invalid = sum(1 for category in results if category is None)
+        if invalid:
+            logger.warning(f"⚠️ AI không phân loại được {invalid}/{len(descriptions)} mô tả trong lô")
+        else:
+            logger.info(f"AI phân loại lô {len(descriptions)} mô tả {transaction_type}")
+        return results
+
     def is_enabled(self) -> bool:
         """Kiểm tra AI có được bật không"""
         return self.enabled
@@ -157,58 +283,341 @@ Chỉ trả về TÊN DANH MỤC, không giải thích gì thêm.
     
     def get_current_key_info(self) -> str:
         """Lấy thông tin API key hiện tại"""
-        if not self.current_api_key:
+        api_key = self.current_api_key
+        if not api_key:
             return "Không có API key"
         
         try:
-            key_index = self.api_manager.api_keys.index(self.current_api_key) + 1
-            return f"API Key {key_index} ({self.current_api_key[:20]}...)"
+            key_index = self.api_manager.api_keys.index(api_key) + 1
+            return f"API Key {key_index} ({api_key[:20]}...)"
         except:
             return "Unknown key"
     
-    def _generate_content(self, prompt: str) -> str:
-        """Helper method để generate content với auto key rotation"""
+    @classmethod
+    def _build_schema(cls, spec: Dict[str, Any]) -> glm.Schema:
+        """Chuyển schema dạng dict (OpenAPI rút gọn) sang glm.Schema"""
+        fields = {'type_': glm.Type[spec['type'].upper()], 'nullable': spec.get('nullable', False)}
+        if spec.get('properties'):
+            fields['properties'] = {name: cls._build_schema(item) for name, item in spec['properties'].items()}
+        if spec.get('required'):
+            fields['required'] = spec['required']
+        if spec.get('items'):
+            fields['items'] = cls._build_schema(spec['items'])
+        if spec.get('enum'):
+            fields['format_'] = 'enum'
+            fields['enum'] = spec['enum']
+        return glm.Schema(**fields)
+
+    def _json_generation_config(self, response_schema: Dict[str, Any]):
+        """Cấu hình bắt Gemini trả JSON đúng schema (None nếu SDK không hỗ trợ)"""
+        try:
+            return glm.GenerationConfig(
+                response_mime_type='application/json',
+                response_schema=self._build_schema(response_schema)
+            )
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            logger.warning(f"⚠️ Không bật được structured output ({e}) - cần google-generativeai>=0.7")
+            return None
+
+    @staticmethod
+    def _is_quota_error(error_msg: str) -> bool:
+        return any(keyword in error_msg.lower() for keyword in [
+            '429', 'quota', 'rate limit', 'exceeded', 'resource_exhausted'
+        ])
+
+    @classmethod
+    def _is_retryable_error(cls, error: BaseException) -> bool:
+        """Lỗi của riêng key/lần gọi đó (quota, quá hạn, server tạm lỗi) - thử key khác có thể thành công"""
+        if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+            return True
+        error_msg = str(error).lower()
+        return cls._is_quota_error(error_msg) or any(keyword in error_msg for keyword in [
+            'deadline', 'timed out', 'timeout', 'unavailable', 'internal error'
+        ])
+
+    def _call_model(self, api_key: str, prompt: str, generation_config=None, timeout: float = None) -> str:
+        """Một lệnh gọi Gemini bằng một key (đồng bộ, có deadline phía gRPC)"""
+        request = glm.GenerateContentRequest(model=f"models/{self.MODEL_NAME}", contents=self._contents(prompt))
+        if generation_config is not None:
+            request.generation_config = generation_config
+        response = self._get_client(api_key).generate_content(request=request, timeout=timeout or self.timeout_seconds)
+        if not response.candidates:
+            raise ValueError(f"Gemini không trả kết quả: {response.prompt_feedback}")
+        return "".join(part.text for part in response.candidates[0].content.parts).strip()
+
+    def _handle_call_error(self, error: BaseException, attempt: int):
+        """Ghi nhận lỗi của một lần gọi; raise lại nếu đổi key cũng không giúp được"""
+        error_msg = str(error) or type(error).__name__
+        logger.error(f"🚫 Lỗi generate content (attempt {attempt + 1}): {error_msg}")
+
+        if not self._is_retryable_error(error):
+            raise error
+
+    def _generate_content(self, prompt: str, response_schema: Dict[str, Any] = None) -> str:
+        """
+        Helper method để generate content với auto key rotation
+
+        Args:
+            prompt: Prompt gửi Gemini
+            response_schema: Schema JSON của kết quả - có thì Gemini trả JSON đúng schema
+
+        Raises:
+            CircuitOpenError: Gemini đang lỗi/chậm (circuit mở) - người gọi xử lý cục bộ ngay
+        """
         if not self.enabled:
             return ""
-        
-        max_retries = len(self.api_manager.api_keys) if self.api_manager.api_keys else 1
-        
-        for attempt in range(max_retries):
+
+        probe = self._enter_circuit()
+        started = time.monotonic()
+        failed = None
+        try:
+            text = self._generate_with_rotation(prompt, response_schema)
+            failed = False
+            return text
+        except Exception as e:
+            failed = self._circuit_outcome(e)
+            raise
+        finally:
+            self.circuit.record(time.monotonic() - started, failed, probe)
+
+    def _generate_with_rotation(self, prompt: str, response_schema: Dict[str, Any] = None) -> str:
+        """Gọi Gemini, lỗi tạm thời thì thử key kế tiếp"""
+        generation_config = self._json_generation_config(response_schema) if response_schema else None
+        tried = set()
+
+        for attempt in range(max(len(self.api_manager.api_keys), 1)):
+            lease = self.api_manager.acquire_key(tried)
+            if not lease:
+                logger.warning("⚠️  Không còn API key khả dụng cho request này")
+                break
+            tried.add(lease.api_key)
+
             try:
-                # Đảm bảo có API key khả dụng
-                if not self.api_manager.has_available_keys():
-                    logger.warning("⚠️  Tất cả API keys đều trong cooldown")
-                    break
-                
-                # Reinitialize nếu cần
-                self._initialize_with_current_key()
-                
-                if not self.enabled or not self.model:
-                    break
-                
-                # Thử generate content
-                response = self.model.generate_content(prompt)
-                return response.text.strip()
-                
+                started = time.monotonic()
+                self._count_metric('model_requests')
+                text = self._call_model(lease.api_key, prompt, generation_config)
+                self._record_latency(time.monotonic() - started)
+                return text
             except Exception as e:
-                error_msg = str(e)
-                logger.error(f"🚫 Lỗi generate content (attempt {attempt + 1}): {error_msg}")
-                
-                # Đánh dấu key hiện tại failed và rotate
-                if self.current_api_key:
-                    self.api_manager.mark_key_failed(self.current_api_key, error_msg)
-                
-                # Nếu không phải lỗi quota, không retry
-                is_quota_error = any(keyword in error_msg.lower() for keyword in [
-                    '429', 'quota', 'rate limit', 'exceeded', 'resource_exhausted'
-                ])
-                
-                if not is_quota_error:
-                    raise e
-                
-                # Thử key tiếp theo
-                continue
-        
+                # Đánh dấu đúng key vừa dùng (key hiện tại có thể đã bị thread khác đổi)
+                self.api_manager.release_key(lease, e)
+                self._handle_call_error(e, attempt)
+            finally:
+                self.api_manager.release_key(lease)
+
         # Hết tất cả attempts
+        self._raise_keys_exhausted(tried)
+
+    async def generate_content_async(self, prompt: str, response_schema: Dict[str, Any] = None,
+                                     timeout: float = None) -> str:
+        """
+        Bản async của _generate_content cho handler - không chặn event loop
+
+        Mỗi lần gọi chạy trong thread riêng với hạn chót GEMINI_TIMEOUT_SECONDS
+        (asyncio.wait_for phía bot + deadline gRPC phía request, nên lệnh gọi treo
+        thực sự bị hủy chứ không chạy ngầm mãi). Quá hạn, hết quota hoặc server tạm
+        lỗi thì thử key kế tiếp; lỗi khác (prompt sai, bị chặn) raise ngay.
+        Task bị hủy (user gửi tin mới, bot tắt) thì CancelledError được truyền ra.
+        GEMINI_HEDGING=true: xem _hedged_call.
+        Circuit mở thì raise CircuitOpenError ngay, không chờ key nào.
+        """
+        if not self.enabled:
+            return ""
+
+        probe = self._enter_circuit()
+        started = time.monotonic()
+        failed = None
+        try:
+            text = await self._generate_with_rotation_async(prompt, response_schema, timeout or self.timeout_seconds)
+            failed = False
+            return text
+        except Exception as e:
+            failed = self._circuit_outcome(e)
+            raise
+        finally:
+            # CancelledError không phải Exception - failed=None, chỉ trả lượt thăm dò
+            self.circuit.record(time.monotonic() - started, failed, probe)
+
+    async def _generate_with_rotation_async(self, prompt: str, response_schema: Optional[Dict[str, Any]],
+                                            timeout: float) -> str:
+        """Bản async của _generate_with_rotation"""
+        generation_config = self._json_generation_config(response_schema) if response_schema else None
+        tried = set()
+
+        for attempt in range(max(len(self.api_manager.api_keys), 1)):
+            lease = self.api_manager.acquire_key(tried)
+            if not lease:
+                logger.warning("⚠️  Không còn API key khả dụng cho request này")
+                break
+            tried.add(lease.api_key)
+
+            try:
+                if self.hedging:
+                    return await self._hedged_call(lease, tried, prompt, generation_config, timeout)
+                return await self._timed_call(lease, prompt, generation_config, timeout)
+            except asyncio.TimeoutError as e:
+                logger.warning(f"⏱️ Gemini quá {timeout:g}s (attempt {attempt + 1}) - thử key khác")
+                self._handle_call_error(e, attempt)
+            except Exception as e:
+                self._handle_call_error(e, attempt)
+
+        self._raise_keys_exhausted(tried)
+
+    def _enter_circuit(self) -> bool:
+        """Đếm lệnh gọi và hỏi circuit breaker (raise CircuitOpenError nếu đang mở)"""
+        try:
+            probe = self.circuit.check()
+        except CircuitOpenError:
+            self._count_metric('short_circuited')
+            raise
+        self._count_metric('calls')
+        return probe
+
+    def _raise_keys_exhausted(self, tried: set):
+        """Hết key: chưa thử key nào là do ngân sách cục bộ (tự giới hạn), không phải Gemini lỗi"""
+        if not tried:
+            self._count_metric('budget_exhausted')
+            raise KeyBudgetExhaustedError("All API keys are over their local RPM/RPD budget")
         logger.error("❌ Đã thử hết tất cả API keys")
-        raise Exception("All API keys exhausted")
\ No newline at end of file
+        raise KeysExhaustedError("All API keys exhausted")
+
+    def _circuit_outcome(self, error: BaseException) -> Optional[bool]:
+        """
+        Kết quả ghi vào circuit breaker cho một lệnh gọi lỗi
+
+        True: lỗi do Gemini (quá hạn, quá tải, mọi key đã thử đều lỗi).
+        None: không tính - hết ngân sách key cục bộ (bot tự giới hạn khi tải cao) hoặc
+        lỗi do request (400, prompt bị chặn): không nói gì về sức khỏe Gemini, kể cả
+        khi là lệnh thăm dò lúc HALF_OPEN.
+        """
+        if isinstance(error, KeyBudgetExhaustedError):
+            return None
+        if isinstance(error, KeysExhaustedError) or self._is_retryable_error(error):
+            return True
+        return None
+
+    async def _timed_call(self, lease: KeyLease, prompt: str, generation_config, timeout: float) -> str:
+        """Một lệnh gọi async có hạn chót bằng key đã mượn; trả key kèm kết quả khi xong"""
+        started = time.monotonic()
+        self._count_metric('model_requests')
+        try:
+            text = await asyncio.wait_for(
+                asyncio.to_thread(self._call_model, lease.api_key, prompt, generation_config, timeout),
+                timeout=timeout
+            )
+        except Exception as e:
+            self.api_manager.release_key(lease, e)
+            raise
+        finally:
+            # Bị hủy (thua hedge, user gửi tin mới) thì trả key không tính lỗi
+            self.api_manager.release_key(lease)
+        self._record_latency(time.monotonic() - started)
+        return text
+
+    async def _hedged_call(self, lease: KeyLease, tried: set, prompt: str, generation_config, timeout: float) -> str:
+        """
+        Gọi bằng api_key; quá hedge_delay() chưa xong thì gửi bản sao qua key khác
+
+        Kết quả thành công đầu tiên được dùng, lệnh còn lại bị hủy (deadline gRPC
+        chặn thread của nó). Mỗi bản sao tốn thêm 1 request quota - xem get_metrics().
+        Cả hai đều lỗi thì raise lỗi của lệnh chính.
+        """
+        primary = self._leased_task(lease, prompt, generation_config, timeout)
+        pending = {primary}
+        hedge = None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_delay())
+            if done:
+                return primary.result()
+
+            hedge_lease = self.api_manager.acquire_key(tried)
+            if hedge_lease:
+                tried.add(hedge_lease.api_key)
+                self._count_metric('hedged')
+                logger.info(f"🏁 Gemini chậm hơn {self.hedge_delay():.1f}s - gửi thêm bản sao qua key khác")
+                hedge = self._leased_task(hedge_lease, prompt, generation_config, timeout)
+                pending.add(hedge)
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._count_metric('hedge_wins')
+                        return task.result()
+                    # Lỗi của bản sao đã ghi nhận cho key đó khi trả key - vẫn chờ lệnh chính
+            return primary.result()
+        finally:
+            # Bên thua (hoặc cả hai khi task gọi bị hủy) không được chạy tiếp
+            for task in pending:
+                task.cancel()
+                # Bản sao thua/bị hủy và lệnh chính bị hủy (thua hedge, user gửi tin mới) đếm riêng
+                self._count_metric('hedge_cancelled' if task is hedge else 'primary_cancelled')
+
+    def _leased_task(self, lease: KeyLease, prompt: str, generation_config, timeout: float) -> asyncio.Task:
+        """Chạy _timed_call thành task; task bị hủy trước khi kịp chạy vẫn trả key"""
+        task = asyncio.ensure_future(self._timed_call(lease, prompt, generation_config, timeout))
+        task.add_done_callback(lambda _: self.api_manager.release_key(lease))
+        return task
+
+    def hedge_delay(self) -> float:
+        """Thời gian chờ trước khi gửi bản sao: percentile độ trễ gần đây (mặc định khi chưa đủ mẫu)"""
+        with self._metrics_lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < 20:
+            return self.hedge_default_delay
+        index = min(int(len(latencies) * self.hedge_percentile / 100), len(latencies) - 1)
+        return max(latencies[index], 0.2)
+
+    def _record_latency(self, seconds: float):
+        with self._metrics_lock:
+            self._latencies.append(seconds)
+
+    def _count_metric(self, name: str):
+        with self._metrics_lock:
+            self._metrics[name] += 1
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Độ trễ, tỉ lệ hedge và số request thực gửi (chi phí quota) của các lệnh gọi Gemini"""
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+            latencies = sorted(self._latencies)
+
+        def percentile(value: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(int(len(latencies) * value / 100), len(latencies) - 1)], 3)
+
+        calls = metrics.get('calls', 0)
+        return {
+            'hedging': self.hedging,
+            'calls': calls,
+            'model_requests': metrics.get('model_requests', 0),
+            'hedged': metrics.get('hedged', 0),
+            'hedge_wins': metrics.get('hedge_wins', 0),
+            'hedge_cancelled': metrics.get('hedge_cancelled', 0),
+            'primary_cancelled': metrics.get('primary_cancelled', 0),
+            'hedge_rate': round(metrics.get('hedged', 0) / calls, 3) if calls else 0.0,
+            # Request thực gửi trên mỗi lệnh gọi (>1 do retry + hedge) - tỉ lệ quota tốn thêm
+            'requests_per_call': round(metrics.get('model_requests', 0) / calls, 3) if calls else 0.0,
+            'hedge_delay': round(self.hedge_delay(), 3),
+            'latency_p50': percentile(50),
+            'latency_p90': percentile(90),
+            'latency_p99': percentile(99),
+            'short_circuited': metrics.get('short_circuited', 0),
+            'budget_exhausted': metrics.get('budget_exhausted', 0),
+            'circuit': self.circuit.get_stats(),
+        }
+
+
+_ai_service: Optional[GeminiAIService] = None
+_ai_service_lock = threading.Lock()
+
+
+def get_ai_service() -> GeminiAIService:
+    """Lấy AI service dùng chung của process"""
+    global _ai_service
+    with _ai_service_lock:
+        if _ai_service is None:
+            _ai_service = GeminiAIService()
+        return _ai_service
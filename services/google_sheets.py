@@ -1,91 +1,156 @@
 import gspread
-from google.oauth2.service_account import Credentials
 import os
 from datetime import datetime, timedelta
 import logging
-from typing import List, Dict, Optional
-from collections import defaultdict
+import time
+from typing import Iterator, List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from services.sheets_query import QueryUnsupportedError, SheetsQuery
+from services.sheet_archive import TRANSACTION_HEADER, SheetArchiveManager
+from services.sheets_scheduler import PRIORITY_USER_WRITE, PRIORITY_USER_READ, PRIORITY_BACKGROUND
+from services.service_account_pool import ServiceAccount, get_service_account_pool
+from services.category_index import CategoryIndex, get_category_index
+from services.category_memo import get_category_memo
+from services.write_journal import get_write_journal
+from services.worksheet_cache import WorksheetCache, get_worksheet_cache
+from services.storage_backend import StorageBackend, build_statistics, empty_statistics, summarize_transactions
 
 logger = logging.getLogger(__name__)
 
-class GoogleSheetsService:
+class GoogleSheetsService(StorageBackend):
     """Dịch vụ quản lý Google Sheets"""
-    
-    def __init__(self):
-        self.credentials_path = os.getenv('GOOGLE_CREDENTIALS_PATH')
-        self.sheet_id = os.getenv('GOOGLE_SHEET_ID')
-        self.sheet_url = os.getenv('GOOGLE_SHEET_URL')
+
+    # Worksheet không truy vấn gviz được → thời điểm ghi nhận (dùng chung cho mọi instance)
+    _query_unsupported: Dict[tuple, float] = {}
+
+    def __init__(self, sheet_id: str = None, sheet_url: str = None, account: ServiceAccount = None):
+        """
+        Args:
+            sheet_id: ID spreadsheet (mặc định GOOGLE_SHEET_ID)
+            sheet_url: URL spreadsheet (mặc định GOOGLE_SHEET_URL)
+            account: Service account dùng để truy cập (mặc định account chính của pool -
+                sheet chung ở shared mode chỉ được share cho account này)
+        """
+        self.sheet_id = sheet_id or os.getenv('GOOGLE_SHEET_ID')
+        self.sheet_url = sheet_url or os.getenv('GOOGLE_SHEET_URL')
         
-        if not self.credentials_path:
-            raise ValueError("GOOGLE_CREDENTIALS_PATH không tìm thấy trong .env")
         if not self.sheet_id:
             raise ValueError("GOOGLE_SHEET_ID không tìm thấy trong .env")
         if not self.sheet_url:
             raise ValueError("GOOGLE_SHEET_URL không tìm thấy trong .env")
-            
+        
+        self.account = account or get_service_account_pool().primary
+        # Mọi lệnh gọi Sheets đều đi qua scheduler quota của service account
+        self.scheduler = self.account.scheduler
         self._setup_client()
     
     def _setup_client(self):
         """Thiết lập client Google Sheets"""
         try:
-            # Cấu hình scopes
-            scopes = [
-                'https://www.googleapis.com/auth/spreadsheets',
-                'https://www.googleapis.com/auth/drive'
-            ]
-            
-            # Tạo credentials từ file JSON
-            credentials = Credentials.from_service_account_file(
-                self.credentials_path, 
-                scopes=scopes
-            )
-            
-            # Khởi tạo client
-            self.client = gspread.authorize(credentials)
-            self.spreadsheet = self.client.open_by_key(self.sheet_id)
+            # Client của service account được authorize 1 lần và dùng chung
+            self.client = self.account.client
+            self.spreadsheet = self._call(self.client.open_by_key, self.sheet_id)
             
             # Không tạo worksheet mặc định nữa - sẽ tạo theo user
-            logger.info("✅ Google Sheets client đã sẵn sàng - Multi-user mode")
+            logger.info(f"✅ Google Sheets client đã sẵn sàng - Multi-user mode ({self.account.email})")
                 
         except Exception as e:
             logger.error(f"Lỗi thiết lập Google Sheets client: {e}")
             raise
     
+    @staticmethod
+    def _worksheet_title(user_name: str) -> str:
+        """Tên worksheet của user"""
+        # Normalize tên user (loại bỏ ký tự đặc biệt)
+        safe_name = "".join(c for c in user_name if c.isalnum() or c in (' ', '_', '-')).strip()
+        if not safe_name:
+            safe_name = "Unknown_User"
+        
+        # Giới hạn độ dài tên worksheet (Google Sheets limit)
+        if len(safe_name) > 100:
+            safe_name = safe_name[:97] + "..."
+        return safe_name
+    
+    def _category_key(self, user_name: str) -> str:
+        """Key index danh mục của worksheet user"""
+        return CategoryIndex.make_key(self.sheet_id, self._worksheet_title(user_name))
+    
+    def get_user_key(self, user_name: str) -> str:
+        """Key định danh worksheet của user"""
+        return self._category_key(user_name)
+    
     def _get_or_create_user_worksheet(self, user_name: str):
         """Lấy hoặc tạo worksheet cho user"""
         try:
-            # Normalize tên user (loại bỏ ký tự đặc biệt)
-            safe_name = "".join(c for c in user_name if c.isalnum() or c in (' ', '_', '-')).strip()
-            if not safe_name:
-                safe_name = "Unknown_User"
-            
-            # Giới hạn độ dài tên worksheet (Google Sheets limit)
-            if len(safe_name) > 100:
-                safe_name = safe_name[:97] + "..."
+            safe_name = self._worksheet_title(user_name)
             
             try:
                 # Thử lấy worksheet có sẵn
-                worksheet = self.spreadsheet.worksheet(safe_name)
+                worksheet = self._call(self.spreadsheet.worksheet, safe_name)
                 logger.info(f"📋 Sử dụng worksheet có sẵn: {safe_name}")
+                
+                # Sang năm mới thì chuyển giao dịch năm cũ ra worksheet lưu trữ
+                if SheetArchiveManager.is_enabled():
+                    self._get_archive_manager().ensure_rollover(worksheet)
                 return worksheet
             except gspread.WorksheetNotFound:
                 # Tạo worksheet mới cho user
                 logger.info(f"🆕 Tạo worksheet mới cho user: {safe_name}")
-                worksheet = self.spreadsheet.add_worksheet(
+                worksheet = self._call(
+                    self.spreadsheet.add_worksheet,
                     title=safe_name,
                     rows="1000",
-                    cols="10"
+                    cols="10",
+                    kind='write', priority=PRIORITY_USER_WRITE
                 )
                 # Thêm header
-                worksheet.append_row([
+                self._call(worksheet.append_row, [
                     "Ngày", "Loại", "Số tiền", "Danh mục", "Ghi chú"
-                ])
+                ], kind='write', priority=PRIORITY_USER_WRITE)
+                
+                # Worksheet mới chưa có danh mục nào - index rỗng là đầy đủ
+                get_category_index().rebuild(self._category_key(user_name), {safe_name: []})
                 return worksheet
                 
         except Exception as e:
             logger.error(f"Lỗi tạo/lấy worksheet cho user {user_name}: {e}")
             raise
 
+    def _get_archive_manager(self) -> SheetArchiveManager:
+        """Lấy archive manager cho spreadsheet hiện tại"""
+        manager = getattr(self, '_archive_manager', None)
+        if manager is None or manager.sheet_id != self.spreadsheet.id:
+            manager = SheetArchiveManager(self.client, self.spreadsheet, self.scheduler)
+            self._archive_manager = manager
+        return manager
+    
+    def _get_worksheets_for_range(self, user_worksheet, start_date: datetime = None,
+                                  end_date: datetime = None) -> list:
+        """Worksheet đang dùng + các archive năm cũ giao với khoảng thời gian"""
+        worksheets = [user_worksheet]
+        if not SheetArchiveManager.is_enabled():
+            return worksheets
+        
+        manager = self._get_archive_manager()
+        for entry in manager.get_archives(user_worksheet.title, start_date, end_date):
+            try:
+                worksheets.append(manager.open_archive(entry))
+            except Exception as e:
+                logger.error(f"❌ Không mở được archive '{entry['archive']}': {e}")
+        return worksheets
+    
+    @staticmethod
+    def _map_worksheets(func, worksheets: list) -> list:
+        """Chạy func song song trên nhiều worksheet, giữ nguyên thứ tự kết quả"""
+        if len(worksheets) == 1:
+            return [func(worksheets[0])]
+        with ThreadPoolExecutor(max_workers=min(len(worksheets), 4)) as executor:
+            return list(executor.map(func, worksheets))
+    
+    def _call(self, func, *args, kind: str = 'read', priority: int = PRIORITY_USER_READ, **kwargs):
+        """Gọi Google Sheets qua scheduler (quota, ưu tiên, retry 429)"""
+        return self.scheduler.call(func, *args, kind=kind, priority=priority, **kwargs)
+    
     def test_connection(self):
         """Test kết nối Google Sheets"""
         try:
@@ -111,12 +176,9 @@ class GoogleSheetsService:
             custom_date: Ngày tùy chỉnh (VD: "5/9", "hôm qua", null)
             
         Returns:
-            bool: True nếu thành công
+            bool: True nếu đã ghi lên sheet hoặc đã lưu vào outbox chờ đồng bộ
         """
         try:
-            # Lấy worksheet riêng cho user này
-            user_worksheet = self._get_or_create_user_worksheet(user_name)
-            
             # Chuẩn bị dữ liệu (không cần user_name nữa vì đã có worksheet riêng)
             from utils.date_utils import parse_custom_date
             
@@ -131,18 +193,100 @@ class GoogleSheetsService:
                 category,
                 note
             ]
+        except Exception as e:
+            logger.error(f"❌ Lỗi thêm giao dịch cho {user_name}: {e}")
+            return False
+        
+        journal = get_write_journal()
+        worksheet_title = self._worksheet_title(user_name)
+        
+        # Worksheet còn dòng chờ đồng bộ - xếp hàng sau để giữ đúng thứ tự
+        if not journal.has_pending(self.sheet_id, worksheet_title):
+            try:
+                # Lấy worksheet riêng cho user này
+                user_worksheet = self._get_or_create_user_worksheet(user_name)
+                
+                # Thêm vào worksheet của user
+                self._call(user_worksheet.append_row, row_data, kind='write', priority=PRIORITY_USER_WRITE)
+                get_worksheet_cache().note_write(self.sheet_id)
+                get_category_index().record(self._category_key(user_name), transaction_type, category, target_datetime)
+                
+                logger.info(f"👤 {user_name}: {transaction_type} - {amount:,.0f} VNĐ - {category}")
+                return True
+                
+            except Exception as e:
+                logger.error(f"❌ Lỗi thêm giao dịch cho {user_name}, chuyển vào outbox: {e}")
+        
+        try:
+            pending = journal.enqueue(self.account.email, self.sheet_id, worksheet_title, row_data)
+            get_category_index().record(self._category_key(user_name), transaction_type, category, target_datetime)
             
-            # Thêm vào worksheet của user
-            user_worksheet.append_row(row_data)
-            
-            logger.info(f"👤 {user_name}: {transaction_type} - {amount:,.0f} VNĐ - {category}")
+            logger.info(f"📮 {user_name}: {transaction_type} - {amount:,.0f} VNĐ - {category} (chờ đồng bộ: {pending})")
             return True
             
         except Exception as e:
-            logger.error(f"❌ Lỗi thêm giao dịch cho {user_name}: {e}")
+            logger.error(f"❌ Lỗi lưu giao dịch vào outbox cho {user_name}: {e}")
             return False
     
-    def get_transactions(self, user_name: str, start_date: datetime = None, end_date: datetime = None) -> List[Dict]:
+    def add_transactions(self, user_name: str, transactions: List[Dict]) -> int:
+        """
+        Ghi nhiều giao dịch bằng 1 lệnh append_rows (import)
+
+        Chạy ở mức ưu tiên nền; lỗi hoặc worksheet còn dòng chờ thì đưa cả lô vào outbox.
+        """
+        rows = [
+            [
+                transaction['date'].strftime("%d/%m/%Y %H:%M:%S"),
+                transaction['type'],
+                transaction['amount'],
+                transaction['category'],
+                transaction['note']
+            ]
+            for transaction in transactions
+        ]
+        if not rows:
+            return 0
+        
+        journal = get_write_journal()
+        worksheet_title = self._worksheet_title(user_name)
+        written = False
+        
+        if not journal.has_pending(self.sheet_id, worksheet_title):
+            try:
+                user_worksheet = self._get_or_create_user_worksheet(user_name)
+                self._call(user_worksheet.append_rows, rows, kind='write', priority=PRIORITY_BACKGROUND)
+                get_worksheet_cache().note_write(self.sheet_id)
+                written = True
+                logger.info(f"👤 {user_name}: đã ghi {len(rows)} giao dịch")
+            except Exception as e:
+                logger.error(f"❌ Lỗi ghi {len(rows)} giao dịch cho {user_name}, chuyển vào outbox: {e}")
+        
+        if not written:
+            for row in rows:
+                journal.enqueue(self.account.email, self.sheet_id, worksheet_title, row)
+            logger.info(f"📮 {user_name}: {len(rows)} giao dịch chờ đồng bộ")
+        
+        get_category_index().record_many(self._category_key(user_name), transactions)
+        return len(rows)
+    
+    def get_pending_count(self, user_name: str) -> int:
+        """Số giao dịch của user đang chờ đồng bộ lên Google Sheets"""
+        try:
+            return get_write_journal().pending_count(self.sheet_id, self._worksheet_title(user_name))
+        except Exception as e:
+            logger.error(f"❌ Lỗi đọc outbox: {e}")
+            return 0
+    
+    def get_failed_sync_count(self, user_name: str) -> int:
+        """Số giao dịch của user không ghi được lên Google Sheets sau WRITE_JOURNAL_MAX_ATTEMPTS lần thử"""
+        try:
+            return get_write_journal().failed_count(self.sheet_id, self._worksheet_title(user_name))
+        except Exception as e:
+            logger.error(f"❌ Lỗi đọc outbox: {e}")
+            return 0
+    
+    def get_transactions(self, user_name: str, start_date: datetime = None, end_date: datetime = None,
+                         transaction_type: str = None) -> List[Dict]:
         """
         Lấy danh sách giao dịch theo khoảng thời gian từ worksheet của user
         
@@ -150,6 +294,7 @@ class GoogleSheetsService:
             user_name: Tên người dùng
             start_date: Ngày bắt đầu
             end_date: Ngày kết thúc
+            transaction_type: Chỉ lấy 'Thu' hoặc 'Chi' (None = tất cả)
             
         Returns:
             List[Dict]: Danh sách giao dịch
@@ -158,57 +303,38 @@ class GoogleSheetsService:
             # Lấy worksheet của user
             user_worksheet = self._get_or_create_user_worksheet(user_name)
             
-            # Lấy tất cả dữ liệu từ worksheet của user
-            all_records = user_worksheet.get_all_records()
-            
-            if not all_records:
-                return []
+            # Đọc song song worksheet đang dùng và các archive giao với khoảng thời gian
+            worksheets = self._get_worksheets_for_range(user_worksheet, start_date, end_date)
+            record_lists = self._map_worksheets(
+                lambda worksheet: self._read_records(worksheet, start_date, end_date, transaction_type, user_name),
+                worksheets
+            )
             
             transactions = []
+            transactions_by_source = {}
             
-            for record in all_records:
-                try:
-                    # Parse ngày từ string
-                    date_str = record.get('Ngày', '')
-                    if not date_str:
+            for worksheet, records in zip(worksheets, record_lists):
+                source_transactions = transactions_by_source.setdefault(worksheet.title, [])
+                for record in records:
+                    transaction = self._parse_record(record)
+                    if not transaction:
                         continue
                     
-                    # Xử lý format ngày (có thể có giờ)
-                    if ' ' in date_str:
-                        date_part = date_str.split(' ')[0]
-                    else:
-                        date_part = date_str
-                    
-                    transaction_date = datetime.strptime(date_part, "%d/%m/%Y")
-                    
                     # Lọc theo khoảng thời gian
-                    if start_date and transaction_date < start_date:
+                    if start_date and transaction['date'] < start_date:
                         continue
-                    if end_date and transaction_date > end_date:
+                    if end_date and transaction['date'] > end_date:
+                        continue
+                    if transaction_type and transaction['type'] != transaction_type:
                         continue
                     
-                    # Chuẩn hóa số tiền
-                    amount = 0
-                    if record.get('Số tiền'):
-                        try:
-                            amount = float(str(record['Số tiền']).replace(',', ''))
-                        except:
-                            amount = 0
-                    
-                    transaction = {
-                        'date': transaction_date,
-                        'type': record.get('Loại', ''),
-                        'amount': amount,
-                        'category': record.get('Danh mục', ''),
-                        'note': record.get('Ghi chú', ''),
-                        'user': record.get('Người dùng', '')
-                    }
-                    
+                    source_transactions.append(transaction)
                     transactions.append(transaction)
-                    
-                except Exception as e:
-                    logger.warning(f"Lỗi parse giao dịch: {record}, Error: {e}")
-                    continue
+            
+            # Đọc toàn bộ (mọi năm, mọi loại) - dựng lại index danh mục và học danh mục user giữ trên sheet
+            if not start_date and not end_date and not transaction_type:
+                get_category_index().rebuild(self._category_key(user_name), transactions_by_source)
+                get_category_memo().learn_user(self._category_key(user_name), transactions)
             
             return transactions
             
@@ -216,30 +342,243 @@ class GoogleSheetsService:
             logger.error(f"Lỗi lấy giao dịch: {e}")
             return []
     
-    def get_categories(self) -> Dict[str, List[str]]:
+    def iter_transactions(self, user_name: str, start_date: datetime = None, end_date: datetime = None,
+                          chunk_size: int = 1000) -> Iterator[List[Dict]]:
+        """
+        Đọc giao dịch theo từng khối dòng (A{i}:E{j}) để xuất dữ liệu lớn
+
+        Không nạp cả worksheet vào RAM và chạy ở mức ưu tiên nền để
+        không chiếm quota của các tin nhắn đang chờ trả lời.
+
+        Giao dịch còn trong outbox được ghi lên sheet trước; Sheets lỗi thì
+        các dòng còn lại được nối vào cuối (drainer tạm dừng trong lúc đọc
+        nên không dòng nào bị đọc hai lần hoặc bị sót).
+        """
+        user_worksheet = self._get_or_create_user_worksheet(user_name)
+        worksheets = self._get_worksheets_for_range(user_worksheet, start_date, end_date)
+
+        journal = get_write_journal()
+        journal.flush(self.sheet_id, user_worksheet.title)
+
+        def filter_records(records: List[Dict]) -> List[Dict]:
+            chunk = []
+            for record in records:
+                transaction = self._parse_record(record)
+                if not transaction:
+                    continue
+                if start_date and transaction['date'] < start_date:
+                    continue
+                if end_date and transaction['date'] > end_date:
+                    continue
+                chunk.append(transaction)
+            return chunk
+
+        with journal.paused():
+            # Archive các năm cũ trước, worksheet đang dùng sau cùng
+            for worksheet in worksheets[1:] + worksheets[:1]:
+                for records in self._iter_worksheet_records(worksheet, chunk_size):
+                    chunk = filter_records(records)
+                    if chunk:
+                        yield chunk
+
+            pending_rows = journal.pending_rows(self.sheet_id, user_worksheet.title)
+            if pending_rows:
+                logger.info(f"📮 Xuất kèm {len(pending_rows)} giao dịch chưa đồng bộ của '{user_worksheet.title}'")
+                chunk = filter_records(self._rows_to_records([TRANSACTION_HEADER] + pending_rows))
+                if chunk:
+                    yield chunk
+
+    def _iter_worksheet_records(self, worksheet, chunk_size: int) -> Iterator[List[Dict]]:
+        """Đọc records của một worksheet theo từng khối dòng"""
+        header_rows = self._call(worksheet.get, "A1:E1", priority=PRIORITY_BACKGROUND)
+        if not header_rows:
+            return
+        header = header_rows[0]
+
+        start_row = 2
+        while True:
+            end_row = start_row + chunk_size - 1
+            try:
+                rows = self._call(worksheet.get, f"A{start_row}:E{end_row}", priority=PRIORITY_BACKGROUND)
+            except gspread.exceptions.APIError:
+                # Khối bắt đầu sau biên grid của worksheet - đã đọc hết
+                if start_row > worksheet.row_count:
+                    break
+                raise
+            if not rows:
+                break
+
+            yield [
+                dict(zip(header, row + [''] * (len(header) - len(row))))
+                for row in rows
+            ]
+            start_row = end_row + 1
+
+    def _read_records(self, worksheet, start_date: datetime = None, end_date: datetime = None,
+                      transaction_type: str = None, user_name: str = None) -> List[Dict]:
+        """
+        Đọc records của một worksheet
+
+        Cache đã có worksheet (hoặc cần đọc toàn bộ) → đọc qua cache. Worksheet chưa
+        có trong cache → lọc phía server cho lần này và tải cache ở nền.
         """
-        Lấy danh sách danh mục theo loại giao dịch
+        filtered = bool(start_date or end_date or transaction_type)
+        if WorksheetCache.is_enabled() and (not filtered or get_worksheet_cache().is_warm(worksheet)):
+            return self._read_cached_records(worksheet, user_name)
         
-        Returns:
-            Dict: {'Thu': [...], 'Chi': [...]}
+        records = self._query_records(worksheet, start_date, end_date, transaction_type)
+        if records is not None:
+            self._warm_cache([worksheet], user_name)
+            return records
+        
+        if WorksheetCache.is_enabled():
+            return self._read_cached_records(worksheet, user_name)
+        # Fallback: lấy tất cả dữ liệu từ worksheet
+        return self._call(worksheet.get_all_records)
+    
+    @staticmethod
+    def _rows_to_records(rows: List[List]) -> List[Dict]:
+        """Dòng thô (gồm header) → records cùng format get_all_records()"""
+        if not rows:
+            return []
+        header = rows[0]
+        return [
+            dict(zip(header, row + [''] * (len(header) - len(row))))
+            for row in rows[1:]
+        ]
+    
+    def _read_cached_records(self, worksheet, user_name: str = None) -> List[Dict]:
+        """Đọc toàn bộ worksheet qua cache (chỉ tải lại phần thay đổi)"""
+        def on_change(rows: List[List]):
+            if user_name:
+                self._refresh_category_index(user_name, worksheet, self._rows_to_records(rows))
+        
+        rows = get_worksheet_cache().get_rows(worksheet, self.client.session, self._call, on_change=on_change)
+        return self._rows_to_records(rows)
+    
+    def _warm_cache(self, worksheets: list, user_name: str = None):
+        """Tải ở nền các worksheet chưa có trong cache (lần đọc đầu đã trả lời bằng gviz)"""
+        if not WorksheetCache.is_enabled():
+            return
+        cache = get_worksheet_cache()
+        for worksheet in worksheets:
+            if cache.is_warm(worksheet):
+                continue
+            
+            def on_change(rows: List[List], worksheet=worksheet):
+                if user_name:
+                    self._refresh_category_index(user_name, worksheet, self._rows_to_records(rows))
+            
+            cache.warm(worksheet, self.client.session, self._call, on_change=on_change)
+    
+    def _refresh_category_index(self, user_name: str, worksheet, records: List[Dict]):
         """
+        Cache vừa tải lại worksheet (có thể do user sửa tay): cập nhật phần index
+        danh mục của worksheet đó, và học lại danh mục user giữ trong worksheet đang dùng
+        """
+        try:
+            key = self._category_key(user_name)
+            transactions = [transaction for transaction in map(self._parse_record, records) if transaction]
+            get_category_index().rebuild_source(key, worksheet.title, transactions)
+            if worksheet.title == self._worksheet_title(user_name):
+                get_category_memo().learn_user(key, transactions)
+        except Exception as e:
+            logger.error(f"❌ Lỗi cập nhật index danh mục từ cache: {e}")
+    
+    def _parse_record(self, record: Dict) -> Optional[Dict]:
+        """Chuyển một dòng của worksheet thành giao dịch (None nếu dòng không hợp lệ)"""
         try:
-            all_records = self.worksheet.get_all_records()
-            categories = {'Thu': set(), 'Chi': set()}
+            # Parse ngày từ string
+            date_str = str(record.get('Ngày', ''))
+            if not date_str:
+                return None
             
-            for record in all_records:
-                transaction_type = record.get('Loại', '')
-                category = record.get('Danh mục', '')
-                
-                if transaction_type in categories and category:
-                    categories[transaction_type].add(category)
+            # Xử lý format ngày (có thể có giờ)
+            if ' ' in date_str:
+                date_part = date_str.split(' ')[0]
+            else:
+                date_part = date_str
+            
+            transaction_date = datetime.strptime(date_part, "%d/%m/%Y")
+            
+            # Chuẩn hóa số tiền
+            amount = 0
+            if record.get('Số tiền'):
+                try:
+                    amount = float(str(record['Số tiền']).replace(',', ''))
+                except:
+                    amount = 0
             
-            # Convert set to sorted list
             return {
-                'Thu': sorted(list(categories['Thu'])),
-                'Chi': sorted(list(categories['Chi']))
+                'date': transaction_date,
+                'type': record.get('Loại', ''),
+                'amount': amount,
+                'category': record.get('Danh mục', ''),
+                'note': record.get('Ghi chú', ''),
+                'user': record.get('Người dùng', '')
             }
             
+        except Exception as e:
+            logger.warning(f"Lỗi parse giao dịch: {record}, Error: {e}")
+            return None
+    
+    def _get_query(self, worksheet) -> Optional[SheetsQuery]:
+        """Lấy SheetsQuery nếu worksheet hỗ trợ truy vấn phía server"""
+        if not SheetsQuery.is_enabled():
+            return None
+        key = (worksheet.spreadsheet.id, worksheet.title)
+        marked_at = self._query_unsupported.get(key)
+        if marked_at is not None:
+            # Hết hạn thì thử lại (VD: user đã share lại sheet, sửa tên worksheet)
+            if time.monotonic() - marked_at < float(os.getenv('SHEETS_QUERY_RETRY_SECONDS', 3600)):
+                return None
+            self._query_unsupported.pop(key, None)
+        return SheetsQuery(self.client.session, worksheet.spreadsheet.id, scheduler=self.scheduler)
+    
+    def _on_query_error(self, worksheet, error: Exception):
+        """
+        Xử lý lỗi gviz trước khi fallback về đọc phía client
+
+        Chỉ lỗi quyền/parse mới ghi nhớ worksheet không truy vấn được (trong
+        SHEETS_QUERY_RETRY_SECONDS); timeout, 5xx chỉ fallback lần này.
+        """
+        if isinstance(error, QueryUnsupportedError):
+            self._query_unsupported[(worksheet.spreadsheet.id, worksheet.title)] = time.monotonic()
+            logger.warning(f"⚠️ Không truy vấn server được '{worksheet.title}', dùng lọc phía client: {error}")
+        else:
+            logger.warning(f"⚠️ Lỗi tạm thời khi truy vấn '{worksheet.title}', lần này lọc phía client: {error}")
+    
+    def _query_records(self, worksheet, start_date: datetime, end_date: datetime,
+                       transaction_type: str = None) -> Optional[List[Dict]]:
+        """Lọc giao dịch phía server, trả về None để fallback về đọc toàn bộ"""
+        query = self._get_query(worksheet)
+        if not query:
+            return None
+        try:
+            return query.fetch_records(worksheet.title, start_date, end_date, transaction_type)
+        except Exception as e:
+            self._on_query_error(worksheet, e)
+            return None
+    
+    def get_category_usage(self, user_name: str) -> Dict[str, List[Dict]]:
+        """
+        Lấy danh mục của user kèm số lần dùng và ngày dùng gần nhất
+        
+        Đọc từ index danh mục; chỉ quét worksheet một lần nếu chưa có index.
+        
+        Returns:
+            Dict: {'Thu': [{'category', 'count', 'last_used'}], 'Chi': [...]}
+        """
+        try:
+            index = get_category_index()
+            key = self._category_key(user_name)
+            
+            if not index.has(key):
+                # get_transactions() không lọc sẽ dựng index
+                self.get_transactions(user_name)
+            
+            return index.get_entries(key) or {'Thu': [], 'Chi': []}
+            
         except Exception as e:
             logger.error(f"Lỗi lấy danh mục: {e}")
             return {'Thu': [], 'Chi': []}
@@ -254,58 +593,54 @@ class GoogleSheetsService:
             end_date: Ngày kết thúc
             
         Returns:
-            Dict: Thống kê chi tiết
+            Dict: Thống kê chi tiết (pending_sync/failed_sync: số giao dịch chờ/lỗi đồng bộ, chưa được tính)
         """
+        stats = self._compute_statistics(user_name, start_date, end_date)
+        stats['pending_sync'] = self.get_pending_count(user_name)
+        stats['failed_sync'] = self.get_failed_sync_count(user_name)
+        return stats
+    
+    def _compute_statistics(self, user_name: str, start_date: datetime, end_date: datetime) -> Dict:
+        """Tính thống kê từ dữ liệu đã có trên Google Sheets"""
         try:
-            transactions = self.get_transactions(user_name, start_date, end_date)
-            
-            if not transactions:
-                return {
-                    'total_income': 0,
-                    'total_expense': 0,
-                    'balance': 0,
-                    'income_categories': {},
-                    'expense_categories': {},
-                    'transaction_count': 0
-                }
-            
-            total_income = 0
-            total_expense = 0
-            income_categories = defaultdict(float)
-            expense_categories = defaultdict(float)
+            user_worksheet = self._get_or_create_user_worksheet(user_name)
+            worksheets = self._get_worksheets_for_range(user_worksheet, start_date, end_date)
             
-            for transaction in transactions:
-                amount = transaction['amount']
-                category = transaction['category']
-                
-                if transaction['type'] == 'Thu':
-                    total_income += amount
-                    income_categories[category] += amount
-                elif transaction['type'] == 'Chi':
-                    total_expense += amount
-                    expense_categories[category] += amount
+            # Cache đã có đủ worksheet thì tính từ cache; chưa có (lần đầu) hoặc tắt cache
+            # thì để server tính SUM/GROUP BY - chỉ tải về các tổng, cache được tải ở nền
+            cache_warm = WorksheetCache.is_enabled() and all(
+                get_worksheet_cache().is_warm(worksheet) for worksheet in worksheets
+            )
+            if not cache_warm:
+                server_stats = self._query_statistics(worksheets, start_date, end_date)
+                if server_stats is not None:
+                    self._warm_cache(worksheets, user_name)
+                    return server_stats
             
-            return {
-                'total_income': total_income,
-                'total_expense': total_expense,
-                'balance': total_income - total_expense,
-                'income_categories': dict(income_categories),
-                'expense_categories': dict(expense_categories),
-                'transaction_count': len(transactions),
-                'start_date': start_date,
-                'end_date': end_date
-            }
+            transactions = self.get_transactions(user_name, start_date, end_date)
+            return build_statistics(summarize_transactions(transactions), start_date, end_date)
             
         except Exception as e:
             logger.error(f"Lỗi tính thống kê: {e}")
-            return {
-                'total_income': 0,
-                'total_expense': 0,
-                'balance': 0,
-                'income_categories': {},
-                'expense_categories': {},
-                'transaction_count': 0
-            }
+            return empty_statistics()
+    
+    def _query_statistics(self, worksheets: list, start_date: datetime, end_date: datetime) -> Optional[Dict]:
+        """Tính thống kê bằng gviz GROUP BY, trả về None để fallback về tính phía client"""
+        def fetch_totals(worksheet):
+            query = self._get_query(worksheet)
+            if not query:
+                return None
+            try:
+                return query.fetch_category_totals(worksheet.title, start_date, end_date)
+            except Exception as e:
+                self._on_query_error(worksheet, e)
+                return None
+        
+        total_lists = self._map_worksheets(fetch_totals, worksheets)
+        if any(totals is None for totals in total_lists):
+            return None
+        totals = [row for rows in total_lists for row in rows]
+        return build_statistics(totals, start_date, end_date)
     
     def get_sheet_url(self) -> str:
         """Lấy URL của Google Sheet"""
@@ -0,0 +1,189 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from datetime import date
+from typing import Any, Dict, Optional
+
+from utils.json_utils import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+# Từ chỉ thời gian tương đối - kết quả chỉ đúng trong ngày nên key phải kèm ngày hiện tại
+RELATIVE_DATE_PATTERN = re.compile(
+    r"(?<!\w)(hôm nay|hôm qua|hôm kia|bữa qua|ngày mai|nay|qua|mai|"
+    r"tuần này|tuần trước|tuần sau|tháng này|tháng trước|tháng sau|năm này|năm nay|năm ngoái|năm trước|"
+    r"thứ hai|thứ ba|thứ tư|thứ năm|thứ sáu|thứ bảy|chủ nhật)(?!\w)"
+)
+
+
+def normalize_message(message: str) -> str:
+    """
+    Chuẩn hóa tin nhắn làm key cache
+
+    Chữ thường, dấu tiếng Việt về dạng dựng sẵn (NFC - bàn phím khác nhau
+    gửi "ú" dạng tổ hợp hoặc dựng sẵn), gộp khoảng trắng, bỏ dấu câu cuối câu.
+    Không bỏ dấu vì dấu đổi nghĩa ("bán" khác "bạn").
+    """
+    text = unicodedata.normalize('NFC', str(message or '')).lower()
+    text = ' '.join(text.split())
+    return text.rstrip('.!?~ ')
+
+
+class IntentCache:
+    """
+    Cache kết quả phân tích intent của AI theo tin nhắn đã chuẩn hóa
+
+    LRU + TTL trong bộ nhớ, có thể lưu xuống file (INTENT_CACHE_FILE) để
+    giữ lại sau khi khởi động lại bot - thread nền ghi nguyên tử mỗi
+    INTENT_CACHE_SAVE_SECONDS giây nếu có thay đổi và khi thoát, put() không chờ I/O đĩa.
+    Tin nhắn có từ thời gian tương đối ("hôm qua", "tuần này") được cache riêng theo từng ngày.
+    """
+
+    def __init__(self, max_entries: int = None, ttl: int = None, cache_file: str = None):
+        self.max_entries = max_entries or int(os.getenv('INTENT_CACHE_MAX_ENTRIES', 2000))
+        self.ttl = ttl or int(os.getenv('INTENT_CACHE_TTL', 7 * 24 * 3600))
+        self.cache_file = cache_file if cache_file is not None else os.getenv('INTENT_CACHE_FILE', '')
+        self.save_seconds = float(os.getenv('INTENT_CACHE_SAVE_SECONDS', 5))
+
+        self._entries: 'OrderedDict[str, Dict]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = Counter()
+        self._load_cache()
+
+        # Cache đổi sau lần lưu cuối - thread nền ghi file
+        self._dirty = False
+        self._save_lock = threading.Lock()
+        self._flusher = None
+        if self.cache_file:
+            atexit.register(self.flush)
+
+    @staticmethod
+    def is_enabled() -> bool:
+        """Kiểm tra cache intent có được bật không"""
+        return os.getenv('INTENT_CACHE', 'true').lower() == 'true'
+
+    @staticmethod
+    def make_key(message: str, today: date = None) -> str:
+        """Key cache của tin nhắn (kèm ngày nếu có từ thời gian tương đối)"""
+        normalized = normalize_message(message)
+        if RELATIVE_DATE_PATTERN.search(normalized):
+            return f"{(today or date.today()).isoformat()}|{normalized}"
+        return normalized
+
+    def _load_cache(self):
+        """Load cache từ file JSON (nếu bật lưu file)"""
+        if not self.cache_file:
+            return
+        try:
+            if os.path.exists(self.cache_file):
+                with open(self.cache_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                now = time.time()
+                for key, entry in sorted(data.items(), key=lambda item: item[1]['stored_at']):
+                    if now - entry['stored_at'] < self.ttl:
+                        self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                logger.info(f"📂 Loaded {len(self._entries)} intent từ cache")
+        except Exception as e:
+            logger.error(f"❌ Lỗi load cache intent: {e}")
+
+    def _mark_dirty(self):
+        """Cache vừa đổi - hẹn thread nền lưu xuống file (gọi khi đang giữ lock)"""
+        if not self.cache_file:
+            return
+        self._dirty = True
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name="intent-cache-save", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.save_seconds)
+            self.flush()
+
+    def flush(self):
+        """Lưu cache xuống file JSON nếu có thay đổi (ghi file ngoài lock của cache)"""
+        if not self.cache_file:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                # Entry chỉ bị thay chứ không sửa tại chỗ - bản sao nông là đủ
+                data = dict(self._entries)
+                self._dirty = False
+            try:
+                write_json_atomic(self.cache_file, data)
+            except Exception as e:
+                logger.error(f"❌ Lỗi lưu cache intent: {e}")
+                with self._lock:
+                    self._dirty = True
+
+    def get(self, message: str) -> Optional[Dict[str, Any]]:
+        """Kết quả đã cache của tin nhắn (None nếu chưa có hoặc đã hết hạn)"""
+        key = self.make_key(message)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry['stored_at'] >= self.ttl:
+                del self._entries[key]
+                self._stats['expired'] += 1
+                entry = None
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            # Bản sao - handler được phép sửa kết quả mà không làm hỏng cache
+            return copy.deepcopy(entry['result'])
+
+    def put(self, message: str, result: Dict[str, Any]):
+        """Lưu kết quả AI của tin nhắn"""
+        key = self.make_key(message)
+        with self._lock:
+            self._entries[key] = {'result': copy.deepcopy(result), 'stored_at': time.time()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+            self._mark_dirty()
+
+    def clear(self):
+        """Xóa toàn bộ cache"""
+        with self._lock:
+            self._entries.clear()
+            self._mark_dirty()
+
+    def get_stats(self) -> Dict:
+        """Thống kê cache (hit rate, số entry)"""
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                'enabled': self.is_enabled(),
+                'entries': len(self._entries),
+                'hits': self._stats['hits'],
+                'misses': self._stats['misses'],
+                'expired': self._stats['expired'],
+                'evictions': self._stats['evictions'],
+                'hit_rate': round(self._stats['hits'] / lookups, 3) if lookups else 0.0
+            }
+
+
+_cache: Optional[IntentCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_intent_cache() -> IntentCache:
+    """Lấy cache intent dùng chung của process"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = IntentCache()
+        return _cache
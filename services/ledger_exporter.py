@@ -0,0 +1,234 @@
+import csv
+import logging
+import os
+import secrets
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import urlparse
+
+from services.storage_backend import StorageBackend
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('csv', 'xlsx')
+EXPORT_HEADER = ["Ngày", "Loại", "Số tiền", "Danh mục", "Ghi chú"]
+
+
+def is_xlsx_available() -> bool:
+    """Kiểm tra openpyxl (tùy chọn) đã được cài chưa"""
+    try:
+        import openpyxl  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _export_amount(amount):
+    """Số tiền nguyên ghi không kèm '.0' (1500000 thay vì 1500000.0)"""
+    return int(amount) if isinstance(amount, float) and amount.is_integer() else amount
+
+
+# Ô text bắt đầu bằng các ký tự này bị Excel/LibreOffice hiểu là công thức
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _export_text(value):
+    """Thêm ' trước text giống công thức ("=HYPERLINK(...)") để chống formula injection"""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+class LedgerExporter:
+    """
+    Xuất sổ thu chi của user ra CSV/XLSX theo kiểu streaming
+
+    Giao dịch được đọc theo lô (StorageBackend.iter_transactions) và ghi
+    ngay xuống file, nên bộ nhớ chỉ giữ một lô dù sheet có hàng trăm nghìn dòng.
+    """
+
+    def __init__(self, export_dir: str = None):
+        self.export_dir = export_dir or os.getenv('EXPORT_DIR', 'exports')
+        self.chunk_size = int(os.getenv('EXPORT_CHUNK_ROWS', 5000))
+        self.link_ttl = int(os.getenv('EXPORT_LINK_TTL', 3600))
+        self.cleanup_seconds = float(os.getenv('EXPORT_CLEANUP_SECONDS', 300))
+
+        self._downloads: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._sweeper: Optional[threading.Thread] = None
+
+    def export(self, backend: StorageBackend, user_name: str, start_date: datetime = None,
+               end_date: datetime = None, export_format: str = 'csv', output_path: str = None) -> Dict:
+        """
+        Xuất giao dịch của user trong khoảng thời gian ra file
+
+        Args:
+            backend: Nơi lưu giao dịch của user
+            user_name: Tên người dùng
+            start_date, end_date: Khoảng thời gian (None = không giới hạn)
+            export_format: 'csv' hoặc 'xlsx'
+            output_path: Đường dẫn file (mặc định tạo trong EXPORT_DIR)
+
+        Returns:
+            Dict: {'path', 'format', 'rows', 'bytes', 'seconds', 'rows_per_second'}
+        """
+        export_format = export_format.lower()
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Định dạng không hỗ trợ: {export_format} (chọn {', '.join(EXPORT_FORMATS)})")
+        if export_format == 'xlsx' and not is_xlsx_available():
+            raise RuntimeError("Xuất Excel cần cài openpyxl (pip install openpyxl)")
+
+        if not output_path:
+            os.makedirs(self.export_dir, exist_ok=True)
+            output_path = os.path.join(self.export_dir, self._file_name(user_name, export_format))
+
+        started = time.perf_counter()
+        chunks = backend.iter_transactions(user_name, start_date, end_date, chunk_size=self.chunk_size)
+        if export_format == 'xlsx':
+            rows = self._write_xlsx(output_path, chunks)
+        else:
+            rows = self._write_csv(output_path, chunks)
+        seconds = time.perf_counter() - started
+
+        result = {
+            'path': output_path,
+            'format': export_format,
+            'rows': rows,
+            'bytes': os.path.getsize(output_path),
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(rows / seconds) if seconds > 0 else rows
+        }
+        logger.info(f"📦 Xuất {rows} giao dịch của {user_name} ra {export_format.upper()} "
+                    f"trong {seconds:.2f}s ({result['rows_per_second']} dòng/s)")
+        return result
+
+    @staticmethod
+    def _file_name(user_name: str, export_format: str) -> str:
+        safe_name = "".join(c for c in user_name if c.isalnum() or c in ('_', '-')).strip() or "user"
+        return f"{safe_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(3)}.{export_format}"
+
+    @staticmethod
+    def _write_csv(path: str, chunks: Iterable[List[Dict]]) -> int:
+        rows = 0
+        # utf-8-sig để Excel mở đúng tiếng Việt
+        with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_HEADER)
+            for chunk in chunks:
+                writer.writerows(
+                    [
+                        transaction['date'].strftime("%d/%m/%Y"),
+                        _export_text(transaction['type']),
+                        _export_amount(transaction['amount']),
+                        _export_text(transaction['category']),
+                        _export_text(transaction['note'])
+                    ]
+                    for transaction in chunk
+                )
+                rows += len(chunk)
+        return rows
+
+    @staticmethod
+    def _write_xlsx(path: str, chunks: Iterable[List[Dict]]) -> int:
+        from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
+
+        # write_only: dòng được ghi thẳng ra file tạm, không giữ cả bảng trong RAM
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet("Giao dịch")
+        sheet.append(EXPORT_HEADER)
+
+        rows = 0
+        for chunk in chunks:
+            for transaction in chunk:
+                date_cell = WriteOnlyCell(sheet, value=transaction['date'])
+                date_cell.number_format = 'DD/MM/YYYY'
+                sheet.append([
+                    date_cell,
+                    _export_text(transaction['type']),
+                    _export_amount(transaction['amount']),
+                    _export_text(transaction['category']),
+                    _export_text(transaction['note'])
+                ])
+            rows += len(chunk)
+
+        workbook.save(path)
+        return rows
+
+    def register_download(self, path: str) -> str:
+        """Tạo token tải file (hết hạn sau EXPORT_LINK_TTL giây)"""
+        self.cleanup()
+        token = secrets.token_urlsafe(16)
+        with self._lock:
+            self._downloads[token] = {'path': path, 'expires_at': time.time() + self.link_ttl}
+            # File hết hạn được dọn định kỳ dù không ai xuất thêm hay tải nữa
+            if self._sweeper is None or not self._sweeper.is_alive():
+                self._sweeper = threading.Thread(target=self._sweep_loop, name="export-sweeper", daemon=True)
+                self._sweeper.start()
+        return token
+
+    def _sweep_loop(self):
+        """Dọn file hết hạn mỗi EXPORT_CLEANUP_SECONDS, dừng khi không còn link nào"""
+        while True:
+            time.sleep(self.cleanup_seconds)
+            self.cleanup()
+            with self._lock:
+                if not self._downloads:
+                    self._sweeper = None
+                    return
+
+    def resolve_download(self, token: str) -> Optional[str]:
+        """Đường dẫn file của token (None nếu không có hoặc đã hết hạn)"""
+        self.cleanup()
+        with self._lock:
+            entry = self._downloads.get(token)
+        if not entry or entry['expires_at'] < time.time() or not os.path.exists(entry['path']):
+            return None
+        return entry['path']
+
+    def cleanup(self):
+        """Xóa token và file xuất đã hết hạn"""
+        now = time.time()
+        with self._lock:
+            expired = [token for token, entry in self._downloads.items() if entry['expires_at'] < now]
+            paths = [self._downloads.pop(token)['path'] for token in expired]
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def get_public_base_url() -> Optional[str]:
+        """URL công khai của bot (PUBLIC_BASE_URL, hoặc suy ra từ WEBHOOK_URL)"""
+        base_url = os.getenv('PUBLIC_BASE_URL')
+        if base_url:
+            return base_url.rstrip('/')
+        webhook_url = os.getenv('WEBHOOK_URL')
+        if webhook_url:
+            parsed = urlparse(webhook_url)
+            if parsed.scheme and parsed.netloc:
+                return f"{parsed.scheme}://{parsed.netloc}"
+        return None
+
+    def build_download_url(self, token: str) -> Optional[str]:
+        """Link tải file xuất (None nếu bot không có URL công khai)"""
+        base_url = self.get_public_base_url()
+        if not base_url:
+            return None
+        return f"{base_url}/exports/{token}"
+
+
+_exporter: Optional[LedgerExporter] = None
+_exporter_lock = threading.Lock()
+
+
+def get_ledger_exporter() -> LedgerExporter:
+    """Lấy exporter dùng chung của process"""
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = LedgerExporter()
+        return _exporter
@@ -0,0 +1,400 @@
+"""
+Phân tích tin nhắn ghi chi tiêu bằng luật cục bộ (không gọi AI)
+
+- Số tiền kiểu nói tiếng Việt: "45k", "50 nghìn", "100 ngàn", "2.5tr", "1tr2",
+  "1 triệu rưỡi", "1 triệu 200 nghìn", "2 củ", "3 trăm", "50.000đ", "150000".
+- Nhiều khoản trong một tin: phân tách bằng dấu phẩy, "và", "+" hoặc xuống dòng.
+- Ngày ở đầu tin (áp dụng cho mọi khoản) hoặc đầu/cuối từng khoản:
+  "hôm qua", "5/9", "ngày 5/9/2024", "thứ hai", "tuần trước"...
+
+Câu hỏi chỉ đọc (parse_query): "thống kê tháng 8", "báo cáo từ 1/8 đến 15/8",
+"ăn uống tuần này", "danh mục", "xuất excel tháng trước", "hướng dẫn".
+
+Kết quả cùng dạng với AI (EXPENSE / MULTIPLE_EXPENSES / STATS / CATEGORY_STATS...).
+Tin nhắn nào không chắc chắn (thu nhập, vay, số không rõ đơn vị, từ lạ...) trả về
+None để AI xử lý.
+So sánh với bộ tin nhắn mẫu: `python admin_cli.py benchmark-nlp`.
+"""
+
+import re
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from services.category_rules import EXPENSE_CATEGORIES, FALLBACK_CATEGORY
+
+_UNIT_VALUES = {
+    'k': 1_000, 'nghìn': 1_000, 'ngàn': 1_000,
+    'trăm': 100_000,
+    'tr': 1_000_000, 'triệu': 1_000_000, 'củ': 1_000_000, 'm': 1_000_000,
+    'tỷ': 1_000_000_000, 'tỉ': 1_000_000_000,
+    'đ': 1, 'đồng': 1, 'vnd': 1, 'vnđ': 1,
+}
+
+# Số + đơn vị; phần sau đơn vị lớn: "1tr2", "1 triệu 2", "1 triệu 200 nghìn", "1 triệu rưỡi"
+_AMOUNT_PATTERN = re.compile(
+    r"(?<![\w/.,])(?<!năm )(?P<num>\d+(?:[.,]\d+)*)\s*"
+    r"(?:"
+    r"(?P<big>tỷ|tỉ|triệu|tr|củ|m)"
+    r"(?:\s*(?P<big_half>rưỡi)|(?P<tail>\d{1,3})|\s+(?P<sub>\d{1,3})\s*(?:k|nghìn|ngàn)|\s+(?P<spaced_tail>\d{1,3}))?"
+    r"|(?P<hundred>trăm)(?:\s*(?:nghìn|ngàn|k))?(?:\s*(?P<hundred_half>rưỡi))?"
+    r"|(?P<small>k|nghìn|ngàn)(?:\s*(?P<small_half>rưỡi))?"
+    r"|(?P<dong>đồng|đ|vnđ|vnd)"
+    r")?(?![\w/])"
+)
+
+# Từ chỉ ngày - khớp đầu/cuối một khoản
+_DATE_WORDS = (
+    r"hôm nay|hôm qua|hôm kia|bữa qua|nay|tuần trước|tháng trước|chủ nhật|"
+    r"thứ (?:hai|ba|tư|năm|sáu|bảy|[2-7])"
+)
+# Giới từ đi kèm ngày ("đổ xăng 50k ở 5/9", "vào hôm qua ăn phở 50k") được bỏ cùng ngày
+_DATE_TOKEN = (
+    rf"(?:(?:ở|vào|lúc|hồi)\s+)?(?:ngày\s+)?"
+    rf"(?P<date>\d{{1,2}}/\d{{1,2}}(?:/\d{{2,4}})?|{_DATE_WORDS})"
+)
+_LEADING_DATE = re.compile(rf"^{_DATE_TOKEN}(?![\w/])[\s,:\-]*")
+_TRAILING_DATE = re.compile(rf"(?:^|[\s,\-]+){_DATE_TOKEN}$")
+# Còn ngày (kể cả "tháng 8") ở giữa mô tả → không chắc áp dụng cho khoản nào, để AI xử lý
+_ANY_DATE = re.compile(rf"(?<![\w/])(?:\d{{1,2}}/\d{{1,2}}|tháng\s+\d+|{_DATE_WORDS})(?![\w/])")
+_DATE_ALIASES = {'nay': 'hôm nay', 'bữa qua': 'hôm qua'}
+
+_ITEM_SEPARATOR = re.compile(r"\s*(?:(?<!\d),|,(?!\d)|;|\+|\s(?:và|&)\s)\s*")
+_FILLER_WORDS = ('chi tiêu', 'chi(?! phí)', 'tiêu', 'hết', 'mất', 'tốn', 'giá', 'là')
+# Tiểu từ cuối câu ("45k bún nha")
+_PARTICLES = ('nha', 'nhé', 'nhe', 'nhen', 'ạ')
+_FILLER_PATTERN = re.compile(
+    rf"^(?:(?:{'|'.join(_FILLER_WORDS)})(?!\w)|[:=\-])\s*"
+    rf"|\s*(?:(?<!\w)(?:{'|'.join(_FILLER_WORDS + _PARTICLES)})|[:=\-])$"
+)
+# Không phải khoản chi thường - để luật thu nhập/vay mượn hoặc AI xử lý
+_NOT_EXPENSE = re.compile(
+    r"(?<!\w)(?:thu|lương|thưởng|nhận|được|vay|mượn|nợ|bán|hoàn tiền|lãi|cổ tức|"
+    r"thống kê|báo cáo|tổng kết|danh mục|xuất|export|help|hướng dẫn|trợ giúp)(?!\w)"
+)
+
+
+def _to_number(num: str) -> Optional[float]:
+    """"50.000" → 50000 (phân cách nghìn), "2.5"/"2,5" → 2.5"""
+    if re.fullmatch(r"\d{1,3}(?:[.,]\d{3})+", num):
+        return float(re.sub(r"[.,]", '', num))
+    if re.fullmatch(r"\d+(?:[.,]\d+)?", num):
+        return float(num.replace(',', '.'))
+    return None
+
+
+def _match_value(match: re.Match) -> Optional[int]:
+    """Giá trị VND của một lần khớp _AMOUNT_PATTERN (None nếu không phải số tiền)"""
+    number = _to_number(match.group('num'))
+    if number is None:
+        return None
+
+    if match.group('big'):
+        unit = _UNIT_VALUES[match.group('big')]
+        value = number * unit
+        tail = match.group('tail') or match.group('spaced_tail')
+        if match.group('big_half'):
+            value += unit / 2
+        elif tail:
+            # "1tr2" = 1.2 triệu, "1tr05" = 1.05 triệu
+            value += int(tail) / 10 ** len(tail) * unit
+        elif match.group('sub'):
+            value += int(match.group('sub')) * 1_000
+    elif match.group('hundred'):
+        value = number * 100_000 + (50_000 if match.group('hundred_half') else 0)
+    elif match.group('small'):
+        value = number * 1_000 + (500 if match.group('small_half') else 0)
+    else:
+        # Không đơn vị hoặc chỉ có "đ": phải là số nguyên, không đơn vị thì từ 4 chữ số
+        if number != int(number):
+            return None
+        if not match.group('dong') and len(re.sub(r"\D", '', match.group('num'))) < 4:
+            return None
+        value = number
+    return int(round(value))
+
+
+def find_amounts(text: str) -> List[Dict[str, Any]]:
+    """Các số tiền trong text: [{'amount', 'start', 'end'}] theo thứ tự xuất hiện"""
+    amounts = []
+    for match in _AMOUNT_PATTERN.finditer(text.lower()):
+        value = _match_value(match)
+        if value:
+            amounts.append({'amount': value, 'start': match.start(), 'end': match.end()})
+    return amounts
+
+
+def parse_amount(text: str) -> Optional[int]:
+    """Số tiền duy nhất trong text (None nếu không có hoặc có nhiều hơn một)"""
+    amounts = find_amounts(text)
+    return amounts[0]['amount'] if len(amounts) == 1 else None
+
+
+def _is_valid_date(value: str, year: Optional[int] = None) -> bool:
+    """
+    Ngày dd/mm(/yyyy) có tồn tại trong năm handler sẽ dùng không ("31/2" → False)
+
+    Không ghi năm: năm hiện tại, lùi về năm trước nếu ngày còn ở tương lai - giống
+    parse_custom_date và handler._get_date_range_with_specific_value; year: ép năm cụ thể.
+    """
+    parts = [int(part) for part in value.split('/')]
+    day, month = parts[0], parts[1]
+    try:
+        if len(parts) > 2:
+            datetime(parts[2] + 2000 if parts[2] < 100 else parts[2], month, day)
+        elif year is not None:
+            datetime(year, month, day)
+        else:
+            now = datetime.now()
+            if datetime(now.year, month, day) > now:
+                datetime(now.year - 1, month, day)
+        return True
+    except ValueError:
+        return False
+
+
+def _is_valid_range(start: str, end: str) -> bool:
+    """
+    Khoảng dd/mm - dd/mm hợp lệ theo cách handler dựng: cả hai ngày trong năm hiện tại,
+    ngày đầu sau ngày cuối ("25/12 đến 5/1") thì ngày đầu thuộc năm trước
+    """
+    year = datetime.now().year
+    if not _is_valid_date(start, year) or not _is_valid_date(end, year):
+        return False
+    start_day, start_month = (int(part) for part in start.split('/'))
+    end_day, end_month = (int(part) for part in end.split('/'))
+    return (start_month, start_day) <= (end_month, end_day) or _is_valid_date(start, year - 1)
+
+
+def _take_date(text: str):
+    """Tách ngày ở đầu hoặc cuối một đoạn → (ngày hoặc None, phần còn lại)"""
+    match = _LEADING_DATE.match(text)
+    if not match:
+        match = _TRAILING_DATE.search(text)
+    if not match:
+        return None, text
+    date = match.group('date')
+    if '/' in date and not _is_valid_date(date):
+        # Ngày không tồn tại - để nguyên trong mô tả, khoản bị từ chối và chuyển cho AI
+        return None, text
+    return _DATE_ALIASES.get(date, date), (text[:match.start()] + ' ' + text[match.end():]).strip()
+
+
+def _clean_description(text: str) -> str:
+    """Bỏ từ nối quanh số tiền ("ăn sáng hết" → "ăn sáng")"""
+    text = ' '.join(text.split())
+    while True:
+        cleaned = _FILLER_PATTERN.sub('', text).strip(' ,.')
+        if cleaned == text:
+            return text
+        text = cleaned
+
+
+def parse_expense_items(message: str) -> Optional[List[Dict[str, Any]]]:
+    """
+    Tách tin nhắn thành các khoản chi
+
+    Returns:
+        Optional[List[Dict]]: [{'amount', 'description', 'custom_date'}], None nếu
+        tin nhắn không chắc là khoản chi (để AI xử lý)
+    """
+    text = ' '.join(str(message or '').lower().replace('\n', ' , ').split())
+    if not text or '?' in text or _NOT_EXPENSE.search(text):
+        return None
+
+    message_date, text = _take_date(text)
+    segments = [segment for segment in _ITEM_SEPARATOR.split(text) if segment]
+
+    items, pending = [], []
+    for segment in segments:
+        date, segment = _take_date(segment)
+        amounts = find_amounts(segment)
+        if not amounts:
+            # "bún và phở 80k" - phần chưa có số tiền gộp vào khoản kế tiếp
+            if date:
+                return None
+            pending.append(segment)
+            continue
+        if len(amounts) > 1:
+            return None
+
+        amount = amounts[0]
+        description = _clean_description(
+            ' và '.join(pending + [segment[:amount['start']] + ' ' + segment[amount['end']:]])
+        )
+        pending = []
+        if not re.search(r"[^\W\d_]", description) or _ANY_DATE.search(description):
+            return None
+        items.append({'amount': amount['amount'], 'description': description, 'custom_date': date})
+
+    if pending or not items:
+        return None
+
+    dated = [item for item in items if item['custom_date']]
+    if not message_date and len(dated) == 1 and dated[0] is items[-1] and len(items) > 1:
+        # "bún 30k, phở 40k hôm qua" - ngày cuối tin áp dụng cho cả tin
+        message_date = dated[0]['custom_date']
+    for item in items:
+        item['custom_date'] = item['custom_date'] or message_date
+    return items
+
+
+def build_expense_result(items: List[Dict[str, Any]], confidence: float = 0.85) -> Dict[str, Any]:
+    """
+    Kết quả intent cùng dạng AI từ các khoản đã có category
+
+    Như prompt AI: nhiều món cùng danh mục, cùng ngày → một EXPENSE cộng tổng;
+    khác danh mục (hoặc chưa biết danh mục) → MULTIPLE_EXPENSES.
+    """
+    first = items[0]
+    same_group = all(
+        item['category'] and item['category'] == first['category'] and item['custom_date'] == first['custom_date']
+        for item in items
+    )
+    if len(items) == 1 or same_group:
+        return {
+            'intent': 'EXPENSE',
+            'confidence': confidence,
+            'data': {
+                'amount': sum(item['amount'] for item in items),
+                'description': ' và '.join(item['description'] for item in items),
+                'category': first['category'],
+                'custom_date': first['custom_date'],
+            }
+        }
+    return {
+        'intent': 'MULTIPLE_EXPENSES',
+        'confidence': confidence,
+        'data': {'transactions': [dict(item) for item in items]}
+    }
+
+
+# ---- Câu hỏi chỉ đọc: thống kê / danh mục / xuất dữ liệu / hướng dẫn ----
+
+# (pattern, hàm → (time_period, specific_value) hoặc None nếu ngày không tồn tại) - cùng
+# quy ước với QUERY_PROMPT và handler._get_date_range_with_specific_value; thứ tự: cụ thể trước, chung sau
+_PERIOD_RULES = tuple((re.compile(rf"(?<![\w/])(?:{pattern})(?!\w)"), convert) for pattern, convert in (
+    (r"(?:từ\s+)?(?:ngày\s+)?(\d{1,2})/(\d{1,2})\s*(?:đến|tới|-|~)\s*(?:ngày\s+)?(\d{1,2})/(\d{1,2})(?![\d/])",
+     lambda m: ('custom', '%02d/%02d-%02d/%02d' % tuple(int(part) for part in m.groups()))
+     if _is_valid_range('%s/%s' % m.group(1, 2), '%s/%s' % m.group(3, 4)) else None),
+    (r"(?:ngày\s+)?(\d{1,2}/\d{1,2})(?![\d/])", lambda m: ('ngay', m.group(1)) if _is_valid_date(m.group(1)) else None),
+    (r"(?:ngày\s+)?hôm (qua|kia)", lambda m: ('ngay', f"hôm {m.group(1)}")),
+    (r"(?:ngày\s+)?hôm nay|bữa nay", lambda m: ('ngay', None)),
+    (r"tuần (?:trước|rồi)", lambda m: ('tuan', 'tuan_truoc')),
+    (r"tháng (?:trước|rồi)", lambda m: ('thang', 'thang_truoc')),
+    (r"tháng (1[0-2]|0?[1-9])(?![\d/])", lambda m: ('thang', str(int(m.group(1))))),
+    (r"năm (\d{4})", lambda m: ('nam', m.group(1))),
+    (r"năm (?:ngoái|trước|rồi)", lambda m: ('nam', str(datetime.now().year - 1))),
+    (r"(?:trong\s+)?(?:theo\s+)?(?P<unit>tuần|tháng|năm)(?: (?:này|nay|hiện tại))?",
+     lambda m: ({'tuần': 'tuan', 'tháng': 'thang', 'năm': 'nam'}[m.group('unit')], None)),
+    (r"nay", lambda m: ('ngay', None)),
+))
+
+_HELP_WORDS = ('hướng dẫn sử dụng', 'hướng dẫn', 'trợ giúp', 'cách sử dụng', 'cách dùng', 'help', 'giúp đỡ')
+_EXPORT_WORDS = ('xuất dữ liệu', 'xuất file', 'xuất báo cáo', 'tải file', 'tải dữ liệu', 'xuất', 'export', 'tải về')
+_STATS_WORDS = ('thống kê', 'báo cáo', 'tổng kết', 'tổng hợp', 'tổng thu chi', 'thu chi')
+_CATEGORY_LIST_WORDS = ('danh sách danh mục', 'các danh mục', 'danh mục')
+_TOP_WORDS = ('top chi tiêu', 'chi nhiều nhất', 'chi tiêu nhiều nhất')
+_QUERY_CATEGORY_NAMES = ('xăng xe',) + tuple(
+    category.lower() for category in EXPENSE_CATEGORIES if category != FALLBACK_CATEGORY
+)
+# Từ đệm được phép còn lại sau khi đã nhận ra ý định và thời gian
+_QUERY_FILLERS = (
+    'cho tôi', 'cho mình', 'cho em', 'giúp tôi', 'giúp mình', 'giúp em', 'bot ơi', 'bot', 'ơi',
+    'xem', 'coi', 'muốn', 'tôi', 'mình', 'em', 'chi tiêu', 'chi phí', 'tiền', 'khoản',
+    'của', 'trong', 'theo', 'ra', 'file', 'dạng', 'định dạng', 'đi', 'với', 'nhé', 'nha', 'ạ', 'đã',
+    'tất cả', 'toàn bộ', 'các', 'sao', 'bao nhiêu', 'thế nào', 'như thế nào', 'luôn',
+)
+
+
+def _phrase_pattern(phrases) -> re.Pattern:
+    return re.compile(rf"(?<!\w)(?:{'|'.join(sorted(map(re.escape, phrases), key=len, reverse=True))})(?!\w)")
+
+
+_HELP_PATTERN = _phrase_pattern(_HELP_WORDS)
+_EXPORT_PATTERN = _phrase_pattern(_EXPORT_WORDS)
+_STATS_PATTERN = _phrase_pattern(_STATS_WORDS)
+_CATEGORY_LIST_PATTERN = _phrase_pattern(_CATEGORY_LIST_WORDS)
+_TOP_PATTERN = _phrase_pattern(_TOP_WORDS)
+_CATEGORY_NAME_PATTERN = _phrase_pattern(_QUERY_CATEGORY_NAMES)
+_FORMAT_PATTERN = re.compile(r"(?<!\w)(excel|xlsx|csv)(?!\w)")
+_QUERY_FILLER_PATTERN = _phrase_pattern(_QUERY_FILLERS)
+
+
+def _take_period(text: str):
+    """
+    Tách một mốc thời gian khỏi câu hỏi → (time_period, specific_value, phần còn lại)
+
+    Không có mốc → (None, None, text). Có hai mốc trở lên hoặc ngày không tồn tại
+    ("31/2") → raise ValueError (không chắc người dùng muốn khoảng nào, để AI xử lý).
+    """
+    found = None
+    for pattern, convert in _PERIOD_RULES:
+        match = pattern.search(text)
+        if not match:
+            continue
+        if found:
+            raise ValueError("nhiều mốc thời gian")
+        found = convert(match)
+        if found is None:
+            raise ValueError(f"ngày không hợp lệ: {match.group(0)}")
+        text = f"{text[:match.start()]} {text[match.end():]}"
+    if not found:
+        return None, None, text
+    return found[0], found[1], text
+
+
+def parse_query(message: str) -> Optional[Dict[str, Any]]:
+    """
+    Nhận diện câu hỏi chỉ đọc: STATS, CATEGORY_STATS, CATEGORY_LIST, HELP, EXPORT
+
+    Kết quả cùng dạng AI (data: time_period, specific_value, category_name, format).
+    Chỉ trả kết quả khi mọi từ trong tin đều được hiểu (ý định, mốc thời gian, từ
+    đệm); còn lại từ lạ, số tiền hoặc nhiều mốc thời gian → None để AI xử lý.
+    """
+    text = ' '.join(re.sub(r"[?!.,;:]+", ' ', str(message or '').lower()).split())
+    if not text or text.startswith('/') or find_amounts(text):
+        return None
+
+    try:
+        time_period, specific_value, rest = _take_period(text)
+    except ValueError:
+        return None
+
+    data: Dict[str, Any] = {}
+    if _HELP_PATTERN.search(rest):
+        if time_period:
+            return None
+        intent, rest = 'HELP', _HELP_PATTERN.sub(' ', rest)
+    elif _EXPORT_PATTERN.search(rest):
+        formats = set(_FORMAT_PATTERN.findall(rest))
+        intent, rest = 'EXPORT', _FORMAT_PATTERN.sub(' ', _EXPORT_PATTERN.sub(' ', rest))
+        data['format'] = 'xlsx' if formats & {'excel', 'xlsx'} else 'csv'
+        time_period = time_period or 'nam'
+    elif _TOP_PATTERN.search(rest):
+        intent, rest = 'CATEGORY_STATS', _TOP_PATTERN.sub(' ', rest)
+        data['category_name'] = 'top chi tiêu'
+    elif _CATEGORY_NAME_PATTERN.search(rest):
+        names = _CATEGORY_NAME_PATTERN.findall(rest)
+        if len(set(names)) > 1:
+            return None
+        intent, rest = 'CATEGORY_STATS', _CATEGORY_NAME_PATTERN.sub(' ', rest)
+        data['category_name'] = names[0]
+    elif _CATEGORY_LIST_PATTERN.search(rest):
+        # "danh mục" kèm thống kê hoặc mốc thời gian → chi tiêu theo mọi danh mục
+        asks_stats = time_period or _STATS_PATTERN.search(rest)
+        intent = 'CATEGORY_STATS' if asks_stats else 'CATEGORY_LIST'
+        rest = _CATEGORY_LIST_PATTERN.sub(' ', rest)
+    elif _STATS_PATTERN.search(rest):
+        intent = 'STATS'
+    else:
+        return None
+
+    rest = _QUERY_FILLER_PATTERN.sub(' ', _STATS_PATTERN.sub(' ', rest))
+    if rest.strip():
+        return None
+
+    if intent in ('STATS', 'CATEGORY_STATS', 'EXPORT'):
+        data['time_period'] = time_period or 'thang'
+        if specific_value:
+            data['specific_value'] = specific_value
+    return {'intent': intent, 'confidence': 0.85, 'data': data}
@@ -0,0 +1,95 @@
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterator, List
+
+from services.storage_backend import StorageBackend
+
+logger = logging.getLogger(__name__)
+
+
+class InMemoryStorageBackend(StorageBackend):
+    """Lưu giao dịch trong RAM - dùng để benchmark/load test, mất dữ liệu khi restart"""
+
+    _instances: Dict[str, 'InMemoryStorageBackend'] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, namespace: str = 'default'):
+        self.namespace = namespace
+        self._transactions: Dict[str, List[Dict]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, namespace: str = 'default') -> 'InMemoryStorageBackend':
+        """Lấy backend của namespace (giữ dữ liệu giữa các lần gọi)"""
+        with cls._instances_lock:
+            if namespace not in cls._instances:
+                cls._instances[namespace] = cls(namespace)
+            return cls._instances[namespace]
+
+    def add_transaction(self, transaction_type: str, amount: float, category: str,
+                        note: str, user_name: str, custom_date: str = None) -> bool:
+        try:
+            from utils.date_utils import parse_custom_date
+
+            with self._lock:
+                self._transactions[user_name].append({
+                    'date': parse_custom_date(custom_date),
+                    'type': transaction_type,
+                    'amount': float(amount),
+                    'category': category,
+                    'note': note,
+                    'user': user_name
+                })
+            return True
+        except Exception as e:
+            logger.error(f"❌ Lỗi thêm giao dịch cho {user_name}: {e}")
+            return False
+
+    def add_transactions(self, user_name: str, transactions: List[Dict]) -> int:
+        with self._lock:
+            self._transactions[user_name].extend(
+                {
+                    'date': transaction['date'],
+                    'type': transaction['type'],
+                    'amount': float(transaction['amount']),
+                    'category': transaction['category'],
+                    'note': transaction['note'],
+                    'user': user_name
+                }
+                for transaction in transactions
+            )
+        return len(transactions)
+
+    def get_transactions(self, user_name: str, start_date: datetime = None, end_date: datetime = None,
+                         transaction_type: str = None) -> List[Dict]:
+        with self._lock:
+            transactions = list(self._transactions.get(user_name, []))
+
+        return [
+            dict(transaction)
+            for transaction in transactions
+            if (not start_date or transaction['date'] >= start_date)
+            and (not end_date or transaction['date'] <= end_date)
+            and (not transaction_type or transaction['type'] == transaction_type)
+        ]
+
+    def iter_transactions(self, user_name: str, start_date: datetime = None, end_date: datetime = None,
+                          chunk_size: int = 1000) -> Iterator[List[Dict]]:
+        # Chụp danh sách trong lock như get_transactions - luồng khác vẫn ghi thêm được
+        with self._lock:
+            transactions = list(self._transactions.get(user_name, []))
+
+        for index in range(0, len(transactions), chunk_size):
+            chunk = [
+                dict(transaction)
+                for transaction in transactions[index:index + chunk_size]
+                if (not start_date or transaction['date'] >= start_date)
+                and (not end_date or transaction['date'] <= end_date)
+            ]
+            if chunk:
+                yield chunk
+
+    def get_sheet_url(self) -> str:
+        return f"memory://{self.namespace}"
@@ -1,10 +1,23 @@
 import os
 import logging
-import json
+import re
+import threading
+from collections import Counter
 from typing import Optional, Dict, Any
 from datetime import datetime
 from dotenv import load_dotenv
-from services.gemini_ai import GeminiAIService
+from services.category_memo import get_category_memo
+from services.category_rules import match_category
+from services.circuit_breaker import CircuitOpenError
+from services.gemini_ai import get_ai_service
+from services.intent_cache import IntentCache, get_intent_cache
+from services.local_parser import build_expense_result, parse_expense_items, parse_query
+from services.nlp_prompts import (
+    DATA_FIELDS, FAMILY_OTHER, FAMILY_TRANSACTION, KNOWN_INTENTS, build_family_prompt, build_legacy_prompt,
+    build_response_schema, build_router_prompt, estimate_tokens, parse_router_reply, route_message
+)
+from utils.json_utils import extract_json_fields, parse_json_lenient
+from services.template_cache import TemplateCache, get_template_cache
 
 # Load environment variables
 load_dotenv()
@@ -15,323 +28,225 @@ class NaturalLanguageProcessor:
     """Xử lý ngôn ngữ tự nhiên để hiểu ý định người dùng"""
     
     def __init__(self):
-        self.ai_service = GeminiAIService()
+        self.ai_service = get_ai_service()
+        self.intent_cache = get_intent_cache() if IntentCache.is_enabled() else None
+        self.template_cache = get_template_cache() if TemplateCache.is_enabled() else None
+        self.category_memo = get_category_memo()
+        # Router + prompt ngắn theo nhóm intent thay cho prompt cũ ~6k token
+        self.staged_prompts = os.getenv('NLP_STAGED_PROMPTS', 'true').lower() == 'true'
+        self._stats = Counter()
+        self._stats_lock = threading.Lock()
         
-    def process_message(self, message: str) -> Optional[Dict[str, Any]]:
+    def process_message(self, message: str, user_key: str = None) -> Optional[Dict[str, Any]]:
         """
         Phân tích tin nhắn tự nhiên và trả về intent + data
         CHỈ XỬ LÝ CÁC TIN NHẮN LIÊN QUAN ĐẾN TÀI CHÍNH
         
         Args:
             message: Tin nhắn từ người dùng
+            user_key: Key sổ giao dịch của user (để dùng danh mục user đã học)
             
         Returns:
             Dict với intent, action, và data hoặc None nếu không liên quan tài chính
         """
+        result = self._lookup_without_ai(message, user_key)
+        if result:
+            return result
+
+        if not self.ai_service.is_enabled():
+            return self._fallback_process(message)
+
+        try:
+            result = self._analyze_with_ai(message)
+        except CircuitOpenError:
+            # Gemini đang lỗi/chậm - trả lời ngay bằng xử lý cục bộ
+            self._count('circuit_open')
+            return self._fallback_process(message)
+        except Exception as e:
+            logger.error(f"Lỗi xử lý ngôn ngữ tự nhiên: {e}")
+            return self._fallback_process(message)
+        return self._finish_ai_result(message, result)
+
+    async def process_message_async(self, message: str, user_key: str = None) -> Optional[Dict[str, Any]]:
+        """
+        Bản async của process_message cho handler - lệnh gọi Gemini không chặn event loop
+
+        Mỗi lệnh gọi có hạn chót GEMINI_TIMEOUT_SECONDS; hết hạn trên mọi key thì
+        trả về fallback như khi AI lỗi. Task bị hủy thì CancelledError được truyền ra.
+        """
+        result = self._lookup_without_ai(message, user_key)
+        if result:
+            return result
+
+        if not self.ai_service.is_enabled():
+            return self._fallback_process(message)
+
+        try:
+            result = await self._analyze_with_ai_async(message)
+        except CircuitOpenError:
+            # Gemini đang lỗi/chậm - trả lời ngay bằng xử lý cục bộ
+            self._count('circuit_open')
+            return self._fallback_process(message)
+        except Exception as e:
+            logger.error(f"Lỗi xử lý ngôn ngữ tự nhiên: {e}")
+            return self._fallback_process(message)
+        return self._finish_ai_result(message, result)
+
+    def _lookup_without_ai(self, message: str, user_key: str = None) -> Optional[Dict[str, Any]]:
+        """Kết quả không cần gọi AI: phân loại nhanh, cache intent, cache khuôn tin nhắn"""
         # Try fast processing first for simple messages
-        quick_result = self._quick_classify(message)
+        quick_result = self._quick_classify(message, user_key)
         if quick_result:
             logger.info(f"⚡ Quick classified: {message[:20]}... -> {quick_result['intent']}")
             return quick_result
         
-        if not self.ai_service.is_enabled():
-            return self._fallback_process(message)
+        # Tin nhắn đã hỏi AI trước đó (lặp lại nguyên văn hoặc chỉ khác hoa/thường, khoảng trắng)
+        if self.intent_cache:
+            cached_result = self.intent_cache.get(message)
+            if cached_result:
+                logger.info(f"💾 Intent cache: {message[:20]}... -> {cached_result.get('intent')}")
+                return cached_result
         
-        try:
-            prompt = f"""
-Phân tích tin nhắn sau và xác định có liên quan đến quản lý tài chính không:
-
-Tin nhắn: "{message}"
-
-CHỈ XỬ LÝ các ý định liên quan đến tài chính:
-1. EXPENSE (Chi tiêu): 
-   - Một món: "500k trà sữa", "mua áo 300k", "200k xăng"
-   - Nhiều món cùng danh mục: "bún 80k và phở 150k" → CỘNG TỔNG: 80000 + 150000 = 230000
-   - QUAN TRỌNG - Nhiều món KHÁC danh mục: "bún 12k, gà 20k, laptop 1.5m, 200k xăng" → TỰ ĐỘNG TÁCH THÀNH NHIỀU GIAO DỊCH
-   - QUAN TRỌNG - Khác danh mục với từ kết nối: "480k nướng, 575k siêu thị" → TÁCH THÀNH 2 GIAO DỊCH RIÊNG
-   - QUAN TRỌNG - KÈM NGÀY CỤ THỂ: "5/9 bánh 200k", "hôm qua 80k đi chợ", "tuần trước mua áo 300k"
-2. INCOME (Thu nhập): "thu 5m lương", "5m lương", "nhận 1tr", "được 500k"
-   - QUAN TRỌNG - KÈM NGÀY CỤ THỂ: "2/9 thưởng 500k", "hôm qua nhận 1tr", "thứ hai lương 5m"
-3. LENDING (Cho vay): "cho vay", "cho mượn", "vay cho", "mượn cho", "cho bạn vay"
-   - Đơn giản: "cho vay 1tr", "cho An mượn 500k", "vay cho Nam 2m"
-   - Chi tiết: "cho bạn vay 10tr trong đó 6tr tiền nhà, 4tr tiền tiết kiệm"
-   - QUAN TRỌNG - KÈM NGÀY CỤ THỂ: "hôm qua cho vay 1tr", "5/9 cho An mượn 500k"
-4. BORROWING (Đi vay): "vay tiền", "mượn tiền", "vay", "mượn"  
-   - Đơn giản: "vay 2tr", "mượn bạn 500k", "vay Nam 1tr"
-   - Chi tiết: "vay 5tr từ anh Minh để trả nợ"
-   - QUAN TRỌNG - KÈM NGÀY CỤ THỂ: "hôm qua vay 1tr", "tuần trước mượn 500k"
-3. STATS (Thống kê tổng): 
-   - Mặc định: "thống kê", "báo cáo", "tổng kết" → THÁNG HIỆN TẠI
-   - Cụ thể: "thống kê tháng trước", "báo cáo tháng 8", "thống kê tuần này", "thống kê hôm nay"
-4. CATEGORY_STATS (Thống kê danh mục cụ thể):
-   - Mặc định: "thống kê ăn uống", "top chi tiêu", "ăn uống" → THÁNG HIỆN TẠI  
-   - Cụ thể: "ăn uống tháng 8", "top chi tiêu tuần này", "thống kê xăng xe tháng trước"
-   - QUAN TRỌNG: "ăn uống hôm nay", "xăng xe hôm nay", "mua sắm ngày hôm nay" → NGÀY HIỆN TẠI
-
-HƯỚNG DẪN XỬ LÝ THỜI GIAN CHO AI - PHÂN TÍCH KỸ LƯỠNG:
-*** CHÚ Ý QUAN TRỌNG: PHẢI PHÂN TÍCH CHÍNH XÁC TỪ THỜI GIAN TRONG TIN NHẮN ***
-
-- "hôm nay", "ngày hôm nay", "[danh_mục] hôm nay", "ngày này" → time_period: "ngay"
-- "thống kê hôm qua", "báo cáo hôm qua", "thống kê ngày hôm qua" → time_period: "ngay", specific_value: "hôm qua"
-- "thống kê hôm kia", "báo cáo hôm kia", "thống kê ngày hôm kia" → time_period: "ngay", specific_value: "hôm kia"
-- "thống kê 2/9", "báo cáo 15/8", "thống kê ngày 02/09" → time_period: "ngay", specific_value: "2/9", "15/8", "02/09"
-- "tuần này", "tuần hiện tại", "[danh_mục] tuần này" → time_period: "tuan"  
-- "tháng này", "tháng hiện tại", "[danh_mục]" (CHÍNH XÁC KHÔNG có từ thời gian nào khác) → time_period: "thang"
-- "năm này", "năm hiện tại", "[danh_mục] năm này" → time_period: "nam"
-- "tháng trước", "[danh_mục] tháng trước" → time_period: "thang", specific_value: "thang_truoc"
-- "tháng 8", "tháng 12", "[danh_mục] tháng 8" → time_period: "thang", specific_value: "8" hoặc "12"
-- "tuần trước", "[danh_mục] tuần trước" → time_period: "tuan", specific_value: "tuan_truoc"
-
-*** CẨN THẬN: "ăn uống hôm nay" KHÁC VỚI "ăn uống" - PHẢI NHẬN DIỆN "hôm nay" ***
-
-HƯỚNG DẪN XỬ LÝ NGÀY THÁNG CHO CHI TIÊU/THU NHẬP:
-*** QUAN TRỌNG: PHẢI PHÂN TÍCH NGÀY THÁNG TRONG TIN NHẮN EXPENSE/INCOME ***
-
-NHẬN DIỆN NGÀY CỤ THỂ:
-- "5/9 bánh 200k", "2/9 thưởng 500k" → custom_date: "5/9", "2/9"
-- "15/8 mua áo 300k", "10/12 nhận lương" → custom_date: "15/8", "10/12"
-- "hôm qua 80k đi chợ", "hôm kia nhận 1tr" → custom_date: "hôm qua", "hôm kia"
-- "thứ hai mua sách 50k", "thứ ba lương 5m" → custom_date: "thứ hai", "thứ ba"
-- "tuần trước mua laptop", "tháng trước thưởng" → custom_date: "tuần trước", "tháng trước"
-- "500k trà sữa" (không có ngày) → custom_date: null
-
-CHÚ Ý: Nếu KHÔNG có ngày cụ thể → custom_date: null (ghi vào ngày hiện tại)
-
-QUAN TRỌNG - KHOẢNG THỜI GIAN CỤ THỂ:
-- "từ 01/08 đến 31/08", "từ 1/8 đến 31/8" → time_period: "custom", specific_value: "01/08-31/08"
-- "từ 01/09 đến 05/09", "từ 1/9 đến 5/9" → time_period: "custom", specific_value: "01/09-05/09"
-- "từ 15/12 đến 20/12" → time_period: "custom", specific_value: "15/12-20/12"
-- Bất kỳ "từ XX/XX đến YY/YY" → time_period: "custom", specific_value: "XX/XX-YY/YY"
-
-QUY TẮC TÍNH TOÁN SỐ TIỀN:
-- k = 1,000 (VD: 80k = 80000)
-- m/tr/triệu = 1,000,000 (VD: 1.5m = 1500000)
-- Nhiều món: PHẢI CỘNG TẤT CẢ (VD: "80k + 150k" = 230000, KHÔNG PHẢI 230)
-- Đơn vị: Luôn chuyển về VND (số nguyên)
-
-QUY TẮC PHÂN LOẠI DANH MỤC CHO EXPENSE - PHÂN TÍCH KỸ LƯỠNG:
-*** QUAN TRỌNG: PHẢI PHÂN TÍCH TỪ KHÓA CHÍNH XÁC ***
-
-- Ăn uống: 
-  * Món ăn: bún, phở, gà, rau, cơm, bánh, thịt, cá, tôm, nướng, luộc, xào, chiên, lẩu, nồi, canh, súp
-  * Thức uống: trà sữa, cà phê, nước, bia, rượu, sinh tố, nước ngọt, soda
-  * Địa điểm: nhà hàng, quán ăn, quán cà phê, quán nhậu, buffet, food court, căng tin
-  * Nguyên liệu: thịt, rau, củ, quả, gạo, mì, bánh mì, sữa, trứng, gia vị
-  * Đồ ăn vặt: bánh kẹo, snack, kẹo, chocolate, bánh quy
-
-- Di chuyển: xăng xe, vé xe buýt, taxi, grab, đi lại, gửi xe, xe ôm, bus, xanhsm, bee, tiền xe, phí đường, cầu phí
-
-- Mua sắm: quần áo, giày dép, đồ dùng, mỹ phẩm, điện tử, áo, giày, máy tính, laptop, điện thoại, túi xách
-
-- Giải trí: xem phim, game, du lịch, karaoke, bar, vui chơi, giải trí, concert, show
-
-- Y tế: thuốc, khám bệnh, nha khoa, bảo hiểm y tế, bác sĩ, bệnh viện, xét nghiệm
-
-- Học tập: sách vở, khóa học, học phí, văn phòng phẩm, sách, học, giáo dục
-
-- Nhà cửa: tiền nhà, điện nước, internet, sửa chữa, nhà, gas, wifi
-
-- Khác: những thứ THỰC SỰ không thuộc 7 danh mục trên
-
-QUY TẮC PHÂN LOẠI CHO LENDING & BORROWING:
-*** QUAN TRỌNG: LENDING và BORROWING luôn có category cố định ***
-
-- LENDING (Cho vay): category luôn là "Cho vay"
-  * Tất cả giao dịch cho vay đều ghi là "Cho vay"
-  * Mô tả chi tiết sẽ trong phần description
-
-- BORROWING (Đi vay): category luôn là "Đi vay" 
-  * Tất cả giao dịch vay đều ghi là "Đi vay"
-  * Mô tả chi tiết sẽ trong phần description
-
-*** LƯU Ý ĐẶC BIỆT - QUAN TRỌNG NHẤT: ***
-- "nướng" = NẤU ĂN → Ăn uống (KHÔNG PHẢI Khác!)
-- "luộc", "xào", "chiên" = NẤU ĂN → Ăn uống (KHÔNG PHẢI Khác!)
-- "thịt", "cá", "gà", "tôm" = THỰC PHẨM → Ăn uống (KHÔNG PHẢI Khác!)
-- "rau", "củ", "quả" = THỰC PHẨM → Ăn uống (KHÔNG PHẢI Khác!)
-- "đi chợ", "mua đồ ăn" = MUA THỰC PHẨM → Ăn uống (KHÔNG PHẢI Mua sắm!)
-
-*** TUYỆT ĐỐI KHÔNG ĐƯỢC PHÂN LOẠI SAI! ***
-
-*** QUY TẮC QUAN TRỌNG CHO MULTIPLE_EXPENSES: ***
-- PHẢI nhận diện chính xác khi có nhiều món KHÁC danh mục
-- VD: "480k nướng, 575k siêu thị" = KHÁC danh mục → MULTIPLE_EXPENSES
-
-CÁCH PHÂN TÍCH ĐÚNG:
-1. "480k nướng" → Ăn uống
-2. "575k siêu thị" → Mua sắm  
-3. Ăn uống ≠ Mua sắm → MULTIPLE_EXPENSES
-
-KẾT QUẢ PHẢI TẠO cho "hôm qua 480k nướng, 575k siêu thị":
-{{"intent": "MULTIPLE_EXPENSES", "data": {{"transactions": [
-  {{"amount": 480000, "description": "nướng", "category": "Ăn uống", "custom_date": "hôm qua"}},
-  {{"amount": 575000, "description": "siêu thị", "category": "Mua sắm", "custom_date": "hôm qua"}}
-]}}}}
-
-CHÚ Ý: CẢ 2 transactions đều có custom_date: "hôm qua" vì từ thời gian ở ĐẦU tin nhắn
-
-*** VÍ DỤ CHO LENDING: ***
-Tin nhắn: "cho bạn vay 10tr trong đó 6tr tiền nhà, 4tr tiền tiết kiệm của anh"
-Kết quả đúng:
-{{
-    "intent": "LENDING",
-    "confidence": 0.95,
-    "data": {{
-        "amount": 10000000,
-        "description": "cho bạn vay 10tr trong đó 6tr tiền nhà, 4tr tiền tiết kiệm",
-        "category": "Cho vay",
-        "custom_date": null,
-        "person": "bạn"
-    }}
-}}
-
-*** VÍ DỤ CHO BORROWING: ***
-Tin nhắn: "vay anh Nam 2tr để trả nợ"
-Kết quả đúng:
-{{
-    "intent": "BORROWING", 
-    "confidence": 0.95,
-    "data": {{
-        "amount": 2000000,
-        "description": "vay anh Nam 2tr để trả nợ",
-        "category": "Đi vay",
-        "custom_date": null,
-        "person": "anh Nam"
-    }}
-}}
-
-TUYỆT ĐỐI KHÔNG ĐƯỢC:
-- Gộp chung: amount=1055000, description="nướng và siêu thị"
-- Sai intent: EXPENSE thay vì MULTIPLE_EXPENSES
-
-*** LƯU Ý QUAN TRỌNG VỀ CUSTOM_DATE CHO MULTIPLE_EXPENSES: ***
-- Nếu có ngày ở đầu tin nhắn → TẤT CẢ transactions dùng cùng custom_date
-- VD: "hôm qua 480k nướng, 575k siêu thị" → custom_date: "hôm qua" cho CẢ 2 transactions
-- VD: "5/9 bún 12k, laptop 1.5m" → custom_date: "5/9" cho CẢ 2 transactions
-- Nếu KHÔNG có ngày → custom_date: null cho tất cả
-
-*** PHÂN TÍCH CUSTOM_DATE CHO MULTIPLE_EXPENSES: ***
-Step 1: Tìm từ thời gian ở ĐẦU tin nhắn ("hôm qua", "5/9", "thứ hai")
-Step 2: Nếu có → Áp dụng cho TẤT CẢ transactions trong array
-Step 3: Nếu không có → custom_date: null cho tất cả
-5. MULTIPLE_EXPENSES (Nhiều khoản chi khác danh mục): 
-   - Khi có items thuộc nhiều danh mục khác nhau
-   - PHẢI TÁCH RIÊNG từng khoản với amount và category riêng biệt
-   - KHÔNG ĐƯỢC gộp chung thành một transaction
-6. LENDING (Cho vay): "cho vay", "cho mượn", "vay cho", "mượn cho"
-7. BORROWING (Đi vay): "vay tiền", "mượn tiền", "vay", "mượn" 
-8. CATEGORY_LIST (Xem danh mục): "danh mục", "categories", "xem danh mục"
-9. HELP (Trợ giúp): "help", "hướng dẫn"
-
-KHÔNG XỬ LÝ:
-- Chào hỏi thông thường: "xin chào", "bạn khỏe không"
-- Câu hỏi cá nhân: "bạn ăn cơm chưa", "hôm nay thế nào"
-- Trò chuyện chung: "thời tiết", "tin tức"
-
-Nếu tin nhắn KHÔNG liên quan đến tài chính, trả về:
-{{
-    "intent": "HELP_GUIDE",
-    "confidence": 1.0,
-    "data": {{}}
-}}
-
-Nếu liên quan đến tài chính, trả về:
-{{
-    "intent": "EXPENSE|INCOME|LENDING|BORROWING|STATS|CATEGORY_STATS|CATEGORY_LIST|MULTIPLE_EXPENSES|HELP",
-    "confidence": 0.0-1.0,
-    "data": {{
-        "amount": số_tiền_hoặc_null (QUAN TRỌNG: Với nhiều món PHẢI CỘNG TỔNG tất cả, VD: 80k+150k=230000, KHÔNG được là 230),
-        "description": "mô_tả",
-        "category": "danh_mục" (cho EXPENSE/INCOME/LENDING/BORROWING - LENDING→"Cho vay", BORROWING→"Đi vay", PHẢI phân loại chính xác theo quy tắc trên),
-        "custom_date": "ngày_cụ_thể_hoặc_null" (VD: "5/9", "2/9", "hôm qua", "tuần trước", "thứ hai", null nếu không có),
-        "transactions": [array của nhiều giao dịch] (chỉ cho MULTIPLE_EXPENSES - mỗi transaction có amount, description, category, custom_date riêng),
-        "time_period": "ngay|tuan|thang|nam|custom" (cho STATS & CATEGORY_STATS, mặc định "thang"),
-        "specific_value": "số_hoặc_keyword" (VD: "8", "12", "thang_truoc", "tuan_truoc"),
-        "category_name": "tên_danh_mục" (chỉ cho CATEGORY_STATS, VD: "ăn uống", "xăng xe", "mua sắm"),
-        "person": "tên_người" (cho LENDING/BORROWING - người cho vay/đi vay, VD: "An", "bạn", "anh Minh")
-    }}
-}}
-
-VÍ DỤ CỤ THỂ CHO NHIỀU MÓN:
-- "bún 80k và phở 150k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 230000, "description": "bún và phở", "category": "Ăn uống", "custom_date": null}}}}
-- "bún 12k, gà 20k, rau 70k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 102000, "description": "bún, gà, rau", "category": "Ăn uống", "custom_date": null}}}}
-- "mua áo 300k và giày 200k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 500000, "description": "mua áo và giày", "category": "Mua sắm", "custom_date": null}}}}
-- "1.5m laptop và 500k chuột" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 2000000, "description": "laptop và chuột", "category": "Mua sắm", "custom_date": null}}}}
-- "hôm qua bún 80k và phở 150k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 230000, "description": "bún và phở", "category": "Ăn uống", "custom_date": "hôm qua"}}}}
-- "3/9 mua áo 300k và giày 200k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 500000, "description": "mua áo và giày", "category": "Mua sắm", "custom_date": "3/9"}}}}
-
-VÍ DỤ CHO MỘT MÓN:
-- "500k trà sữa" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 500000, "description": "trà sữa", "category": "Ăn uống", "custom_date": null}}}}
-- "480k nướng" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 480000, "description": "nướng", "category": "Ăn uống", "custom_date": null}}}}
-- "200k xăng xe" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 200000, "description": "xăng xe", "category": "Di chuyển", "custom_date": null}}}}
-- "150k thịt" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 150000, "description": "thịt", "category": "Ăn uống", "custom_date": null}}}}
-- "80k rau củ" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 80000, "description": "rau củ", "category": "Ăn uống", "custom_date": null}}}}
-
-VÍ DỤ CHO GIAO DỊCH CÓ NGÀY CỤ THỂ:
-- "5/9 bánh 200k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 200000, "description": "bánh", "category": "Ăn uống", "custom_date": "5/9"}}}}
-- "hôm qua 480k nướng" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 480000, "description": "nướng", "category": "Ăn uống", "custom_date": "hôm qua"}}}}
-- "hôm qua 80k đi chợ" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 80000, "description": "đi chợ", "category": "Ăn uống", "custom_date": "hôm qua"}}}}
-- "3/9 thịt nướng 350k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 350000, "description": "thịt nướng", "category": "Ăn uống", "custom_date": "3/9"}}}}
-- "2/9 thưởng 500k" → {{"intent": "INCOME", "confidence": 0.9, "data": {{"amount": 500000, "description": "thưởng", "category": "Thưởng", "custom_date": "2/9"}}}}
-- "thứ hai lương 5m" → {{"intent": "INCOME", "confidence": 0.9, "data": {{"amount": 5000000, "description": "lương", "category": "Lương", "custom_date": "thứ hai"}}}}
-- "tuần trước mua áo 300k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 300000, "description": "mua áo", "category": "Mua sắm", "custom_date": "tuần trước"}}}}
-
-VÍ DỤ CHO NHIỀU KHOẢN CHI KHÁC DANH MỤC:
-- "bún 12k, gà 20k, laptop 1.5m, 200k xăng" → {{"intent": "MULTIPLE_EXPENSES", "confidence": 0.9, "data": {{"transactions": [{{"amount": 32000, "description": "bún, gà", "category": "Ăn uống", "custom_date": null}}, {{"amount": 1500000, "description": "laptop", "category": "Mua sắm", "custom_date": null}}, {{"amount": 200000, "description": "xăng", "category": "Di chuyển", "custom_date": null}}]}}}}
-- "480k nướng, 575k siêu thị" → {{"intent": "MULTIPLE_EXPENSES", "confidence": 0.9, "data": {{"transactions": [{{"amount": 480000, "description": "nướng", "category": "Ăn uống", "custom_date": null}}, {{"amount": 575000, "description": "siêu thị", "category": "Mua sắm", "custom_date": null}}]}}}}
-- "hôm qua 480k nướng, 575k siêu thị" → {{"intent": "MULTIPLE_EXPENSES", "confidence": 0.9, "data": {{"transactions": [{{"amount": 480000, "description": "nướng", "category": "Ăn uống", "custom_date": "hôm qua"}}, {{"amount": 575000, "description": "siêu thị", "category": "Mua sắm", "custom_date": "hôm qua"}}]}}}}
-- "thứ hai 100k bánh, 500k laptop" → {{"intent": "MULTIPLE_EXPENSES", "confidence": 0.9, "data": {{"transactions": [{{"amount": 100000, "description": "bánh", "category": "Ăn uống", "custom_date": "thứ hai"}}, {{"amount": 500000, "description": "laptop", "category": "Mua sắm", "custom_date": "thứ hai"}}]}}}}
-- "5/9 bún 12k, gà 20k, laptop 1.5m, 200k xăng" → {{"intent": "MULTIPLE_EXPENSES", "confidence": 0.9, "data": {{"transactions": [{{"amount": 32000, "description": "bún, gà", "category": "Ăn uống", "custom_date": "5/9"}}, {{"amount": 1500000, "description": "laptop", "category": "Mua sắm", "custom_date": "5/9"}}, {{"amount": 200000, "description": "xăng", "category": "Di chuyển", "custom_date": "5/9"}}]}}}}
-
-VÍ DỤ CHO THỐNG KÊ:
-- "thống kê" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "thang"}}}}
-- "thống kê tháng trước" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "thang", "specific_value": "thang_truoc"}}}}
-- "báo cáo tháng 8" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "thang", "specific_value": "8"}}}}
-- "thống kê tuần này" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "tuan"}}}}
-- "thống kê 2/9" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "ngay", "specific_value": "2/9"}}}}
-- "báo cáo ngày 15/8" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "ngay", "specific_value": "15/8"}}}}
-- "thống kê ngày 02/09" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "ngay", "specific_value": "02/09"}}}}
-- "thống kê từ 01/08 đến 31/08" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "custom", "specific_value": "01/08-31/08"}}}}
-- "báo cáo từ 1/9 đến 5/9" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "custom", "specific_value": "01/09-05/09"}}}}
-- "thống kê hôm nay" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "ngay"}}}}
-- "thống kê hôm qua" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "ngay", "specific_value": "hôm qua"}}}}
-- "báo cáo hôm kia" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "ngay", "specific_value": "hôm kia"}}}}
-- "báo cáo ngày hôm nay" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "ngay"}}}}
-
-VÍ DỤ CHO THỐNG KÊ DANH MỤC:
-- "ăn uống" → {{"intent": "CATEGORY_STATS", "confidence": 0.9, "data": {{"category_name": "ăn uống", "time_period": "thang"}}}}
-- "ăn uống hôm nay" → {{"intent": "CATEGORY_STATS", "confidence": 0.9, "data": {{"category_name": "ăn uống", "time_period": "ngay"}}}}
-- "ăn uống tháng 8" → {{"intent": "CATEGORY_STATS", "confidence": 0.9, "data": {{"category_name": "ăn uống", "time_period": "thang", "specific_value": "8"}}}}
-- "xăng xe tuần này" → {{"intent": "CATEGORY_STATS", "confidence": 0.9, "data": {{"category_name": "xăng xe", "time_period": "tuan"}}}}
-- "mua sắm ngày hôm nay" → {{"intent": "CATEGORY_STATS", "confidence": 0.9, "data": {{"category_name": "mua sắm", "time_period": "ngay"}}}}
-- "top chi tiêu tuần này" → {{"intent": "CATEGORY_STATS", "confidence": 0.9, "data": {{"category_name": "top chi tiêu", "time_period": "tuan"}}}}
-
-Chỉ trả về JSON, không giải thích gì thêm.
-"""
-            
-            response = self.ai_service._generate_content(prompt)
-            
-            # Parse JSON response (remove markdown formatting if present)
-            try:
-                # Clean response - remove ```json and ``` if present
-                clean_response = response.strip()
-                if clean_response.startswith('```json'):
-                    clean_response = clean_response[7:]
-                if clean_response.endswith('```'):
-                    clean_response = clean_response[:-3]
-                clean_response = clean_response.strip()
-                
-                result = json.loads(clean_response)
-                logger.info(f"AI phân tích: '{message}' -> {result['intent']} ({result.get('confidence', 0):.2f})")
-                return result
-            except json.JSONDecodeError:
-                logger.warning(f"AI trả về JSON không hợp lệ: {response}")
-                return self._fallback_process(message)
-                
-        except Exception as e:
-            logger.error(f"Lỗi xử lý ngôn ngữ tự nhiên: {e}")
+        # Cùng cách diễn đạt, khác số tiền/ngày ("60k bún bò" sau "hôm qua 45k bún bò")
+        if self.template_cache:
+            cached_result = self.template_cache.get(message)
+            if cached_result:
+                logger.info(f"💾 Template cache: {message[:20]}... -> {cached_result.get('intent')}")
+                return cached_result
+        return None
+
+    def _finish_ai_result(self, message: str, result: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Lưu kết quả AI vào cache (fallback nếu AI không trả được intent)"""
+        if result is None:
             return self._fallback_process(message)
-    
+
+        logger.info(f"AI phân tích: '{message}' -> {result['intent']} ({result.get('confidence', 0):.2f})")
+        if self.intent_cache:
+            self.intent_cache.put(message, result)
+        if self.template_cache:
+            self.template_cache.put(message, result)
+        return result
+
+    def _analyze_with_ai(self, message: str) -> Optional[Dict[str, Any]]:
+        """Phân tích tin nhắn bằng Gemini (prompt theo bước hoặc prompt cũ, theo NLP_STAGED_PROMPTS)"""
+        if self.staged_prompts:
+            return self._analyze_staged(message)
+        return self._analyze_legacy(message)
+
+    async def _analyze_with_ai_async(self, message: str) -> Optional[Dict[str, Any]]:
+        """Bản async của _analyze_with_ai"""
+        if not self.staged_prompts:
+            return await self._ask_ai_json_async(build_legacy_prompt(message), 'legacy')
+
+        family = self._route_local(message)
+        if not family:
+            prompt = self._router_prompt(message)
+            family = self._route_from_reply(message, await self.ai_service.generate_content_async(prompt))
+        if family == FAMILY_OTHER:
+            return {"intent": "HELP_GUIDE", "confidence": 1.0, "data": {}}
+        return await self._ask_ai_json_async(build_family_prompt(family, message), family, family)
+
+    def _analyze_legacy(self, message: str) -> Optional[Dict[str, Any]]:
+        """Một lần gọi với toàn bộ quy tắc (prompt cũ)"""
+        return self._ask_ai_json(build_legacy_prompt(message), 'legacy')
+
+    def _analyze_staged(self, message: str) -> Optional[Dict[str, Any]]:
+        """
+        Router chọn nhóm intent rồi prompt ngắn của nhóm đó trích xuất dữ liệu
+
+        Router cục bộ xử lý phần lớn tin nhắn; chỉ tin nhắn mơ hồ mới tốn thêm
+        một lần gọi router AI (prompt vài chục token).
+        """
+        family = self._route_local(message)
+        if not family:
+            prompt = self._router_prompt(message)
+            family = self._route_from_reply(message, self.ai_service._generate_content(prompt))
+        if family == FAMILY_OTHER:
+            return {"intent": "HELP_GUIDE", "confidence": 1.0, "data": {}}
+        return self._ask_ai_json(build_family_prompt(family, message), family, family)
+
+    def _route_local(self, message: str) -> Optional[str]:
+        family = route_message(message)
+        if family:
+            self._count('router_local')
+        return family
+
+    def _router_prompt(self, message: str) -> str:
+        prompt = build_router_prompt(message)
+        self._count_prompt('router', prompt)
+        return prompt
+
+    def _route_from_reply(self, message: str, reply: str) -> str:
+        """Nhóm intent từ câu trả lời router AI (không hợp lệ → nhóm giao dịch)"""
+        self._count('router_ai')
+        family = parse_router_reply(reply)
+        if family is None:
+            logger.warning(f"Router AI trả lời không hợp lệ cho '{message}', dùng nhóm giao dịch")
+            family = FAMILY_TRANSACTION
+        return family
+
+    def _ask_ai_json(self, prompt: str, stage: str, family: str = None) -> Optional[Dict[str, Any]]:
+        """Gọi Gemini (structured output theo schema của nhóm intent) và parse JSON trả về"""
+        self._count_prompt(stage, prompt)
+        return self._parse_ai_json(
+            self.ai_service._generate_content(prompt, response_schema=build_response_schema(family))
+        )
+
+    async def _ask_ai_json_async(self, prompt: str, stage: str, family: str = None) -> Optional[Dict[str, Any]]:
+        """Bản async của _ask_ai_json"""
+        self._count_prompt(stage, prompt)
+        return self._parse_ai_json(
+            await self.ai_service.generate_content_async(prompt, response_schema=build_response_schema(family))
+        )
+
+    def _parse_ai_json(self, response: str) -> Optional[Dict[str, Any]]:
+        """
+        Parse kết quả JSON của AI
+
+        JSON gần đúng được sửa cục bộ; hỏng nặng thì vẫn nhặt intent + các trường
+        đơn còn đọc được. None chỉ khi không tìm thấy intent hợp lệ nào.
+        """
+        result, repaired = parse_json_lenient(response)
+        if isinstance(result, dict) and result.get('intent') in KNOWN_INTENTS:
+            if repaired:
+                logger.info(f"🔧 Đã sửa JSON AI trả về: {response[:120]}")
+                self._count('json_repaired')
+            return result
+
+        fields = extract_json_fields(response, ('intent', 'confidence') + DATA_FIELDS)
+        if fields.get('intent') in KNOWN_INTENTS:
+            logger.warning(f"🔧 JSON AI hỏng, chỉ giữ được các trường đơn: {response[:200]}")
+            self._count('json_salvaged')
+            intent = fields.pop('intent')
+            confidence = fields.pop('confidence', None) or 0.5
+            return {"intent": intent, "confidence": confidence, "data": fields}
+
+        logger.warning(f"AI trả về JSON không hợp lệ: {response}")
+        self._count('invalid_json')
+        return None
+
+    def _count(self, name: str, value: int = 1):
+        with self._stats_lock:
+            self._stats[name] += value
+
+    def _count_prompt(self, stage: str, prompt: str):
+        """Ghi nhận kích thước prompt đã gửi theo từng bước"""
+        with self._stats_lock:
+            self._stats[f'{stage}_calls'] += 1
+            self._stats[f'{stage}_chars'] += len(prompt)
+            self._stats[f'{stage}_tokens'] += estimate_tokens(prompt)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Thống kê gọi AI: số lần router cục bộ/AI, số lần gọi và token ước lượng theo từng bước"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        calls = sum(value for key, value in stats.items() if key.endswith('_calls'))
+        tokens = sum(value for key, value in stats.items() if key.endswith('_tokens'))
+        stats['staged_prompts'] = self.staged_prompts
+        stats['ai_calls'] = calls
+        stats['avg_tokens_per_call'] = round(tokens / calls, 1) if calls else 0.0
+        return stats
+
     def _fallback_process(self, message: str) -> Dict[str, Any]:
         """Fallback đơn giản khi AI không khả dụng - CHỈ PHÁT HIỆN CƠ BẢN"""
         message_lower = message.lower().strip()
@@ -366,8 +281,6 @@ Chỉ trả về JSON, không giải thích gì thêm.
     
     def _parse_amount(self, amount_str: str) -> Optional[float]:
         """Parse số tiền từ string"""
-        import re
-        
         # Remove spaces and normalize
         amount_str = amount_str.lower().strip()
         
@@ -387,53 +300,42 @@ Chỉ trả về JSON, không giải thích gì thêm.
         else:
             return number
     
-    def _quick_classify(self, message: str) -> Optional[Dict[str, Any]]:
+    def _parse_expenses_locally(self, message: str, user_key: str = None) -> Optional[Dict[str, Any]]:
+        """
+        EXPENSE / MULTIPLE_EXPENSES bằng ngữ pháp cục bộ (services.local_parser)
+
+        Danh mục: danh mục đã nhớ cho mô tả → luật từ khóa → để trống (handler
+        phân loại sau, nhiều khoản thì gộp một lệnh categorize_batch).
+        """
+        items = parse_expense_items(message)
+        if not items:
+            return None
+        for item in items:
+            item['category'] = (self.category_memo.lookup('Chi', item['description'], user_key)
+                                or match_category(item['description'], 'Chi'))
+        self._count('local_expense')
+        return build_expense_result(items)
+
+    def _quick_classify(self, message: str, user_key: str = None) -> Optional[Dict[str, Any]]:
         """Quick classification for simple messages without AI"""
-        import re
-        
         message_lower = message.lower()
         
+        # Câu hỏi chỉ đọc (thống kê, danh mục, xuất dữ liệu, hướng dẫn) - không cần AI
+        query_result = parse_query(message)
+        if query_result:
+            self._count('local_query')
+            return query_result
+        
+        # Khoản chi (một hoặc nhiều món, có ngày) - ngữ pháp số tiền/danh sách món cục bộ
+        expense_result = self._parse_expenses_locally(message, user_key)
+        if expense_result:
+            return expense_result
+        
         # Skip complex messages (but allow lending/borrowing with complex text)
         has_lending = any(keyword in message_lower for keyword in ['cho vay', 'cho mượn', 'vay cho', 'mượn cho', 'vay tiền', 'mượn tiền'])
         if not has_lending and any(word in message_lower for word in [',', ' và ', 'hôm qua', 'ngày', '/', 'từ', 'đến']):
             return None
         
-        # Check for income keywords first to avoid misclassifying as expense
-        income_keywords = ['lương', 'thưởng', 'thu', 'nhận', 'được', 'tiền lương']
-        if any(keyword in message_lower for keyword in income_keywords):
-            # Skip expense detection if income keywords found
-            pass
-        else:
-            # Quick expense detection (only if no income keywords)
-            expense_pattern = r'(\d+(?:\.\d+)?)\s*([kmKM])\s*([\w\s]+)'
-            expense_match = re.search(expense_pattern, message)
-            if expense_match:
-                number = float(expense_match.group(1))
-                suffix = expense_match.group(2).lower()
-                description = expense_match.group(3).strip()
-                
-                # Calculate amount
-                amount = int(number * 1000) if suffix == 'k' else int(number * 1000000)
-                
-                # Quick categorization
-                category = 'Khác'  # default
-                if any(word in message_lower for word in ['bún', 'phở', 'cơm', 'bánh', 'trà sữa', 'cà phê', 'nướng']):
-                    category = 'Ăn uống'
-                elif any(word in message_lower for word in ['xăng', 'taxi', 'grab']):
-                    category = 'Di chuyển'
-                elif any(word in message_lower for word in ['áo', 'laptop', 'điện thoại']):
-                    category = 'Mua sắm'
-                
-                return {
-                    'intent': 'EXPENSE',
-                    'confidence': 0.85,
-                    'data': {
-                        'amount': amount,
-                        'description': description,
-                        'category': category
-                    }
-                }
-        
         # Quick income detection - hỗ trợ cả 2 pattern: "thu 5m" và "5m lương"
         income_keywords = ['thu', 'lương', 'nhận', 'được', 'thưởng', 'tiền lương', 'lương tháng']
         
@@ -450,14 +352,16 @@ Chỉ trả về JSON, không giải thích gì thêm.
                 suffix = amount_match.group(2).lower()
                 amount = int(number * 1000) if suffix == 'k' else int(number * 1000000)
                 
-                # Quick income categorization
-                category = 'Khác'  # default
-                if any(word in message_lower for word in ['lương', 'tiền lương']):
-                    category = 'Lương'
-                elif any(word in message_lower for word in ['thưởng', 'bonus']):
-                    category = 'Thưởng'
-                elif any(word in message_lower for word in ['bán', 'kinh doanh']):
-                    category = 'Kinh doanh'
+                # Quick income categorization - ưu tiên danh mục đã nhớ cho mô tả này
+                category = self.category_memo.lookup('Thu', message, user_key)
+                if not category:
+                    category = 'Khác'  # default
+                    if any(word in message_lower for word in ['lương', 'tiền lương']):
+                        category = 'Lương'
+                    elif any(word in message_lower for word in ['thưởng', 'bonus']):
+                        category = 'Thưởng'
+                    elif any(word in message_lower for word in ['bán', 'kinh doanh']):
+                        category = 'Kinh doanh'
                 
                 return {
                     'intent': 'INCOME',
@@ -534,22 +438,6 @@ Chỉ trả về JSON, không giải thích gì thêm.
                     }
                 }
         
-        # Quick stats detection
-        if any(word in message_lower for word in ['thống kê', 'báo cáo']):
-            time_period = 'thang'  # default
-            if 'hôm nay' in message_lower:
-                time_period = 'ngay'
-            elif 'tuần' in message_lower:
-                time_period = 'tuan'
-            
-            return {
-                'intent': 'STATS',
-                'confidence': 0.8,
-                'data': {
-                    'time_period': time_period
-                }
-            }
-        
         return None
 
 # Đã xóa generate_response_for_unknown - không cần thiết nữa 
\ No newline at end of file
@@ -0,0 +1,499 @@
+"""
+Prompt phân tích tin nhắn cho Gemini theo từng bước
+
+1. Router: chọn nhóm intent - bằng luật cục bộ (route_message), chỉ hỏi AI
+   bằng prompt rất ngắn (ROUTER_PROMPT) khi luật không chắc chắn.
+2. Prompt ngắn riêng cho nhóm đó (ghi giao dịch hoặc xem dữ liệu).
+
+LEGACY_PROMPT là prompt cũ gửi toàn bộ quy tắc cho mọi tin nhắn - giữ lại để
+so sánh trong `admin_cli.py benchmark-nlp` và bật lại bằng NLP_STAGED_PROMPTS=false.
+"""
+
+from typing import Dict, Optional
+
+from services.category_rules import (EXPENSE_CATEGORIES, EXPENSE_KEYWORDS, FALLBACK_CATEGORY,
+                                     INCOME_CATEGORIES)
+from services.local_parser import find_amounts
+
+FAMILY_TRANSACTION = 'transaction'
+FAMILY_QUERY = 'query'
+FAMILY_OTHER = 'other'
+INTENT_FAMILIES = (FAMILY_TRANSACTION, FAMILY_QUERY, FAMILY_OTHER)
+
+FAMILY_INTENTS = {
+    FAMILY_TRANSACTION: ('EXPENSE', 'MULTIPLE_EXPENSES', 'INCOME', 'LENDING', 'BORROWING'),
+    FAMILY_QUERY: ('STATS', 'CATEGORY_STATS', 'CATEGORY_LIST', 'EXPORT', 'HELP'),
+    FAMILY_OTHER: ('HELP_GUIDE',),
+}
+KNOWN_INTENTS = tuple(intent for intents in FAMILY_INTENTS.values() for intent in intents)
+# Trường đơn (chuỗi/số) trong "data" - nhặt lại được cả khi JSON hỏng
+DATA_FIELDS = ('amount', 'description', 'category', 'custom_date', 'person',
+               'time_period', 'specific_value', 'category_name', 'format')
+
+# Gợi ý ngắn cho từng danh mục chi: vài từ khóa đầu của category_rules (thay cho danh
+# sách từ khóa dài của prompt cũ) - prompt và luật phân loại cục bộ dùng chung một nguồn
+_HINT_KEYWORDS = 8
+EXPENSE_CATEGORY_HINTS = {
+    category: ', '.join(EXPENSE_KEYWORDS[category][:_HINT_KEYWORDS]) if category in EXPENSE_KEYWORDS
+    else "chỉ khi không thuộc nhóm nào ở trên"
+    for category in EXPENSE_CATEGORIES
+}
+EXPENSE_CATEGORY_HINTS["Ăn uống"] += "; nướng/luộc/xào/chiên = nấu ăn"
+INCOME_CATEGORY_HINTS = ", ".join(INCOME_CATEGORIES)
+
+ROUTER_PROMPT = """Tin nhắn gửi bot quản lý thu chi: "{message}"
+Trả về đúng 1 từ:
+transaction - ghi khoản chi, thu nhập, cho vay, đi vay
+query - thống kê, báo cáo, xem danh mục, xuất dữ liệu, hướng dẫn dùng bot
+other - không liên quan tài chính"""
+
+TRANSACTION_PROMPT = """Trích xuất giao dịch từ tin nhắn: "{message}"
+
+intent:
+- EXPENSE: một khoản chi, hoặc nhiều món CÙNG danh mục (cộng tổng amount, gộp description)
+- MULTIPLE_EXPENSES: nhiều món KHÁC danh mục → data.transactions, mỗi khoản có amount, description, category, custom_date
+- INCOME: thu nhập. Danh mục: {income_categories}
+- LENDING: cho vay/cho mượn → category "Cho vay", person là người vay
+- BORROWING: vay/mượn của người khác → category "Đi vay", person là người cho vay
+- HELP_GUIDE: không phải giao dịch
+
+Danh mục chi:
+{expense_categories}
+
+amount: VND số nguyên; k = 1000, m/tr/triệu = 1000000 (1.5m = 1500000)
+custom_date: giữ nguyên cách ghi ngày trong tin ("5/9", "hôm qua", "thứ hai", "tuần trước"), không có → null.
+Ngày ở đầu tin áp dụng cho mọi khoản.
+
+Ví dụ:
+"hôm qua 80k đi chợ" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 80000, "description": "đi chợ", "category": "Ăn uống", "custom_date": "hôm qua"}}}}
+"bún 80k và phở 150k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 230000, "description": "bún và phở", "category": "Ăn uống", "custom_date": null}}}}
+"5/9 480k nướng, 575k siêu thị" → {{"intent": "MULTIPLE_EXPENSES", "confidence": 0.9, "data": {{"transactions": [{{"amount": 480000, "description": "nướng", "category": "Ăn uống", "custom_date": "5/9"}}, {{"amount": 575000, "description": "siêu thị", "category": "Mua sắm", "custom_date": "5/9"}}]}}}}
+"thứ hai lương 5m" → {{"intent": "INCOME", "confidence": 0.9, "data": {{"amount": 5000000, "description": "lương", "category": "Lương", "custom_date": "thứ hai"}}}}
+"vay anh Nam 2tr" → {{"intent": "BORROWING", "confidence": 0.9, "data": {{"amount": 2000000, "description": "vay anh Nam 2tr", "category": "Đi vay", "custom_date": null, "person": "anh Nam"}}}}
+
+Chỉ trả về JSON."""
+
+QUERY_PROMPT = """Phân tích yêu cầu xem dữ liệu thu chi: "{message}"
+
+intent:
+- STATS: thống kê/báo cáo/tổng kết chung
+- CATEGORY_STATS: thống kê một danh mục hoặc "top chi tiêu" → category_name (VD: "ăn uống", "xăng xe", "top chi tiêu")
+- CATEGORY_LIST: xem danh sách danh mục
+- EXPORT: xuất dữ liệu/file/excel → format "xlsx" nếu nhắc excel/xlsx, còn lại "csv"; time_period mặc định "nam"
+- HELP: hướng dẫn sử dụng
+- HELP_GUIDE: không liên quan tài chính
+
+time_period: ngay|tuan|thang|nam|custom (mặc định "thang")
+specific_value (bỏ trống nếu là hôm nay/tuần này/tháng này/năm nay):
+- "hôm qua", "hôm kia", "2/9" → time_period "ngay", specific_value giữ nguyên
+- "tháng 8" → "8"; "tháng trước" → "thang_truoc"; "tuần trước" → "tuan_truoc"; "năm 2024" → "2024"
+- "từ 1/8 đến 31/8" → time_period "custom", specific_value "01/08-31/08"
+
+Ví dụ:
+"báo cáo tháng trước" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "thang", "specific_value": "thang_truoc"}}}}
+"thống kê từ 1/9 đến 5/9" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "custom", "specific_value": "01/09-05/09"}}}}
+"ăn uống hôm nay" → {{"intent": "CATEGORY_STATS", "confidence": 0.9, "data": {{"category_name": "ăn uống", "time_period": "ngay"}}}}
+"xuất excel tháng 8" → {{"intent": "EXPORT", "confidence": 0.9, "data": {{"time_period": "thang", "specific_value": "8", "format": "xlsx"}}}}
+
+Chỉ trả về JSON."""
+
+_QUERY_KEYWORDS = (
+    'thống kê', 'báo cáo', 'tổng kết', 'danh mục', 'top chi tiêu', 'xuất dữ liệu', 'xuất file',
+    'xuất excel', 'xuất csv', 'export', 'help', 'hướng dẫn', 'trợ giúp'
+)
+# Chỉ có tên danh mục, không có số tiền ("ăn uống tháng 8") → thống kê danh mục
+_CATEGORY_NAMES = ('xăng xe',) + tuple(category.lower() for category in EXPENSE_CATEGORIES if category != FALLBACK_CATEGORY)
+
+
+def route_message(message: str) -> Optional[str]:
+    """
+    Chọn nhóm intent bằng luật cục bộ
+
+    Returns:
+        Optional[str]: 'transaction' hoặc 'query', None nếu không chắc (hỏi AI bằng ROUTER_PROMPT)
+    """
+    text = ' '.join(message.lower().split())
+    # Cùng ngữ pháp số tiền với local_parser ("45k", "1tr2", số >= 4 chữ số trừ "năm 2024")
+    has_amount = bool(find_amounts(text))
+
+    if any(keyword in text for keyword in _QUERY_KEYWORDS):
+        # "báo cáo chi 500k" - vừa số tiền vừa từ khóa thống kê, để router AI quyết
+        return None if has_amount else FAMILY_QUERY
+    if has_amount:
+        return FAMILY_TRANSACTION
+    if any(name in text for name in _CATEGORY_NAMES):
+        return FAMILY_QUERY
+    return None
+
+
+_TRANSACTION_ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "amount": {"type": "number"},
+        "description": {"type": "string"},
+        "category": {"type": "string"},
+        "custom_date": {"type": "string", "nullable": True},
+    },
+    "required": ["amount", "description", "category"],
+}
+_DATA_PROPERTIES = {
+    FAMILY_TRANSACTION: {
+        "amount": {"type": "number", "nullable": True},
+        "description": {"type": "string", "nullable": True},
+        "category": {"type": "string", "nullable": True},
+        "custom_date": {"type": "string", "nullable": True},
+        "person": {"type": "string", "nullable": True},
+        "transactions": {"type": "array", "items": _TRANSACTION_ITEM_SCHEMA},
+    },
+    FAMILY_QUERY: {
+        "time_period": {"type": "string", "enum": ["ngay", "tuan", "thang", "nam", "custom"]},
+        "specific_value": {"type": "string", "nullable": True},
+        "category_name": {"type": "string", "nullable": True},
+        "format": {"type": "string", "enum": ["csv", "xlsx"]},
+    },
+}
+
+
+def build_response_schema(family: str = None) -> Dict:
+    """
+    Schema JSON của kết quả phân tích (Gemini structured output)
+
+    Có family thì intent chỉ được chọn trong nhóm đó (+ HELP_GUIDE); None = mọi intent (prompt cũ).
+    """
+    if family:
+        intents = list(FAMILY_INTENTS[family]) + ['HELP_GUIDE']
+        properties = dict(_DATA_PROPERTIES[family])
+    else:
+        intents = list(KNOWN_INTENTS)
+        properties = {**_DATA_PROPERTIES[FAMILY_TRANSACTION], **_DATA_PROPERTIES[FAMILY_QUERY]}
+    return {
+        "type": "object",
+        "properties": {
+            "intent": {"type": "string", "enum": intents},
+            "confidence": {"type": "number"},
+            "data": {"type": "object", "properties": properties},
+        },
+        "required": ["intent", "confidence", "data"],
+    }
+
+
+def parse_router_reply(reply: str) -> Optional[str]:
+    """Nhóm intent trong câu trả lời của router AI"""
+    word = (reply or '').strip().strip('`"\'.').lower()
+    return word if word in INTENT_FAMILIES else None
+
+
+def build_router_prompt(message: str) -> str:
+    """Prompt router (chỉ dùng khi route_message không chắc chắn)"""
+    return ROUTER_PROMPT.format(message=message)
+
+
+def build_family_prompt(family: str, message: str) -> str:
+    """Prompt trích xuất ngắn của một nhóm intent"""
+    if family == FAMILY_TRANSACTION:
+        expense_categories = "\n".join(f"- {category}: {hint}" for category, hint in EXPENSE_CATEGORY_HINTS.items())
+        return TRANSACTION_PROMPT.format(
+            message=message, income_categories=INCOME_CATEGORY_HINTS, expense_categories=expense_categories
+        )
+    if family == FAMILY_QUERY:
+        return QUERY_PROMPT.format(message=message)
+    raise ValueError(f"Nhóm intent không có prompt: {family}")
+
+
+def build_legacy_prompt(message: str) -> str:
+    """Prompt cũ (toàn bộ quy tắc + ví dụ trong một lần gọi)"""
+    return LEGACY_PROMPT.format(message=message)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Ước lượng số token của prompt (không gọi API)
+
+    Tiếng Việt có dấu tốn token hơn tiếng Anh - ước lượng ~3 ký tự/token;
+    số chính xác lấy bằng `python admin_cli.py benchmark-nlp --count-tokens`.
+    """
+    return max(1, round(len(text) / 3))
+
+
+def prompt_sizes(prompts: Dict[str, str]) -> Dict[str, Dict[str, int]]:
+    """Kích thước từng prompt: {'tên': {'chars', 'tokens'}}"""
+    return {name: {'chars': len(prompt), 'tokens': estimate_tokens(prompt)} for name, prompt in prompts.items()}
+
+
+LEGACY_PROMPT = """Phân tích tin nhắn sau và xác định có liên quan đến quản lý tài chính không:
+
+Tin nhắn: "{message}"
+
+CHỈ XỬ LÝ các ý định liên quan đến tài chính:
+1. EXPENSE (Chi tiêu): 
+   - Một món: "500k trà sữa", "mua áo 300k", "200k xăng"
+   - Nhiều món cùng danh mục: "bún 80k và phở 150k" → CỘNG TỔNG: 80000 + 150000 = 230000
+   - QUAN TRỌNG - Nhiều món KHÁC danh mục: "bún 12k, gà 20k, laptop 1.5m, 200k xăng" → TỰ ĐỘNG TÁCH THÀNH NHIỀU GIAO DỊCH
+   - QUAN TRỌNG - Khác danh mục với từ kết nối: "480k nướng, 575k siêu thị" → TÁCH THÀNH 2 GIAO DỊCH RIÊNG
+   - QUAN TRỌNG - KÈM NGÀY CỤ THỂ: "5/9 bánh 200k", "hôm qua 80k đi chợ", "tuần trước mua áo 300k"
+2. INCOME (Thu nhập): "thu 5m lương", "5m lương", "nhận 1tr", "được 500k"
+   - QUAN TRỌNG - KÈM NGÀY CỤ THỂ: "2/9 thưởng 500k", "hôm qua nhận 1tr", "thứ hai lương 5m"
+3. LENDING (Cho vay): "cho vay", "cho mượn", "vay cho", "mượn cho", "cho bạn vay"
+   - Đơn giản: "cho vay 1tr", "cho An mượn 500k", "vay cho Nam 2m"
+   - Chi tiết: "cho bạn vay 10tr trong đó 6tr tiền nhà, 4tr tiền tiết kiệm"
+   - QUAN TRỌNG - KÈM NGÀY CỤ THỂ: "hôm qua cho vay 1tr", "5/9 cho An mượn 500k"
+4. BORROWING (Đi vay): "vay tiền", "mượn tiền", "vay", "mượn"  
+   - Đơn giản: "vay 2tr", "mượn bạn 500k", "vay Nam 1tr"
+   - Chi tiết: "vay 5tr từ anh Minh để trả nợ"
+   - QUAN TRỌNG - KÈM NGÀY CỤ THỂ: "hôm qua vay 1tr", "tuần trước mượn 500k"
+3. STATS (Thống kê tổng): 
+   - Mặc định: "thống kê", "báo cáo", "tổng kết" → THÁNG HIỆN TẠI
+   - Cụ thể: "thống kê tháng trước", "báo cáo tháng 8", "thống kê tuần này", "thống kê hôm nay"
+4. CATEGORY_STATS (Thống kê danh mục cụ thể):
+   - Mặc định: "thống kê ăn uống", "top chi tiêu", "ăn uống" → THÁNG HIỆN TẠI  
+   - Cụ thể: "ăn uống tháng 8", "top chi tiêu tuần này", "thống kê xăng xe tháng trước"
+   - QUAN TRỌNG: "ăn uống hôm nay", "xăng xe hôm nay", "mua sắm ngày hôm nay" → NGÀY HIỆN TẠI
+
+HƯỚNG DẪN XỬ LÝ THỜI GIAN CHO AI - PHÂN TÍCH KỸ LƯỠNG:
+*** CHÚ Ý QUAN TRỌNG: PHẢI PHÂN TÍCH CHÍNH XÁC TỪ THỜI GIAN TRONG TIN NHẮN ***
+
+- "hôm nay", "ngày hôm nay", "[danh_mục] hôm nay", "ngày này" → time_period: "ngay"
+- "thống kê hôm qua", "báo cáo hôm qua", "thống kê ngày hôm qua" → time_period: "ngay", specific_value: "hôm qua"
+- "thống kê hôm kia", "báo cáo hôm kia", "thống kê ngày hôm kia" → time_period: "ngay", specific_value: "hôm kia"
+- "thống kê 2/9", "báo cáo 15/8", "thống kê ngày 02/09" → time_period: "ngay", specific_value: "2/9", "15/8", "02/09"
+- "tuần này", "tuần hiện tại", "[danh_mục] tuần này" → time_period: "tuan"  
+- "tháng này", "tháng hiện tại", "[danh_mục]" (CHÍNH XÁC KHÔNG có từ thời gian nào khác) → time_period: "thang"
+- "năm này", "năm hiện tại", "[danh_mục] năm này" → time_period: "nam"
+- "tháng trước", "[danh_mục] tháng trước" → time_period: "thang", specific_value: "thang_truoc"
+- "tháng 8", "tháng 12", "[danh_mục] tháng 8" → time_period: "thang", specific_value: "8" hoặc "12"
+- "tuần trước", "[danh_mục] tuần trước" → time_period: "tuan", specific_value: "tuan_truoc"
+
+*** CẨN THẬN: "ăn uống hôm nay" KHÁC VỚI "ăn uống" - PHẢI NHẬN DIỆN "hôm nay" ***
+
+HƯỚNG DẪN XỬ LÝ NGÀY THÁNG CHO CHI TIÊU/THU NHẬP:
+*** QUAN TRỌNG: PHẢI PHÂN TÍCH NGÀY THÁNG TRONG TIN NHẮN EXPENSE/INCOME ***
+
+NHẬN DIỆN NGÀY CỤ THỂ:
+- "5/9 bánh 200k", "2/9 thưởng 500k" → custom_date: "5/9", "2/9"
+- "15/8 mua áo 300k", "10/12 nhận lương" → custom_date: "15/8", "10/12"
+- "hôm qua 80k đi chợ", "hôm kia nhận 1tr" → custom_date: "hôm qua", "hôm kia"
+- "thứ hai mua sách 50k", "thứ ba lương 5m" → custom_date: "thứ hai", "thứ ba"
+- "tuần trước mua laptop", "tháng trước thưởng" → custom_date: "tuần trước", "tháng trước"
+- "500k trà sữa" (không có ngày) → custom_date: null
+
+CHÚ Ý: Nếu KHÔNG có ngày cụ thể → custom_date: null (ghi vào ngày hiện tại)
+
+QUAN TRỌNG - KHOẢNG THỜI GIAN CỤ THỂ:
+- "từ 01/08 đến 31/08", "từ 1/8 đến 31/8" → time_period: "custom", specific_value: "01/08-31/08"
+- "từ 01/09 đến 05/09", "từ 1/9 đến 5/9" → time_period: "custom", specific_value: "01/09-05/09"
+- "từ 15/12 đến 20/12" → time_period: "custom", specific_value: "15/12-20/12"
+- Bất kỳ "từ XX/XX đến YY/YY" → time_period: "custom", specific_value: "XX/XX-YY/YY"
+
+QUY TẮC TÍNH TOÁN SỐ TIỀN:
+- k = 1,000 (VD: 80k = 80000)
+- m/tr/triệu = 1,000,000 (VD: 1.5m = 1500000)
+- Nhiều món: PHẢI CỘNG TẤT CẢ (VD: "80k + 150k" = 230000, KHÔNG PHẢI 230)
+- Đơn vị: Luôn chuyển về VND (số nguyên)
+
+QUY TẮC PHÂN LOẠI DANH MỤC CHO EXPENSE - PHÂN TÍCH KỸ LƯỠNG:
+*** QUAN TRỌNG: PHẢI PHÂN TÍCH TỪ KHÓA CHÍNH XÁC ***
+
+- Ăn uống: 
+  * Món ăn: bún, phở, gà, rau, cơm, bánh, thịt, cá, tôm, nướng, luộc, xào, chiên, lẩu, nồi, canh, súp
+  * Thức uống: trà sữa, cà phê, nước, bia, rượu, sinh tố, nước ngọt, soda
+  * Địa điểm: nhà hàng, quán ăn, quán cà phê, quán nhậu, buffet, food court, căng tin
+  * Nguyên liệu: thịt, rau, củ, quả, gạo, mì, bánh mì, sữa, trứng, gia vị
+  * Đồ ăn vặt: bánh kẹo, snack, kẹo, chocolate, bánh quy
+
+- Di chuyển: xăng xe, vé xe buýt, taxi, grab, đi lại, gửi xe, xe ôm, bus, xanhsm, bee, tiền xe, phí đường, cầu phí
+
+- Mua sắm: quần áo, giày dép, đồ dùng, mỹ phẩm, điện tử, áo, giày, máy tính, laptop, điện thoại, túi xách
+
+- Giải trí: xem phim, game, du lịch, karaoke, bar, vui chơi, giải trí, concert, show
+
+- Y tế: thuốc, khám bệnh, nha khoa, bảo hiểm y tế, bác sĩ, bệnh viện, xét nghiệm
+
+- Học tập: sách vở, khóa học, học phí, văn phòng phẩm, sách, học, giáo dục
+
+- Nhà cửa: tiền nhà, điện nước, internet, sửa chữa, nhà, gas, wifi
+
+- Khác: những thứ THỰC SỰ không thuộc 7 danh mục trên
+
+QUY TẮC PHÂN LOẠI CHO LENDING & BORROWING:
+*** QUAN TRỌNG: LENDING và BORROWING luôn có category cố định ***
+
+- LENDING (Cho vay): category luôn là "Cho vay"
+  * Tất cả giao dịch cho vay đều ghi là "Cho vay"
+  * Mô tả chi tiết sẽ trong phần description
+
+- BORROWING (Đi vay): category luôn là "Đi vay" 
+  * Tất cả giao dịch vay đều ghi là "Đi vay"
+  * Mô tả chi tiết sẽ trong phần description
+
+*** LƯU Ý ĐẶC BIỆT - QUAN TRỌNG NHẤT: ***
+- "nướng" = NẤU ĂN → Ăn uống (KHÔNG PHẢI Khác!)
+- "luộc", "xào", "chiên" = NẤU ĂN → Ăn uống (KHÔNG PHẢI Khác!)
+- "thịt", "cá", "gà", "tôm" = THỰC PHẨM → Ăn uống (KHÔNG PHẢI Khác!)
+- "rau", "củ", "quả" = THỰC PHẨM → Ăn uống (KHÔNG PHẢI Khác!)
+- "đi chợ", "mua đồ ăn" = MUA THỰC PHẨM → Ăn uống (KHÔNG PHẢI Mua sắm!)
+
+*** TUYỆT ĐỐI KHÔNG ĐƯỢC PHÂN LOẠI SAI! ***
+
+*** QUY TẮC QUAN TRỌNG CHO MULTIPLE_EXPENSES: ***
+- PHẢI nhận diện chính xác khi có nhiều món KHÁC danh mục
+- VD: "480k nướng, 575k siêu thị" = KHÁC danh mục → MULTIPLE_EXPENSES
+
+CÁCH PHÂN TÍCH ĐÚNG:
+1. "480k nướng" → Ăn uống
+2. "575k siêu thị" → Mua sắm  
+3. Ăn uống ≠ Mua sắm → MULTIPLE_EXPENSES
+
+KẾT QUẢ PHẢI TẠO cho "hôm qua 480k nướng, 575k siêu thị":
+{{"intent": "MULTIPLE_EXPENSES", "data": {{"transactions": [
+  {{"amount": 480000, "description": "nướng", "category": "Ăn uống", "custom_date": "hôm qua"}},
+  {{"amount": 575000, "description": "siêu thị", "category": "Mua sắm", "custom_date": "hôm qua"}}
+]}}}}
+
+CHÚ Ý: CẢ 2 transactions đều có custom_date: "hôm qua" vì từ thời gian ở ĐẦU tin nhắn
+
+*** VÍ DỤ CHO LENDING: ***
+Tin nhắn: "cho bạn vay 10tr trong đó 6tr tiền nhà, 4tr tiền tiết kiệm của anh"
+Kết quả đúng:
+{{
+    "intent": "LENDING",
+    "confidence": 0.95,
+    "data": {{
+        "amount": 10000000,
+        "description": "cho bạn vay 10tr trong đó 6tr tiền nhà, 4tr tiền tiết kiệm",
+        "category": "Cho vay",
+        "custom_date": null,
+        "person": "bạn"
+    }}
+}}
+
+*** VÍ DỤ CHO BORROWING: ***
+Tin nhắn: "vay anh Nam 2tr để trả nợ"
+Kết quả đúng:
+{{
+    "intent": "BORROWING", 
+    "confidence": 0.95,
+    "data": {{
+        "amount": 2000000,
+        "description": "vay anh Nam 2tr để trả nợ",
+        "category": "Đi vay",
+        "custom_date": null,
+        "person": "anh Nam"
+    }}
+}}
+
+TUYỆT ĐỐI KHÔNG ĐƯỢC:
+- Gộp chung: amount=1055000, description="nướng và siêu thị"
+- Sai intent: EXPENSE thay vì MULTIPLE_EXPENSES
+
+*** LƯU Ý QUAN TRỌNG VỀ CUSTOM_DATE CHO MULTIPLE_EXPENSES: ***
+- Nếu có ngày ở đầu tin nhắn → TẤT CẢ transactions dùng cùng custom_date
+- VD: "hôm qua 480k nướng, 575k siêu thị" → custom_date: "hôm qua" cho CẢ 2 transactions
+- VD: "5/9 bún 12k, laptop 1.5m" → custom_date: "5/9" cho CẢ 2 transactions
+- Nếu KHÔNG có ngày → custom_date: null cho tất cả
+
+*** PHÂN TÍCH CUSTOM_DATE CHO MULTIPLE_EXPENSES: ***
+Step 1: Tìm từ thời gian ở ĐẦU tin nhắn ("hôm qua", "5/9", "thứ hai")
+Step 2: Nếu có → Áp dụng cho TẤT CẢ transactions trong array
+Step 3: Nếu không có → custom_date: null cho tất cả
+5. MULTIPLE_EXPENSES (Nhiều khoản chi khác danh mục): 
+   - Khi có items thuộc nhiều danh mục khác nhau
+   - PHẢI TÁCH RIÊNG từng khoản với amount và category riêng biệt
+   - KHÔNG ĐƯỢC gộp chung thành một transaction
+6. LENDING (Cho vay): "cho vay", "cho mượn", "vay cho", "mượn cho"
+7. BORROWING (Đi vay): "vay tiền", "mượn tiền", "vay", "mượn" 
+8. CATEGORY_LIST (Xem danh mục): "danh mục", "categories", "xem danh mục"
+9. HELP (Trợ giúp): "help", "hướng dẫn"
+10. EXPORT (Xuất dữ liệu ra file): "xuất dữ liệu", "xuất file", "xuất excel", "export"
+
+KHÔNG XỬ LÝ:
+- Chào hỏi thông thường: "xin chào", "bạn khỏe không"
+- Câu hỏi cá nhân: "bạn ăn cơm chưa", "hôm nay thế nào"
+- Trò chuyện chung: "thời tiết", "tin tức"
+
+Nếu tin nhắn KHÔNG liên quan đến tài chính, trả về:
+{{
+    "intent": "HELP_GUIDE",
+    "confidence": 1.0,
+    "data": {{}}
+}}
+
+Nếu liên quan đến tài chính, trả về:
+{{
+    "intent": "EXPENSE|INCOME|LENDING|BORROWING|STATS|CATEGORY_STATS|CATEGORY_LIST|MULTIPLE_EXPENSES|EXPORT|HELP",
+    "confidence": 0.0-1.0,
+    "data": {{
+        "amount": số_tiền_hoặc_null (QUAN TRỌNG: Với nhiều món PHẢI CỘNG TỔNG tất cả, VD: 80k+150k=230000, KHÔNG được là 230),
+        "description": "mô_tả",
+        "category": "danh_mục" (cho EXPENSE/INCOME/LENDING/BORROWING - LENDING→"Cho vay", BORROWING→"Đi vay", PHẢI phân loại chính xác theo quy tắc trên),
+        "custom_date": "ngày_cụ_thể_hoặc_null" (VD: "5/9", "2/9", "hôm qua", "tuần trước", "thứ hai", null nếu không có),
+        "transactions": [array của nhiều giao dịch] (chỉ cho MULTIPLE_EXPENSES - mỗi transaction có amount, description, category, custom_date riêng),
+        "time_period": "ngay|tuan|thang|nam|custom" (cho STATS & CATEGORY_STATS, mặc định "thang"; cho EXPORT mặc định "nam"),
+        "format": "csv|xlsx" (chỉ cho EXPORT - "excel"/"xlsx" → "xlsx", còn lại "csv"),
+        "specific_value": "số_hoặc_keyword" (VD: "8", "12", "thang_truoc", "tuan_truoc"),
+        "category_name": "tên_danh_mục" (chỉ cho CATEGORY_STATS, VD: "ăn uống", "xăng xe", "mua sắm"),
+        "person": "tên_người" (cho LENDING/BORROWING - người cho vay/đi vay, VD: "An", "bạn", "anh Minh")
+    }}
+}}
+
+VÍ DỤ CỤ THỂ CHO NHIỀU MÓN:
+- "bún 80k và phở 150k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 230000, "description": "bún và phở", "category": "Ăn uống", "custom_date": null}}}}
+- "bún 12k, gà 20k, rau 70k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 102000, "description": "bún, gà, rau", "category": "Ăn uống", "custom_date": null}}}}
+- "mua áo 300k và giày 200k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 500000, "description": "mua áo và giày", "category": "Mua sắm", "custom_date": null}}}}
+- "1.5m laptop và 500k chuột" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 2000000, "description": "laptop và chuột", "category": "Mua sắm", "custom_date": null}}}}
+- "hôm qua bún 80k và phở 150k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 230000, "description": "bún và phở", "category": "Ăn uống", "custom_date": "hôm qua"}}}}
+- "3/9 mua áo 300k và giày 200k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 500000, "description": "mua áo và giày", "category": "Mua sắm", "custom_date": "3/9"}}}}
+
+VÍ DỤ CHO MỘT MÓN:
+- "500k trà sữa" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 500000, "description": "trà sữa", "category": "Ăn uống", "custom_date": null}}}}
+- "480k nướng" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 480000, "description": "nướng", "category": "Ăn uống", "custom_date": null}}}}
+- "200k xăng xe" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 200000, "description": "xăng xe", "category": "Di chuyển", "custom_date": null}}}}
+- "150k thịt" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 150000, "description": "thịt", "category": "Ăn uống", "custom_date": null}}}}
+- "80k rau củ" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 80000, "description": "rau củ", "category": "Ăn uống", "custom_date": null}}}}
+
+VÍ DỤ CHO GIAO DỊCH CÓ NGÀY CỤ THỂ:
+- "5/9 bánh 200k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 200000, "description": "bánh", "category": "Ăn uống", "custom_date": "5/9"}}}}
+- "hôm qua 480k nướng" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 480000, "description": "nướng", "category": "Ăn uống", "custom_date": "hôm qua"}}}}
+- "hôm qua 80k đi chợ" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 80000, "description": "đi chợ", "category": "Ăn uống", "custom_date": "hôm qua"}}}}
+- "3/9 thịt nướng 350k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 350000, "description": "thịt nướng", "category": "Ăn uống", "custom_date": "3/9"}}}}
+- "2/9 thưởng 500k" → {{"intent": "INCOME", "confidence": 0.9, "data": {{"amount": 500000, "description": "thưởng", "category": "Thưởng", "custom_date": "2/9"}}}}
+- "thứ hai lương 5m" → {{"intent": "INCOME", "confidence": 0.9, "data": {{"amount": 5000000, "description": "lương", "category": "Lương", "custom_date": "thứ hai"}}}}
+- "tuần trước mua áo 300k" → {{"intent": "EXPENSE", "confidence": 0.9, "data": {{"amount": 300000, "description": "mua áo", "category": "Mua sắm", "custom_date": "tuần trước"}}}}
+
+VÍ DỤ CHO NHIỀU KHOẢN CHI KHÁC DANH MỤC:
+- "bún 12k, gà 20k, laptop 1.5m, 200k xăng" → {{"intent": "MULTIPLE_EXPENSES", "confidence": 0.9, "data": {{"transactions": [{{"amount": 32000, "description": "bún, gà", "category": "Ăn uống", "custom_date": null}}, {{"amount": 1500000, "description": "laptop", "category": "Mua sắm", "custom_date": null}}, {{"amount": 200000, "description": "xăng", "category": "Di chuyển", "custom_date": null}}]}}}}
+- "480k nướng, 575k siêu thị" → {{"intent": "MULTIPLE_EXPENSES", "confidence": 0.9, "data": {{"transactions": [{{"amount": 480000, "description": "nướng", "category": "Ăn uống", "custom_date": null}}, {{"amount": 575000, "description": "siêu thị", "category": "Mua sắm", "custom_date": null}}]}}}}
+- "hôm qua 480k nướng, 575k siêu thị" → {{"intent": "MULTIPLE_EXPENSES", "confidence": 0.9, "data": {{"transactions": [{{"amount": 480000, "description": "nướng", "category": "Ăn uống", "custom_date": "hôm qua"}}, {{"amount": 575000, "description": "siêu thị", "category": "Mua sắm", "custom_date": "hôm qua"}}]}}}}
+- "thứ hai 100k bánh, 500k laptop" → {{"intent": "MULTIPLE_EXPENSES", "confidence": 0.9, "data": {{"transactions": [{{"amount": 100000, "description": "bánh", "category": "Ăn uống", "custom_date": "thứ hai"}}, {{"amount": 500000, "description": "laptop", "category": "Mua sắm", "custom_date": "thứ hai"}}]}}}}
+- "5/9 bún 12k, gà 20k, laptop 1.5m, 200k xăng" → {{"intent": "MULTIPLE_EXPENSES", "confidence": 0.9, "data": {{"transactions": [{{"amount": 32000, "description": "bún, gà", "category": "Ăn uống", "custom_date": "5/9"}}, {{"amount": 1500000, "description": "laptop", "category": "Mua sắm", "custom_date": "5/9"}}, {{"amount": 200000, "description": "xăng", "category": "Di chuyển", "custom_date": "5/9"}}]}}}}
+
+VÍ DỤ CHO THỐNG KÊ:
+- "thống kê" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "thang"}}}}
+- "thống kê tháng trước" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "thang", "specific_value": "thang_truoc"}}}}
+- "báo cáo tháng 8" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "thang", "specific_value": "8"}}}}
+- "thống kê tuần này" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "tuan"}}}}
+- "thống kê 2/9" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "ngay", "specific_value": "2/9"}}}}
+- "báo cáo ngày 15/8" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "ngay", "specific_value": "15/8"}}}}
+- "thống kê ngày 02/09" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "ngay", "specific_value": "02/09"}}}}
+- "thống kê từ 01/08 đến 31/08" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "custom", "specific_value": "01/08-31/08"}}}}
+- "báo cáo từ 1/9 đến 5/9" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "custom", "specific_value": "01/09-05/09"}}}}
+- "thống kê hôm nay" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "ngay"}}}}
+- "thống kê hôm qua" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "ngay", "specific_value": "hôm qua"}}}}
+- "báo cáo hôm kia" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "ngay", "specific_value": "hôm kia"}}}}
+- "báo cáo ngày hôm nay" → {{"intent": "STATS", "confidence": 0.9, "data": {{"time_period": "ngay"}}}}
+
+VÍ DỤ CHO THỐNG KÊ DANH MỤC:
+- "ăn uống" → {{"intent": "CATEGORY_STATS", "confidence": 0.9, "data": {{"category_name": "ăn uống", "time_period": "thang"}}}}
+- "ăn uống hôm nay" → {{"intent": "CATEGORY_STATS", "confidence": 0.9, "data": {{"category_name": "ăn uống", "time_period": "ngay"}}}}
+- "ăn uống tháng 8" → {{"intent": "CATEGORY_STATS", "confidence": 0.9, "data": {{"category_name": "ăn uống", "time_period": "thang", "specific_value": "8"}}}}
+- "xăng xe tuần này" → {{"intent": "CATEGORY_STATS", "confidence": 0.9, "data": {{"category_name": "xăng xe", "time_period": "tuan"}}}}
+- "mua sắm ngày hôm nay" → {{"intent": "CATEGORY_STATS", "confidence": 0.9, "data": {{"category_name": "mua sắm", "time_period": "ngay"}}}}
+- "top chi tiêu tuần này" → {{"intent": "CATEGORY_STATS", "confidence": 0.9, "data": {{"category_name": "top chi tiêu", "time_period": "tuan"}}}}
+
+VÍ DỤ CHO XUẤT DỮ LIỆU:
+- "xuất dữ liệu" → {{"intent": "EXPORT", "confidence": 0.9, "data": {{"time_period": "nam", "format": "csv"}}}}
+- "xuất excel tháng 8" → {{"intent": "EXPORT", "confidence": 0.9, "data": {{"time_period": "thang", "specific_value": "8", "format": "xlsx"}}}}
+- "xuất file từ 1/1 đến 30/6" → {{"intent": "EXPORT", "confidence": 0.9, "data": {{"time_period": "custom", "specific_value": "01/01-30/06", "format": "csv"}}}}
+- "export năm 2024" → {{"intent": "EXPORT", "confidence": 0.9, "data": {{"time_period": "nam", "specific_value": "2024", "format": "csv"}}}}
+
+Chỉ trả về JSON, không giải thích gì thêm.
+"""
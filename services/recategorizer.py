@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+from collections import Counter
+from datetime import datetime
+from typing import Callable, Dict, List
+
+from services.batch_categorizer import BatchCategorizer
+from services.category_index import get_category_index
+from services.category_rules import FALLBACK_CATEGORY
+from services.sheet_archive import SheetArchiveManager, TRANSACTION_HEADER
+from services.sheets_scheduler import PRIORITY_BACKGROUND
+from services.worksheet_cache import normalize_row, get_worksheet_cache
+
+logger = logging.getLogger(__name__)
+
+# Cột Danh mục (D) trong worksheet giao dịch
+CATEGORY_COLUMN = "D"
+
+
+class Recategorizer:
+    """
+    Phân loại lại các giao dịch "Khác" đã ghi trong Google Sheets
+
+    Mỗi worksheet: đọc 1 lần, phân loại các dòng "Khác" bằng luật cục bộ +
+    AI theo lô, đọc lại để chắc dòng chưa bị sửa/xóa, rồi ghi toàn bộ
+    thay đổi bằng 1 lệnh batch_update. Worksheet đã xong và kết quả AI
+    được lưu vào checkpoint nên chạy lại sẽ tiếp tục từ chỗ dừng.
+    """
+
+    def __init__(self, ai_service=None, checkpoint_file: str = None, max_ai_calls: int = None,
+                 dry_run: bool = False):
+        """
+        Args:
+            ai_service: GeminiAIService (None = chỉ dùng luật cục bộ)
+            checkpoint_file: File lưu tiến độ (mặc định RECATEGORIZE_CHECKPOINT)
+            max_ai_calls: Ngân sách lệnh gọi AI cho lần chạy (mặc định RECATEGORIZE_MAX_AI_CALLS)
+            dry_run: Chỉ thống kê, không ghi lên sheet
+        """
+        self.checkpoint_file = checkpoint_file or os.getenv('RECATEGORIZE_CHECKPOINT', 'recategorize_checkpoint.json')
+        self.dry_run = dry_run
+        self.categorizer = BatchCategorizer(
+            ai_service,
+            max_ai_calls=max_ai_calls if max_ai_calls is not None else int(os.getenv('RECATEGORIZE_MAX_AI_CALLS', 50))
+        )
+        self.stats = Counter()
+        self._checkpoint = self._load_checkpoint()
+        # Kết quả AI của lần chạy trước - không tốn quota hỏi lại
+        for key, category in self._checkpoint['memo'].items():
+            transaction_type, description = key.split('|', 1)
+            self.categorizer._memo[(transaction_type, description)] = category
+
+    def _load_checkpoint(self) -> Dict:
+        try:
+            if os.path.exists(self.checkpoint_file):
+                with open(self.checkpoint_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                    logger.info(f"📍 Tiếp tục từ checkpoint: {len(data.get('done', {}))} worksheet đã xong")
+                    return {'done': data.get('done', {}), 'memo': data.get('memo', {})}
+        except Exception as e:
+            logger.error(f"❌ Lỗi load checkpoint phân loại lại: {e}")
+        return {'done': {}, 'memo': {}}
+
+    def _save_checkpoint(self):
+        if self.dry_run:
+            return
+        self._checkpoint['memo'] = {
+            f"{transaction_type}|{description}": category
+            for (transaction_type, description), category in self.categorizer._memo.items()
+        }
+        try:
+            with open(self.checkpoint_file, 'w', encoding='utf-8') as f:
+                json.dump(self._checkpoint, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            logger.error(f"❌ Lỗi lưu checkpoint phân loại lại: {e}")
+
+    def reset(self):
+        """Xóa checkpoint để quét lại từ đầu"""
+        self._checkpoint = {'done': {}, 'memo': {}}
+        if os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+    @staticmethod
+    def list_user_worksheets(service) -> List[str]:
+        """Tên các worksheet giao dịch của user trong spreadsheet (không tính archive/danh bạ)"""
+        archives = set()
+        if SheetArchiveManager.is_enabled():
+            archives = {entry['archive'] for entry in service._get_archive_manager().get_directory()}
+
+        titles = []
+        for worksheet in service._call(service.spreadsheet.worksheets, priority=PRIORITY_BACKGROUND):
+            if worksheet.title in archives or worksheet.title == SheetArchiveManager.DIRECTORY_TITLE:
+                continue
+            titles.append(worksheet.title)
+        return titles
+
+    def run(self, service, user_names: List[str], progress: Callable[[Dict], None] = None) -> Dict:
+        """
+        Phân loại lại giao dịch "Khác" của các user trong một spreadsheet
+
+        Args:
+            service: GoogleSheetsService của spreadsheet
+            user_names: Tên worksheet của các user
+            progress: Hàm nhận tiến độ sau mỗi worksheet
+
+        Returns:
+            Dict: Thống kê (worksheets, scanned, updated, ai_calls, ...)
+        """
+        for user_name in user_names:
+            try:
+                worksheet = service._call(service.spreadsheet.worksheet, user_name, priority=PRIORITY_BACKGROUND)
+            except Exception as e:
+                logger.error(f"❌ Không mở được worksheet '{user_name}': {e}")
+                continue
+
+            worksheets = service._get_worksheets_for_range(worksheet)
+            changed = False
+            for target in worksheets:
+                if self.categorizer.ai_budget_left() == 0:
+                    logger.warning("⏸️ Hết ngân sách AI - chạy lại lệnh để tiếp tục từ checkpoint")
+                    self.stats['paused'] = 1
+                    break
+                changed = self._process_worksheet(service, target, service.get_user_key(user_name)) or changed
+                if progress:
+                    progress(self.get_stats())
+
+            if changed and not self.dry_run:
+                # Số lần dùng danh mục đã đổi - dựng lại index ở lần đọc toàn bộ tiếp theo
+                get_category_index().invalidate(service._category_key(user_name))
+
+            if self.stats['paused']:
+                break
+
+        return self.get_stats()
+
+    def _process_worksheet(self, service, worksheet, user_key: str = None) -> bool:
+        """Phân loại lại một worksheet, trả về True nếu có dòng được cập nhật"""
+        sheet_id = worksheet.spreadsheet.id
+        key = f"{sheet_id}:{worksheet.title}"
+        if key in self._checkpoint['done']:
+            self.stats['skipped_worksheets'] += 1
+            return False
+
+        rows = [normalize_row(row) for row in service._call(worksheet.get, "A:E", priority=PRIORITY_BACKGROUND)]
+        if not rows or rows[0][:len(TRANSACTION_HEADER)] != TRANSACTION_HEADER:
+            logger.info(f"⏭️ Bỏ qua '{worksheet.title}' - không phải worksheet giao dịch")
+            return False
+
+        # (số dòng trên sheet, dòng gốc) của các giao dịch "Khác"
+        targets = [
+            (index + 1, row) for index, row in enumerate(rows)
+            if index > 0 and len(row) > 3 and row[3] == FALLBACK_CATEGORY and row[1] in ('Thu', 'Chi')
+        ]
+        self.stats['worksheets'] += 1
+        self.stats['scanned'] += len(rows) - 1
+        self.stats['other_rows'] += len(targets)
+
+        categories = self.categorizer.categorize(
+            [(row[1], row[4] if len(row) > 4 else '') for _, row in targets], user_key=user_key
+        )
+        updates = [
+            (row_number, row, category)
+            for (row_number, row), category in zip(targets, categories)
+            if category != FALLBACK_CATEGORY
+        ]
+        budget_exhausted = self.categorizer.ai_budget_left() == 0
+
+        updated = 0
+        if updates and not self.dry_run:
+            updated = self._write_updates(service, worksheet, updates)
+        elif self.dry_run:
+            updated = len(updates)
+        self.stats['updated'] += updated
+
+        logger.info(f"🏷️ '{worksheet.title}': {len(targets)} dòng 'Khác', phân loại lại {updated}")
+
+        # Hết ngân sách giữa chừng thì chưa đánh dấu xong - lần sau quét lại phần còn thiếu
+        if not budget_exhausted:
+            self._checkpoint['done'][key] = {
+                'updated': updated,
+                'at': datetime.now().isoformat(timespec='seconds')
+            }
+        self._save_checkpoint()
+        return updated > 0
+
+    def _write_updates(self, service, worksheet, updates: List[tuple]) -> int:
+        """Đọc lại sheet, bỏ các dòng đã bị sửa/xóa, ghi phần còn lại bằng 1 lệnh batch_update"""
+        current = service._call(worksheet.get, "A:D", priority=PRIORITY_BACKGROUND)
+
+        data = []
+        for row_number, row, category in updates:
+            now = normalize_row(current[row_number - 1]) if row_number <= len(current) else []
+            if now != normalize_row(row[:4]):
+                self.stats['conflicts'] += 1
+                continue
+            data.append({'range': f"{CATEGORY_COLUMN}{row_number}", 'values': [[category]]})
+
+        if not data:
+            return 0
+
+        service._call(worksheet.batch_update, data, kind='write', priority=PRIORITY_BACKGROUND)
+        # Sửa giữa sheet - cache phải tải lại toàn bộ worksheet
+        get_worksheet_cache().invalidate(worksheet.spreadsheet.id, worksheet.title)
+        return len(data)
+
+    def get_stats(self) -> Dict:
+        """Thống kê lần chạy"""
+        categorizer_stats = self.categorizer.stats
+        return {
+            'worksheets': self.stats['worksheets'],
+            'skipped_worksheets': self.stats['skipped_worksheets'],
+            'scanned': self.stats['scanned'],
+            'other_rows': self.stats['other_rows'],
+            'updated': self.stats['updated'],
+            'conflicts': self.stats['conflicts'],
+            'categorized_local': categorizer_stats['local'],
+            'categorized_ai': categorizer_stats['ai'],
+            'ai_calls': categorizer_stats['ai_calls'],
+            'paused': bool(self.stats['paused'])
+        }
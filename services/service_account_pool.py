@@ -0,0 +1,272 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Callable, Dict, List, Optional
+
+import gspread
+from google.oauth2.service_account import Credentials
+from services.sheets_scheduler import get_sheets_scheduler
+from utils.json_utils import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
+
+class ServiceAccount:
+    """Một service account Google với client và scheduler quota riêng"""
+
+    def __init__(self, credentials_path: str):
+        self.credentials_path = credentials_path
+        self.credentials = Credentials.from_service_account_file(credentials_path, scopes=SCOPES)
+        self.email = self.credentials.service_account_email
+        self.scheduler = get_sheets_scheduler(self.email)
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self) -> gspread.Client:
+        """gspread client - authorize 1 lần rồi dùng lại cho mọi user"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = gspread.authorize(self.credentials)
+        return self._client
+
+
+class ServiceAccountPool:
+    """
+    Pool service account để vượt quota của một account
+
+    Chỉ chia user ở chế độ private: mỗi user được gán cố định vào một account
+    bằng rendezvous hashing, thêm account mới chỉ chuyển khoảng 1/n user sang
+    account đó. User đã share sheet cho một email cụ thể nên được "ghim" vào
+    account đó cho tới khi rebalance xác nhận account mới mở được sheet.
+
+    Shared mode (một GOOGLE_SHEET_ID chung) luôn dùng account chính - sheet chung
+    chỉ được share cho email của GOOGLE_CREDENTIALS_PATH.
+    """
+
+    def __init__(self):
+        self.assignments_file = "service_accounts.json"
+        self.accounts = self._load_accounts()
+        self._lock = threading.Lock()
+
+        data = self._load_assignments()
+        self.assignments: Dict[str, str] = data.get('assignments', {})
+        self.known_accounts: List[str] = data.get('accounts', [])
+
+        logger.info(f"🔐 Loaded {len(self.accounts)} service account(s)")
+
+    def _load_accounts(self) -> List[ServiceAccount]:
+        """Load service accounts từ environment variables"""
+        paths = []
+
+        # Method 1: Single file (backward compatibility)
+        single_path = os.getenv('GOOGLE_CREDENTIALS_PATH')
+        if single_path:
+            paths.append(single_path.strip())
+
+        # Method 2: Multiple files (comma separated)
+        for path in os.getenv('GOOGLE_CREDENTIALS_PATHS', '').split(','):
+            path = path.strip()
+            if path and path not in paths:
+                paths.append(path)
+
+        # Method 3: Tất cả file JSON trong một thư mục
+        credentials_dir = os.getenv('GOOGLE_CREDENTIALS_DIR')
+        if credentials_dir:
+            for path in sorted(glob.glob(os.path.join(credentials_dir, '*.json'))):
+                if path not in paths:
+                    paths.append(path)
+
+        accounts = []
+        emails = set()
+        for path in paths:
+            try:
+                account = ServiceAccount(path)
+            except Exception as e:
+                logger.error(f"❌ Không load được service account {path}: {e}")
+                continue
+            if account.email in emails:
+                continue
+            emails.add(account.email)
+            accounts.append(account)
+
+        if not accounts:
+            raise ValueError("Không tìm thấy service account nào (GOOGLE_CREDENTIALS_PATH/PATHS/DIR)")
+
+        return accounts
+
+    def _load_assignments(self) -> Dict:
+        """Load danh sách user đã ghim vào account từ file JSON"""
+        try:
+            if os.path.exists(self.assignments_file):
+                with open(self.assignments_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"❌ Lỗi load service account assignments: {e}")
+        return {}
+
+    def _save_assignments(self):
+        """Lưu danh sách user đã ghim vào file JSON (gọi khi đang giữ lock)"""
+        try:
+            write_json_atomic(self.assignments_file, {
+                'accounts': self.known_accounts,
+                'assignments': self.assignments
+            }, indent=2)
+        except Exception as e:
+            logger.error(f"❌ Lỗi lưu service account assignments: {e}")
+
+    @property
+    def primary(self) -> ServiceAccount:
+        """Account chính (GOOGLE_CREDENTIALS_PATH): sheet chung của shared mode và user cũ"""
+        return self.accounts[0]
+
+    def get_account_by_email(self, email: str) -> Optional[ServiceAccount]:
+        """Tìm account trong pool theo email"""
+        return next((account for account in self.accounts if account.email == email), None)
+
+    def get_hashed_account(self, user_key: str) -> ServiceAccount:
+        """Account theo rendezvous hashing (không xét ghim)"""
+        def weight(account: ServiceAccount) -> int:
+            digest = hashlib.sha256(f"{account.email}:{user_key}".encode('utf-8')).digest()
+            return int.from_bytes(digest[:8], 'big')
+
+        return max(self.accounts, key=weight)
+
+    def get_account(self, user_key: str) -> ServiceAccount:
+        """
+        Lấy service account phục vụ một user ở chế độ private
+
+        Args:
+            user_key: user_id
+        """
+        user_key = str(user_key)
+        pinned = self.assignments.get(user_key)
+        if pinned:
+            account = self.get_account_by_email(pinned)
+            if account:
+                return account
+            logger.warning(f"⚠️ Service account {pinned} của user {user_key} không còn trong pool")
+        return self.get_hashed_account(user_key)
+
+    def get_service_email(self, user_key: str) -> str:
+        """Email user cần share Google Sheet cho"""
+        return self.get_account(user_key).email
+
+    def pin(self, user_key: str, account: ServiceAccount):
+        """Ghim user vào account (sheet của user đã share cho email này)"""
+        with self._lock:
+            self.assignments[str(user_key)] = account.email
+            self._save_assignments()
+
+    def pin_missing(self, user_keys: List[str], account: ServiceAccount) -> int:
+        """Ghim các user chưa có account (VD: user đăng ký trước khi có pool)"""
+        with self._lock:
+            missing = [str(key) for key in user_keys if str(key) not in self.assignments]
+            for user_key in missing:
+                self.assignments[user_key] = account.email
+            if missing:
+                self._save_assignments()
+        return len(missing)
+
+    def unpin(self, user_key: str):
+        """Bỏ ghim khi user xóa sheet"""
+        with self._lock:
+            if self.assignments.pop(str(user_key), None):
+                self._save_assignments()
+
+    def accounts_changed(self) -> bool:
+        """Kiểm tra danh sách account có khác lần chạy trước không"""
+        return sorted(self.known_accounts) != sorted(account.email for account in self.accounts)
+
+    def rebalance(self, can_access: Callable[[str, ServiceAccount], bool],
+                  grant_access: Callable[[str, ServiceAccount, ServiceAccount], None] = None) -> int:
+        """
+        Chuyển user đã ghim sang account theo hashing
+
+        Account mới chưa mở được sheet thì user ở lại account cũ. Chỉ khi có
+        grant_access (admin bật SERVICE_ACCOUNT_AUTO_SHARE) mới nhờ account đang ghim
+        (đã có quyền Editor) share sheet cho email mới, kiểm tra lại rồi mới chuyển.
+        Không share được (chủ sheet chặn Editor chia sẻ...) thì user ở lại account cũ.
+
+        Args:
+            can_access: Hàm kiểm tra account mới có mở được sheet của user không
+            grant_access: Hàm (user_key, account hiện tại, account mới) share sheet cho account mới;
+                None = không tự share
+
+        Returns:
+            int: Số user đã chuyển account
+        """
+        moved = 0
+        failed = 0
+        for user_key, email in list(self.assignments.items()):
+            target = self.get_hashed_account(user_key)
+            if target.email == email:
+                continue
+            source = self.get_account_by_email(email)
+            try:
+                accessible = self._try_access(can_access, user_key, target)
+                if not accessible and grant_access and source:
+                    grant_access(user_key, source, target)
+                    accessible = self._try_access(can_access, user_key, target)
+            except Exception as e:
+                logger.warning(f"⚠️ Không share được sheet của user {user_key} cho {target.email}: {e}")
+                accessible = False
+
+            if not accessible:
+                failed += 1
+                continue
+            with self._lock:
+                self.assignments[user_key] = target.email
+                self._save_assignments()
+            moved += 1
+            logger.info(f"🔀 User {user_key}: {email} → {target.email}")
+
+        with self._lock:
+            self.known_accounts = [account.email for account in self.accounts]
+            self._save_assignments()
+
+        logger.info(f"⚖️ Rebalance service accounts: chuyển {moved} user, giữ nguyên {failed} user")
+        return moved
+
+    @staticmethod
+    def _try_access(can_access: Callable[[str, ServiceAccount], bool], user_key: str,
+                    account: ServiceAccount) -> bool:
+        """can_access() nhưng lỗi (chưa được share) tính là False"""
+        try:
+            return bool(can_access(user_key, account))
+        except Exception as e:
+            logger.debug(f"User {user_key} chưa share cho {account.email}: {e}")
+            return False
+
+    def get_stats(self) -> Dict:
+        """Lấy thống kê phân bổ user theo account"""
+        pinned_counts = {account.email: 0 for account in self.accounts}
+        for email in self.assignments.values():
+            if email in pinned_counts:
+                pinned_counts[email] += 1
+        return {
+            'total_accounts': len(self.accounts),
+            'pinned_users': pinned_counts
+        }
+
+
+_pool: Optional[ServiceAccountPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_service_account_pool() -> ServiceAccountPool:
+    """Lấy pool service account dùng chung của process"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ServiceAccountPool()
+        return _pool
@@ -0,0 +1,368 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import gspread
+from services.category_index import CategoryIndex, get_category_index
+from services.sheets_scheduler import PRIORITY_USER_READ, PRIORITY_BACKGROUND
+from services.worksheet_cache import get_worksheet_cache, row_checksum
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_HEADER = ["Ngày", "Loại", "Số tiền", "Danh mục", "Ghi chú"]
+
+
+def parse_row_date(value) -> Optional[datetime]:
+    """Parse cột Ngày (dd/mm/YYYY [HH:MM:SS]) của một dòng, None nếu không hợp lệ"""
+    if not isinstance(value, str) or not value.strip():
+        return None
+    try:
+        return datetime.strptime(value.strip().split(' ')[0], "%d/%m/%Y")
+    except ValueError:
+        return None
+
+
+class SheetArchiveManager:
+    """
+    Tách giao dịch các năm cũ sang worksheet lưu trữ theo năm
+
+    Rollover chạy nền, mỗi worksheet một lock, và làm lại được từ bất kỳ bước nào:
+    1. Ghi các dòng năm cũ vào archive - bỏ qua dòng archive đã có (lần trước
+       ghi xong nhưng chưa kịp xóa).
+    2. Ghi danh bạ (ghi nhận tiến độ) trước khi xóa.
+    3. Xóa đúng các dòng đã chuyển bằng một batch_update (không ghi đè dòng còn
+       lại nên không đụng giao dịch mới được append cùng lúc).
+    """
+
+    DIRECTORY_TITLE = "_Lưu trữ"
+    DIRECTORY_HEADER = ["Worksheet", "Lưu trữ", "Spreadsheet", "Từ ngày", "Đến ngày"]
+
+    # Rollover lỗi thì chờ bấy nhiêu giây mới thử lại (không thử lại ở mọi tin nhắn)
+    RETRY_SECONDS = 600
+
+    # Cache dùng chung giữa các instance (service được tạo lại theo từng user)
+    _directories: Dict[str, List[Dict]] = {}
+    _directory_rows: Dict[str, int] = {}
+    _checked = set()
+    _running = set()
+    _failed_at: Dict[tuple, float] = {}
+    _worksheet_locks: Dict[tuple, threading.Lock] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, client, spreadsheet, scheduler):
+        self.client = client
+        self.spreadsheet = spreadsheet
+        self.scheduler = scheduler
+        self.sheet_id = spreadsheet.id
+        self.archive_spreadsheets = self._load_archive_spreadsheets()
+
+    @staticmethod
+    def is_enabled() -> bool:
+        """Kiểm tra tính năng lưu trữ theo năm có được bật không"""
+        return os.getenv('SHEETS_YEARLY_ARCHIVE', 'true').lower() == 'true'
+
+    @staticmethod
+    def _load_archive_spreadsheets() -> Dict[int, str]:
+        """
+        Đọc cấu hình spreadsheet lưu trữ riêng theo năm
+
+        VD: SHEETS_ARCHIVE_SPREADSHEETS=2023:1AbC...,2024:1XyZ...
+        Năm không có cấu hình sẽ lưu trữ ngay trong spreadsheet hiện tại.
+        """
+        mapping = {}
+        raw = os.getenv('SHEETS_ARCHIVE_SPREADSHEETS', '')
+        for item in raw.split(','):
+            if ':' not in item:
+                continue
+            year, sheet_id = item.split(':', 1)
+            if year.strip().isdigit() and sheet_id.strip():
+                mapping[int(year.strip())] = sheet_id.strip()
+        return mapping
+
+    def _call(self, func, *args, kind: str = 'read', priority: int = PRIORITY_BACKGROUND, **kwargs):
+        """Gọi Google Sheets qua scheduler - lưu trữ mặc định là việc nền"""
+        return self.scheduler.call(func, *args, kind=kind, priority=priority, **kwargs)
+
+    @staticmethod
+    def archive_title(base_title: str, year: int) -> str:
+        """Tên worksheet lưu trữ của một năm"""
+        return f"{base_title[:94]} {year}"
+
+    def _open_spreadsheet(self, sheet_id: str):
+        """Mở spreadsheet chứa archive (mặc định là spreadsheet hiện tại)"""
+        if not sheet_id or sheet_id == self.sheet_id:
+            return self.spreadsheet
+        return self._call(self.client.open_by_key, sheet_id, priority=PRIORITY_USER_READ)
+
+    def get_directory(self) -> List[Dict]:
+        """
+        Lấy danh bạ lưu trữ: archive nào chứa giao dịch của khoảng ngày nào
+
+        Returns:
+            List[Dict]: [{'worksheet', 'archive', 'spreadsheet', 'start', 'end'}]
+        """
+        if self.sheet_id in self._directories:
+            return self._directories[self.sheet_id]
+
+        entries = []
+        rows = []
+        try:
+            directory = self._call(self.spreadsheet.worksheet, self.DIRECTORY_TITLE, priority=PRIORITY_USER_READ)
+            rows = self._call(directory.get_all_values, priority=PRIORITY_USER_READ)
+            for row in rows[1:]:
+                if len(row) < 5:
+                    continue
+                start, end = parse_row_date(row[3]), parse_row_date(row[4])
+                if not start or not end:
+                    continue
+                entries.append({
+                    'worksheet': row[0],
+                    'archive': row[1],
+                    'spreadsheet': row[2] or self.sheet_id,
+                    'start': start,
+                    'end': end
+                })
+        except gspread.WorksheetNotFound:
+            pass
+
+        self._directories[self.sheet_id] = entries
+        self._directory_rows[self.sheet_id] = len(rows)
+        return entries
+
+    def _save_directory(self, entries: List[Dict]):
+        """
+        Ghi lại toàn bộ danh bạ lưu trữ (vài chục dòng) bằng một lệnh update
+
+        Không clear() trước: dòng thừa của bản cũ được ghi đè bằng dòng trống
+        trong cùng lệnh, nên không có lúc nào danh bạ bị rỗng.
+        Cache trong RAM do rollover cập nhật sau khi đã xóa dòng khỏi worksheet.
+        """
+        try:
+            directory = self._call(self.spreadsheet.worksheet, self.DIRECTORY_TITLE)
+        except gspread.WorksheetNotFound:
+            directory = self._call(
+                self.spreadsheet.add_worksheet,
+                title=self.DIRECTORY_TITLE,
+                rows=str(max(len(entries) + 1, 10)),
+                cols=str(len(self.DIRECTORY_HEADER)),
+                kind='write'
+            )
+
+        values = [self.DIRECTORY_HEADER] + [
+            [
+                entry['worksheet'],
+                entry['archive'],
+                entry['spreadsheet'],
+                entry['start'].strftime("%d/%m/%Y"),
+                entry['end'].strftime("%d/%m/%Y")
+            ]
+            for entry in entries
+        ]
+        previous_rows = self._directory_rows.get(self.sheet_id, 0)
+        values += [[''] * len(self.DIRECTORY_HEADER)] * max(previous_rows - len(values), 0)
+        self._call(directory.update, 'A1', values, kind='write')
+        self._directory_rows[self.sheet_id] = len(values)
+
+    def get_archives(self, base_title: str, start_date: datetime = None,
+                     end_date: datetime = None) -> List[Dict]:
+        """
+        Lấy các archive của worksheet có khoảng ngày giao với khoảng yêu cầu
+
+        Args:
+            base_title: Tên worksheet đang dùng của user
+            start_date: Ngày bắt đầu (None = không giới hạn)
+            end_date: Ngày kết thúc (None = không giới hạn)
+        """
+        archives = []
+        for entry in self.get_directory():
+            if entry['worksheet'] != base_title:
+                continue
+            if start_date and entry['end'] < start_date.replace(hour=0, minute=0, second=0, microsecond=0):
+                continue
+            if end_date and entry['start'] > end_date:
+                continue
+            archives.append(entry)
+        return archives
+
+    def open_archive(self, entry: Dict):
+        """Mở worksheet lưu trữ theo một dòng của danh bạ"""
+        spreadsheet = self._open_spreadsheet(entry['spreadsheet'])
+        return self._call(spreadsheet.worksheet, entry['archive'], priority=PRIORITY_USER_READ)
+
+    def ensure_rollover(self, worksheet, background: bool = True):
+        """
+        Chuyển các giao dịch năm cũ ra archive - kiểm tra tối đa 1 lần/năm/worksheet
+
+        Chạy ở thread nền để tin nhắn đầu tiên của năm không phải chờ; chỉ tốn
+        1 lệnh đọc ô A2 nếu worksheet không có dữ liệu năm cũ.
+        """
+        current_year = datetime.now().year
+        key = (self.sheet_id, worksheet.title, current_year)
+        if key in self._checked:
+            return
+
+        with self._lock:
+            if key in self._checked or key in self._running:
+                return
+            if time.monotonic() - self._failed_at.get(key, float('-inf')) < self.RETRY_SECONDS:
+                return
+            self._running.add(key)
+
+        if background:
+            threading.Thread(
+                target=self._run_rollover, args=(worksheet, key), name="sheet-archive", daemon=True
+            ).start()
+        else:
+            self._run_rollover(worksheet, key)
+
+    def _worksheet_lock(self, worksheet_title: str) -> threading.Lock:
+        with self._lock:
+            return self._worksheet_locks.setdefault((self.sheet_id, worksheet_title), threading.Lock())
+
+    def _run_rollover(self, worksheet, key: tuple):
+        try:
+            with self._worksheet_lock(worksheet.title):
+                first_date = parse_row_date(self._call(worksheet.acell, 'A2').value)
+                if first_date and first_date.year < key[2]:
+                    self.rollover(worksheet, key[2])
+            self._checked.add(key)
+            self._failed_at.pop(key, None)
+        except Exception as e:
+            self._failed_at[key] = time.monotonic()
+            logger.error(f"❌ Lỗi lưu trữ năm cũ cho '{worksheet.title}' (thử lại sau {self.RETRY_SECONDS}s): {e}")
+        finally:
+            with self._lock:
+                self._running.discard(key)
+
+    def _open_or_create_archive(self, spreadsheet, title: str, rows: int):
+        """Mở worksheet archive, tạo mới (kèm header) nếu chưa có → (worksheet, các dòng đang có)"""
+        try:
+            archive = self._call(spreadsheet.worksheet, title)
+        except gspread.WorksheetNotFound:
+            archive = self._call(
+                spreadsheet.add_worksheet,
+                title=title,
+                rows=str(rows + 1),
+                cols=str(len(TRANSACTION_HEADER)),
+                kind='write'
+            )
+            self._call(archive.append_row, TRANSACTION_HEADER, kind='write')
+            return archive, []
+        existing = self._call(archive.get_all_values, value_render_option='UNFORMATTED_VALUE')
+        return archive, existing[1:]
+
+    @staticmethod
+    def _missing_rows(rows: List[List], existing: List[List]) -> List[List]:
+        """Các dòng chưa có trong archive (so theo checksum, tính cả số lần lặp)"""
+        remaining = Counter(row_checksum(row) for row in existing)
+        missing = []
+        for row in rows:
+            checksum = row_checksum(row)
+            if remaining[checksum] > 0:
+                remaining[checksum] -= 1
+            else:
+                missing.append(row)
+        return missing
+
+    @staticmethod
+    def _row_blocks(indexes: List[int]) -> List[tuple]:
+        """[2, 3, 4, 7, 8] → [(2, 4), (7, 8)] - các khối dòng liền nhau"""
+        blocks = []
+        for index in indexes:
+            if blocks and blocks[-1][1] == index - 1:
+                blocks[-1] = (blocks[-1][0], index)
+            else:
+                blocks.append((index, index))
+        return blocks
+
+    def rollover(self, worksheet, current_year: int):
+        """Chuyển toàn bộ dòng có năm < current_year sang archive của năm đó"""
+        values = self._call(worksheet.get_all_values, value_render_option='UNFORMATTED_VALUE')
+        if len(values) <= 1:
+            return
+
+        moved_rows_by_year = defaultdict(list)
+        moved_indexes = []
+
+        for index, row in enumerate(values[1:], start=2):
+            row_date = parse_row_date(row[0] if row else None)
+            if row_date and row_date.year < current_year:
+                moved_rows_by_year[row_date.year].append(row)
+                moved_indexes.append(index)
+
+        if not moved_indexes:
+            return
+
+        entries = [dict(entry) for entry in self.get_directory()]
+
+        # Bước 1: ghi archive, bỏ qua dòng đã ghi ở lần chạy trước bị dừng giữa chừng
+        for year, rows in sorted(moved_rows_by_year.items()):
+            spreadsheet_id = self.archive_spreadsheets.get(year, self.sheet_id)
+            spreadsheet = self._open_spreadsheet(spreadsheet_id)
+            title = self.archive_title(worksheet.title, year)
+
+            archive, existing = self._open_or_create_archive(spreadsheet, title, len(rows))
+            missing = self._missing_rows(rows, existing)
+            if missing:
+                self._call(archive.append_rows, missing, kind='write')
+
+            dates = [parse_row_date(row[0]) for row in rows]
+            entry = next((e for e in entries if e['worksheet'] == worksheet.title and e['archive'] == title), None)
+            if entry:
+                entry['start'] = min(entry['start'], min(dates))
+                entry['end'] = max(entry['end'], max(dates))
+            else:
+                entries.append({
+                    'worksheet': worksheet.title,
+                    'archive': title,
+                    'spreadsheet': spreadsheet_id,
+                    'start': min(dates),
+                    'end': max(dates)
+                })
+
+            skipped = len(rows) - len(missing)
+            logger.info(
+                f"🗄️ Lưu trữ {len(missing)} giao dịch năm {year} → '{title}'"
+                + (f" (bỏ qua {skipped} dòng đã lưu trữ trước đó)" if skipped else "")
+            )
+
+        # Bước 2: ghi nhận tiến độ - từ đây dòng năm cũ đã nằm trong archive
+        self._save_directory(entries)
+
+        # Bước 3: chỉ xóa nếu các dòng vẫn y như lúc đọc (không bị sửa tay/chèn dòng phía trên)
+        blocks = self._row_blocks(moved_indexes)
+        current = self._call(
+            worksheet.batch_get, [f"A{start}:E{end}" for start, end in blocks],
+            value_render_option='UNFORMATTED_VALUE'
+        )
+        for (start, end), block_rows in zip(blocks, current):
+            expected = values[start - 1:end]
+            if [row_checksum(row) for row in block_rows] != [row_checksum(row[:5]) for row in expected]:
+                raise RuntimeError("worksheet thay đổi trong lúc lưu trữ, sẽ thử lại")
+
+        # Xóa từ dưới lên trong 1 batch_update để chỉ số dòng phía trên không bị dịch
+        self._call(self.spreadsheet.batch_update, {
+            'requests': [
+                {
+                    'deleteDimension': {
+                        'range': {
+                            'sheetId': worksheet.id,
+                            'dimension': 'ROWS',
+                            'startIndex': start - 1,
+                            'endIndex': end
+                        }
+                    }
+                }
+                for start, end in reversed(blocks)
+            ]
+        }, kind='write')
+
+        self._directories[self.sheet_id] = entries
+        get_worksheet_cache().invalidate(self.sheet_id, worksheet.title)
+        # Dòng đã chuyển nguồn (worksheet → archive) - dựng lại index ở lần đọc toàn bộ tiếp theo
+        get_category_index().invalidate(CategoryIndex.make_key(self.sheet_id, worksheet.title))
+        logger.info(f"🗄️ Đã xóa {len(moved_indexes)} dòng năm cũ khỏi '{worksheet.title}'")
@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+GVIZ_URL = "https://docs.google.com/spreadsheets/d/{sheet_id}/gviz/tq"
+
+# Cột trong worksheet của user: Ngày | Loại | Số tiền | Danh mục | Ghi chú
+TRANSACTION_COLUMNS = ['Ngày', 'Loại', 'Số tiền', 'Danh mục', 'Ghi chú']
+
+# Khoảng thời gian dài hơn sẽ tạo regex quá lớn - để client tự lọc
+MAX_QUERY_MONTHS = 24
+
+# HTTP status cho biết worksheet không truy vấn gviz được (không phải lỗi tạm thời)
+UNSUPPORTED_STATUS_CODES = (400, 401, 403, 404)
+
+
+class QueryUnsupportedError(Exception):
+    """Worksheet không dùng được gviz (không có quyền, sai tên, response không parse được)"""
+
+
+def _day_token(value: int) -> str:
+    """Số ngày/tháng có thể được nhập có hoặc không có số 0 ở đầu"""
+    return f"0?{value}" if value < 10 else str(value)
+
+
+def build_date_pattern(start_date: datetime, end_date: datetime) -> Optional[str]:
+    """
+    Tạo regex khớp cột Ngày (dd/mm/YYYY HH:MM:SS) trong khoảng thời gian
+
+    Cột Ngày được ghi dạng text nên không so sánh khoảng được trên server,
+    thay vào đó liệt kê các tháng (và các ngày của tháng lẻ) nằm trong khoảng.
+
+    Args:
+        start_date: Ngày bắt đầu
+        end_date: Ngày kết thúc
+
+    Returns:
+        str: Regex cho mệnh đề `matches`, hoặc None nếu khoảng quá dài
+    """
+    if not start_date or not end_date or start_date > end_date:
+        return None
+
+    start_day = start_date.date()
+    end_day = end_date.date()
+
+    alternatives = []
+    month_cursor = start_day.replace(day=1)
+    months = 0
+
+    while month_cursor <= end_day:
+        months += 1
+        if months > MAX_QUERY_MONTHS:
+            return None
+
+        if month_cursor.month == 12:
+            next_month = month_cursor.replace(year=month_cursor.year + 1, month=1)
+        else:
+            next_month = month_cursor.replace(month=month_cursor.month + 1)
+        month_end = next_month - timedelta(days=1)
+
+        first = max(start_day, month_cursor)
+        last = min(end_day, month_end)
+        month_part = f"{_day_token(month_cursor.month)}/{month_cursor.year}"
+
+        if first == month_cursor and last == month_end:
+            # Cả tháng nằm trong khoảng
+            alternatives.append(f"[0-9]{{1,2}}/{month_part}")
+        else:
+            days = "|".join(_day_token(day) for day in range(first.day, last.day + 1))
+            alternatives.append(f"({days})/{month_part}")
+
+        month_cursor = next_month
+
+    return f"({'|'.join(alternatives)})( .*)?"
+
+
+class SheetsQuery:
+    """Đẩy bộ lọc ngày/loại và phép SUM/GROUP BY lên Google Visualization API"""
+
+    def __init__(self, session, sheet_id: str, timeout: float = 10, scheduler=None):
+        self.session = session
+        self.sheet_id = sheet_id
+        self.timeout = timeout
+        self.scheduler = scheduler
+
+    @staticmethod
+    def is_enabled() -> bool:
+        """Kiểm tra chế độ truy vấn phía server có được bật không"""
+        return os.getenv('SHEETS_SERVER_QUERY', 'true').lower() == 'true'
+
+    def _build_where(self, start_date: datetime, end_date: datetime,
+                     transaction_type: str = None) -> Optional[str]:
+        """Tạo mệnh đề WHERE cho khoảng ngày và loại giao dịch"""
+        date_pattern = build_date_pattern(start_date, end_date)
+        if not date_pattern:
+            return None
+
+        # Ô Ngày gõ tay thành kiểu date (cột đa số là text) bị gviz trả về null:
+        # lấy cả các dòng đó để phát hiện lệch kiểu thay vì âm thầm bỏ sót
+        where = f"(A matches '{date_pattern}' or (A is null and B is not null))"
+        if transaction_type:
+            safe_type = transaction_type.replace("'", "")
+            where += f" and B = '{safe_type}'"
+        return where
+
+    def _execute(self, worksheet_title: str, query: str) -> Dict:
+        """Gửi câu truy vấn gviz và trả về bảng kết quả"""
+        def fetch():
+            response = self.session.get(
+                GVIZ_URL.format(sheet_id=self.sheet_id),
+                params={
+                    'tqx': 'out:json',
+                    'sheet': worksheet_title,
+                    'headers': 1,
+                    'tq': query
+                },
+                timeout=self.timeout
+            )
+            # Raise trong hàm được schedule để scheduler retry được HTTP 429
+            response.raise_for_status()
+            return response
+
+        try:
+            response = self.scheduler.call(fetch) if self.scheduler else fetch()
+        except Exception as e:
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            if status in UNSUPPORTED_STATUS_CODES:
+                raise QueryUnsupportedError(f"gviz HTTP {status}") from e
+            # Timeout, 5xx, hết lượt retry 429... - lỗi tạm thời
+            raise
+
+        # Response có dạng: /*O_o*/ google.visualization.Query.setResponse({...});
+        text = response.text
+        try:
+            payload = json.loads(text[text.index('{'):text.rindex('}') + 1])
+        except ValueError as e:
+            # VD: trang đăng nhập HTML thay vì JSON
+            raise QueryUnsupportedError(f"response gviz không hợp lệ: {e}") from e
+
+        if payload.get('status') == 'error':
+            errors = payload.get('errors', [])
+            message = errors[0].get('detailed_message') if errors else 'unknown'
+            raise QueryUnsupportedError(f"gviz query lỗi: {message}")
+
+        return payload.get('table', {})
+
+    @staticmethod
+    def _cell_value(cell):
+        """Lấy giá trị thô của một ô trong bảng gviz"""
+        if not cell:
+            return ''
+        value = cell.get('v')
+        return '' if value is None else value
+
+    def fetch_records(self, worksheet_title: str, start_date: datetime, end_date: datetime,
+                      transaction_type: str = None) -> Optional[List[Dict]]:
+        """
+        Chỉ tải các dòng khớp khoảng ngày (và loại giao dịch)
+
+        Returns:
+            List[Dict]: Records cùng format với get_all_records(), hoặc None nếu không truy vấn
+            được hoặc có ô Ngày/Số tiền bị lệch kiểu (gviz trả null) - khi đó phải đọc toàn bộ
+        """
+        where = self._build_where(start_date, end_date, transaction_type)
+        if not where:
+            return None
+
+        table = self._execute(worksheet_title, f"select A, B, C, D, E where {where}")
+
+        records = []
+        for row in table.get('rows', []):
+            cells = row.get('c', [])
+            values = [self._cell_value(cells[i]) if i < len(cells) else '' for i in range(len(TRANSACTION_COLUMNS))]
+            if values[0] == '' or values[2] == '':
+                logger.info(f"🔎 gviz: '{worksheet_title}' có ô Ngày/Số tiền lệch kiểu, đọc toàn bộ")
+                return None
+            records.append(dict(zip(TRANSACTION_COLUMNS, values)))
+
+        logger.info(f"🔎 gviz: tải {len(records)} dòng từ '{worksheet_title}'")
+        return records
+
+    def fetch_category_totals(self, worksheet_title: str, start_date: datetime,
+                              end_date: datetime) -> Optional[List[Dict]]:
+        """
+        Để server tính tổng tiền và số giao dịch theo (Loại, Danh mục)
+
+        gviz suy ra một kiểu cho mỗi cột và trả null cho các ô khác kiểu (số tiền
+        gõ dạng text, ngày bị Sheets đổi thành date): nhóm nào có count(C)/count(A)
+        nhỏ hơn số dòng count(B) là đã bỏ sót dòng → trả None để tính phía client.
+
+        Returns:
+            List[Dict]: [{'type', 'category', 'amount', 'count'}], hoặc None nếu không truy vấn được
+        """
+        where = self._build_where(start_date, end_date)
+        if not where:
+            return None
+
+        table = self._execute(
+            worksheet_title,
+            f"select B, D, sum(C), count(C), count(A), count(B) where {where} group by B, D"
+        )
+
+        totals = []
+        for row in table.get('rows', []):
+            cells = row.get('c', [])
+            if len(cells) < 6:
+                continue
+            rows = int(self._cell_value(cells[5]) or 0)
+            if int(self._cell_value(cells[3]) or 0) < rows or int(self._cell_value(cells[4]) or 0) < rows:
+                logger.info(f"🔎 gviz: '{worksheet_title}' có ô Ngày/Số tiền lệch kiểu, tính phía client")
+                return None
+            totals.append({
+                'type': self._cell_value(cells[0]),
+                'category': self._cell_value(cells[1]),
+                'amount': float(self._cell_value(cells[2]) or 0),
+                'count': int(self._cell_value(cells[3]) or 0)
+            })
+
+        logger.info(f"🔎 gviz: {len(totals)} nhóm (Loại, Danh mục) từ '{worksheet_title}'")
+        return totals
@@ -0,0 +1,220 @@
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+# Độ ưu tiên: số nhỏ được phục vụ trước
+PRIORITY_USER_WRITE = 0
+PRIORITY_USER_READ = 1
+PRIORITY_BACKGROUND = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_USER_WRITE: 'user_write',
+    PRIORITY_USER_READ: 'user_read',
+    PRIORITY_BACKGROUND: 'background'
+}
+
+# Deadline mặc định (giây) cho từng độ ưu tiên
+DEFAULT_DEADLINES = {
+    PRIORITY_USER_WRITE: 20,
+    PRIORITY_USER_READ: 15,
+    PRIORITY_BACKGROUND: 300
+}
+
+
+class SchedulerTimeout(Exception):
+    """Không lấy được quota Google Sheets trước deadline của request"""
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Kiểm tra lỗi có phải do vượt quota Google Sheets (HTTP 429) không"""
+    response = getattr(error, 'response', None)
+    if getattr(response, 'status_code', None) == 429:
+        return True
+    error_msg = str(error).lower()
+    return any(keyword in error_msg for keyword in [
+        '429', 'rate_limit_exceeded', 'quota exceeded', 'resource_exhausted'
+    ])
+
+
+class TokenBucket:
+    """Token bucket cho quota theo phút"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = max(per_minute, 1)
+        self.tokens = float(self.capacity)
+        self.refill_rate = self.capacity / 60.0
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_rate)
+        self.updated_at = now
+
+    def try_acquire(self, now: float) -> float:
+        """Lấy 1 token; trả về 0 nếu thành công, ngược lại số giây cần chờ"""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.refill_rate
+
+    def drain(self, now: float):
+        """Server báo 429 - coi như đã hết token trong cửa sổ hiện tại"""
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0)
+
+
+class SheetsRequestScheduler:
+    """Điều phối mọi lệnh gọi Google Sheets của một service account theo quota"""
+
+    def __init__(self, name: str = 'default', read_per_minute: int = None, write_per_minute: int = None):
+        self.name = name
+        self.buckets = {
+            'read': TokenBucket(read_per_minute or int(os.getenv('SHEETS_READ_PER_MINUTE', 60))),
+            'write': TokenBucket(write_per_minute or int(os.getenv('SHEETS_WRITE_PER_MINUTE', 60)))
+        }
+        self.max_retries = int(os.getenv('SHEETS_MAX_RETRIES', 5))
+
+        self._condition = threading.Condition()
+        self._waiters = {'read': [], 'write': []}
+        self._sequence = itertools.count()
+
+        # Metrics thời gian chờ hàng đợi theo độ ưu tiên
+        self._wait_count = defaultdict(int)
+        self._wait_total = defaultdict(float)
+        self._wait_max = defaultdict(float)
+        self._retries = 0
+        self._timeouts = 0
+
+    def call(self, func: Callable, *args, kind: str = 'read', priority: int = PRIORITY_USER_READ,
+             deadline: float = None, **kwargs):
+        """
+        Thực hiện một lệnh gọi Google Sheets qua hàng đợi quota
+
+        Hàm chặn (chờ quota, backoff khi 429) tới hết deadline - từ handler async
+        phải gọi qua asyncio.to_thread, không gọi thẳng trên event loop.
+
+        Args:
+            func: Hàm gspread cần gọi
+            kind: 'read' hoặc 'write' (quota riêng)
+            priority: PRIORITY_USER_WRITE / PRIORITY_USER_READ / PRIORITY_BACKGROUND
+            deadline: Số giây tối đa cho cả chờ quota lẫn retry
+
+        Returns:
+            Kết quả của func
+
+        Raises:
+            SchedulerTimeout: Hết deadline khi đang chờ quota
+        """
+        timeout = deadline if deadline is not None else DEFAULT_DEADLINES.get(priority, 30)
+        deadline_at = time.monotonic() + timeout
+
+        attempt = 0
+        while True:
+            self._acquire(kind, priority, deadline_at)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= self.max_retries:
+                    raise
+
+                with self._condition:
+                    self.buckets[kind].drain(time.monotonic())
+                    self._retries += 1
+
+                # Exponential backoff có jitter, không vượt quá deadline
+                backoff = min(2 ** attempt, 32) * random.uniform(0.5, 1.5)
+                remaining = deadline_at - time.monotonic()
+                if remaining <= backoff:
+                    raise
+
+                attempt += 1
+                logger.warning(f"⏳ Sheets 429 ({self.name}/{kind}) - thử lại sau {backoff:.1f}s (lần {attempt})")
+                time.sleep(backoff)
+
+    def _acquire(self, kind: str, priority: int, deadline_at: float):
+        """Chờ đến lượt (theo độ ưu tiên rồi FIFO) và lấy 1 token"""
+        started = time.monotonic()
+        ticket = (priority, next(self._sequence))
+        waiters = self._waiters[kind]
+        bucket = self.buckets[kind]
+
+        with self._condition:
+            heapq.heappush(waiters, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if waiters[0] == ticket:
+                        wait_for = bucket.try_acquire(now)
+                        if wait_for == 0:
+                            heapq.heappop(waiters)
+                            break
+                    else:
+                        wait_for = 0.05
+
+                    if now >= deadline_at:
+                        self._timeouts += 1
+                        raise SchedulerTimeout(
+                            f"Hết thời gian chờ quota Google Sheets ({self.name}/{kind})"
+                        )
+                    self._condition.wait(timeout=max(min(wait_for, deadline_at - now), 0.001))
+            except SchedulerTimeout:
+                waiters.remove(ticket)
+                heapq.heapify(waiters)
+                raise
+            finally:
+                self._condition.notify_all()
+
+            waited = time.monotonic() - started
+            self._wait_count[priority] += 1
+            self._wait_total[priority] += waited
+            self._wait_max[priority] = max(self._wait_max[priority], waited)
+
+        if waited > 1:
+            logger.info(f"🚦 Chờ quota Sheets {waited:.1f}s ({self.name}/{kind}, {PRIORITY_NAMES.get(priority)})")
+
+    def get_stats(self) -> Dict:
+        """Lấy thống kê hàng đợi và thời gian chờ"""
+        with self._condition:
+            waits = {}
+            for priority, name in PRIORITY_NAMES.items():
+                count = self._wait_count[priority]
+                waits[name] = {
+                    'requests': count,
+                    'avg_wait_ms': round(self._wait_total[priority] / count * 1000, 1) if count else 0,
+                    'max_wait_ms': round(self._wait_max[priority] * 1000, 1)
+                }
+            return {
+                'queued': {kind: len(waiters) for kind, waiters in self._waiters.items()},
+                'tokens': {kind: round(bucket.tokens, 1) for kind, bucket in self.buckets.items()},
+                'waits': waits,
+                'retries': self._retries,
+                'timeouts': self._timeouts
+            }
+
+
+_schedulers: Dict[str, SheetsRequestScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_sheets_scheduler(name: str = 'default') -> SheetsRequestScheduler:
+    """Lấy scheduler dùng chung của một service account (tạo nếu chưa có)"""
+    with _schedulers_lock:
+        if name not in _schedulers:
+            _schedulers[name] = SheetsRequestScheduler(name)
+        return _schedulers[name]
+
+
+def get_all_scheduler_stats() -> Dict[str, Dict]:
+    """Thống kê của tất cả scheduler (dùng cho /health)"""
+    with _schedulers_lock:
+        schedulers = dict(_schedulers)
+    return {name: scheduler.get_stats() for name, scheduler in schedulers.items()}
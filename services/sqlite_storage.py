@@ -0,0 +1,197 @@
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, Iterator, List
+
+from services.storage_backend import StorageBackend, build_statistics, empty_statistics
+
+logger = logging.getLogger(__name__)
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class SQLiteStorageBackend(StorageBackend):
+    """Lưu giao dịch trong SQLite - cho triển khai gọn nhẹ không cần Google Sheets"""
+
+    _initialized = set()
+    _init_lock = threading.Lock()
+
+    def __init__(self, namespace: str = 'default', db_path: str = None):
+        self.namespace = namespace
+        self.db_path = db_path or os.getenv('SQLITE_STORAGE_PATH', 'expenses.db')
+        self._init_db()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _init_db(self):
+        """Tạo bảng giao dịch nếu chưa có (1 lần/file)"""
+        with self._init_lock:
+            if self.db_path in self._initialized:
+                return
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS transactions (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        namespace TEXT NOT NULL,
+                        user_name TEXT NOT NULL,
+                        date TEXT NOT NULL,
+                        type TEXT NOT NULL,
+                        amount REAL NOT NULL,
+                        category TEXT,
+                        note TEXT
+                    )
+                """)
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_transactions_user_date "
+                    "ON transactions (namespace, user_name, date)"
+                )
+            self._initialized.add(self.db_path)
+
+    def add_transaction(self, transaction_type: str, amount: float, category: str,
+                        note: str, user_name: str, custom_date: str = None) -> bool:
+        try:
+            from utils.date_utils import parse_custom_date
+
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT INTO transactions (namespace, user_name, date, type, amount, category, note) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (self.namespace, user_name, parse_custom_date(custom_date).strftime(DATE_FORMAT),
+                     transaction_type, float(amount), category, note)
+                )
+            logger.info(f"👤 {user_name}: {transaction_type} - {amount:,.0f} VNĐ - {category}")
+            return True
+        except Exception as e:
+            logger.error(f"❌ Lỗi thêm giao dịch cho {user_name}: {e}")
+            return False
+
+    def add_transactions(self, user_name: str, transactions: List[Dict]) -> int:
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO transactions (namespace, user_name, date, type, amount, category, note) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (self.namespace, user_name, transaction['date'].strftime(DATE_FORMAT), transaction['type'],
+                     float(transaction['amount']), transaction['category'], transaction['note'])
+                    for transaction in transactions
+                ]
+            )
+        logger.info(f"👤 {user_name}: đã ghi {len(transactions)} giao dịch")
+        return len(transactions)
+
+    def _where(self, user_name: str, start_date: datetime = None, end_date: datetime = None,
+               transaction_type: str = None):
+        """Mệnh đề WHERE và tham số cho user/khoảng ngày/loại"""
+        clauses = ["namespace = ?", "user_name = ?"]
+        params = [self.namespace, user_name]
+        if start_date:
+            clauses.append("date >= ?")
+            params.append(start_date.strftime(DATE_FORMAT))
+        if end_date:
+            clauses.append("date <= ?")
+            params.append(end_date.strftime(DATE_FORMAT))
+        if transaction_type:
+            clauses.append("type = ?")
+            params.append(transaction_type)
+        return " AND ".join(clauses), params
+
+    @staticmethod
+    def _to_transaction(row: tuple, user_name: str) -> Dict:
+        date, transaction_type, amount, category, note = row
+        return {
+            'date': datetime.fromisoformat(date),
+            'type': transaction_type,
+            'amount': amount,
+            'category': category or '',
+            'note': note or '',
+            'user': user_name
+        }
+
+    def get_transactions(self, user_name: str, start_date: datetime = None, end_date: datetime = None,
+                         transaction_type: str = None) -> List[Dict]:
+        try:
+            where, params = self._where(user_name, start_date, end_date, transaction_type)
+            with self._connect() as conn:
+                rows = conn.execute(
+                    f"SELECT date, type, amount, category, note FROM transactions WHERE {where} ORDER BY id",
+                    params
+                ).fetchall()
+            return [self._to_transaction(row, user_name) for row in rows]
+        except Exception as e:
+            logger.error(f"Lỗi lấy giao dịch: {e}")
+            return []
+
+    def iter_transactions(self, user_name: str, start_date: datetime = None, end_date: datetime = None,
+                          chunk_size: int = 1000) -> Iterator[List[Dict]]:
+        """Đọc dần bằng cursor - không nạp toàn bộ kết quả vào RAM"""
+        where, params = self._where(user_name, start_date, end_date)
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                f"SELECT date, type, amount, category, note FROM transactions WHERE {where} ORDER BY date, id",
+                params
+            )
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [self._to_transaction(row, user_name) for row in rows]
+        finally:
+            conn.close()
+
+    def get_statistics(self, user_name: str, start_date: datetime, end_date: datetime) -> Dict:
+        """Tính SUM/COUNT theo (Loại, Danh mục) ngay trong SQLite"""
+        try:
+            where, params = self._where(user_name, start_date, end_date)
+            with self._connect() as conn:
+                rows = conn.execute(
+                    f"SELECT type, category, SUM(amount), COUNT(*) FROM transactions WHERE {where} "
+                    "GROUP BY type, category",
+                    params
+                ).fetchall()
+            totals = [
+                {'type': transaction_type, 'category': category or '', 'amount': amount, 'count': count}
+                for transaction_type, category, amount, count in rows
+            ]
+            stats = build_statistics(totals, start_date, end_date)
+        except Exception as e:
+            logger.error(f"Lỗi tính thống kê: {e}")
+            stats = empty_statistics()
+        stats['pending_sync'] = 0
+        stats['failed_sync'] = 0
+        return stats
+
+    def get_category_usage(self, user_name: str) -> Dict[str, List[Dict]]:
+        usage = {'Thu': [], 'Chi': []}
+        try:
+            where, params = self._where(user_name)
+            with self._connect() as conn:
+                rows = conn.execute(
+                    f"SELECT type, category, COUNT(*), MAX(date) FROM transactions "
+                    f"WHERE {where} AND category != '' GROUP BY type, category "
+                    "ORDER BY COUNT(*) DESC, category",
+                    params
+                ).fetchall()
+            for transaction_type, category, count, last_used in rows:
+                if transaction_type in usage:
+                    usage[transaction_type].append({
+                        'category': category,
+                        'count': count,
+                        'last_used': last_used[:10]
+                    })
+        except Exception as e:
+            logger.error(f"Lỗi lấy danh mục: {e}")
+        return usage
+
+    def test_connection(self) -> bool:
+        with self._connect() as conn:
+            conn.execute("SELECT 1 FROM transactions LIMIT 1")
+        logger.info(f"✅ SQLite storage sẵn sàng: {self.db_path}")
+        return True
+
+    def get_sheet_url(self) -> str:
+        return f"sqlite://{os.path.abspath(self.db_path)}"
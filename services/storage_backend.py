@@ -0,0 +1,217 @@
+import logging
+import os
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKENDS = ('sheets', 'sqlite', 'memory')
+
+
+def get_storage_backend_name() -> str:
+    """Backend lưu trữ được cấu hình (STORAGE_BACKEND)"""
+    name = os.getenv('STORAGE_BACKEND', 'sheets').lower()
+    if name not in STORAGE_BACKENDS:
+        raise ValueError(f"STORAGE_BACKEND không hợp lệ: {name} (chọn một trong {', '.join(STORAGE_BACKENDS)})")
+    return name
+
+
+def empty_statistics() -> Dict:
+    """Thống kê rỗng (khi không có giao dịch hoặc bị lỗi)"""
+    return {
+        'total_income': 0,
+        'total_expense': 0,
+        'balance': 0,
+        'income_categories': {},
+        'expense_categories': {},
+        'transaction_count': 0
+    }
+
+
+def summarize_transactions(transactions: Iterable[Dict]) -> List[Dict]:
+    """Gộp giao dịch thành tổng tiền và số giao dịch theo (Loại, Danh mục)"""
+    groups = defaultdict(lambda: {'amount': 0.0, 'count': 0})
+    for transaction in transactions:
+        group = groups[(transaction['type'], transaction['category'])]
+        group['amount'] += transaction['amount']
+        group['count'] += 1
+    return [
+        {'type': transaction_type, 'category': category, 'amount': group['amount'], 'count': group['count']}
+        for (transaction_type, category), group in groups.items()
+    ]
+
+
+def build_statistics(totals: Iterable[Dict], start_date: datetime, end_date: datetime) -> Dict:
+    """
+    Tạo dict thống kê từ các tổng theo (Loại, Danh mục)
+
+    Args:
+        totals: [{'type', 'category', 'amount', 'count'}]
+        start_date: Ngày bắt đầu
+        end_date: Ngày kết thúc
+    """
+    total_income = 0
+    total_expense = 0
+    transaction_count = 0
+    income_categories = defaultdict(float)
+    expense_categories = defaultdict(float)
+
+    for row in totals:
+        if row['type'] == 'Thu':
+            total_income += row['amount']
+            income_categories[row['category']] += row['amount']
+        elif row['type'] == 'Chi':
+            total_expense += row['amount']
+            expense_categories[row['category']] += row['amount']
+        else:
+            continue
+        transaction_count += row['count']
+
+    return {
+        'total_income': total_income,
+        'total_expense': total_expense,
+        'balance': total_income - total_expense,
+        'income_categories': dict(income_categories),
+        'expense_categories': dict(expense_categories),
+        'transaction_count': transaction_count,
+        'start_date': start_date,
+        'end_date': end_date
+    }
+
+
+class StorageBackend(ABC):
+    """
+    Interface lưu trữ giao dịch mà các handler sử dụng
+
+    Giao dịch trả về có dạng:
+    {'date', 'type', 'amount', 'category', 'note', 'user'}
+    """
+
+    @abstractmethod
+    def add_transaction(self, transaction_type: str, amount: float, category: str,
+                        note: str, user_name: str, custom_date: str = None) -> bool:
+        """Thêm giao dịch mới, trả về True nếu thành công"""
+
+    @abstractmethod
+    def add_transactions(self, user_name: str, transactions: List[Dict]) -> int:
+        """
+        Thêm nhiều giao dịch cùng lúc (import)
+
+        Args:
+            transactions: [{'date': datetime, 'type', 'amount', 'category', 'note'}]
+
+        Returns:
+            int: Số giao dịch đã ghi nhận
+        """
+
+    @abstractmethod
+    def get_transactions(self, user_name: str, start_date: datetime = None, end_date: datetime = None,
+                         transaction_type: str = None) -> List[Dict]:
+        """Lấy giao dịch của user trong khoảng thời gian"""
+
+    def iter_transactions(self, user_name: str, start_date: datetime = None, end_date: datetime = None,
+                          chunk_size: int = 1000) -> Iterator[List[Dict]]:
+        """
+        Đọc giao dịch theo từng lô (cho xuất dữ liệu lớn)
+
+        Mặc định đọc hết rồi chia lô - backend nên override để đọc dần.
+        """
+        transactions = self.get_transactions(user_name, start_date, end_date)
+        for index in range(0, len(transactions), chunk_size):
+            yield transactions[index:index + chunk_size]
+
+    @abstractmethod
+    def get_sheet_url(self) -> str:
+        """Link xem dữ liệu gửi kèm tin nhắn trả lời"""
+
+    def get_user_key(self, user_name: str) -> str:
+        """Key định danh sổ giao dịch của user (cho dữ liệu học theo từng user)"""
+        return f"{self.get_sheet_url()}|{user_name}"
+
+    def get_statistics(self, user_name: str, start_date: datetime, end_date: datetime) -> Dict:
+        """Tính thống kê thu chi của user trong khoảng thời gian"""
+        try:
+            transactions = self.get_transactions(user_name, start_date, end_date)
+            stats = build_statistics(summarize_transactions(transactions), start_date, end_date)
+        except Exception as e:
+            logger.error(f"Lỗi tính thống kê: {e}")
+            stats = empty_statistics()
+        stats['pending_sync'] = self.get_pending_count(user_name)
+        stats['failed_sync'] = self.get_failed_sync_count(user_name)
+        return stats
+
+    def get_category_usage(self, user_name: str) -> Dict[str, List[Dict]]:
+        """
+        Lấy danh mục của user kèm số lần dùng và ngày dùng gần nhất
+
+        Returns:
+            Dict: {'Thu': [{'category', 'count', 'last_used'}], 'Chi': [...]}
+        """
+        usage = {'Thu': {}, 'Chi': {}}
+        try:
+            for transaction in self.get_transactions(user_name):
+                if transaction['type'] not in usage or not transaction['category']:
+                    continue
+                entry = usage[transaction['type']].setdefault(
+                    transaction['category'], {'category': transaction['category'], 'count': 0, 'last_used': None}
+                )
+                entry['count'] += 1
+                used = transaction['date'].strftime("%Y-%m-%d")
+                if not entry['last_used'] or used > entry['last_used']:
+                    entry['last_used'] = used
+        except Exception as e:
+            logger.error(f"Lỗi lấy danh mục: {e}")
+
+        return {
+            transaction_type: sorted(entries.values(), key=lambda item: (-item['count'], item['category']))
+            for transaction_type, entries in usage.items()
+        }
+
+    def get_categories(self, user_name: str) -> Dict[str, List[str]]:
+        """
+        Lấy danh sách danh mục theo loại giao dịch (dùng nhiều xếp trước)
+
+        Returns:
+            Dict: {'Thu': [...], 'Chi': [...]}
+        """
+        usage = self.get_category_usage(user_name)
+        return {
+            transaction_type: [item['category'] for item in items]
+            for transaction_type, items in usage.items()
+        }
+
+    def get_pending_count(self, user_name: str) -> int:
+        """Số giao dịch chưa được ghi xuống nơi lưu trữ (mặc định: không có)"""
+        return 0
+
+    def get_failed_sync_count(self, user_name: str) -> int:
+        """Số giao dịch không ghi được xuống nơi lưu trữ sau nhiều lần thử (mặc định: không có)"""
+        return 0
+
+    def test_connection(self) -> bool:
+        """Test kết nối nơi lưu trữ"""
+        return True
+
+
+def create_storage_backend(namespace: str = None, sheet_id: str = None, sheet_url: str = None,
+                           account=None) -> StorageBackend:
+    """
+    Tạo backend lưu trữ theo STORAGE_BACKEND
+
+    Args:
+        namespace: Tách dữ liệu của từng user ở private mode (sqlite/memory)
+        sheet_id, sheet_url, account: Tham số cho GoogleSheetsService
+    """
+    name = get_storage_backend_name()
+
+    if name == 'sqlite':
+        from services.sqlite_storage import SQLiteStorageBackend
+        return SQLiteStorageBackend(namespace=namespace or 'default')
+    if name == 'memory':
+        from services.memory_storage import InMemoryStorageBackend
+        return InMemoryStorageBackend.get(namespace or 'default')
+
+    from services.google_sheets import GoogleSheetsService
+    return GoogleSheetsService(sheet_id, sheet_url, account)
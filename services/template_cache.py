@@ -0,0 +1,215 @@
+import logging
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from services.intent_cache import IntentCache, normalize_message
+from services.local_parser import find_amounts
+
+logger = logging.getLogger(__name__)
+
+AMOUNT_PLACEHOLDER = "<AMT>"
+DATE_PLACEHOLDER = "<DATE>"
+
+# Ngày mà parse_custom_date hiểu được: "5/9", "05/09/2025", "hôm qua", "thứ hai", "thứ 2"...
+DATE_TOKEN_PATTERN = re.compile(
+    r"(?<![\w/])(\d{1,2}/\d{1,2}(?:/\d{2,4})?|(?:ngày )?hôm (?:nay|qua|kia)|tuần trước|tháng trước|"
+    r"thứ (?:hai|ba|tư|năm|sáu|bảy|[2-7])|chủ nhật)(?![\w/])"
+)
+# Intent ghi giao dịch - kết quả chỉ phụ thuộc cách diễn đạt, không phụ thuộc số tiền/ngày
+TEMPLATE_INTENTS = ('EXPENSE', 'INCOME', 'LENDING', 'BORROWING', 'MULTIPLE_EXPENSES')
+
+
+def tokenize_message(message: str) -> Tuple[str, List[Tuple[str, float]], List[str]]:
+    """
+    Tách số tiền và ngày khỏi tin nhắn
+
+    Returns:
+        Tuple: (template, [(chuỗi số tiền, giá trị)], [chuỗi ngày]) theo thứ tự xuất hiện,
+        VD: "hôm qua 45k bún bò" → ("<DATE> <AMT> bún bò", [("45k", 45000)], ["hôm qua"])
+    """
+    text = normalize_message(message)
+    dates = [match.group(0) for match in DATE_TOKEN_PATTERN.finditer(text)]
+    text = DATE_TOKEN_PATTERN.sub(DATE_PLACEHOLDER, text)
+
+    # Số tiền theo ngữ pháp của local_parser: số trần dưới 4 chữ số ("cà phê 30") không phải
+    # số tiền, nếu không "30" và "30k" sẽ chung khuôn và bị điền thành 30đ
+    amounts = []
+    for found in reversed(find_amounts(text)):
+        amounts.append((text[found['start']:found['end']], float(found['amount'])))
+        text = text[:found['start']] + AMOUNT_PLACEHOLDER + text[found['end']:]
+    amounts.reverse()
+    return text, amounts, dates
+
+
+class TemplateCache(IntentCache):
+    """
+    Cache kết quả AI theo "khuôn" tin nhắn - số tiền và ngày được thay bằng <AMT>/<DATE>
+
+    "hôm qua 45k bún bò" và "60k bún bò" có chung phần mô tả/danh mục; khi trúng
+    cache, số tiền và ngày của tin nhắn mới được parse cục bộ rồi điền vào
+    kết quả đã lưu. Chỉ lưu khi biết chắc số tiền/ngày trong kết quả AI ứng với
+    token nào trong tin nhắn, nên cách diễn đạt mới vẫn được gửi cho Gemini.
+    """
+
+    def __init__(self, max_entries: int = None, ttl: int = None, cache_file: str = None):
+        super().__init__(
+            max_entries=max_entries or int(os.getenv('TEMPLATE_CACHE_MAX_ENTRIES', 5000)),
+            ttl=ttl or int(os.getenv('TEMPLATE_CACHE_TTL', 30 * 24 * 3600)),
+            cache_file=cache_file if cache_file is not None else os.getenv('TEMPLATE_CACHE_FILE', '')
+        )
+
+    @staticmethod
+    def is_enabled() -> bool:
+        """Kiểm tra cache khuôn tin nhắn có được bật không"""
+        return os.getenv('TEMPLATE_CACHE', 'true').lower() == 'true'
+
+    @staticmethod
+    def make_key(message: str, today=None) -> str:
+        """
+        Key cache: tin nhắn đã chuẩn hóa, số tiền thay bằng <AMT> và bỏ ngày
+
+        Ngày luôn áp dụng cho cả tin nhắn nên "hôm qua 45k bún bò" và "60k bún bò" chung một key.
+        """
+        return ' '.join(tokenize_message(message)[0].replace(DATE_PLACEHOLDER, ' ').split())
+
+    def get(self, message: str) -> Optional[Dict[str, Any]]:
+        """Kết quả cho tin nhắn, điền số tiền/ngày của chính tin nhắn này (None nếu không trúng)"""
+        template, amounts, dates = tokenize_message(message)
+        if not amounts or len(dates) > 1:
+            return None
+        cached = super().get(message)
+        if cached is None:
+            return None
+        try:
+            return self._fill(cached, amounts, dates)
+        except (IndexError, KeyError, TypeError, ValueError) as e:
+            logger.warning(f"⚠️ Không điền được khuôn '{template}': {e}")
+            return None
+
+    def put(self, message: str, result: Dict[str, Any]):
+        """Lưu khuôn kết quả nếu số tiền/ngày trong kết quả khớp được với tin nhắn"""
+        if result.get('intent') not in TEMPLATE_INTENTS:
+            return
+        template, amounts, dates = tokenize_message(message)
+        # Khuôn chỉ toàn placeholder ("50k") không mang thông tin gì về mô tả
+        if not amounts or len(dates) > 1 or not re.search(r"[^\W\d_]", template.replace(AMOUNT_PLACEHOLDER, '').replace(DATE_PLACEHOLDER, '')):
+            return
+        abstracted = self._abstract(result, amounts, dates)
+        if abstracted is None:
+            with self._lock:
+                self._stats['uncacheable'] += 1
+            return
+        super().put(message, abstracted)
+
+    def _abstract(self, result: Dict[str, Any], amounts: List[Tuple[str, float]],
+                  dates: List[str]) -> Optional[Dict[str, Any]]:
+        """Thay số tiền/ngày trong kết quả AI bằng chỉ số token (None nếu không khớp)"""
+        data = result.get('data') or {}
+        if result['intent'] == 'MULTIPLE_EXPENSES':
+            transactions = data.get('transactions') or []
+            if not transactions:
+                return None
+            used = set()
+            items = []
+            for transaction in transactions:
+                item = self._abstract_transaction(transaction, amounts, dates, used)
+                if item is None:
+                    return None
+                items.append(item)
+            abstracted_data = dict(data, transactions=items)
+        else:
+            abstracted_data = self._abstract_transaction(data, amounts, dates, set(), allow_sum=True)
+            if abstracted_data is None:
+                return None
+        return dict(result, data=abstracted_data)
+
+    def _abstract_transaction(self, data: Dict[str, Any], amounts: List[Tuple[str, float]], dates: List[str],
+                              used: set, allow_sum: bool = False) -> Optional[Dict[str, Any]]:
+        amount = data.get('amount')
+        if not isinstance(amount, (int, float)) or amount <= 0:
+            return None
+
+        # Số tiền = đúng một token (lần lượt từ trái sang) hoặc tổng tất cả ("bún 80k và phở 150k")
+        marker = None
+        for index, (_, value) in enumerate(amounts):
+            if index not in used and abs(value - amount) < 0.5:
+                marker = f"<AMT{index}>"
+                used.add(index)
+                break
+        if marker is None and allow_sum and len(amounts) > 1 and abs(sum(v for _, v in amounts) - amount) < 0.5:
+            marker = "<AMT*>"
+        if marker is None:
+            return None
+
+        # Ngày (nếu có) phải đúng là ngày trong tin nhắn - khi điền sẽ lấy ngày của tin nhắn mới
+        custom_date = data.get('custom_date')
+        if custom_date:
+            if [normalize_message(custom_date)] != dates:
+                return None
+        elif dates:
+            # Tin nhắn có ngày nhưng AI không dùng - không biết tin nhắn sau sẽ ra sao
+            return None
+
+        abstracted = {}
+        for key, value in data.items():
+            if isinstance(value, str):
+                value = self._abstract_text(value, amounts, dates)
+            abstracted[key] = value
+        abstracted['amount'] = marker
+        abstracted['custom_date'] = DATE_PLACEHOLDER
+        return abstracted
+
+    @staticmethod
+    def _abstract_text(text: str, amounts: List[Tuple[str, float]], dates: List[str]) -> str:
+        """Mô tả có nhắc lại số tiền/ngày ("vay anh Nam 2tr") → thay bằng chỉ số token"""
+        tokens = [(token, f"<AMT{index}>") for index, (token, _) in enumerate(amounts)]
+        tokens += [(token, f"<DATE{index}>") for index, token in enumerate(dates)]
+        for token, marker in sorted(tokens, key=lambda item: len(item[0]), reverse=True):
+            text = re.sub(rf"(?<![\w/<]){re.escape(token)}(?![\w/>])", marker, text, flags=re.IGNORECASE)
+        return text
+
+    def _fill(self, value: Any, amounts: List[Tuple[str, float]], dates: List[str]) -> Any:
+        """Điền số tiền/ngày của tin nhắn mới vào khuôn kết quả"""
+        if isinstance(value, dict):
+            return {key: self._fill(item, amounts, dates) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._fill(item, amounts, dates) for item in value]
+        if not isinstance(value, str):
+            return value
+        if value == DATE_PLACEHOLDER:
+            return dates[0] if dates else None
+        if value == "<AMT*>":
+            total = sum(amount for _, amount in amounts)
+            return int(total) if total.is_integer() else total
+        match = re.fullmatch(r"<AMT(\d+)>", value)
+        if match:
+            amount = amounts[int(match.group(1))][1]
+            return int(amount) if amount.is_integer() else amount
+        match = re.fullmatch(r"<DATE(\d+)>", value)
+        if match:
+            return dates[int(match.group(1))]
+        value = re.sub(r"<AMT(\d+)>", lambda m: amounts[int(m.group(1))][0], value)
+        return re.sub(r"<DATE(\d+)>", lambda m: dates[int(m.group(1))], value)
+
+
+    def get_stats(self) -> Dict:
+        """Thống kê cache (kèm số kết quả AI không tạo được khuôn)"""
+        stats = super().get_stats()
+        with self._lock:
+            stats['uncacheable'] = self._stats['uncacheable']
+        return stats
+
+
+_cache: Optional[TemplateCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_template_cache() -> TemplateCache:
+    """Lấy cache khuôn tin nhắn dùng chung của process"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = TemplateCache()
+        return _cache
@@ -0,0 +1,362 @@
+import csv
+import hashlib
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional
+
+from services.batch_categorizer import BatchCategorizer
+from services.category_memo import get_category_memo
+from services.category_rules import get_valid_categories, match_category, strip_accents
+from services.storage_backend import StorageBackend
+
+logger = logging.getLogger(__name__)
+
+# Tên cột (không dấu, chữ thường) của file bot xuất ra và sao kê các ngân hàng phổ biến
+COLUMN_ALIASES = {
+    'date': ['ngay', 'ngay giao dich', 'ngay gd', 'ngay hieu luc', 'thoi gian', 'thoi gian giao dich',
+             'date', 'transaction date', 'posting date', 'value date', 'txn date'],
+    'amount': ['so tien', 'so tien giao dich', 'amount', 'transaction amount'],
+    'debit': ['ghi no', 'no', 'so tien ghi no', 'rut ra', 'tien ra', 'debit', 'withdrawal', 'withdrawals'],
+    'credit': ['ghi co', 'co', 'so tien ghi co', 'gui vao', 'tien vao', 'credit', 'deposit', 'deposits'],
+    'note': ['ghi chu', 'mo ta', 'noi dung', 'noi dung giao dich', 'dien giai', 'chi tiet',
+             'description', 'details', 'narrative', 'remarks', 'note'],
+    'type': ['loai', 'loai giao dich', 'type'],
+    'category': ['danh muc', 'category'],
+}
+
+DATE_FORMATS = [
+    "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%d/%m/%Y", "%d-%m-%Y %H:%M:%S", "%d-%m-%Y",
+    "%d.%m.%Y", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d", "%d/%m/%y"
+]
+
+# Số dòng đầu file được quét để tìm header (sao kê thường có phần thông tin tài khoản phía trên)
+HEADER_SCAN_ROWS = 30
+
+
+def _normalize_header(value: str) -> str:
+    value = re.sub(r"\(.*?\)", "", strip_accents(str(value)).lower())
+    return ' '.join(re.sub(r"[^a-z0-9 ]", " ", value).split())
+
+
+def parse_amount(value) -> Optional[float]:
+    """Parse số tiền kiểu '1.234.567', '1,234,567.00', '-50.000 VND', '(200,000)'"""
+    text = str(value or '').strip()
+    if not text:
+        return None
+
+    negative = text.startswith('-') or (text.startswith('(') and text.endswith(')'))
+    text = re.sub(r"[^\d.,]", "", text)
+    if not text:
+        return None
+
+    if '.' in text and ',' in text:
+        # Dấu xuất hiện sau cùng là dấu thập phân
+        decimal = '.' if text.rfind('.') > text.rfind(',') else ','
+        thousands = ',' if decimal == '.' else '.'
+        text = text.replace(thousands, '').replace(decimal, '.')
+    else:
+        for separator in ('.', ','):
+            if separator in text:
+                if re.fullmatch(rf"\d{{1,3}}(\{separator}\d{{3}})+", text):
+                    text = text.replace(separator, '')
+                else:
+                    text = text.replace(separator, '.')
+
+    try:
+        amount = float(text)
+    except ValueError:
+        return None
+    return -amount if negative else amount
+
+
+def parse_date(value) -> Optional[datetime]:
+    """Parse ngày giao dịch theo các định dạng sao kê thường gặp (ưu tiên dd/mm)"""
+    text = str(value or '').strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+    return None
+
+
+def transaction_fingerprint(transaction: Dict) -> str:
+    """Dấu vân tay để nhận ra giao dịch đã có (ngày, loại, số tiền, ghi chú)"""
+    note = ' '.join(str(transaction.get('note') or '').lower().split())
+    raw = f"{transaction['date'].strftime('%Y-%m-%d')}|{transaction['type']}|{round(float(transaction['amount']))}|{note}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class TransactionImporter:
+    """
+    Import giao dịch hàng loạt từ file CSV (sao kê ngân hàng hoặc file bot đã xuất)
+
+    File được đọc theo kiểu streaming: từng lô IMPORT_CHUNK_ROWS dòng được
+    bỏ trùng, phân loại theo lô (luật cục bộ + AI) rồi ghi bằng 1 lệnh
+    append_rows - thay vì 1 lệnh Gemini + 1 append_row cho mỗi dòng.
+
+    scan() giữ lại các giao dịch đã parse (tối đa IMPORT_MAX_BUFFERED_ROWS dòng)
+    để run() không phải đọc file lần thứ hai; file lớn hơn mới được đọc lại.
+    """
+
+    def __init__(self, backend: StorageBackend, ai_service=None, chunk_size: int = None,
+                 max_ai_calls: int = None, encoding: str = 'utf-8-sig'):
+        """
+        Args:
+            backend: Nơi lưu giao dịch của user
+            ai_service: GeminiAIService để phân loại (None = chỉ luật cục bộ)
+            chunk_size: Số dòng mỗi lần ghi (mặc định IMPORT_CHUNK_ROWS)
+            max_ai_calls: Ngân sách lệnh gọi AI cho cả file (mặc định IMPORT_MAX_AI_CALLS)
+            encoding: Encoding của file CSV
+        """
+        self.backend = backend
+        self.chunk_size = chunk_size or int(os.getenv('IMPORT_CHUNK_ROWS', 500))
+        self.max_buffered_rows = int(os.getenv('IMPORT_MAX_BUFFERED_ROWS', 100000))
+        self.encoding = encoding
+        self.categorizer = BatchCategorizer(
+            ai_service,
+            max_ai_calls=max_ai_calls if max_ai_calls is not None else int(os.getenv('IMPORT_MAX_AI_CALLS', 50))
+        )
+
+    def _open(self, path: str):
+        f = open(path, newline='', encoding=self.encoding)
+        sample = f.read(8192)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+        except csv.Error:
+            dialect = csv.excel
+        return f, csv.reader(f, dialect)
+
+    @staticmethod
+    def _detect_columns(header: List[str]) -> Optional[Dict[str, int]]:
+        """Tìm vị trí các cột cần thiết trong header (None nếu không phải header)"""
+        normalized = [_normalize_header(value) for value in header]
+        columns = {}
+        for field, aliases in COLUMN_ALIASES.items():
+            for index, name in enumerate(normalized):
+                if name in aliases and index not in columns.values():
+                    columns[field] = index
+                    break
+        if 'date' not in columns:
+            return None
+        if 'amount' not in columns and not ('debit' in columns or 'credit' in columns):
+            return None
+        return columns
+
+    def iter_rows(self, path: str, stats: Counter = None) -> Iterator[Dict]:
+        """
+        Đọc file CSV từng dòng, trả về giao dịch đã chuẩn hóa (chưa có danh mục thì category='')
+
+        Dòng không hợp lệ (thiếu ngày, số tiền = 0...) được bỏ qua và đếm vào stats['invalid'].
+        """
+        stats = stats if stats is not None else Counter()
+        f, reader = self._open(path)
+        with f:
+            columns = None
+            for row in reader:
+                if columns is None:
+                    if reader.line_num > HEADER_SCAN_ROWS:
+                        raise ValueError(f"Không tìm thấy dòng tiêu đề (cột ngày và số tiền) trong {path}")
+                    columns = self._detect_columns(row)
+                    continue
+
+                transaction = self._parse_row(row, columns)
+                if transaction:
+                    yield transaction
+                elif any(cell.strip() for cell in row):
+                    stats['invalid'] += 1
+                    if stats['invalid'] <= 5:
+                        logger.warning(f"⚠️ Bỏ qua dòng {reader.line_num} không hợp lệ: {row}")
+
+            if columns is None:
+                raise ValueError(f"Không tìm thấy dòng tiêu đề (cột ngày và số tiền) trong {path}")
+
+    @staticmethod
+    def _parse_row(row: List[str], columns: Dict[str, int]) -> Optional[Dict]:
+        def cell(field: str) -> str:
+            index = columns.get(field)
+            return row[index].strip() if index is not None and index < len(row) else ''
+
+        date = parse_date(cell('date'))
+        if not date:
+            return None
+
+        transaction_type = None
+        type_value = strip_accents(cell('type')).lower()
+        if type_value in ('thu', 'credit', 'cr', 'c', '+'):
+            transaction_type = 'Thu'
+        elif type_value in ('chi', 'debit', 'dr', 'd', '-'):
+            transaction_type = 'Chi'
+
+        if 'amount' in columns:
+            amount = parse_amount(cell('amount'))
+            if amount is None:
+                return None
+            if transaction_type is None:
+                # Sao kê 1 cột số tiền: âm là tiền ra
+                transaction_type = 'Chi' if amount < 0 else 'Thu'
+            amount = abs(amount)
+        else:
+            debit = abs(parse_amount(cell('debit')) or 0)
+            credit = abs(parse_amount(cell('credit')) or 0)
+            transaction_type, amount = ('Chi', debit) if debit else ('Thu', credit)
+
+        if not amount:
+            return None
+
+        category = cell('category')
+        if category not in get_valid_categories(transaction_type) and category not in ('Cho vay', 'Đi vay'):
+            category = ''
+
+        return {
+            'date': date,
+            'type': transaction_type,
+            'amount': amount,
+            'category': category,
+            'note': cell('note')
+        }
+
+    def scan(self, path: str, user_name: str = None) -> Dict:
+        """
+        Đọc cả file (không ghi gì) để lập kế hoạch quota trước khi import
+
+        Args:
+            path: Đường dẫn file CSV
+            user_name: Tên người dùng (ước lượng theo danh mục user đã dùng)
+
+        Returns:
+            Dict: số dòng, khoảng ngày, số lệnh ghi Sheets và lệnh gọi AI dự kiến
+                (kèm 'transactions' đã parse nếu file không quá IMPORT_MAX_BUFFERED_ROWS dòng)
+        """
+        stats = Counter()
+        start_date = end_date = None
+        needs_ai = set()
+        transactions = []
+        memo = get_category_memo()
+        user_key = self.backend.get_user_key(user_name) if user_name else None
+        for transaction in self.iter_rows(path, stats):
+            stats['rows'] += 1
+            start_date = min(start_date, transaction['date']) if start_date else transaction['date']
+            end_date = max(end_date, transaction['date']) if end_date else transaction['date']
+            if not transaction['category'] and not (
+                memo.lookup(transaction['type'], transaction['note'], user_key)
+                or match_category(transaction['note'], transaction['type'])
+            ):
+                needs_ai.add((transaction['type'], ' '.join(transaction['note'].lower().split())))
+            if transactions is not None:
+                transactions.append(transaction)
+                if len(transactions) > self.max_buffered_rows:
+                    # File quá lớn để giữ trong RAM - run() sẽ đọc lại file
+                    transactions = None
+
+        ai_calls = math.ceil(len(needs_ai) / self.categorizer.batch_size)
+        budget = self.categorizer.max_ai_calls
+        return {
+            'rows': stats['rows'],
+            'invalid': stats['invalid'],
+            'start_date': start_date,
+            'end_date': end_date,
+            'write_calls': math.ceil(stats['rows'] / self.chunk_size),
+            'ai_descriptions': len(needs_ai),
+            'ai_calls': ai_calls if budget is None else min(ai_calls, budget),
+            'path': path,
+            'transactions': transactions
+        }
+
+    def _load_existing(self, user_name: str, start_date: datetime, end_date: datetime) -> Counter:
+        """Dấu vân tay giao dịch đã có trong khoảng ngày của file"""
+        existing = Counter()
+        if start_date is None:
+            return existing
+        start = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = end_date.replace(hour=23, minute=59, second=59, microsecond=999999)
+        for chunk in self.backend.iter_transactions(user_name, start, end):
+            existing.update(transaction_fingerprint(transaction) for transaction in chunk)
+        return existing
+
+    def run(self, path: str, user_name: str, progress: Callable[[Dict], None] = None,
+            plan: Dict = None) -> Dict:
+        """
+        Import file CSV vào sổ của user
+
+        Args:
+            path: Đường dẫn file CSV
+            user_name: Tên người dùng (worksheet)
+            progress: Hàm nhận tiến độ sau mỗi lô đã ghi
+            plan: Kết quả scan(path) nếu đã có - dùng lại giao dịch đã parse, không đọc file lần 2
+
+        Returns:
+            Dict: Kết quả import (imported, duplicates, invalid, ai_calls, ...)
+        """
+        started = time.perf_counter()
+        if not plan or plan.get('path') != path:
+            plan = self.scan(path, user_name)
+        existing = self._load_existing(user_name, plan['start_date'], plan['end_date'])
+        logger.info(f"📥 Import {plan['rows']} dòng cho {user_name} ({len(existing)} giao dịch đã có để đối chiếu)")
+
+        stats = Counter()
+        buffer: List[Dict] = []
+        user_key = self.backend.get_user_key(user_name)
+
+        if plan['transactions'] is not None:
+            rows = iter(plan['transactions'])
+            stats['invalid'] = plan['invalid']
+        else:
+            logger.info(f"📄 File lớn hơn {self.max_buffered_rows} dòng - đọc lại {path}")
+            rows = self.iter_rows(path, stats)
+
+        def flush():
+            if not buffer:
+                return
+            uncategorized = [transaction for transaction in buffer if not transaction['category']]
+            if uncategorized:
+                categories = self.categorizer.categorize(
+                    [(transaction['type'], transaction['note']) for transaction in uncategorized], user_key=user_key
+                )
+                for transaction, category in zip(uncategorized, categories):
+                    transaction['category'] = category
+            stats['imported'] += self.backend.add_transactions(user_name, buffer)
+            stats['write_calls'] += 1
+            buffer.clear()
+            if progress:
+                progress(self._summary(stats, plan, started))
+
+        for transaction in rows:
+            stats['processed'] += 1
+            fingerprint = transaction_fingerprint(transaction)
+            if existing[fingerprint] > 0:
+                # Mỗi dòng đã có chỉ khớp 1 lần - 2 ly cà phê giống nhau trong ngày vẫn được giữ
+                existing[fingerprint] -= 1
+                stats['duplicates'] += 1
+                continue
+            buffer.append(transaction)
+            if len(buffer) >= self.chunk_size:
+                flush()
+        flush()
+
+        result = self._summary(stats, plan, started)
+        logger.info(f"✅ Import xong cho {user_name}: {result['imported']} mới, {result['duplicates']} trùng, "
+                    f"{result['invalid']} lỗi, {result['ai_calls']} lệnh AI trong {result['seconds']:.1f}s")
+        return result
+
+    def _summary(self, stats: Counter, plan: Dict, started: float) -> Dict:
+        categorizer_stats = self.categorizer.stats
+        return {
+            'total': plan['rows'],
+            'processed': stats['processed'],
+            'imported': stats['imported'],
+            'duplicates': stats['duplicates'],
+            'invalid': stats['invalid'],
+            'write_calls': stats['write_calls'],
+            'ai_calls': categorizer_stats['ai_calls'],
+            'categorized_local': categorizer_stats['local'],
+            'categorized_ai': categorizer_stats['ai'],
+            'uncategorized': categorizer_stats['fallback'],
+            'seconds': round(time.perf_counter() - started, 2)
+        }
@@ -2,8 +2,13 @@ import json
 import os
 import logging
 import re
+import threading
 from typing import Optional, Dict
 from services.google_sheets import GoogleSheetsService
+from services.storage_backend import StorageBackend
+from services.service_account_pool import ServiceAccount, get_service_account_pool
+from services.sheets_scheduler import PRIORITY_BACKGROUND
+from services.write_journal import get_write_journal
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +19,17 @@ class UserSheetManager:
         self.user_sheets_file = "user_sheets.json"
         self.user_sheets = self._load_user_sheets()
         
+        # Service của từng user được tạo 1 lần rồi dùng lại
+        self._services: Dict[str, GoogleSheetsService] = {}
+        
+        # User đăng ký trước khi có pool đã share sheet cho account đầu tiên (GOOGLE_CREDENTIALS_PATH)
+        self.pool = get_service_account_pool()
+        self.pool.pin_missing(list(self.user_sheets.keys()), self.pool.primary)
+        
+        # Có account mới/bị bỏ - chuyển user sang account theo hashing ở background
+        if len(self.pool.accounts) > 1 and self.pool.accounts_changed():
+            threading.Thread(target=self.rebalance_accounts, daemon=True).start()
+        
     def _load_user_sheets(self) -> Dict[str, str]:
         """Load danh sách user sheets từ file JSON"""
         try:
@@ -58,27 +74,32 @@ class UserSheetManager:
             logger.error(f"❌ Lỗi extract sheet ID: {e}")
             return None
     
-    def _validate_sheet_url(self, sheet_url: str) -> bool:
+    def _find_account_for_sheet(self, sheet_url: str, user_id: str = None) -> Optional[ServiceAccount]:
+        """
+        Tìm service account truy cập được Google Sheet
+
+        Thử account được gán cho user trước, sau đó các account còn lại
+        (user có thể đã share cho email cũ).
+        """
+        sheet_id = self._extract_sheet_id(sheet_url)
+        if not sheet_id:
+            return None
+        
+        assigned = self.pool.get_account(user_id) if user_id else self.pool.primary
+        candidates = [assigned] + [account for account in self.pool.accounts if account is not assigned]
+        
+        for account in candidates:
+            try:
+                test_service = GoogleSheetsService(sheet_id, sheet_url, account)
+                test_service.test_connection()
+                return account
+            except Exception as e:
+                logger.warning(f"⚠️ {account.email} không truy cập được sheet: {e}")
+        return None
+    
+    def _validate_sheet_url(self, sheet_url: str, user_id: str = None) -> bool:
         """Kiểm tra xem Google Sheet URL có hợp lệ không"""
-        try:
-            sheet_id = self._extract_sheet_id(sheet_url)
-            if not sheet_id:
-                return False
-            
-            # Thử tạo GoogleSheetsService để test
-            test_service = GoogleSheetsService()
-            test_service.sheet_id = sheet_id
-            
-            # Override spreadsheet
-            test_service.spreadsheet = test_service.client.open_by_key(sheet_id)
-            
-            # Thử test connection
-            test_service.test_connection()
-            return True
-            
-        except Exception as e:
-            logger.warning(f"⚠️ Sheet URL không hợp lệ: {e}")
-            return False
+        return self._find_account_for_sheet(sheet_url, user_id) is not None
     
     def has_user_sheet(self, user_id: str) -> bool:
         """Kiểm tra user đã có sheet chưa"""
@@ -92,13 +113,18 @@ class UserSheetManager:
         """Thêm Google Sheet cho user"""
         try:
             # Validate URL trước
-            if not self._validate_sheet_url(sheet_url):
+            account = self._find_account_for_sheet(sheet_url, user_id)
+            if not account:
                 logger.error(f"❌ Sheet URL không hợp lệ cho user {user_name}")
                 return False
             
-            # Lưu vào mapping
+            # Lưu vào mapping và ghim user vào account đã được share
             self.user_sheets[user_id] = sheet_url
             self._save_user_sheets()
+            self.pool.pin(user_id, account)
+            self._services.pop(user_id, None)
+            # User gửi lại link sau khi sửa quyền chia sẻ - thử đồng bộ lại giao dịch đã lỗi
+            get_write_journal().retry_failed(self._extract_sheet_id(sheet_url))
             
             logger.info(f"✅ Đã thêm sheet cho user {user_name} (ID: {user_id})")
             return True
@@ -113,6 +139,8 @@ class UserSheetManager:
             if user_id in self.user_sheets:
                 del self.user_sheets[user_id]
                 self._save_user_sheets()
+                self.pool.unpin(user_id)
+                self._services.pop(user_id, None)
                 logger.info(f"🗑️ Đã xóa sheet cho user ID: {user_id}")
                 return True
             return False
@@ -120,35 +148,83 @@ class UserSheetManager:
             logger.error(f"❌ Lỗi xóa user sheet: {e}")
             return False
     
-    def get_user_service(self, user_id: str) -> Optional[GoogleSheetsService]:
-        """Tạo GoogleSheetsService riêng cho user"""
+    def get_user_service(self, user_id: str) -> Optional[StorageBackend]:
+        """Lấy GoogleSheetsService riêng cho user (tạo 1 lần rồi cache)"""
         try:
             sheet_url = self.get_user_sheet_url(user_id)
             if not sheet_url:
                 return None
             
+            account = self.pool.get_account(user_id)
+            user_service = self._services.get(user_id)
+            if user_service and user_service.sheet_url == sheet_url and user_service.account is account:
+                return user_service
+            
             # Extract sheet ID
             sheet_id = self._extract_sheet_id(sheet_url)
             if not sheet_id:
                 return None
             
-            # Tạo service với sheet ID của user
-            user_service = GoogleSheetsService()
-            user_service.sheet_id = sheet_id
-            user_service.sheet_url = sheet_url
-            
-            # Override spreadsheet
-            user_service.spreadsheet = user_service.client.open_by_key(sheet_id)
-            
-            # Service đã có method tự động tạo worksheet, không cần gọi thêm
-            # user_service sẽ tự động tạo worksheet khi cần
-            
+            # Tạo service với sheet ID và service account của user
+            # Service đã có method tự động tạo worksheet khi cần
+            user_service = GoogleSheetsService(sheet_id, sheet_url, account)
+            self._services[user_id] = user_service
             return user_service
             
         except Exception as e:
             logger.error(f"❌ Lỗi tạo user service cho {user_id}: {e}")
             return None
     
+    def get_service_email(self, user_id: str = None) -> str:
+        """Email service account mà user cần share Google Sheet"""
+        try:
+            if user_id:
+                return self.pool.get_service_email(user_id)
+        except Exception as e:
+            logger.error(f"❌ Lỗi lấy service account cho {user_id}: {e}")
+        return os.getenv('GOOGLE_SERVICE_EMAIL', 'service-account-email')
+    
+    def rebalance_accounts(self, auto_share: bool = None) -> int:
+        """
+        Chuyển user sang account theo hashing
+
+        Mặc định chỉ chuyển user đã tự share sheet cho account mới, user khác ở lại
+        account cũ. Admin bật SERVICE_ACCOUNT_AUTO_SHARE=true (hoặc auto_share=True)
+        thì account đang ghim share sheet của user cho account mới (quyền Editor,
+        không gửi email) rồi mới chuyển - mỗi lần share đều được ghi log.
+        """
+        if auto_share is None:
+            auto_share = os.getenv('SERVICE_ACCOUNT_AUTO_SHARE', 'false').lower() == 'true'
+
+        def can_access(user_id: str, account: ServiceAccount) -> bool:
+            sheet_id = self._extract_sheet_id(self.user_sheets.get(user_id, ''))
+            if not sheet_id:
+                return False
+            account.scheduler.call(account.client.open_by_key, sheet_id, priority=PRIORITY_BACKGROUND)
+            return True
+        
+        def grant_access(user_id: str, source: ServiceAccount, target: ServiceAccount):
+            sheet_id = self._extract_sheet_id(self.user_sheets.get(user_id, ''))
+            if not sheet_id:
+                return
+            logger.warning(
+                f"🔑 SERVICE_ACCOUNT_AUTO_SHARE: {source.email} share sheet {sheet_id} "
+                f"của user {user_id} cho {target.email} (Editor)"
+            )
+            source.scheduler.call(
+                source.client.insert_permission, sheet_id, target.email, 'user', 'writer',
+                notify=False, kind='write', priority=PRIORITY_BACKGROUND
+            )
+        
+        try:
+            moved = self.pool.rebalance(can_access, grant_access if auto_share else None)
+            if moved:
+                self._services.clear()
+            return moved
+        except Exception as e:
+            logger.error(f"❌ Lỗi rebalance service accounts: {e}")
+            return 0
+    
     def _get_user_name_from_id(self, user_id: str) -> str:
         """Helper để lấy user name từ ID (fallback)"""
         # Có thể mở rộng sau để lưu thêm user name
@@ -158,7 +234,8 @@ class UserSheetManager:
         """Lấy thống kê user sheets"""
         return {
             'total_users': len(self.user_sheets),
-            'users': list(self.user_sheets.keys())
+            'users': list(self.user_sheets.keys()),
+            'service_accounts': self.pool.get_stats()
         }
     
     def is_google_sheet_url(self, text: str) -> bool:
@@ -171,8 +248,9 @@ class UserSheetManager:
         
         return any(re.search(pattern, text, re.IGNORECASE) for pattern in google_sheet_patterns)
     
-    def generate_setup_message(self, user_name: str) -> str:
+    def generate_setup_message(self, user_name: str, user_id: str = None) -> str:
         """Tạo tin nhắn hướng dẫn setup sheet cho user"""
+        service_email = self.get_service_email(user_id)
         return f"""
 👋 Chào mừng {user_name} đến với Bot Quản Lý Thu Chi AI!
 
@@ -187,7 +265,7 @@ BƯỚC 1: Tạo Google Sheet
 BƯỚC 2: Chia sẻ với Bot ⚠️ QUAN TRỌNG
 • Click nút "Chia sẻ" ở góc phải màn hình
 • Thêm email service account của bot:
-📧 {os.getenv('GOOGLE_SERVICE_EMAIL', 'service-account-email')}
+📧 {service_email}
 • PHẢI chọn quyền "Trình chỉnh sửa" (Editor)
 • Click "Gửi" để lưu quyền
 
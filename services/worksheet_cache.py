@@ -0,0 +1,335 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from services.sheets_scheduler import PRIORITY_BACKGROUND, PRIORITY_USER_READ, TokenBucket, is_rate_limit_error
+
+logger = logging.getLogger(__name__)
+
+DRIVE_FILE_URL = "https://www.googleapis.com/drive/v3/files/{file_id}"
+
+# Cột giao dịch: Ngày | Loại | Số tiền | Danh mục | Ghi chú
+CACHE_COLUMNS = "A:E"
+
+
+def normalize_row(row: List) -> List[str]:
+    """Bỏ ô trống cuối dòng để so sánh kết quả get() và get_all_values()"""
+    values = [str(value) for value in row]
+    while values and values[-1] == '':
+        values.pop()
+    return values
+
+
+def row_checksum(row: List) -> str:
+    """Checksum của một dòng"""
+    return hashlib.sha1(json.dumps(normalize_row(row), ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class WorksheetCache:
+    """
+    Cache nội dung worksheet, kiểm tra thay đổi trước khi dùng
+
+    1. Probe Drive `version` của spreadsheet (quota probe riêng, không tính vào
+       quota đọc Sheets): không đổi → dùng cache.
+    2. Bot vừa ghi (hoặc không probe được): đọc dòng cuối đã cache + phần đuôi trong
+       1 lệnh. Dòng cuối khớp checksum → chỉ nối thêm các dòng mới (tail reload).
+       Không có Drive version thì cùng lệnh đó đọc thêm một khối dòng theo vòng
+       (WORKSHEET_CACHE_CHUNK_ROWS) để phát hiện sửa tay ở giữa sheet và chỉ thay khối đổi.
+    3. Dòng cuối khác, hoặc spreadsheet thay đổi mà bot không ghi gì
+       (sửa tay ở giữa sheet) → tải lại worksheet, so checksum từng khối để
+       giữ nguyên dữ liệu (và index danh mục) khi nội dung thực ra không đổi.
+    """
+
+    def __init__(self):
+        self.max_entries = int(os.getenv('WORKSHEET_CACHE_MAX_ENTRIES', 200))
+        self.max_age = int(os.getenv('WORKSHEET_CACHE_MAX_AGE', 3600))
+        self.probe_ttl = float(os.getenv('WORKSHEET_CACHE_PROBE_TTL', 2))
+        self.chunk_rows = max(int(os.getenv('WORKSHEET_CACHE_CHUNK_ROWS', 500)), 1)
+
+        self._entries: 'OrderedDict[tuple, Dict]' = OrderedDict()
+        self._versions: Dict[str, tuple] = {}
+        self._version_unsupported = set()
+        self._writes = Counter()
+        self._lock = threading.Lock()
+        self._key_locks: Dict[tuple, threading.Lock] = {}
+        self._warming = set()
+        # Drive API có quota riêng - probe không lấy token đọc Sheets của tin nhắn user
+        self._probe_bucket = TokenBucket(int(os.getenv('WORKSHEET_CACHE_PROBES_PER_MINUTE', 300)))
+
+        self._stats = Counter()
+
+    @staticmethod
+    def is_enabled() -> bool:
+        """Kiểm tra cache worksheet có được bật không"""
+        return os.getenv('WORKSHEET_CACHE', 'true').lower() == 'true'
+
+    def note_write(self, sheet_id: str):
+        """Bot vừa ghi vào spreadsheet - thay đổi version tiếp theo là do bot"""
+        with self._lock:
+            self._writes[sheet_id] += 1
+            self._versions.pop(sheet_id, None)
+
+    def invalidate(self, sheet_id: str, worksheet_title: str = None):
+        """Xóa cache của một worksheet (hoặc cả spreadsheet)"""
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == sheet_id and (worksheet_title is None or key[1] == worksheet_title):
+                    del self._entries[key]
+            self._versions.pop(sheet_id, None)
+
+    def is_warm(self, worksheet) -> bool:
+        """Worksheet đã có trong cache và chưa quá hạn (đọc từ cache không cần tải toàn bộ)"""
+        with self._lock:
+            entry = self._entries.get((worksheet.spreadsheet.id, worksheet.title))
+        return entry is not None and time.monotonic() - entry['loaded_at'] <= self.max_age
+
+    def warm(self, worksheet, session, call: Callable, on_change: Callable[[List[List]], None] = None):
+        """
+        Tải worksheet vào cache ở thread nền (ưu tiên thấp)
+
+        Lần đọc đầu tiên được trả lời bằng gviz, các lần sau đọc từ cache.
+        """
+        key = (worksheet.spreadsheet.id, worksheet.title)
+        with self._lock:
+            if key in self._warming:
+                return
+            self._warming.add(key)
+
+        def background_call(func, *args, priority: int = None, **kwargs):
+            return call(func, *args, priority=PRIORITY_BACKGROUND, **kwargs)
+
+        def run():
+            try:
+                self.get_rows(worksheet, session, background_call, on_change=on_change)
+            except Exception as e:
+                logger.warning(f"⚠️ Không tải trước được cache '{worksheet.title}': {e}")
+            finally:
+                with self._lock:
+                    self._warming.discard(key)
+
+        threading.Thread(target=run, name=f"cache-warm-{worksheet.title}", daemon=True).start()
+
+    def _key_lock(self, key: tuple) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _probe_version(self, session, sheet_id: str) -> Optional[str]:
+        """Lấy version/modifiedTime của spreadsheet qua Drive API (cache vài giây)"""
+        if sheet_id in self._version_unsupported:
+            return None
+
+        with self._lock:
+            cached = self._versions.get(sheet_id)
+            if cached and time.monotonic() - cached[1] < self.probe_ttl:
+                return cached[0]
+            if self._probe_bucket.try_acquire(time.monotonic()) > 0:
+                # Hết quota probe - coi như không biết version, kiểm tra bằng dòng cuối
+                self._stats['probes_skipped'] += 1
+                return None
+
+        try:
+            response = session.get(
+                DRIVE_FILE_URL.format(file_id=sheet_id),
+                params={'fields': 'version,modifiedTime', 'supportsAllDrives': 'true'},
+                timeout=10
+            )
+            response.raise_for_status()
+            data = response.json()
+        except Exception as e:
+            if is_rate_limit_error(e):
+                with self._lock:
+                    self._probe_bucket.drain(time.monotonic())
+                return None
+            # Drive API chưa bật/không có quyền - dùng probe dòng cuối thay thế
+            self._version_unsupported.add(sheet_id)
+            logger.warning(f"⚠️ Không probe được Drive version của {sheet_id}, dùng checksum dòng cuối: {e}")
+            return None
+
+        version = f"{data.get('version')}:{data.get('modifiedTime')}"
+        with self._lock:
+            self._versions[sheet_id] = (version, time.monotonic())
+        self._stats['version_probes'] += 1
+        return version
+
+    def get_rows(self, worksheet, session, call: Callable, on_change: Callable[[List[List]], None] = None) -> List[List]:
+        """
+        Lấy toàn bộ dòng (gồm header) của worksheet, dùng cache nếu không đổi
+
+        Args:
+            worksheet: gspread Worksheet
+            session: AuthorizedSession của client (để probe Drive)
+            call: Hàm gọi Sheets qua scheduler (GoogleSheetsService._call)
+            on_change: Gọi với toàn bộ dòng mỗi khi cache tải lại nội dung mới
+                (dựng lại index danh mục khi user sửa tay)
+        """
+        with self._lock:
+            before = self._entries.get((worksheet.spreadsheet.id, worksheet.title))
+        rows = self._get_rows(worksheet, session, call)
+        if on_change and (before is None or rows is not before['rows']):
+            on_change(rows)
+        return rows
+
+    def _get_rows(self, worksheet, session, call: Callable) -> List[List]:
+        sheet_id = worksheet.spreadsheet.id
+        key = (sheet_id, worksheet.title)
+
+        with self._key_lock(key):
+            with self._lock:
+                entry = self._entries.get(key)
+                writes = self._writes[sheet_id]
+
+            # Probe trước khi đọc dữ liệu để không gán version mới cho dữ liệu cũ
+            version = self._probe_version(session, sheet_id)
+
+            if entry is None or time.monotonic() - entry['loaded_at'] > self.max_age:
+                return self._full_load(worksheet, key, None, version, writes, call)
+
+            if version is not None and version == entry['version']:
+                self._stats['hits'] += 1
+                self._touch(key)
+                return entry['rows']
+
+            if version is not None and writes == entry['writes']:
+                # Spreadsheet đổi nhưng bot không ghi gì → có thể sửa tay bất kỳ đâu
+                return self._full_load(worksheet, key, entry, version, writes, call)
+
+            return self._tail_load(worksheet, key, entry, version, writes, call)
+
+    def _chunk_checksums(self, rows: List[List]) -> List[str]:
+        """Checksum từng khối chunk_rows dòng (theo vị trí dòng trên sheet, gồm header)"""
+        return [
+            hashlib.sha1(json.dumps(rows[start:start + self.chunk_rows], ensure_ascii=False).encode('utf-8')).hexdigest()
+            for start in range(0, len(rows), self.chunk_rows)
+        ]
+
+    def _full_load(self, worksheet, key: tuple, entry: Optional[Dict], version: Optional[str], writes: int,
+                   call: Callable) -> List[List]:
+        rows = [normalize_row(row) for row in call(worksheet.get, CACHE_COLUMNS, priority=PRIORITY_USER_READ)]
+        chunks = self._chunk_checksums(rows)
+        self._stats['full_loads'] += 1
+
+        if entry is not None and chunks == entry['chunks']:
+            # Version đổi nhưng nội dung A:E không đổi (VD: sửa định dạng) - giữ dữ liệu cũ
+            self._store(key, entry['rows'], chunks, version, writes, loaded_at=time.monotonic())
+            return entry['rows']
+
+        if entry is not None:
+            changed = sum(1 for index, checksum in enumerate(chunks)
+                          if index >= len(entry['chunks']) or entry['chunks'][index] != checksum)
+            self._stats['changed_chunks'] += changed
+            logger.info(f"📥 Cache: tải lại '{worksheet.title}', {changed}/{len(chunks)} khối thay đổi")
+        else:
+            logger.info(f"📥 Cache: tải toàn bộ {len(rows)} dòng '{worksheet.title}'")
+        self._store(key, rows, chunks, version, writes, loaded_at=time.monotonic())
+        return rows
+
+    def _tail_load(self, worksheet, key: tuple, entry: Dict, version: Optional[str], writes: int,
+                   call: Callable) -> List[List]:
+        """
+        Kiểm tra dòng cuối đã cache và tải các dòng được thêm sau nó (1 lệnh batch_get)
+
+        Không có Drive version thì kiểm tra thêm một khối dòng theo vòng trong cùng lệnh.
+        """
+        cached_rows = entry['rows']
+        if not cached_rows:
+            return self._full_load(worksheet, key, entry, version, writes, call)
+        last_index = len(cached_rows)  # Số thứ tự dòng cuối trên sheet (header là dòng 1)
+
+        ranges = [f"A{last_index}:E{last_index}", f"A{last_index + 1}:E"]
+        chunk_index = None
+        if version is None and entry['chunks']:
+            chunk_index = entry['cursor'] % len(entry['chunks'])
+            chunk_start = chunk_index * self.chunk_rows
+            chunk_end = min(chunk_start + self.chunk_rows, last_index)
+            ranges.append(f"A{chunk_start + 1}:E{chunk_end}")
+
+        try:
+            ranges_values = call(worksheet.batch_get, ranges, priority=PRIORITY_USER_READ)
+        except Exception as e:
+            # VD: dòng cuối nằm ở biên grid nên range đuôi không hợp lệ
+            logger.debug(f"Không probe được phần đuôi '{worksheet.title}': {e}")
+            return self._full_load(worksheet, key, entry, version, writes, call)
+
+        last_range, tail_range = ranges_values[0], ranges_values[1]
+        last_row = last_range[0] if last_range else []
+        if row_checksum(last_row) != row_checksum(cached_rows[-1]):
+            # Dòng bị xóa/sửa/chèn phía trên - phải tải lại
+            return self._full_load(worksheet, key, entry, version, writes, call)
+
+        rows = cached_rows
+        chunks = entry['chunks']
+        if chunk_index is not None:
+            chunk_rows = [normalize_row(row) for row in ranges_values[2]]
+            chunk_rows += [[] for _ in range(chunk_end - chunk_start - len(chunk_rows))]
+            checksum = self._chunk_checksums(chunk_rows)[0] if chunk_rows else None
+            if checksum != chunks[chunk_index]:
+                # Dòng bị sửa tay trong khối - chỉ thay khối đó
+                rows = rows[:chunk_start] + chunk_rows + rows[chunk_end:]
+                chunks = chunks[:chunk_index] + [checksum] + chunks[chunk_index + 1:]
+                self._stats['changed_chunks'] += 1
+                logger.info(f"📥 Cache: khối dòng {chunk_start + 1}-{chunk_end} của '{worksheet.title}' đã bị sửa")
+
+        new_rows = [normalize_row(row) for row in tail_range]
+        if new_rows:
+            rows = rows + new_rows
+            chunks = self._chunk_checksums(rows)
+        self._store(key, rows, chunks, version, writes, loaded_at=entry['loaded_at'],
+                    cursor=entry['cursor'] + (1 if chunk_index is not None else 0))
+        self._stats['tail_loads'] += 1
+        if new_rows:
+            logger.info(f"📥 Cache: tải thêm {len(new_rows)} dòng mới của '{worksheet.title}'")
+        return rows
+
+    def _store(self, key: tuple, rows: List[List], chunks: List[str], version: Optional[str], writes: int,
+               loaded_at: float, cursor: int = 0):
+        with self._lock:
+            self._entries[key] = {
+                'rows': rows,
+                'chunks': chunks,
+                'cursor': cursor,
+                'version': version,
+                'writes': writes,
+                'loaded_at': loaded_at
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _touch(self, key: tuple):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+    def get_stats(self) -> Dict:
+        """Thống kê cache (dùng cho /health)"""
+        with self._lock:
+            reads = self._stats['hits'] + self._stats['tail_loads'] + self._stats['full_loads']
+            return {
+                'worksheets': len(self._entries),
+                'hits': self._stats['hits'],
+                'tail_loads': self._stats['tail_loads'],
+                'full_loads': self._stats['full_loads'],
+                'changed_chunks': self._stats['changed_chunks'],
+                'version_probes': self._stats['version_probes'],
+                'probes_skipped': self._stats['probes_skipped'],
+                'warming': len(self._warming),
+                'hit_rate': round(self._stats['hits'] / reads, 3) if reads else 0
+            }
+
+
+_cache: Optional[WorksheetCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_worksheet_cache() -> WorksheetCache:
+    """Lấy cache worksheet dùng chung của process"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = WorksheetCache()
+        return _cache
@@ -0,0 +1,404 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import gspread
+from services.service_account_pool import get_service_account_pool
+from services.sheet_archive import TRANSACTION_HEADER
+from services.sheets_scheduler import PRIORITY_BACKGROUND
+from services.worksheet_cache import get_worksheet_cache
+
+logger = logging.getLogger(__name__)
+
+
+class WriteJournal:
+    """
+    Outbox SQLite cho các giao dịch chưa ghi được lên Google Sheets
+
+    Giao dịch được lưu bền vững trên đĩa rồi được một thread nền ghi lại
+    theo lô (append_rows), giữ đúng thứ tự trong từng worksheet.
+
+    - Ghi đúng một lần: trước append_rows lô được đánh dấu sent_at; nếu process
+      chết (hoặc timeout) trước khi xóa khỏi outbox, lần sau kiểm tra cuối
+      worksheet - lô đã có trên sheet thì chỉ xóa khỏi outbox, không ghi lại.
+    - Lỗi quá WRITE_JOURNAL_MAX_ATTEMPTS lần (sheet bị bỏ share/xóa): cả worksheet
+      chuyển sang trạng thái lỗi (failed_at), không chặn outbox nữa và user được
+      báo trong tin nhắn trả lời. Gửi lại link sheet hoặc `admin_cli.py outbox --retry`
+      để thử lại.
+    """
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or os.getenv('WRITE_JOURNAL_PATH', 'write_journal.db')
+        self.batch_size = int(os.getenv('WRITE_JOURNAL_BATCH_SIZE', 100))
+        self.interval = int(os.getenv('WRITE_JOURNAL_INTERVAL', 30))
+        self.max_attempts = int(os.getenv('WRITE_JOURNAL_MAX_ATTEMPTS', 20))
+
+        self._lock = threading.Lock()
+        # Giữ trong lúc ghi outbox lên sheet - xuất dữ liệu tạm dừng drainer để không đọc trùng/thiếu
+        self._drain_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._drainer = None
+        self._failures = 0
+        self._synced = 0
+
+        self._init_db()
+        # Số dòng chờ / lỗi theo (spreadsheet, worksheet) - tra cứu O(1) khi ghi giao dịch
+        self._pending = self._load_counts(failed=False)
+        self._failed = self._load_counts(failed=True)
+
+        if self._pending:
+            logger.info(f"📮 Có {sum(self._pending.values())} giao dịch chờ đồng bộ từ lần chạy trước")
+            self.start_drainer()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _init_db(self):
+        """Tạo bảng outbox nếu chưa có"""
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    account_email TEXT NOT NULL,
+                    sheet_id TEXT NOT NULL,
+                    worksheet TEXT NOT NULL,
+                    row_json TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_target ON outbox (sheet_id, worksheet, id)")
+            # Cột thêm sau - outbox của bản cũ được nâng cấp tại chỗ
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(outbox)")}
+            for column in ('sent_at', 'failed_at'):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE outbox ADD COLUMN {column} TEXT")
+
+    def _load_counts(self, failed: bool) -> Counter:
+        condition = "failed_at IS NOT NULL" if failed else "failed_at IS NULL"
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT sheet_id, worksheet, COUNT(*) FROM outbox WHERE {condition} GROUP BY sheet_id, worksheet"
+            )
+            return Counter({(sheet_id, worksheet): count for sheet_id, worksheet, count in rows})
+
+    def enqueue(self, account_email: str, sheet_id: str, worksheet_title: str, row: List) -> int:
+        """
+        Lưu một dòng giao dịch vào outbox
+
+        Returns:
+            int: Số dòng đang chờ của worksheet
+        """
+        with self._lock:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT INTO outbox (account_email, sheet_id, worksheet, row_json, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (account_email, sheet_id, worksheet_title, json.dumps(row, ensure_ascii=False),
+                     datetime.now().isoformat(timespec='seconds'))
+                )
+            self._pending[(sheet_id, worksheet_title)] += 1
+            pending = self._pending[(sheet_id, worksheet_title)]
+
+        self.start_drainer()
+        if not self._failures:
+            # Sheets không đang lỗi liên tiếp - đồng bộ ngay thay vì chờ hết interval
+            self._wakeup.set()
+        return pending
+
+    def pending_count(self, sheet_id: str = None, worksheet_title: str = None) -> int:
+        """Số giao dịch chờ đồng bộ của một worksheet (hoặc tất cả)"""
+        with self._lock:
+            if sheet_id is None:
+                return sum(self._pending.values())
+            return self._pending.get((sheet_id, worksheet_title), 0)
+
+    def failed_count(self, sheet_id: str = None, worksheet_title: str = None) -> int:
+        """Số giao dịch không đồng bộ được sau max_attempts lần thử (cần user/admin xử lý)"""
+        with self._lock:
+            if sheet_id is None:
+                return sum(self._failed.values())
+            return self._failed.get((sheet_id, worksheet_title), 0)
+
+    def retry_failed(self, sheet_id: str = None, worksheet_title: str = None) -> int:
+        """
+        Đưa các giao dịch lỗi về hàng chờ (user đã share lại sheet)
+
+        Args:
+            sheet_id: Chỉ spreadsheet này (None = tất cả)
+            worksheet_title: Chỉ worksheet này (None = mọi worksheet của spreadsheet)
+
+        Returns:
+            int: Số giao dịch được thử lại
+        """
+        conditions, params = ["failed_at IS NOT NULL"], []
+        if sheet_id is not None:
+            conditions.append("sheet_id = ?")
+            params.append(sheet_id)
+        if worksheet_title is not None:
+            conditions.append("worksheet = ?")
+            params.append(worksheet_title)
+
+        with self._lock:
+            with self._connect() as conn:
+                retried = conn.execute(
+                    f"UPDATE outbox SET failed_at = NULL, attempts = 0 WHERE {' AND '.join(conditions)}", params
+                ).rowcount
+            self._pending = self._load_counts(failed=False)
+            self._failed = self._load_counts(failed=True)
+
+        if retried:
+            logger.info(f"🔁 Thử đồng bộ lại {retried} giao dịch lỗi")
+            self._failures = 0
+            self.start_drainer()
+            self._wakeup.set()
+        return retried
+
+    def has_pending(self, sheet_id: str, worksheet_title: str) -> bool:
+        """Worksheet còn dòng chờ - giao dịch mới phải xếp hàng sau để giữ thứ tự"""
+        return self.pending_count(sheet_id, worksheet_title) > 0
+
+    def start_drainer(self):
+        """Khởi động thread nền đồng bộ outbox (nếu chưa chạy)"""
+        with self._lock:
+            if self._drainer and self._drainer.is_alive():
+                return
+            self._drainer = threading.Thread(target=self._drain_loop, name="write-journal", daemon=True)
+            self._drainer.start()
+
+    def _drain_loop(self):
+        while True:
+            # Lỗi liên tiếp thì giãn khoảng thời gian thử lại để không làm sự cố nặng thêm
+            delay = self.interval * min(2 ** self._failures, 8)
+            self._wakeup.wait(timeout=delay)
+            self._wakeup.clear()
+
+            try:
+                self.drain_once()
+            except Exception as e:
+                logger.error(f"❌ Lỗi đồng bộ outbox: {e}")
+
+            if not self.pending_count():
+                with self._lock:
+                    # Kiểm tra lại trong lock để không bỏ sót dòng vừa được thêm
+                    if not self._pending:
+                        self._drainer = None
+                        return
+
+    def _fetch_batch(self, sheet_id: str, worksheet_title: str) -> List[Tuple[int, str, List, int, Optional[str]]]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, account_email, row_json, attempts, sent_at FROM outbox "
+                "WHERE sheet_id = ? AND worksheet = ? AND failed_at IS NULL ORDER BY id LIMIT ?",
+                (sheet_id, worksheet_title, self.batch_size)
+            ).fetchall()
+        return [(row_id, email, json.loads(row_json), attempts, sent_at)
+                for row_id, email, row_json, attempts, sent_at in rows]
+
+    def _open_worksheet(self, account, sheet_id: str, worksheet_title: str):
+        """Mở (hoặc tạo lại) worksheet đích bằng service account đã ghi nhận dòng"""
+        spreadsheet = account.scheduler.call(account.client.open_by_key, sheet_id, priority=PRIORITY_BACKGROUND)
+        try:
+            return account.scheduler.call(spreadsheet.worksheet, worksheet_title, priority=PRIORITY_BACKGROUND)
+        except gspread.WorksheetNotFound:
+            worksheet = account.scheduler.call(
+                spreadsheet.add_worksheet, title=worksheet_title, rows="1000", cols="10",
+                kind='write', priority=PRIORITY_BACKGROUND
+            )
+            account.scheduler.call(worksheet.append_row, TRANSACTION_HEADER, kind='write', priority=PRIORITY_BACKGROUND)
+            return worksheet
+
+    @staticmethod
+    def _same_row(expected: List, actual: List) -> bool:
+        """So sánh dòng trong outbox với dòng đọc lại từ sheet (số 50000.0 == 50000)"""
+        if len(actual) > len(expected) and any(str(value) for value in actual[len(expected):]):
+            return False
+        for index, value in enumerate(expected):
+            other = actual[index] if index < len(actual) else ''
+            if str(value) == str(other):
+                continue
+            try:
+                if float(value) == float(other):
+                    continue
+            except (TypeError, ValueError):
+                pass
+            return False
+        return True
+
+    def _already_written(self, account, worksheet, rows: List[List]) -> bool:
+        """Lô đã đánh dấu sent_at có nằm ở cuối worksheet chưa (append_rows lần trước đã thành công)"""
+        last_row = len(account.scheduler.call(worksheet.get, "A:A", priority=PRIORITY_BACKGROUND))
+        if last_row - 1 < len(rows):
+            return False
+        tail = account.scheduler.call(
+            worksheet.get, f"A{last_row - len(rows) + 1}:E{last_row}",
+            value_render_option='UNFORMATTED_VALUE', priority=PRIORITY_BACKGROUND
+        )
+        return len(tail) == len(rows) and all(self._same_row(row, written) for row, written in zip(rows, tail))
+
+    def _set_sent(self, ids: List[int], sent: bool):
+        placeholders = ",".join("?" * len(ids))
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE outbox SET sent_at = ? WHERE id IN ({placeholders})",
+                [datetime.now().isoformat(timespec='seconds') if sent else None] + ids
+            )
+
+    def drain_once(self, targets: List[Tuple[str, str]] = None) -> int:
+        """
+        Ghi outbox lên Google Sheets theo lô
+
+        Mỗi worksheet được ghi tuần tự theo id; lô lỗi sẽ dừng worksheet đó
+        (các dòng sau không được ghi vượt lên trước).
+
+        Args:
+            targets: Chỉ ghi các (spreadsheet, worksheet) này (None = toàn bộ outbox)
+
+        Returns:
+            int: Số dòng đã đồng bộ
+        """
+        with self._drain_lock:
+            return self._drain(targets)
+
+    def flush(self, sheet_id: str, worksheet_title: str) -> bool:
+        """Ghi ngay outbox của một worksheet (trước khi xuất dữ liệu); True nếu không còn dòng chờ"""
+        if self.has_pending(sheet_id, worksheet_title):
+            self.drain_once([(sheet_id, worksheet_title)])
+        return not self.has_pending(sheet_id, worksheet_title)
+
+    @contextmanager
+    def paused(self):
+        """Tạm dừng đồng bộ outbox (dòng không chuyển từ outbox sang sheet giữa chừng khi đang đọc)"""
+        with self._drain_lock:
+            yield
+
+    def pending_rows(self, sheet_id: str, worksheet_title: str) -> List[List]:
+        """Các dòng của worksheet còn trong outbox (kể cả dòng lỗi), theo thứ tự ghi nhận"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT row_json FROM outbox WHERE sheet_id = ? AND worksheet = ? ORDER BY id",
+                (sheet_id, worksheet_title)
+            ).fetchall()
+        return [json.loads(row_json) for (row_json,) in rows]
+
+    def _drain(self, targets: List[Tuple[str, str]] = None) -> int:
+        pool = get_service_account_pool()
+        with self._lock:
+            targets = [
+                target for target, count in self._pending.items()
+                if count > 0 and (targets is None or target in targets)
+            ]
+
+        synced = 0
+        failed = False
+        for sheet_id, worksheet_title in targets:
+            worksheet = None
+            account = None
+            while True:
+                batch = self._fetch_batch(sheet_id, worksheet_title)
+                if not batch:
+                    break
+
+                ids = [row_id for row_id, _, _, _, _ in batch]
+                rows = [row for _, _, row, _, _ in batch]
+                sent = [row_id for row_id, _, _, _, sent_at in batch if sent_at]
+                try:
+                    if worksheet is None:
+                        # Account đã ghi nhận dòng; account đó bị bỏ khỏi pool thì dùng account chính
+                        account = pool.get_account_by_email(batch[0][1]) or pool.primary
+                        worksheet = self._open_worksheet(account, sheet_id, worksheet_title)
+
+                    if sent:
+                        # Lần trước đã gửi nhưng chưa kịp xóa khỏi outbox (crash/timeout)
+                        if self._already_written(account, worksheet, rows[:len(sent)]):
+                            self._remove(sheet_id, worksheet_title, sent)
+                            synced += len(sent)
+                            logger.info(f"📤 {len(sent)} giao dịch chờ đã có trên '{worksheet_title}', bỏ qua")
+                            continue
+                        self._set_sent(sent, False)
+
+                    self._set_sent(ids, True)
+                    account.scheduler.call(worksheet.append_rows, rows, kind='write', priority=PRIORITY_BACKGROUND)
+                except Exception as e:
+                    failed = True
+                    # Có HTTP response (429, 403...) nghĩa là chắc chắn chưa ghi; timeout thì chưa biết
+                    if getattr(e, 'response', None) is not None:
+                        self._set_sent(ids, False)
+                    self._mark_failed(ids, e)
+                    logger.warning(f"⚠️ Chưa đồng bộ được {len(ids)} dòng vào '{worksheet_title}': {e}")
+                    if batch[0][3] + 1 >= self.max_attempts:
+                        self._dead_letter(sheet_id, worksheet_title, e)
+                    break
+
+                get_worksheet_cache().note_write(sheet_id)
+                self._remove(sheet_id, worksheet_title, ids)
+                synced += len(ids)
+                logger.info(f"📤 Đã đồng bộ {len(ids)} giao dịch chờ vào '{worksheet_title}'")
+
+        self._failures = self._failures + 1 if failed else 0
+        self._synced += synced
+        return synced
+
+    def _mark_failed(self, ids: List[int], error: Exception):
+        placeholders = ",".join("?" * len(ids))
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE outbox SET attempts = attempts + 1, last_error = ? WHERE id IN ({placeholders})",
+                [str(error)[:500]] + ids
+            )
+
+    def _dead_letter(self, sheet_id: str, worksheet_title: str, error: Exception):
+        """Ngừng thử worksheet lỗi quá max_attempts lần để không chặn outbox mãi"""
+        key = (sheet_id, worksheet_title)
+        with self._lock:
+            with self._connect() as conn:
+                moved = conn.execute(
+                    "UPDATE outbox SET failed_at = ? WHERE sheet_id = ? AND worksheet = ? AND failed_at IS NULL",
+                    (datetime.now().isoformat(timespec='seconds'), sheet_id, worksheet_title)
+                ).rowcount
+            self._pending.pop(key, None)
+            self._failed[key] += moved
+        logger.error(
+            f"❌ Ngừng đồng bộ {moved} giao dịch vào '{worksheet_title}' sau {self.max_attempts} lần lỗi: {error}"
+        )
+
+    def _remove(self, sheet_id: str, worksheet_title: str, ids: List[int]):
+        placeholders = ",".join("?" * len(ids))
+        with self._lock:
+            with self._connect() as conn:
+                conn.execute(f"DELETE FROM outbox WHERE id IN ({placeholders})", ids)
+            key = (sheet_id, worksheet_title)
+            self._pending[key] -= len(ids)
+            if self._pending[key] <= 0:
+                del self._pending[key]
+
+    def get_stats(self) -> Dict:
+        """Lấy thống kê outbox (dùng cho /health)"""
+        return {
+            'pending': self.pending_count(),
+            'failed': self.failed_count(),
+            'worksheets': len(self._pending),
+            'synced': self._synced,
+            'consecutive_failures': self._failures,
+            'draining': bool(self._drainer and self._drainer.is_alive())
+        }
+
+
+_journal: Optional[WriteJournal] = None
+_journal_lock = threading.Lock()
+
+
+def get_write_journal() -> WriteJournal:
+    """Lấy outbox dùng chung của process"""
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            _journal = WriteJournal()
+        return _journal
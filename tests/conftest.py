@@ -0,0 +1,33 @@
+"""
+Cấu hình pytest cho các unit test của services/ và utils/
+
+services/__init__.py import GoogleSheetsService, Gemini... (cần gspread, google-auth)
+trong khi các module được test chỉ dùng thư viện chuẩn. Đăng ký package `services`
+trỏ thẳng vào thư mục để import từng module mà không chạy __init__.
+"""
+
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+if 'services' not in sys.modules:
+    services_package = types.ModuleType('services')
+    services_package.__path__ = [os.path.join(ROOT, 'services')]
+    sys.modules['services'] = services_package
+
+
+@pytest.fixture(autouse=True)
+def isolated_state(tmp_path, monkeypatch):
+    """Memo danh mục ghi vào thư mục tạm, không dùng singleton của test trước"""
+    from services import category_memo
+
+    monkeypatch.setenv('CATEGORY_MEMO_FILE', str(tmp_path / 'category_memo.json'))
+    monkeypatch.setenv('GEMINI_BREAKER', 'true')
+    monkeypatch.setattr(category_memo, '_memo', None)
+    yield
@@ -0,0 +1,113 @@
+import time
+
+import pytest
+
+from services.circuit_breaker import CircuitBreaker, CircuitOpenError
+
+
+def _breaker(**overrides):
+    options = dict(window_size=4, min_calls=4, error_rate=0.5, slow_call_seconds=1.0,
+                   slow_rate=0.75, open_seconds=0.05, probe_successes=2)
+    options.update(overrides)
+    return CircuitBreaker('test', **options)
+
+
+def _call(breaker, failed=False, seconds=0.1):
+    probe = breaker.check()
+    breaker.record(seconds, failed, probe)
+    return probe
+
+
+def test_stays_closed_below_min_calls():
+    breaker = _breaker()
+    for _ in range(3):
+        _call(breaker, failed=True)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_opens_on_error_rate_and_rejects():
+    breaker = _breaker()
+    for failed in (True, False, True, False):
+        _call(breaker, failed=failed)
+
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    assert breaker.get_stats()['rejected'] == 1
+
+
+def test_opens_on_slow_rate():
+    breaker = _breaker()
+    for seconds in (2.0, 2.0, 2.0, 0.1):
+        _call(breaker, seconds=seconds)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_half_open_allows_single_probe_then_closes():
+    breaker = _breaker()
+    for _ in range(4):
+        _call(breaker, failed=True)
+    time.sleep(0.06)
+
+    assert breaker.check() is True
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    breaker.record(0.1, False, probe=True)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    assert _call(breaker) is True
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.check() is False
+
+
+def test_failed_probe_reopens():
+    breaker = _breaker()
+    for _ in range(4):
+        _call(breaker, failed=True)
+    time.sleep(0.06)
+
+    _call(breaker, failed=True)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.get_stats()['opened'] == 2
+
+
+def test_cancelled_probe_releases_slot():
+    breaker = _breaker()
+    for _ in range(4):
+        _call(breaker, failed=True)
+    time.sleep(0.06)
+
+    probe = breaker.check()
+    breaker.record(0.1, None, probe)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.check() is True
+
+
+def test_disabled_breaker_never_opens(monkeypatch):
+    monkeypatch.setenv('GEMINI_BREAKER', 'false')
+    breaker = _breaker()
+    for _ in range(10):
+        _call(breaker, failed=True)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_explicit_zero_is_not_replaced_by_default(monkeypatch):
+    monkeypatch.setenv('GEMINI_BREAKER_OPEN_SECONDS', '30')
+    breaker = _breaker(open_seconds=0)
+    for _ in range(4):
+        _call(breaker, failed=True)
+    assert breaker.open_seconds == 0
+    assert breaker.check() is True
+
+
+def test_uncounted_probe_keeps_half_open():
+    breaker = _breaker()
+    for _ in range(4):
+        _call(breaker, failed=True)
+    time.sleep(0.06)
+
+    # Lệnh thăm dò lỗi 400 / hết ngân sách key cục bộ: không phải thành công
+    _call(breaker, failed=None)
+    _call(breaker, failed=None)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
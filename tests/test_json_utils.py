@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+from utils.json_utils import extract_json_fields, parse_json_lenient, strip_code_fence, write_json_atomic
+
+
+def test_valid_json_is_not_marked_repaired():
+    assert parse_json_lenient('{"intent": "EXPENSE"}') == ({'intent': 'EXPENSE'}, False)
+
+
+def test_strip_code_fence():
+    assert strip_code_fence('```json\n{"a": 1}\n```') == '{"a": 1}'
+    assert parse_json_lenient('```json\n{"a": 1}\n```') == ({'a': 1}, False)
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("{'intent': 'EXPENSE', 'amount': 45000}", {'intent': 'EXPENSE', 'amount': 45000}),
+    ('{"category": None, "ok": True}', {'category': None, 'ok': True}),
+    ('{intent: "EXPENSE"}', {'intent': 'EXPENSE'}),
+    ('{"a": 1, "b": [1, 2,],}', {'a': 1, 'b': [1, 2]}),
+    ('Kết quả: {"intent": "HELP"} - xong', {'intent': 'HELP'}),
+    ('{“intent”: “STATS”}', {'intent': 'STATS'}),
+    ("{'note': 'cafe \"sữa\"'}", {'note': 'cafe "sữa"'}),
+])
+def test_repairs_common_mistakes(text, expected):
+    assert parse_json_lenient(text) == (expected, True)
+
+
+def test_repairs_truncated_output():
+    value, repaired = parse_json_lenient('{"intent": "MULTIPLE_EXPENSES", "data": {"transactions": [{"amount": 45000, "desc')
+    assert repaired
+    assert value == {'intent': 'MULTIPLE_EXPENSES', 'data': {'transactions': [{'amount': 45000}]}}
+
+
+def test_unrecoverable_returns_none():
+    assert parse_json_lenient('xin lỗi, tôi không hiểu') == (None, False)
+
+
+def test_extract_json_fields_from_broken_text():
+    text = '{"intent": "EXPENSE", "amount": 45000, "category": null, "description": "ph\\u1edf" ]]]'
+    assert extract_json_fields(text, ['intent', 'amount', 'category', 'description', 'missing']) == {
+        'intent': 'EXPENSE', 'amount': 45000, 'category': None, 'description': 'phở'
+    }
+
+
+def test_write_json_atomic(tmp_path):
+    path = tmp_path / 'usage.json'
+    write_json_atomic(str(path), {'key': 1})
+    write_json_atomic(str(path), {'key': 2})
+    assert json.loads(path.read_text(encoding='utf-8')) == {'key': 2}
+    assert [item.name for item in tmp_path.iterdir()] == ['usage.json']
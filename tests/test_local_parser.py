@@ -0,0 +1,114 @@
+import pytest
+
+from services.local_parser import (
+    _is_valid_date, build_expense_result, find_amounts, parse_amount, parse_expense_items, parse_query,
+)
+
+
+@pytest.mark.parametrize('text, amount', [
+    ('45k', 45000),
+    ('50 nghìn', 50000),
+    ('2.5tr', 2500000),
+    ('1tr2', 1200000),
+    ('1 triệu rưỡi', 1500000),
+    ('1 triệu 200 nghìn', 1200000),
+    ('2 củ', 2000000),
+    ('3 trăm', 300000),
+    ('50.000đ', 50000),
+    ('150000', 150000),
+])
+def test_parse_amount(text, amount):
+    assert parse_amount(text) == amount
+
+
+@pytest.mark.parametrize('text', ['abc', '5'])
+def test_parse_amount_rejects_unclear(text):
+    assert parse_amount(text) is None
+
+
+def test_find_amounts_positions():
+    assert find_amounts('phở 45k và cafe 20k') == [
+        {'amount': 45000, 'start': 4, 'end': 7},
+        {'amount': 20000, 'start': 16, 'end': 19},
+    ]
+
+
+def test_multiple_items_share_leading_date():
+    assert parse_expense_items('hôm qua phở 45k + trà sữa 30k') == [
+        {'amount': 45000, 'description': 'phở', 'custom_date': 'hôm qua'},
+        {'amount': 30000, 'description': 'trà sữa', 'custom_date': 'hôm qua'},
+    ]
+
+
+def test_items_split_by_comma():
+    assert parse_expense_items('phở 45k, cafe 20k') == [
+        {'amount': 45000, 'description': 'phở', 'custom_date': None},
+        {'amount': 20000, 'description': 'cafe', 'custom_date': None},
+    ]
+
+
+def test_trailing_date_strips_preposition():
+    assert parse_expense_items('đổ xăng 50k ở 5/9') == [
+        {'amount': 50000, 'description': 'đổ xăng', 'custom_date': '5/9'},
+    ]
+
+
+@pytest.mark.parametrize('message', [
+    'lương 10tr',          # thu nhập
+    'cho vay 500k',        # vay/cho vay
+    'mua gì đó 5',         # số không rõ đơn vị
+    'gửi xe 5k tháng 8',   # "tháng 8" là ngày, không phải mô tả
+    '31/2 phở 50k',        # ngày không tồn tại
+])
+def test_uncertain_messages_go_to_ai(message):
+    assert parse_expense_items(message) is None
+
+
+def test_build_expense_result_groups_same_category():
+    items = [
+        {'amount': 45000, 'description': 'phở', 'custom_date': None, 'category': 'Ăn uống'},
+        {'amount': 20000, 'description': 'cafe', 'custom_date': None, 'category': 'Ăn uống'},
+    ]
+    result = build_expense_result(items)
+    assert result['intent'] == 'EXPENSE'
+    assert result['data'] == {'amount': 65000, 'description': 'phở và cafe', 'category': 'Ăn uống', 'custom_date': None}
+
+    items[1]['category'] = 'Đi lại'
+    assert build_expense_result(items)['intent'] == 'MULTIPLE_EXPENSES'
+
+
+@pytest.mark.parametrize('message, intent, data', [
+    ('thống kê tháng 8', 'STATS', {'time_period': 'thang', 'specific_value': '8'}),
+    ('thống kê 2/9', 'STATS', {'time_period': 'ngay', 'specific_value': '2/9'}),
+    ('báo cáo từ 1/8 đến 15/8', 'STATS', {'time_period': 'custom', 'specific_value': '01/08-15/08'}),
+    ('ăn uống tuần này', 'CATEGORY_STATS', {'category_name': 'ăn uống', 'time_period': 'tuan'}),
+    ('danh mục', 'CATEGORY_LIST', {}),
+    ('xuất excel tháng trước', 'EXPORT', {'format': 'xlsx', 'time_period': 'thang', 'specific_value': 'thang_truoc'}),
+    ('hướng dẫn', 'HELP', {}),
+])
+def test_parse_query(message, intent, data):
+    result = parse_query(message)
+    assert result['intent'] == intent
+    assert result['data'] == data
+
+
+@pytest.mark.parametrize('message', [
+    'thống kê tháng 8 và tuần này',   # hai mốc thời gian
+    'thống kê 31/2',                  # ngày không tồn tại
+    'báo cáo từ 1/9 đến 31/9',
+    'phở 45k',                        # ghi chi tiêu, không phải câu hỏi
+])
+def test_parse_query_returns_none_when_unsure(message):
+    assert parse_query(message) is None
+
+
+def test_parse_query_range_across_new_year():
+    result = parse_query('thống kê từ 25/12 đến 5/1')
+    assert result['data'] == {'time_period': 'custom', 'specific_value': '25/12-05/01'}
+
+
+def test_date_validated_against_year_used():
+    assert _is_valid_date('29/2', 2024)
+    assert not _is_valid_date('29/2', 2025)
+    assert _is_valid_date('29/2/2024')
+    assert not _is_valid_date('31/4')
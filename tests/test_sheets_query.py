@@ -0,0 +1,109 @@
+import re
+from datetime import datetime
+
+import pytest
+
+from services.sheets_query import MAX_QUERY_MONTHS, QueryUnsupportedError, SheetsQuery, build_date_pattern
+
+
+def _matches(pattern, value):
+    return re.fullmatch(pattern, value) is not None
+
+
+def test_full_month_uses_wildcard_day():
+    pattern = build_date_pattern(datetime(2024, 8, 1), datetime(2024, 8, 31, 23, 59, 59))
+    assert pattern == "([0-9]{1,2}/0?8/2024)( .*)?"
+    assert _matches(pattern, "05/08/2024 12:30:00")
+    assert _matches(pattern, "5/8/2024")
+    assert not _matches(pattern, "05/09/2024 12:30:00")
+
+
+def test_partial_month_lists_days():
+    pattern = build_date_pattern(datetime(2024, 8, 9), datetime(2024, 8, 11))
+    assert _matches(pattern, "09/08/2024 08:00:00")
+    assert _matches(pattern, "9/08/2024")
+    assert _matches(pattern, "11/08/2024 23:59:59")
+    assert not _matches(pattern, "12/08/2024 00:00:00")
+    assert not _matches(pattern, "08/08/2024 00:00:00")
+
+
+def test_range_across_year_boundary():
+    pattern = build_date_pattern(datetime(2023, 12, 30), datetime(2024, 1, 31))
+    assert _matches(pattern, "31/12/2023 10:00:00")
+    assert _matches(pattern, "15/01/2024 10:00:00")
+    assert not _matches(pattern, "29/12/2023 10:00:00")
+    assert not _matches(pattern, "01/02/2024 10:00:00")
+
+
+def test_invalid_or_too_long_range_returns_none():
+    assert build_date_pattern(datetime(2024, 9, 1), datetime(2024, 8, 1)) is None
+    assert build_date_pattern(None, datetime(2024, 8, 1)) is None
+    start = datetime(2020, 1, 1)
+    end = datetime(2020 + MAX_QUERY_MONTHS // 12, 1, 1)
+    assert build_date_pattern(start, end) is None
+
+
+class _Response:
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            error = Exception(f"HTTP {self.status_code}")
+            error.response = self
+            raise error
+
+
+class _Session:
+    def __init__(self, response):
+        self.response = response
+        self.queries = []
+
+    def get(self, url, params=None, timeout=None):
+        self.queries.append(params['tq'])
+        return self.response
+
+
+def _gviz(rows):
+    cells = ','.join('{"c":[%s]}' % ','.join('null' if v is None else '{"v":%s}' % v for v in row) for row in rows)
+    return '/*O_o*/\ngoogle.visualization.Query.setResponse({"status":"ok","table":{"rows":[%s]}});' % cells
+
+
+def test_fetch_records_filters_type_and_maps_columns():
+    session = _Session(_Response(_gviz([['"05/08/2024 10:00:00"', '"Chi"', 45000, '"Ăn uống"', '"phở"']])))
+    query = SheetsQuery(session, 'sheet-id')
+
+    records = query.fetch_records('Minh', datetime(2024, 8, 1), datetime(2024, 8, 31), transaction_type="Chi'")
+
+    assert records == [{'Ngày': '05/08/2024 10:00:00', 'Loại': 'Chi', 'Số tiền': 45000,
+                        'Danh mục': 'Ăn uống', 'Ghi chú': 'phở'}]
+    assert "B = 'Chi'" in session.queries[0]
+    assert "A is null and B is not null" in session.queries[0]
+
+
+def test_fetch_records_type_mismatch_falls_back_to_full_read():
+    session = _Session(_Response(_gviz([[None, '"Chi"', 45000, '"Ăn uống"', '"phở"']])))
+    assert SheetsQuery(session, 'sheet-id').fetch_records('Minh', datetime(2024, 8, 1), datetime(2024, 8, 31)) is None
+
+
+def test_fetch_category_totals_detects_dropped_rows():
+    # 3 dòng nhưng chỉ 2 ô Số tiền là số - gviz bỏ sót 1 dòng
+    session = _Session(_Response(_gviz([['"Chi"', '"Ăn uống"', 90000, 2, 3, 3]])))
+    assert SheetsQuery(session, 'sheet-id').fetch_category_totals('Minh', datetime(2024, 8, 1),
+                                                                 datetime(2024, 8, 31)) is None
+
+    session = _Session(_Response(_gviz([['"Chi"', '"Ăn uống"', 90000, 3, 3, 3]])))
+    totals = SheetsQuery(session, 'sheet-id').fetch_category_totals('Minh', datetime(2024, 8, 1),
+                                                                   datetime(2024, 8, 31))
+    assert totals == [{'type': 'Chi', 'category': 'Ăn uống', 'amount': 90000.0, 'count': 3}]
+
+
+@pytest.mark.parametrize('response', [
+    _Response('', status_code=403),
+    _Response('<html>Đăng nhập</html>'),
+    _Response('{"status":"error","errors":[{"detailed_message":"Invalid query"}]}'),
+])
+def test_unsupported_worksheet_raises(response):
+    with pytest.raises(QueryUnsupportedError):
+        SheetsQuery(_Session(response), 'sheet-id').fetch_records('Minh', datetime(2024, 8, 1), datetime(2024, 8, 31))
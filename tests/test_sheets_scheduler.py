@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+
+from services import sheets_scheduler
+from services.sheets_scheduler import (PRIORITY_BACKGROUND, PRIORITY_USER_READ, PRIORITY_USER_WRITE,
+                                       SchedulerTimeout, SheetsRequestScheduler, TokenBucket, is_rate_limit_error)
+
+
+class _RateLimited(Exception):
+    def __init__(self):
+        super().__init__("APIError: [429]: Quota exceeded for quota metric 'Read requests'")
+
+
+def _wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "hết thời gian chờ"
+        time.sleep(0.005)
+
+
+def test_token_bucket_refill_and_drain():
+    bucket = TokenBucket(60)
+    now = bucket.updated_at
+    bucket.tokens = 0
+    assert bucket.try_acquire(now) == pytest.approx(1.0)
+    assert bucket.try_acquire(now + 1.0) == 0.0
+    bucket.drain(now + 1.0)
+    assert bucket.tokens <= 0
+
+
+def test_is_rate_limit_error():
+    assert is_rate_limit_error(_RateLimited())
+    error = Exception("boom")
+    error.response = type('Response', (), {'status_code': 429})()
+    assert is_rate_limit_error(error)
+    assert not is_rate_limit_error(ValueError("Worksheet not found"))
+
+
+def test_priority_then_fifo_order():
+    scheduler = SheetsRequestScheduler('test', read_per_minute=600)
+    bucket = scheduler.buckets['read']
+    # Hết token ~0.6s - đủ để xếp hàng cả 4 request trước khi lượt đầu được phục vụ
+    bucket.tokens = -5
+    bucket.updated_at = time.monotonic()
+
+    served = []
+    threads = []
+    for name, priority in [('background', PRIORITY_BACKGROUND), ('read-1', PRIORITY_USER_READ),
+                           ('read-2', PRIORITY_USER_READ), ('write', PRIORITY_USER_WRITE)]:
+        thread = threading.Thread(target=scheduler.call, args=(served.append, name),
+                                  kwargs={'priority': priority, 'deadline': 5})
+        thread.start()
+        threads.append(thread)
+        _wait_until(lambda: scheduler.get_stats()['queued']['read'] == len(threads))
+
+    for thread in threads:
+        thread.join(5)
+
+    assert served == ['write', 'read-1', 'read-2', 'background']
+    assert scheduler.get_stats()['waits']['user_read']['requests'] == 2
+
+
+def test_deadline_raises_and_leaves_queue():
+    scheduler = SheetsRequestScheduler('test', read_per_minute=60)
+    scheduler.buckets['read'].tokens = -100
+
+    with pytest.raises(SchedulerTimeout):
+        scheduler.call(lambda: None, deadline=0.05)
+
+    stats = scheduler.get_stats()
+    assert stats['timeouts'] == 1
+    assert stats['queued']['read'] == 0
+
+
+def test_retries_rate_limit_then_succeeds(monkeypatch):
+    monkeypatch.setattr(sheets_scheduler.random, 'uniform', lambda low, high: 0.0)
+    scheduler = SheetsRequestScheduler('test', read_per_minute=600)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise _RateLimited()
+        return 'ok'
+
+    assert scheduler.call(flaky, deadline=5) == 'ok'
+    assert len(attempts) == 3
+    assert scheduler.get_stats()['retries'] == 2
+
+
+def test_non_rate_limit_error_is_not_retried():
+    scheduler = SheetsRequestScheduler('test')
+    attempts = []
+
+    def broken():
+        attempts.append(1)
+        raise ValueError("Worksheet not found")
+
+    with pytest.raises(ValueError):
+        scheduler.call(broken)
+    assert len(attempts) == 1
+
+
+def test_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(sheets_scheduler.random, 'uniform', lambda low, high: 0.0)
+    monkeypatch.setenv('SHEETS_MAX_RETRIES', '2')
+    scheduler = SheetsRequestScheduler('test', read_per_minute=600)
+    attempts = []
+
+    def always_limited():
+        attempts.append(1)
+        raise _RateLimited()
+
+    with pytest.raises(_RateLimited):
+        scheduler.call(always_limited, deadline=5)
+    assert len(attempts) == 3
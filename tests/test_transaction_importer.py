@@ -0,0 +1,93 @@
+from datetime import datetime
+from typing import Dict, List
+
+from services.storage_backend import StorageBackend
+from services.transaction_importer import TransactionImporter, transaction_fingerprint
+
+
+class _MemoryBackend(StorageBackend):
+    """Backend trong RAM để kiểm tra import"""
+
+    def __init__(self, transactions: List[Dict] = None):
+        self.transactions = list(transactions or [])
+        self.add_calls = 0
+
+    def add_transaction(self, transaction_type, amount, category, note, user_name, custom_date=None):
+        raise NotImplementedError
+
+    def add_transactions(self, user_name, transactions):
+        self.add_calls += 1
+        self.transactions.extend(dict(transaction) for transaction in transactions)
+        return len(transactions)
+
+    def get_transactions(self, user_name, start_date=None, end_date=None, transaction_type=None):
+        return [transaction for transaction in self.transactions
+                if (not start_date or transaction['date'] >= start_date)
+                and (not end_date or transaction['date'] <= end_date)]
+
+    def get_sheet_url(self):
+        return 'memory://'
+
+
+CSV = """Ngày,Loại,Số tiền,Danh mục,Ghi chú
+05/08/2024 08:00:00,Chi,25000,Ăn uống,Cà phê
+05/08/2024 15:00:00,Chi,25000,Ăn uống,Cà phê
+06/08/2024,Chi,"45,000",,Phở bò
+07/08/2024,Thu,10000000,Lương,Lương tháng 8
+khong-phai-ngay,Chi,1000,,Lỗi
+"""
+
+
+def _write_csv(tmp_path):
+    path = tmp_path / 'import.csv'
+    path.write_text(CSV, encoding='utf-8')
+    return str(path)
+
+
+def test_fingerprint_ignores_time_case_and_spacing():
+    first = {'date': datetime(2024, 8, 5, 8), 'type': 'Chi', 'amount': 25000.0, 'note': 'Cà  phê'}
+    second = {'date': datetime(2024, 8, 5, 15), 'type': 'Chi', 'amount': 25000, 'note': 'cà phê'}
+    assert transaction_fingerprint(first) == transaction_fingerprint(second)
+    assert transaction_fingerprint(first) != transaction_fingerprint(dict(second, amount=26000))
+
+
+def test_import_skips_existing_once_per_row(tmp_path):
+    # Đã có 1 ly cà phê ngày 5/8: ly thứ hai trong file vẫn được import
+    backend = _MemoryBackend([{'date': datetime(2024, 8, 5, 9), 'type': 'Chi', 'amount': 25000,
+                               'category': 'Ăn uống', 'note': 'cà phê'}])
+    importer = TransactionImporter(backend, chunk_size=2)
+
+    result = importer.run(_write_csv(tmp_path), 'Minh')
+
+    assert result['duplicates'] == 1
+    assert result['imported'] == 3
+    assert result['invalid'] == 1
+    assert backend.add_calls == 2
+    assert [t['note'] for t in backend.transactions[1:]] == ['Cà phê', 'Phở bò', 'Lương tháng 8']
+
+
+def test_reimport_is_idempotent(tmp_path):
+    backend = _MemoryBackend()
+    importer = TransactionImporter(backend)
+    path = _write_csv(tmp_path)
+
+    assert importer.run(path, 'Minh')['imported'] == 4
+    result = importer.run(path, 'Minh')
+
+    assert result['imported'] == 0
+    assert result['duplicates'] == 4
+    assert len(backend.transactions) == 4
+
+
+def test_run_reuses_scanned_rows(tmp_path, monkeypatch):
+    backend = _MemoryBackend()
+    importer = TransactionImporter(backend)
+    path = _write_csv(tmp_path)
+    plan = importer.scan(path, 'Minh')
+
+    assert plan['rows'] == 4
+    assert plan['start_date'] == datetime(2024, 8, 5, 8)
+    assert plan['end_date'] == datetime(2024, 8, 7)
+
+    monkeypatch.setattr(importer, 'iter_rows', lambda *args, **kwargs: iter(()))
+    assert importer.run(path, 'Minh', plan=plan)['imported'] == 4
@@ -3,11 +3,16 @@ Utils package cho Zalo Bot
 """
 
 from .date_utils import DateUtils
-from .format_utils import format_currency, format_statistics, format_category_list
+from .format_utils import format_currency, format_statistics, format_category_list, format_pending_sync
+from .json_utils import parse_json_lenient, extract_json_fields, write_json_atomic
 
 __all__ = [
     'DateUtils',
     'format_currency',
     'format_statistics',
-    'format_category_list'
+    'format_category_list',
+    'format_pending_sync',
+    'parse_json_lenient',
+    'extract_json_fields',
+    'write_json_atomic'
 ]
\ No newline at end of file
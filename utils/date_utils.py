@@ -111,7 +111,7 @@ def parse_custom_date(custom_date_str: str = None) -> datetime:
     Parse custom date string thành datetime object
     
     Args:
-        custom_date_str: String ngày tùy chỉnh từ AI (VD: "5/9", "hôm qua", "thứ hai", null)
+        custom_date_str: String ngày tùy chỉnh từ AI/parser cục bộ (VD: "5/9", "5/9/2024", "hôm qua", "thứ hai", null)
         
     Returns:
         datetime: Ngày được parse hoặc ngày hiện tại nếu None
@@ -125,9 +125,16 @@ def parse_custom_date(custom_date_str: str = None) -> datetime:
     custom_date_str = custom_date_str.lower().strip()
     
     try:
-        # Xử lý ngày dạng DD/MM
+        # Xử lý ngày dạng DD/MM/YYYY (hoặc DD/MM/YY)
         if '/' in custom_date_str:
             parts = custom_date_str.split('/')
+            if len(parts) == 3:
+                year = int(parts[2])
+                if year < 100:
+                    year += 2000
+                return datetime(year, int(parts[1]), int(parts[0]))
+
+            # Xử lý ngày dạng DD/MM
             if len(parts) == 2:
                 day = int(parts[0])
                 month = int(parts[1])
@@ -20,6 +20,25 @@ def format_currency(amount: float) -> str:
         logger.error(f"Lỗi format currency: {e}")
         return f"{amount} VNĐ"
 
+def format_pending_sync(pending_count: int, failed_count: int = 0) -> str:
+    """
+    Format ghi chú giao dịch đang chờ đồng bộ lên Google Sheets
+    
+    Args:
+        pending_count: Số giao dịch trong outbox
+        failed_count: Số giao dịch đã thử quá nhiều lần không ghi được
+        
+    Returns:
+        str: Ghi chú (chuỗi rỗng nếu không có giao dịch chờ/lỗi)
+    """
+    notes = []
+    if pending_count:
+        notes.append(f"⏳ Đã ghi nhận, sẽ đồng bộ sau ({pending_count} giao dịch đang chờ lên Google Sheet)")
+    if failed_count:
+        notes.append(f"⚠️ {failed_count} giao dịch không ghi được lên Google Sheet (bot không truy cập được sheet). "
+                     f"Hãy kiểm tra quyền chia sẻ rồi gửi lại link sheet để bot đồng bộ lại.")
+    return "\n".join(notes)
+
 def format_statistics(stats: Dict[str, Any], stats_type: str, value: str) -> str:
     """
     Format thống kê thành tin nhắn gửi cho user
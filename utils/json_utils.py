@@ -0,0 +1,175 @@
+import ast
+import json
+import logging
+import os
+import re
+import tempfile
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_FENCE_PATTERN = re.compile(r"^```[a-zA-Z]*\s*|\s*```$")
+_TRAILING_COMMA_PATTERN = re.compile(r",(\s*[}\]])")
+_PYTHON_LITERALS = {'None': 'null', 'True': 'true', 'False': 'false'}
+_SMART_QUOTES = str.maketrans({'“': '"', '”': '"', '„': '"', '‘': "'", '’': "'"})
+
+
+def strip_code_fence(text: str) -> str:
+    """Bỏ ```json ... ``` bao quanh câu trả lời của AI"""
+    return _FENCE_PATTERN.sub('', (text or '').strip()).strip()
+
+
+def _extract_json_block(text: str) -> str:
+    """Phần từ dấu { hoặc [ đầu tiên (bỏ lời dẫn kiểu "Kết quả: {...}")"""
+    starts = [index for index in (text.find('{'), text.find('[')) if index >= 0]
+    return text[min(starts):] if starts else text
+
+
+def _repair_tokens(text: str) -> str:
+    """
+    Sửa lỗi JSON thường gặp khi quét từng ký tự (ngoài chuỗi)
+
+    - Chuỗi dùng nháy đơn → nháy kép
+    - None/True/False của Python → null/true/false, key không có nháy → có nháy
+    - Bị cắt giữa chừng: đóng chuỗi, bỏ dấu phẩy/hai chấm thừa, đóng ngoặc còn mở
+    - Bỏ phần thừa sau khi ngoặc ngoài cùng đã đóng
+    """
+    output = []
+    stack = []
+    quote = None
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if quote:
+            if char == '\\' and index + 1 < len(text):
+                output.append(text[index:index + 2])
+                index += 2
+                continue
+            if char == quote:
+                output.append('"')
+                quote = None
+            elif char == '"':
+                # Nháy kép trong chuỗi nháy đơn
+                output.append('\\"')
+            elif char == '\n':
+                output.append('\\n')
+            else:
+                output.append(char)
+            index += 1
+            continue
+
+        if char in '"\'':
+            quote = char
+            output.append('"')
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+            output.append(char)
+        elif char in '}]':
+            if stack and stack[-1] == char:
+                stack.pop()
+            output.append(char)
+            if not stack:
+                break
+        else:
+            word = re.match(r"[A-Za-z_]+", text[index:])
+            if word:
+                name = word.group(0)
+                if name not in _PYTHON_LITERALS and re.match(r"\s*:", text[index + len(name):]):
+                    # Key không có nháy: {intent: "EXPENSE"}
+                    output.append(f'"{name}"')
+                else:
+                    output.append(_PYTHON_LITERALS.get(name, name))
+                index += len(name)
+                continue
+            output.append(char)
+        index += 1
+
+    if quote:
+        output.append('"')
+    repaired = ''.join(output).rstrip()
+    if stack:
+        # Cắt giữa chừng: bỏ dấu phẩy / key chưa có giá trị trước khi đóng ngoặc
+        repaired = re.sub(r'(,\s*"[^"]*"\s*:?|[,:])\s*$', '', repaired)
+        repaired += ''.join(reversed(stack))
+    return _TRAILING_COMMA_PATTERN.sub(r"\1", repaired)
+
+
+def parse_json_lenient(text: str) -> Tuple[Optional[Any], bool]:
+    """
+    Parse JSON do AI trả về, tự sửa JSON gần đúng
+
+    Returns:
+        Tuple: (giá trị hoặc None nếu không cứu được, True nếu phải sửa mới parse được)
+    """
+    cleaned = strip_code_fence(text)
+    try:
+        return json.loads(cleaned), False
+    except (json.JSONDecodeError, TypeError):
+        pass
+
+    candidate = _extract_json_block(cleaned.translate(_SMART_QUOTES))
+    repaired = _repair_tokens(candidate)
+    try:
+        return json.loads(repaired), True
+    except json.JSONDecodeError:
+        pass
+
+    # Cú pháp dict Python (AI đôi khi trả về repr)
+    try:
+        value = ast.literal_eval(candidate)
+        if isinstance(value, (dict, list)):
+            return value, True
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        pass
+
+    logger.debug(f"Không sửa được JSON: {text[:200]}")
+    return None, False
+
+
+def extract_json_fields(text: str, keys: Iterable[str]) -> Dict[str, Any]:
+    """
+    Nhặt các trường dạng "key": giá trị đơn (chuỗi/số/null) từ JSON hỏng nặng
+
+    Dùng khi parse_json_lenient cũng không cứu được - vẫn giữ được intent, số tiền...
+    """
+    fields = {}
+    for key in keys:
+        match = re.search(
+            rf'["\']{re.escape(key)}["\']\s*:\s*("(?:[^"\\]|\\.)*"|\'[^\']*\'|-?\d+(?:\.\d+)?|null|None)',
+            text or ''
+        )
+        if not match:
+            continue
+        raw = match.group(1)
+        if raw in ('null', 'None'):
+            fields[key] = None
+        elif raw[0] in '"\'':
+            try:
+                fields[key] = json.loads('"' + raw[1:-1] + '"') if raw[0] == '"' else raw[1:-1]
+            except json.JSONDecodeError:
+                fields[key] = raw[1:-1]
+        else:
+            fields[key] = float(raw) if '.' in raw else int(raw)
+    return fields
+
+
+def write_json_atomic(path: str, data: Any, **dump_kwargs):
+    """
+    Ghi file JSON an toàn: ghi ra file tạm cùng thư mục rồi os.replace
+
+    Process chết giữa chừng thì file cũ vẫn nguyên vẹn (không bao giờ còn nửa file).
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, **dump_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise